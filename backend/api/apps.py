@@ -3,3 +3,13 @@ from django.apps import AppConfig
 
 class ApiConfig(AppConfig):
     name = 'api'
+
+    def ready(self):
+        from django.db.models.signals import post_delete, post_save
+
+        from .models import Document
+        from .stats import invalidate_document_stats
+
+        # Keep the cached dashboard stats in step with status transitions.
+        post_save.connect(invalidate_document_stats, sender=Document, dispatch_uid='api_stats_post_save')
+        post_delete.connect(invalidate_document_stats, sender=Document, dispatch_uid='api_stats_post_delete')
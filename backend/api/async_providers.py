@@ -0,0 +1,133 @@
+"""
+Asyncio clients for the provider calls made while answering chat and search.
+
+The async views (async_views) await these instead of blocking a worker
+thread on the network, so one ASGI worker (uvicorn) can keep hundreds of
+chats waiting on an LLM at the same time. Mistral and Gemini use their
+SDKs' async methods; Ollama goes through a pooled httpx.AsyncClient. Every
+call is paced and circuit-broken with the same limiters as the
+synchronous calls (provider_limits.acall).
+
+Async clients are bound to the event loop they are used on, so each loop
+gets its own (loop_clients) and they are closed when the loop shuts down:
+for the worker's lifetime under ASGI, at the end of each request under
+WSGI, where Django runs every async view in a fresh loop.
+"""
+import asyncio
+import logging
+import weakref
+
+import httpx
+from mistralai import Mistral
+
+from . import provider_limits
+
+logger = logging.getLogger(__name__)
+
+OLLAMA_TIMEOUT_SECONDS = 60
+
+
+class LoopClients:
+    """Provider clients of one event loop."""
+
+    def __init__(self):
+        self.http = httpx.AsyncClient(
+            timeout=OLLAMA_TIMEOUT_SECONDS,
+            limits=httpx.Limits(max_connections=200, max_keepalive_connections=50),
+        )
+        self._mistral: dict[str, Mistral] = {}
+        self._gemini: dict = {}
+        self._closer = self._close_at_shutdown()
+
+    async def _start(self):
+        # The first step registers the generator with the loop, and
+        # loop.shutdown_asyncgens() (called by asyncio.run) closes it.
+        await self._closer.__anext__()
+
+    async def _close_at_shutdown(self):
+        try:
+            yield
+        finally:
+            await self.aclose()
+
+    def mistral(self, api_key: str) -> Mistral:
+        client = self._mistral.get(api_key)
+        if client is None:
+            client = self._mistral[api_key] = Mistral(api_key=api_key, async_client=self.http)
+        return client
+
+    def gemini(self, api_key: str):
+        client = self._gemini.get(api_key)
+        if client is None:
+            import google.genai as genai
+            client = self._gemini[api_key] = genai.Client(api_key=api_key)
+        return client
+
+    async def aclose(self):
+        for client in self._gemini.values():
+            try:
+                await client.aio.aclose()
+            except Exception as e:
+                logger.debug(f"Closing Gemini async client failed: {e}")
+        self._gemini.clear()
+        self._mistral.clear()
+        await self.http.aclose()
+
+
+_loop_clients: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, LoopClients]' = weakref.WeakKeyDictionary()
+
+
+async def loop_clients() -> LoopClients:
+    """Provider clients of the running event loop."""
+    loop = asyncio.get_running_loop()
+    clients = _loop_clients.get(loop)
+    if clients is None or clients.http.is_closed:
+        clients = _loop_clients[loop] = LoopClients()
+        await clients._start()
+    return clients
+
+
+async def ollama_chat(base_url: str, model: str, messages: list[dict]) -> str:
+    http = (await loop_clients()).http
+
+    async def post():
+        response = await http.post(
+            f"{base_url}/api/chat",
+            json={
+                "model": model,
+                "messages": messages,
+                "stream": False,
+                "options": {"temperature": 0},
+            },
+        )
+        response.raise_for_status()
+        return response.json()
+
+    data = await provider_limits.acall('ollama', 'chat', post)
+    return data.get('message', {}).get('content', '')
+
+
+async def mistral_chat(api_key: str, model: str, messages: list[dict]) -> str:
+    client = (await loop_clients()).mistral(api_key)
+    response = await provider_limits.acall('mistral', 'chat', lambda: client.chat.complete_async(
+        model=model,
+        messages=messages,
+        temperature=0,
+    ))
+    return response.choices[0].message.content
+
+
+async def mistral_embed(api_key: str, model: str, texts: list[str]) -> list[list[float]]:
+    client = (await loop_clients()).mistral(api_key)
+    response = await provider_limits.acall('mistral', 'embeddings', lambda: client.embeddings.create_async(
+        model=model,
+        inputs=texts,
+    ))
+    return [item.embedding for item in response.data]
+
+
+async def gemini_chat(api_key: str, model: str, history: list, message: str) -> str:
+    client = (await loop_clients()).gemini(api_key)
+    chat = client.aio.chats.create(model=model, history=history)
+    response = await provider_limits.acall('gemini', 'generate', lambda: chat.send_message(message))
+    return response.text
@@ -0,0 +1,213 @@
+"""
+Async views for the RAG endpoints that wait on LLM / embedding providers.
+
+chat, chat_batch, rag_status and search are async DRF views (adrf's
+api_view) mounted under the document routes (see urls.py). They go through
+the REST_FRAMEWORK parsers, authentication, permission classes and
+exception handler like DocumentViewSet. Under ASGI (uvicorn
+config.asgi:application) a request waiting on a provider holds a coroutine
+instead of a worker thread, so one worker can serve hundreds of pending
+chats; under WSGI they still work, each request in its own event loop.
+"""
+import logging
+import threading
+
+from adrf.decorators import api_view
+from asgiref.sync import sync_to_async
+from django.shortcuts import aget_object_or_404
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.response import Response
+
+from . import chat_history as chat_store
+from .models import Document
+from .serializers import ChatBatchRequestSerializer, ChatRequestSerializer
+from .services import RAGService
+
+logger = logging.getLogger(__name__)
+
+SEARCH_DEFAULT_TOP_K = 10
+SEARCH_MAX_TOP_K = 50
+
+
+def _not_ingested() -> Response:
+    return Response(
+        {
+            'error': 'Document not ingested yet for RAG. Please call /documents/{id}/ingest_for_rag/ first.',
+            'chunks_count': 0
+        },
+        status=status.HTTP_400_BAD_REQUEST
+    )
+
+
+# One RAGService per process: construction loads the FlashRank model.
+# Its async provider clients are per event loop (async_providers).
+_shared_service: RAGService | None = None
+_shared_service_lock = threading.Lock()
+
+
+def _shared_rag_service() -> RAGService:
+    global _shared_service
+    with _shared_service_lock:
+        if _shared_service is None:
+            _shared_service = RAGService()
+        return _shared_service
+
+
+async def _rag_service() -> RAGService:
+    if _shared_service is not None:
+        return _shared_service
+    # First request: build it in a worker thread, off the event loop
+    return await sync_to_async(_shared_rag_service, thread_sensitive=False)()
+
+
+@api_view(['GET'])
+async def rag_status(request, pk: int):
+    """
+    Check if document is already ingested for RAG
+    GET /api/documents/{id}/rag_status/
+    """
+    document = await aget_object_or_404(Document, pk=pk)
+    chunks_count = await document.chunks.acount()
+
+    return Response({
+        'is_ingested': chunks_count > 0,
+        'chunks_count': chunks_count,
+        'document_id': document.id,
+        'rag_status': document.rag_status,
+        'rag_progress': document.rag_progress,
+        'rag_error_message': document.rag_error_message,
+        'rag_started_at': document.rag_started_at,
+        'rag_completed_at': document.rag_completed_at,
+    })
+
+
+@api_view(['GET'])
+async def search(request, pk: int):
+    """
+    Hybrid search (vector + keyword, reranked) over the document's chunks
+    GET /api/documents/{id}/search/?q=...&top_k=10
+    """
+    query = (request.query_params.get('q') or '').strip()
+    if not query:
+        return Response({'error': "Query parameter 'q' is required"}, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        top_k = max(1, min(int(request.query_params.get('top_k', SEARCH_DEFAULT_TOP_K)), SEARCH_MAX_TOP_K))
+    except ValueError:
+        return Response({'error': 'top_k must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+
+    document = await aget_object_or_404(Document, pk=pk)
+    if not await document.chunks.aexists():
+        return _not_ingested()
+
+    try:
+        rag_service = await _rag_service()
+        chunks = await rag_service.asearch(document.id, query, top_k)
+    except Exception as e:
+        logger.error(f"RAG search error for document {document.id}: {str(e)}")
+        return Response({'error': f'Failed to search document: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    return Response({
+        'query': query,
+        'document_id': document.id,
+        'results': [
+            {
+                'chunk_id': chunk.id,
+                'page': chunk.page_number,
+                'pages': chunk.page_numbers or [chunk.page_number],
+                'content': chunk.content,
+            }
+            for chunk in chunks
+        ],
+    })
+
+
+@api_view(['POST'])
+async def chat(request, pk: int):
+    """
+    Chat with document using RAG
+    POST /api/documents/{id}/chat/
+    Body: {"query": "What is the management fee?", "history": [...]}
+    """
+    document = await aget_object_or_404(Document, pk=pk)
+
+    # Check if document has been ingested
+    if not await document.chunks.aexists():
+        return _not_ingested()
+
+    # Validate request data
+    serializer = ChatRequestSerializer(data=request.data)
+    serializer.is_valid(raise_exception=True)
+
+    user_query = serializer.validated_data['query']
+    history = serializer.validated_data.get('history', [])
+
+    try:
+        logger.info(f"RAG chat query for document {document.id}: {user_query[:50]}...")
+        rag_service = await _rag_service()
+        answer_payload = await rag_service.achat(document.id, user_query, history, return_source=True)
+
+        answer_text = answer_payload.get('text') if isinstance(answer_payload, dict) else str(answer_payload)
+        citations = answer_payload.get('citations', []) if isinstance(answer_payload, dict) else []
+
+        chunks_count = await document.chunks.acount()
+        response_data = {
+            'answer': answer_text,
+            'query': user_query,
+            'chunks_count': chunks_count,
+            'citations': citations,
+        }
+
+        # Persist the turn (question + answer) with a single INSERT.
+        try:
+            asked_at = timezone.now()
+            await sync_to_async(chat_store.append_messages)(document.id, [
+                {'sender': 'user', 'text': user_query, 'timestamp': asked_at.isoformat()},
+                {'sender': 'ai', 'text': answer_text or '', 'chunks_count': chunks_count, 'citations': citations},
+            ])
+        except Exception as e:
+            logger.warning(f"Failed to persist chat turn for document {document.id}: {e}")
+
+        return Response(response_data)
+    except Exception as e:
+        logger.error(f"RAG chat error for document {document.id}: {str(e)}")
+        return Response({'error': f'Failed to process chat: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@api_view(['POST'])
+async def chat_batch(request, pk: int):
+    """
+    Answer several independent questions with shared retrieval work
+    POST /api/documents/{id}/chat_batch/
+    Body: {"questions": ["What is the management fee?", ...]}
+    Answers are not added to the document's chat history.
+    """
+    document = await aget_object_or_404(Document, pk=pk)
+    if not await document.chunks.aexists():
+        return _not_ingested()
+
+    serializer = ChatBatchRequestSerializer(data=request.data)
+    serializer.is_valid(raise_exception=True)
+
+    questions = serializer.validated_data['questions']
+    try:
+        logger.info(f"RAG batch of {len(questions)} questions for document {document.id}")
+        rag_service = await _rag_service()
+        payloads = await rag_service.achat_batch(document.id, questions)
+    except Exception as e:
+        logger.error(f"RAG batch chat error for document {document.id}: {str(e)}")
+        return Response({'error': f'Failed to process questions: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    results = []
+    for question, payload in zip(questions, payloads):
+        result = {
+            'query': question,
+            'answer': payload.get('text'),
+            'contexts': payload.get('contexts', []),
+            'citations': payload.get('citations', []),
+        }
+        if 'error' in payload:
+            result['error'] = payload['error']
+        results.append(result)
+
+    return Response({'document_id': document.id, 'results': results})
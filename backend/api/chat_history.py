@@ -0,0 +1,139 @@
+"""
+Append-only chat history backed by ChatMessage rows.
+
+A chat turn is one INSERT of the new messages; reads fetch one page of the
+newest messages through the (document, -id) index. Retention runs off the
+request path: after an append, a background thread trims the document to
+CHAT_HISTORY_MAX_MESSAGES, at most once per CHAT_PRUNE_INTERVAL seconds per
+document. `manage.py prune_chat_messages` does the same for every document.
+"""
+import logging
+import os
+import threading
+import time
+
+from django.db import close_old_connections
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import ChatMessage
+
+logger = logging.getLogger(__name__)
+
+CHAT_HISTORY_MAX_MESSAGES = int(os.getenv('CHAT_HISTORY_MAX_MESSAGES', '200'))
+CHAT_PRUNE_INTERVAL = float(os.getenv('CHAT_PRUNE_INTERVAL', '300'))
+CHAT_HISTORY_PAGE_SIZE = 50
+CHAT_HISTORY_MAX_PAGE_SIZE = 200
+
+# Keys of an incoming message that are stored in ChatMessage.metadata
+METADATA_KEYS = ('chunks_count', 'citations')
+
+_prune_lock = threading.Lock()
+_last_prune: dict[int, float] = {}
+
+
+def _parse_timestamp(value):
+    if not value:
+        return timezone.now()
+    parsed = parse_datetime(str(value))
+    if parsed is None:
+        return timezone.now()
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+def build_message(document_id: int, message: dict) -> ChatMessage:
+    """Unsaved ChatMessage from a frontend message dict ({sender, text, timestamp, ...})."""
+    sender = message.get('sender') or 'user'
+    if sender not in dict(ChatMessage.SENDER_CHOICES):
+        sender = 'system'
+    return ChatMessage(
+        document_id=document_id,
+        sender=sender,
+        text=str(message.get('text') or ''),
+        metadata={k: message[k] for k in METADATA_KEYS if message.get(k) is not None},
+        created_at=_parse_timestamp(message.get('timestamp')),
+    )
+
+
+def serialize_message(message: ChatMessage) -> dict:
+    """Frontend shape of a stored message (same keys the old JSON blob used)."""
+    return {
+        'id': message.id,
+        'sender': message.sender,
+        'text': message.text,
+        'timestamp': message.created_at.isoformat(),
+        **(message.metadata or {}),
+    }
+
+
+def append_messages(document_id: int, messages: list[dict]) -> list[ChatMessage]:
+    """Insert messages in one statement and schedule retention."""
+    rows = [build_message(document_id, m) for m in messages]
+    if not rows:
+        return []
+    created = ChatMessage.objects.bulk_create(rows)
+    schedule_prune(document_id)
+    return created
+
+
+def replace_history(document_id: int, messages: list[dict]) -> list[ChatMessage]:
+    """Overwrite the whole history (legacy PUT semantics)."""
+    messages = messages[-CHAT_HISTORY_MAX_MESSAGES:]
+    ChatMessage.objects.filter(document_id=document_id).delete()
+    return ChatMessage.objects.bulk_create([build_message(document_id, m) for m in messages])
+
+
+def page(document_id: int, before: int | None = None, limit: int = CHAT_HISTORY_PAGE_SIZE):
+    """
+    Newest `limit` messages older than message id `before`.
+
+    Returns (messages oldest -> newest, next_before); next_before is the id
+    to pass for the previous page, or None when there is nothing older.
+    """
+    queryset = ChatMessage.objects.filter(document_id=document_id)
+    if before is not None:
+        queryset = queryset.filter(id__lt=before)
+    rows = list(queryset.order_by('-id')[:limit + 1])
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    rows.reverse()
+    next_before = rows[0].id if has_more and rows else None
+    return rows, next_before
+
+
+def prune(document_id: int, keep: int = CHAT_HISTORY_MAX_MESSAGES) -> int:
+    """Delete all but the newest `keep` messages of a document."""
+    boundary = (
+        ChatMessage.objects
+        .filter(document_id=document_id)
+        .order_by('-id')
+        .values_list('id', flat=True)[keep:keep + 1]
+    )
+    boundary = list(boundary)
+    if not boundary:
+        return 0
+    deleted, _ = ChatMessage.objects.filter(document_id=document_id, id__lte=boundary[0]).delete()
+    return deleted
+
+
+def schedule_prune(document_id: int):
+    """Run prune() in a background thread, throttled per document."""
+    now = time.monotonic()
+    with _prune_lock:
+        if now - _last_prune.get(document_id, float('-inf')) < CHAT_PRUNE_INTERVAL:
+            return
+        _last_prune[document_id] = now
+
+    def _run():
+        try:
+            deleted = prune(document_id)
+            if deleted:
+                logger.info(f"Pruned {deleted} chat messages of document {document_id}")
+        except Exception as e:
+            logger.warning(f"Chat history prune failed for document {document_id}: {e}")
+        finally:
+            close_old_connections()
+
+    threading.Thread(target=_run, daemon=True).start()
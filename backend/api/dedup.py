@@ -0,0 +1,145 @@
+"""
+Near-duplicate suppression for RAG chunks (MinHash + LSH).
+
+Prospectuses repeat disclaimers, definitions and table headers on many
+pages. Before embedding, chunks whose word-shingle Jaccard similarity is at
+least CHUNK_DEDUP_THRESHOLD are collapsed into the first occurrence, which
+keeps the page numbers of every copy. Chunks must also carry exactly the
+same numbers: two fee tables that differ only in their rates share most
+shingles but are not duplicates.
+
+Candidates come from LSH banding over MinHash signatures (so the pass is
+roughly linear in the number of chunks) and are confirmed with the exact
+Jaccard similarity of their shingle sets.
+"""
+import hashlib
+import logging
+import os
+import re
+from collections import defaultdict
+
+import numpy as np
+from unidecode import unidecode
+
+logger = logging.getLogger(__name__)
+
+CHUNK_DEDUP_THRESHOLD = float(os.getenv('CHUNK_DEDUP_THRESHOLD', '0.85'))
+
+SHINGLE_WORDS = 3
+NUM_PERM = 64
+# 16 bands x 4 rows: pairs above ~0.5 similarity become candidates
+LSH_BANDS = 16
+LSH_ROWS = NUM_PERM // LSH_BANDS
+
+_MASK64 = np.uint64(0xFFFFFFFFFFFFFFFF)
+_rng = np.random.default_rng(20240601)
+_PERM_A = _rng.integers(1, 2 ** 63, size=NUM_PERM, dtype=np.uint64) | np.uint64(1)
+_PERM_B = _rng.integers(0, 2 ** 63, size=NUM_PERM, dtype=np.uint64)
+
+
+def shingles(text: str) -> set[str]:
+    """Word 3-grams of the normalised (ASCII, lower-case) text."""
+    words = re.findall(r'\w+', unidecode(text or '').lower())
+    if len(words) < SHINGLE_WORDS:
+        return {' '.join(words)} if words else set()
+    return {' '.join(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1)}
+
+
+def numeric_tokens(text: str) -> tuple[str, ...]:
+    """Numbers of the text in order ('1,5%' and '1.5' both give '1.5')."""
+    return tuple(m.replace(',', '.') for m in re.findall(r'\d+(?:[.,]\d+)*', text or ''))
+
+
+def _hash64(shingle: str) -> int:
+    return int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def minhash(shingle_set: set[str]) -> np.ndarray:
+    """NUM_PERM-value MinHash signature (multiply-add hashing modulo 2**64)."""
+    if not shingle_set:
+        return np.full(NUM_PERM, _MASK64, dtype=np.uint64)
+    values = np.fromiter((_hash64(s) for s in shingle_set), dtype=np.uint64, count=len(shingle_set))
+    with np.errstate(over='ignore'):
+        permuted = values[:, None] * _PERM_A[None, :] + _PERM_B[None, :]
+    return permuted.min(axis=0)
+
+
+def jaccard(a: set, b: set) -> float:
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+def near_duplicate_groups(texts: list[str], threshold: float = CHUNK_DEDUP_THRESHOLD) -> list[list[int]]:
+    """
+    Partition indices of `texts` into groups of near-duplicates.
+    Each group is sorted; its first index is the canonical text.
+    """
+    shingle_sets = [shingles(t) for t in texts]
+    numbers = [numeric_tokens(t) for t in texts]
+    signatures = [minhash(s) for s in shingle_sets]
+
+    parent = list(range(len(texts)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    buckets = defaultdict(list)
+    for index, signature in enumerate(signatures):
+        if not shingle_sets[index]:
+            continue
+        for band in range(LSH_BANDS):
+            rows = signature[band * LSH_ROWS:(band + 1) * LSH_ROWS]
+            buckets[(band, rows.tobytes())].append(index)
+
+    checked = set()
+    for members in buckets.values():
+        if len(members) < 2:
+            continue
+        # Compare each member with one representative per group seen so far
+        representatives = [members[0]]
+        for index in members[1:]:
+            for rep in representatives:
+                root_a, root_b = find(rep), find(index)
+                if root_a == root_b:
+                    break
+                pair = (rep, index)
+                if pair in checked:
+                    continue
+                checked.add(pair)
+                if numbers[rep] == numbers[index] and jaccard(shingle_sets[rep], shingle_sets[index]) >= threshold:
+                    parent[max(root_a, root_b)] = min(root_a, root_b)
+                    break
+            else:
+                representatives.append(index)
+
+    groups = defaultdict(list)
+    for index in range(len(texts)):
+        groups[find(index)].append(index)
+    return sorted(groups.values(), key=lambda g: g[0])
+
+
+def collapse_chunks(chunks: list, threshold: float = CHUNK_DEDUP_THRESHOLD) -> list:
+    """
+    Collapse near-duplicate langchain Documents (page_content + metadata
+    with 'page_number'). The canonical chunk gets metadata['page_numbers']:
+    the sorted pages of every member of its group.
+    """
+    if len(chunks) < 2:
+        for chunk in chunks:
+            chunk.metadata['page_numbers'] = [chunk.metadata.get('page_number', 1)]
+        return list(chunks)
+
+    groups = near_duplicate_groups([c.page_content for c in chunks], threshold)
+    kept = []
+    for group in groups:
+        canonical = chunks[group[0]]
+        canonical.metadata['page_numbers'] = sorted({chunks[i].metadata.get('page_number', 1) for i in group})
+        kept.append(canonical)
+
+    if len(kept) < len(chunks):
+        logger.info(f"Near-duplicate suppression: {len(chunks)} -> {len(kept)} chunks")
+    return kept
@@ -0,0 +1,90 @@
+"""
+Persistent cache of raw structured-extraction results.
+
+Entries are keyed by the SHA-256 of the uploaded PDF, ocr_model, the
+provider model name and a hash of the prompt/schema text, plus the
+settings that shape what is sent (page selection limits, sectioned mode).
+Re-processing a document, or uploading a byte-identical file, with the
+same prompt returns the stored JSON instead of calling the provider;
+editing a prompt or schema changes the hash and so misses naturally.
+
+Entries store the JSON as returned by the provider (optimized-PDF page
+numbers) together with the optimized page map and page categories it
+refers to. For the same file and settings page selection is
+deterministic, so a hit skips PDF optimization as well.
+"""
+import copy
+import hashlib
+import json
+import logging
+import os
+
+from django.db.models import F
+from django.utils import timezone
+
+from .models import ExtractionCacheEntry
+
+logger = logging.getLogger(__name__)
+
+EXTRACTION_CACHE = os.getenv('EXTRACTION_CACHE', 'true').strip().lower() not in {'0', 'false', 'no'}
+
+
+def prompt_hash(*parts: str) -> str:
+    """SHA-256 of the prompt/schema text the provider receives."""
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part.encode('utf-8'))
+        h.update(b'\x1e')
+    return h.hexdigest()
+
+
+def cache_key(file_sha256: str, ocr_model: str, model_name: str, prompt_digest: str, variant: dict | None = None) -> str:
+    payload = json.dumps(
+        [file_sha256, ocr_model, model_name, prompt_digest, variant or {}],
+        sort_keys=True, default=str,
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def lookup(key: str) -> ExtractionCacheEntry | None:
+    if not EXTRACTION_CACHE:
+        return None
+    return ExtractionCacheEntry.objects.filter(key=key).first()
+
+
+def use(entry: ExtractionCacheEntry) -> tuple[dict, list[int] | None, dict[int, set[str]]] | None:
+    """
+    (extraction, optimized page map, page categories) of a cache entry,
+    copied, or None for entries without a stored page selection. Counts the hit.
+    """
+    stored = entry.data or {}
+    if 'page_categories' not in stored:
+        logger.info(f"Extraction cache entry {entry.key[:12]} has no stored page selection; ignoring")
+        return None
+    ExtractionCacheEntry.objects.filter(pk=entry.pk).update(hits=F('hits') + 1, last_used_at=timezone.now())
+    page_categories = {int(page): set(categories) for page, categories in stored['page_categories'].items()}
+    return copy.deepcopy(stored.get('extracted')), stored.get('page_map'), page_categories
+
+
+def store(key: str, file_sha256: str, ocr_model: str, model_name: str, prompt_digest: str,
+          extracted: dict, page_map: list[int] | None, page_categories: dict[int, set[str]] | None = None) -> None:
+    """Save a successful extraction; parse failures ({'error', 'raw_text'}) are not cached."""
+    if not EXTRACTION_CACHE or not isinstance(extracted, dict) or not extracted or 'error' in extracted:
+        return
+    ExtractionCacheEntry.objects.update_or_create(
+        key=key,
+        defaults={
+            'file_sha256': file_sha256,
+            'ocr_model': ocr_model,
+            'model_name': model_name,
+            'prompt_hash': prompt_digest,
+            'data': {
+                'extracted': copy.deepcopy(extracted),
+                'page_map': page_map,
+                'page_categories': {
+                    str(page): sorted(categories) for page, categories in (page_categories or {}).items()
+                },
+            },
+            'last_used_at': timezone.now(),
+        },
+    )
@@ -0,0 +1,144 @@
+"""
+Mapping from extracted_data (JSON) to ExtractedFundData columns.
+
+Each column is described by how it is read from extracted_data, so edits can
+recompute just the columns whose source keys were touched instead of
+rebuilding the whole row.
+"""
+import logging
+
+from django.db import models as dj_models
+
+logger = logging.getLogger(__name__)
+
+
+def get_value(field_data):
+    """Value of a structured field ({value, page, bbox}) or the raw value."""
+    if isinstance(field_data, dict) and 'value' in field_data:
+        return field_data['value']
+    return field_data
+
+
+# column -> (kind, source key, group)
+#   'plain'  : get_value(data[key])
+#   'fee'    : str(get_value(data['fees'][key])) if set, else None
+#   'nested' : get_value(data[group][key]) if data[group] else get_value(data[key])
+#   'dict'   : data[key] if it is a dict, else {}
+#   'list'   : data.get(key, [])
+FUND_DATA_COLUMNS = {
+    'fund_name': ('plain', 'fund_name', None),
+    'fund_code': ('plain', 'fund_code', None),
+    'fund_type': ('plain', 'fund_type', None),
+    'legal_structure': ('plain', 'legal_structure', None),
+    'license_number': ('plain', 'license_number', None),
+    'regulator': ('plain', 'regulator', None),
+    'management_company': ('plain', 'management_company', None),
+    'custodian_bank': ('plain', 'custodian_bank', None),
+    'fund_supervisor': ('plain', 'fund_supervisor', None),
+
+    'management_fee': ('fee', 'management_fee', 'fees'),
+    'subscription_fee': ('fee', 'subscription_fee', 'fees'),
+    'redemption_fee': ('fee', 'redemption_fee', 'fees'),
+    'switching_fee': ('fee', 'switching_fee', 'fees'),
+    'total_expense_ratio': ('fee', 'total_expense_ratio', 'fees'),
+    'custody_fee': ('fee', 'custody_fee', 'fees'),
+    'audit_fee': ('fee', 'audit_fee', 'fees'),
+    'supervisory_fee': ('fee', 'supervisory_fee', 'fees'),
+    'other_expenses': ('fee', 'other_expenses', 'fees'),
+
+    'investment_objective': ('plain', 'investment_objective', None),
+    'investment_strategy': ('plain', 'investment_strategy', None),
+    'investment_style': ('plain', 'investment_style', None),
+    'sector_focus': ('plain', 'sector_focus', None),
+    'benchmark': ('plain', 'benchmark', None),
+
+    'valuation_method': ('nested', 'valuation_method', 'valuation'),
+    'pricing_source': ('nested', 'pricing_source', 'valuation'),
+
+    'investment_restrictions': ('plain', 'investment_restrictions', None),
+    'borrowing_limit': ('plain', 'borrowing_limit', None),
+    'leverage_limit': ('plain', 'leverage_limit', None),
+
+    'investor_rights': ('plain', 'investor_rights', None),
+    'distribution_agent': ('plain', 'distribution_agent', None),
+    'sales_channels': ('plain', 'sales_channels', None),
+
+    'concentration_risk': ('nested', 'concentration_risk', 'risk_factors'),
+    'liquidity_risk': ('nested', 'liquidity_risk', 'risk_factors'),
+    'interest_rate_risk': ('nested', 'interest_rate_risk', 'risk_factors'),
+
+    'trading_frequency': ('nested', 'trading_frequency', 'operational_details'),
+    'cut_off_time': ('nested', 'cut_off_time', 'operational_details'),
+    'nav_calculation_frequency': ('nested', 'nav_calculation_frequency', 'operational_details'),
+    'nav_publication': ('nested', 'nav_publication', 'operational_details'),
+    'settlement_cycle': ('nested', 'settlement_cycle', 'operational_details'),
+
+    'auditor': ('nested', 'auditor', 'governance'),
+
+    'asset_allocation': ('dict', 'asset_allocation', None),
+    'minimum_investment': ('dict', 'minimum_investment', None),
+    'portfolio': ('list', 'portfolio', None),
+    'nav_history': ('list', 'nav_history', None),
+    'dividend_history': ('list', 'dividend_history', None),
+}
+
+
+def _column_value(data: dict, kind: str, key: str, group):
+    if kind == 'plain':
+        return get_value(data.get(key))
+    if kind == 'fee':
+        fee = (data.get('fees') or {}).get(key)
+        return str(get_value(fee)) if fee else None
+    if kind == 'nested':
+        if data.get(group):
+            return get_value(data.get(group, {}).get(key))
+        return get_value(data.get(key))
+    if kind == 'dict':
+        value = data.get(key)
+        return value if isinstance(value, dict) else {}
+    if kind == 'list':
+        return data.get(key, [])
+    raise ValueError(f"Unknown column kind {kind!r}")
+
+
+def columns_for_keys(top_level_keys) -> list[str]:
+    """ExtractedFundData columns that read from any of these top-level keys."""
+    keys = set(top_level_keys)
+    return [
+        column for column, (_, key, group) in FUND_DATA_COLUMNS.items()
+        if key in keys or (group is not None and group in keys)
+    ]
+
+
+def truncate_for_model(model_cls, values: dict) -> dict:
+    """Ensure values fit DB column limits (e.g., CharField max_length)."""
+    sanitized = dict(values)
+    for field_name, field_value in sanitized.items():
+        if not isinstance(field_value, str):
+            continue
+        try:
+            model_field = model_cls._meta.get_field(field_name)
+        except Exception:
+            continue
+        if not isinstance(model_field, dj_models.CharField):
+            continue
+        max_len = getattr(model_field, 'max_length', None)
+        if max_len and len(field_value) > max_len:
+            logger.warning(
+                f"Truncating {model_cls.__name__}.{field_name}: {len(field_value)} -> {max_len} chars"
+            )
+            sanitized[field_name] = field_value[:max_len]
+    return sanitized
+
+
+def fund_data_values(extracted_data: dict, columns=None) -> dict:
+    """
+    ExtractedFundData column values computed from extracted_data.
+    Pass `columns` to compute only a subset.
+    """
+    from .models import ExtractedFundData
+
+    data = extracted_data or {}
+    selected = FUND_DATA_COLUMNS if columns is None else {c: FUND_DATA_COLUMNS[c] for c in columns}
+    values = {column: _column_value(data, *spec) for column, spec in selected.items()}
+    return truncate_for_model(ExtractedFundData, values)
@@ -0,0 +1,109 @@
+"""
+Gemini File API uploads, cached by content hash.
+
+Extraction uploads the optimized PDF and, when generation fails, retries
+with the original. The original upload is started in the background while
+create_optimized_pdf runs (prefetch), so the fallback finds it already
+processed. Uploads are keyed by the file's SHA-256 and reused until shortly
+before Gemini expires them (files live 48 hours), so re-processing the same
+PDF does not upload it again.
+
+Waiting for a file to leave PROCESSING uses exponential backoff instead of
+a fixed 2-second poll.
+"""
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future
+
+from . import provider_limits
+from .ocr_broker import file_sha256
+
+logger = logging.getLogger(__name__)
+
+# Gemini deletes uploaded files after 48h; stop reusing them a bit earlier
+GEMINI_UPLOAD_TTL_SECONDS = int(os.getenv('GEMINI_UPLOAD_TTL_SECONDS', str(47 * 3600)))
+GEMINI_UPLOAD_TIMEOUT_SECONDS = int(os.getenv('GEMINI_UPLOAD_TIMEOUT_SECONDS', '600'))
+POLL_INITIAL_SECONDS = 0.5
+POLL_MAX_SECONDS = 8.0
+
+_lock = threading.Lock()
+# sha256 -> (expires_at, Future[uploaded file in ACTIVE state])
+_uploads: dict[str, tuple[float, Future]] = {}
+
+
+def wait_until_active(client, uploaded_file, timeout: float = GEMINI_UPLOAD_TIMEOUT_SECONDS):
+    """Poll files.get with exponential backoff until the file is no longer PROCESSING."""
+    delay = POLL_INITIAL_SECONDS
+    deadline = time.monotonic() + timeout
+    while uploaded_file.state.name == "PROCESSING":
+        if time.monotonic() + delay > deadline:
+            raise TimeoutError(f"Gemini file {uploaded_file.name} still processing after {timeout}s")
+        time.sleep(delay)
+        delay = min(delay * 2, POLL_MAX_SECONDS)
+        uploaded_file = client.files.get(name=uploaded_file.name)
+
+    if uploaded_file.state.name == "FAILED":
+        raise ValueError("File processing failed on Gemini API")
+    return uploaded_file
+
+
+def _upload(client, types, pdf_path: str):
+    logger.info(f"Uploading PDF to Gemini: {pdf_path} (Size: {os.path.getsize(pdf_path)} bytes)")
+    start = time.monotonic()
+    uploaded_file = provider_limits.call('gemini', 'upload', lambda: client.files.upload(
+        file=pdf_path,
+        config=types.UploadFileConfig(mime_type="application/pdf"),
+    ))
+    uploaded_file = wait_until_active(client, uploaded_file)
+    logger.info(f"Gemini file {uploaded_file.uri} ready in {time.monotonic() - start:.1f}s")
+    return uploaded_file
+
+
+def upload_future(client, types, pdf_path: str, background: bool = False) -> Future:
+    """
+    Future of the ACTIVE Gemini file for `pdf_path`. Reuses a cached or
+    in-flight upload of the same content; otherwise uploads, in a daemon
+    thread when `background` is set and in the calling thread if not.
+    """
+    digest = file_sha256(pdf_path)
+    now = time.monotonic()
+    with _lock:
+        cached = _uploads.get(digest)
+        if cached and cached[0] > now and not (cached[1].done() and cached[1].exception()):
+            return cached[1]
+        future = Future()
+        _uploads[digest] = (now + GEMINI_UPLOAD_TTL_SECONDS, future)
+
+    def run():
+        try:
+            future.set_result(_upload(client, types, pdf_path))
+        except BaseException as e:
+            with _lock:
+                if _uploads.get(digest, (None, None))[1] is future:
+                    del _uploads[digest]
+            future.set_exception(e)
+
+    if background:
+        threading.Thread(target=run, daemon=True).start()
+    else:
+        run()
+    return future
+
+
+def prefetch(client, types, pdf_path: str) -> Future:
+    """Start uploading `pdf_path` in the background; errors surface on use."""
+    return upload_future(client, types, pdf_path, background=True)
+
+
+def get_active_file(client, types, pdf_path: str):
+    """The ACTIVE Gemini file for `pdf_path`, uploading it if needed."""
+    return upload_future(client, types, pdf_path).result()
+
+
+def forget(pdf_path: str) -> None:
+    """Drop the cached upload of `pdf_path` (e.g. Gemini no longer has it)."""
+    digest = file_sha256(pdf_path)
+    with _lock:
+        _uploads.pop(digest, None)
@@ -0,0 +1,104 @@
+"""
+One running job per (kind, document): RAG ingestion and extraction processing.
+
+Ingestion can be triggered from upload, from the post-processing hook and
+from the ingest endpoint; without a guard two threads could both delete
+and re-insert a document's chunks and pay for the embeddings twice.
+
+run_exclusive() makes the first caller the owner of the job:
+
+- callers in the same process attach to the owner's future and get its
+  result (or its exception);
+- callers in another process find the Postgres advisory lock taken, wait
+  for it to be released and then get `attach()` instead of re-running.
+
+The advisory lock lives on a dedicated connection, so the close_old_connections()
+calls inside long jobs cannot drop it; Postgres also releases it if the
+process dies. On other databases only the in-process guard applies.
+"""
+import logging
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
+from typing import Any, Callable
+
+from django.db import DEFAULT_DB_ALIAS, connections
+
+logger = logging.getLogger(__name__)
+
+# First key of the two-int advisory lock; the second is the document id
+JOB_KINDS = {
+    'rag_ingest': 7301,
+    'process': 7302,
+}
+
+_lock = threading.Lock()
+_running: dict[tuple[str, int], Future] = {}
+
+
+@contextmanager
+def advisory_lock(kind: str, document_id: int, wait: bool = False):
+    """Yield True when the lock is held (always, with wait=True), else False."""
+    if connections[DEFAULT_DB_ALIAS].vendor != 'postgresql':
+        yield True
+        return
+
+    key = (JOB_KINDS[kind], document_id)
+    conn = connections.create_connection(DEFAULT_DB_ALIAS)
+    try:
+        with conn.cursor() as cursor:
+            if wait:
+                cursor.execute('SELECT pg_advisory_lock(%s, %s)', key)
+                acquired = True
+            else:
+                cursor.execute('SELECT pg_try_advisory_lock(%s, %s)', key)
+                acquired = bool(cursor.fetchone()[0])
+            try:
+                yield acquired
+            finally:
+                if acquired:
+                    cursor.execute('SELECT pg_advisory_unlock(%s, %s)', key)
+    finally:
+        conn.close()
+
+
+def is_running(kind: str, document_id: int) -> bool:
+    """True when this process is running the job."""
+    with _lock:
+        return (kind, document_id) in _running
+
+
+def run_exclusive(kind: str, document_id: int, job: Callable[[], Any],
+                  attach: Callable[[], Any] | None = None) -> Any:
+    """
+    Run job() unless the same job is already running for the document.
+    Returns job()'s result, the running owner's result (same process), or
+    attach() once the owner in another process has finished.
+    """
+    key = (kind, document_id)
+    with _lock:
+        running = _running.get(key)
+        if running is None:
+            future = _running[key] = Future()
+    if running is not None:
+        logger.info(f"{kind} for document {document_id} already running; attaching to it")
+        return running.result()
+
+    try:
+        with advisory_lock(kind, document_id) as acquired:
+            if acquired:
+                result = job()
+        if not acquired:
+            logger.info(f"{kind} for document {document_id} is running in another process; waiting for it")
+            with advisory_lock(kind, document_id, wait=True):
+                pass
+            result = attach() if attach else None
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    else:
+        future.set_result(result)
+        return result
+    finally:
+        with _lock:
+            _running.pop(key, None)
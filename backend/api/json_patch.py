@@ -0,0 +1,167 @@
+"""
+Minimal RFC 6902 (JSON Patch) implementation for extracted_data edits.
+
+Operations are applied in place, in order. apply_patch raises
+JsonPatchConflict when an operation cannot be applied to the current
+document (missing path, failed `test`) and InvalidJsonPatch when the patch
+itself is malformed; callers should discard the document in both cases.
+"""
+import copy
+
+OPERATIONS = ('add', 'remove', 'replace', 'move', 'copy', 'test')
+
+
+class InvalidJsonPatch(ValueError):
+    """The patch is not a well-formed RFC 6902 document."""
+
+
+class JsonPatchConflict(ValueError):
+    """The patch is well formed but does not apply to the target document."""
+
+
+def parse_pointer(pointer: str) -> list[str]:
+    """Split an RFC 6901 JSON Pointer into unescaped reference tokens."""
+    if not isinstance(pointer, str):
+        raise InvalidJsonPatch(f"JSON pointer must be a string, got {type(pointer).__name__}")
+    if pointer == '':
+        return []
+    if not pointer.startswith('/'):
+        raise InvalidJsonPatch(f"JSON pointer must start with '/': {pointer!r}")
+    return [token.replace('~1', '/').replace('~0', '~') for token in pointer[1:].split('/')]
+
+
+def _array_index(container: list, token: str, allow_end: bool) -> int:
+    if token == '-' and allow_end:
+        return len(container)
+    if not token.isdigit() or (len(token) > 1 and token.startswith('0')):
+        raise JsonPatchConflict(f"Invalid array index {token!r}")
+    index = int(token)
+    limit = len(container) if allow_end else len(container) - 1
+    if index > limit:
+        raise JsonPatchConflict(f"Array index {index} out of range")
+    return index
+
+
+def _parent(doc, tokens: list[str]):
+    """Resolve the container holding the last token of `tokens`."""
+    current = doc
+    for token in tokens[:-1]:
+        if isinstance(current, dict):
+            if token not in current:
+                raise JsonPatchConflict(f"Path segment {token!r} does not exist")
+            current = current[token]
+        elif isinstance(current, list):
+            current = current[_array_index(current, token, allow_end=False)]
+        else:
+            raise JsonPatchConflict(f"Cannot descend into {type(current).__name__} at {token!r}")
+    return current
+
+
+def resolve(doc, pointer: str):
+    """Value at `pointer`; raises JsonPatchConflict if it does not exist."""
+    tokens = parse_pointer(pointer)
+    if not tokens:
+        return doc
+    parent = _parent(doc, tokens)
+    last = tokens[-1]
+    if isinstance(parent, dict):
+        if last not in parent:
+            raise JsonPatchConflict(f"Path {pointer!r} does not exist")
+        return parent[last]
+    if isinstance(parent, list):
+        return parent[_array_index(parent, last, allow_end=False)]
+    raise JsonPatchConflict(f"Path {pointer!r} does not exist")
+
+
+def _add(doc, tokens, value):
+    if not tokens:
+        return value
+    parent = _parent(doc, tokens)
+    last = tokens[-1]
+    if isinstance(parent, dict):
+        parent[last] = value
+    elif isinstance(parent, list):
+        parent.insert(_array_index(parent, last, allow_end=True), value)
+    else:
+        raise JsonPatchConflict(f"Cannot add to {type(parent).__name__}")
+    return doc
+
+
+def _remove(doc, tokens):
+    if not tokens:
+        raise JsonPatchConflict("Cannot remove the document root")
+    parent = _parent(doc, tokens)
+    last = tokens[-1]
+    if isinstance(parent, dict):
+        if last not in parent:
+            raise JsonPatchConflict(f"Path segment {last!r} does not exist")
+        return parent.pop(last)
+    if isinstance(parent, list):
+        return parent.pop(_array_index(parent, last, allow_end=False))
+    raise JsonPatchConflict(f"Cannot remove from {type(parent).__name__}")
+
+
+def validate_patch(operations) -> list[dict]:
+    """Check shape of every operation up front so nothing is half-applied on bad input."""
+    if not isinstance(operations, list):
+        raise InvalidJsonPatch("A JSON Patch must be an array of operations")
+    for i, op in enumerate(operations):
+        if not isinstance(op, dict):
+            raise InvalidJsonPatch(f"Operation {i} must be an object")
+        name = op.get('op')
+        if name not in OPERATIONS:
+            raise InvalidJsonPatch(f"Operation {i}: unknown op {name!r}")
+        parse_pointer(op.get('path'))
+        if name in ('add', 'replace', 'test') and 'value' not in op:
+            raise InvalidJsonPatch(f"Operation {i}: '{name}' requires 'value'")
+        if name in ('move', 'copy'):
+            parse_pointer(op.get('from'))
+    return operations
+
+
+def apply_patch(doc, operations) -> tuple[object, list[str]]:
+    """
+    Apply `operations` to `doc` in place.
+
+    Returns (doc, touched_pointers). The root may be replaced by an
+    operation on path '', so always use the returned document.
+    """
+    validate_patch(operations)
+    touched: list[str] = []
+
+    for op in operations:
+        name = op['op']
+        path = op['path']
+        tokens = parse_pointer(path)
+
+        if name == 'add':
+            doc = _add(doc, tokens, copy.deepcopy(op['value']))
+        elif name == 'remove':
+            _remove(doc, tokens)
+        elif name == 'replace':
+            resolve(doc, path)  # must exist
+            if tokens:
+                parent = _parent(doc, tokens)
+                if isinstance(parent, list):
+                    parent[_array_index(parent, tokens[-1], allow_end=False)] = copy.deepcopy(op['value'])
+                else:
+                    parent[tokens[-1]] = copy.deepcopy(op['value'])
+            else:
+                doc = copy.deepcopy(op['value'])
+        elif name == 'move':
+            source = parse_pointer(op['from'])
+            if tokens[:len(source)] == source and len(tokens) > len(source):
+                raise JsonPatchConflict("Cannot move a value into one of its children")
+            value = _remove(doc, source)
+            doc = _add(doc, tokens, value)
+            touched.append(op['from'])
+        elif name == 'copy':
+            doc = _add(doc, tokens, copy.deepcopy(resolve(doc, op['from'])))
+        elif name == 'test':
+            if resolve(doc, path) != op['value']:
+                raise JsonPatchConflict(f"Test failed at {path!r}")
+            continue
+
+        touched.append(path)
+
+    return doc, touched
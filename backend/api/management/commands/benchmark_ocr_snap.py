@@ -0,0 +1,91 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from api.rendering import OcrTokenIndex, ocr_best_rect
+
+VOCAB = [
+    "quỹ", "đầu", "tư", "cổ", "phiếu", "phí", "quản", "lý", "mua", "bán", "lại",
+    "chuyển", "đổi", "tối", "đa", "năm", "giá", "trị", "tài", "sản", "ròng",
+    "ngân", "hàng", "giám", "sát", "công", "ty", "chứng", "khoán", "nhà", "nước",
+    "ủy", "ban", "giao", "dịch", "ngày", "tháng", "điều", "lệ", "hoạt", "động",
+    "2,0%", "1,5%", "5%", "nav", "vnd", "t+1", "14h45", "cut-off", "techcomcapital",
+]
+
+
+class Command(BaseCommand):
+    help = 'Microbenchmark OCR highlight snapping: indexed matcher vs linear scan'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lines', type=int, default=300, help='OCR lines per page')
+        parser.add_argument('--targets', type=int, default=40, help='Highlighted fields per page')
+        parser.add_argument('--repeat', type=int, default=20, help='Pages to simulate')
+        parser.add_argument('--seed', type=int, default=7)
+
+    def _make_page(self, rng, n_lines, n_targets):
+        ocr_results = []
+        line_texts = []
+        for i in range(n_lines):
+            words = [rng.choice(VOCAB) for _ in range(rng.randint(3, 10))]
+            text = " ".join(words)
+            if rng.random() < 0.3:
+                text = text.upper()
+            y = 20 + i * 12
+            box = [[40, y], [560, y], [560, y + 10], [40, y + 10]]
+            ocr_results.append((box, text, 0.9))
+            line_texts.append(text)
+
+        targets = []
+        for _ in range(n_targets):
+            kind = rng.random()
+            if kind < 0.5:
+                # Paragraph spanning a few consecutive OCR lines
+                start = rng.randrange(n_lines)
+                targets.append(" ".join(line_texts[start:start + rng.randint(1, 4)]))
+            elif kind < 0.8:
+                # Short value taken from inside a line
+                words = rng.choice(line_texts).split()
+                targets.append(" ".join(words[:2]))
+            else:
+                # Value that isn't on the page
+                targets.append(f"không có {rng.randint(1000, 9999)} xyz")
+        return ocr_results, targets
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        pages = [
+            self._make_page(rng, options['lines'], options['targets'])
+            for _ in range(options['repeat'])
+        ]
+
+        start = time.perf_counter()
+        linear = [[ocr_best_rect(ocr, t) for t in targets] for ocr, targets in pages]
+        linear_s = time.perf_counter() - start
+
+        start = time.perf_counter()
+        indexed = []
+        for ocr, targets in pages:
+            index = OcrTokenIndex(ocr)
+            indexed.append([index.best_rect(t) for t in targets])
+        indexed_s = time.perf_counter() - start
+
+        mismatches = sum(
+            1
+            for lin_page, idx_page in zip(linear, indexed)
+            for a, b in zip(lin_page, idx_page)
+            if a != b
+        )
+
+        n_pages = len(pages)
+        self.stdout.write(
+            f"{n_pages} pages x {options['lines']} OCR lines x {options['targets']} bboxes"
+        )
+        self.stdout.write(f"linear scan : {linear_s * 1000 / n_pages:8.2f} ms/page")
+        self.stdout.write(f"token index : {indexed_s * 1000 / n_pages:8.2f} ms/page (incl. index build)")
+        if indexed_s > 0:
+            self.stdout.write(f"speedup     : {linear_s / indexed_s:8.1f}x")
+        if mismatches:
+            self.stdout.write(self.style.ERROR(f"{mismatches} results differ from the linear scan"))
+        else:
+            self.stdout.write(self.style.SUCCESS("Results identical to the linear scan"))
@@ -0,0 +1,113 @@
+import multiprocessing
+import random
+import re
+import time
+
+from django.core.management.base import BaseCommand
+
+from api.text_cleaning import clean_text_for_rag, collapse_repeats, strip_page_boilerplate
+
+LEGACY_REPEAT_RE = re.compile(r'(.{10,})\1+')
+
+
+def _legacy_worker(text, conn):
+    start = time.perf_counter()
+    LEGACY_REPEAT_RE.sub(r'\1', text)
+    conn.send(time.perf_counter() - start)
+
+
+WORDS = [
+    "quỹ", "đầu", "tư", "cổ", "phiếu", "phí", "quản", "lý", "mua", "bán", "lại",
+    "chuyển", "đổi", "giá", "trị", "tài", "sản", "ròng", "ngân", "hàng", "giám", "sát",
+]
+
+
+class Command(BaseCommand):
+    help = 'Benchmark RAG text cleaning: linear cleaner vs the legacy backtracking regex'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='4000,8000,16000,32000',
+                            help='Comma-separated line lengths for the pathological inputs')
+        parser.add_argument('--pages', type=int, default=60, help='Pages in the synthetic prospectus')
+        parser.add_argument('--timeout', type=float, default=20.0,
+                            help='Seconds to wait for the legacy regex before giving up')
+        parser.add_argument('--seed', type=int, default=7)
+
+    def _time_legacy(self, text, timeout):
+        """
+        Seconds taken by the legacy regex, or None past `timeout`. Runs in a
+        child process because a running regex cannot be interrupted.
+        """
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        worker = multiprocessing.Process(target=_legacy_worker, args=(text, sender), daemon=True)
+        worker.start()
+        if receiver.poll(timeout):
+            seconds = receiver.recv()
+            worker.join()
+            return seconds
+        worker.terminate()
+        worker.join()
+        return None
+
+    def _time(self, fn, text):
+        start = time.perf_counter()
+        fn(text)
+        return time.perf_counter() - start
+
+    def _pathological_lines(self, rng, size):
+        # Near-repeats: long runs over a tiny alphabet, and a phrase repeated
+        # with a one-character mutation in every copy.
+        binary = ''.join(rng.choice('ab') for _ in range(size))
+        phrase = "sở hữu của một Quỹ đầu tư "
+        mutated = ''.join(
+            phrase[:i % len(phrase)] + 'x' + phrase[i % len(phrase) + 1:]
+            for i in range(size // len(phrase))
+        )
+        return {'binary': binary, 'mutated-loop': mutated}
+
+    def _prospectus(self, rng, n_pages):
+        pages = []
+        for number in range(1, n_pages + 1):
+            body = [
+                " ".join(rng.choice(WORDS) for _ in range(rng.randint(8, 16)))
+                for _ in range(rng.randint(15, 30))
+            ]
+            if rng.random() < 0.2:
+                # OCR loop glitch
+                loop = " ".join(rng.choice(WORDS) for _ in range(5)) + " "
+                body.append(loop * rng.randint(3, 12))
+            pages.append("\n".join([
+                f"=== PAGE {number} ===",
+                "CÔNG TY CỔ PHẦN QUẢN LÝ QUỸ ĐẦU TƯ ABC",
+                "BẢN CÁO BẠCH QUỸ ĐẦU TƯ CỔ PHIẾU ABC",
+                *body,
+                f"Trang {number}/{n_pages}",
+            ]))
+        return "\n".join(pages)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        timeout = options['timeout']
+
+        self.stdout.write("Pathological lines (ms):")
+        self.stdout.write(f"{'input':>14} {'chars':>8} {'legacy regex':>14} {'linear':>10}")
+        for size in [int(s) for s in options['sizes'].split(',') if s.strip()]:
+            for name, text in self._pathological_lines(rng, size).items():
+                legacy = self._time_legacy(text, timeout)
+                linear = self._time(collapse_repeats, text)
+                legacy_txt = f"{legacy * 1000:14.1f}" if legacy is not None else f"{'> ' + str(int(timeout)) + ' s':>14}"
+                self.stdout.write(f"{name:>14} {len(text):>8} {legacy_txt} {linear * 1000:10.1f}")
+
+        document = self._prospectus(rng, options['pages'])
+        start = time.perf_counter()
+        cleaned = clean_text_for_rag(document)
+        elapsed = time.perf_counter() - start
+        headers_only = strip_page_boilerplate(document)
+
+        self.stdout.write("")
+        self.stdout.write(f"Synthetic prospectus: {options['pages']} pages, {len(document)} chars")
+        self.stdout.write(f"  after header/footer removal : {len(headers_only)} chars")
+        self.stdout.write(f"  after loop-glitch removal   : {len(cleaned)} chars "
+                          f"({100 * (1 - len(cleaned) / len(document)):.1f}% smaller)")
+        self.stdout.write(f"  cleaning time               : {elapsed * 1000:.1f} ms")
+        self.stdout.write(self.style.SUCCESS("Done"))
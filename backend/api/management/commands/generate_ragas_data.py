@@ -1,4 +1,6 @@
 import json
+from pathlib import Path
+
 import pandas as pd
 from django.core.management.base import BaseCommand
 from api.models import Document
@@ -9,9 +11,18 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument('document_id', type=int, help='ID of the document to test')
+        parser.add_argument('--output', default='ragas_dataset.csv', help='CSV file to write')
+        parser.add_argument('--batch-size', type=int, default=10,
+                            help='Questions sent to RAGService.chat_batch at a time')
+        parser.add_argument('--restart', action='store_true',
+                            help='Ignore answers saved by a previous (interrupted) run')
 
     def handle(self, *args, **options):
         doc_id = options['document_id']
+        output_file = Path(options['output'])
+        # Answers are appended here as they arrive, so an interrupted run resumes
+        progress_file = output_file.with_suffix('.jsonl')
+        batch_size = max(1, options['batch_size'])
         rag_service = RAGService()
 
         # 1. Define your Test Questions (Ground Truth is optional but recommended)
@@ -103,34 +114,64 @@ class Command(BaseCommand):
     }
 ]
 
-        results = {
-            "question": [],
-            "answer": [],
-            "contexts": [],
-            "ground_truth": []
-        }
+        if options['restart'] and progress_file.exists():
+            progress_file.unlink()
+        answered = self._load_progress(progress_file)
+        pending = [case for case in test_cases if case["question"] not in answered]
 
         print(f"--- Generating RAGAS Data for Doc ID {doc_id} ---")
+        if answered:
+            print(f"Resuming: {len(test_cases) - len(pending)} of {len(test_cases)} questions already answered in {progress_file}")
+
+        failed = 0
+        with progress_file.open('a', encoding='utf-8') as progress:
+            if progress.tell() and not progress_file.read_bytes().endswith(b"\n"):
+                progress.write("\n")  # finish a line cut short by a crash
+            for start in range(0, len(pending), batch_size):
+                batch = pending[start:start + batch_size]
+                print(f"Processing questions {start + 1}-{start + len(batch)} of {len(pending)}")
 
-        for case in test_cases:
-            q = case["question"]
-            print(f"Processing: {q}")
+                # One embeddings request and concurrent search / LLM calls per batch
+                payloads = rag_service.chat_batch(doc_id, [case["question"] for case in batch])
 
-            # Call the service with return_sources=True
-            response_data = rag_service.chat(doc_id, q, return_sources=True)
+                for case, response_data in zip(batch, payloads):
+                    if "error" in response_data:
+                        # Not saved, so the next run asks it again
+                        failed += 1
+                        print(f"❌ Failed: {case['question']} ({response_data['error']})")
+                        continue
+                    row = {
+                        "question": case["question"],
+                        "answer": response_data["text"],
+                        "contexts": response_data["contexts"],  # List of strings
+                        "ground_truth": case["ground_truth"],
+                    }
+                    answered[row["question"]] = row
+                    progress.write(json.dumps(row, ensure_ascii=False) + "\n")
+                progress.flush()
 
-            # Append to lists
-            results["question"].append(q)
-            results["answer"].append(response_data["text"])
-            results["contexts"].append(response_data["contexts"]) # List of strings
-            results["ground_truth"].append(case["ground_truth"])
+        # Convert to Pandas DataFrame (test case order)
+        df = pd.DataFrame([answered[case["question"]] for case in test_cases if case["question"] in answered])
 
-        # Convert to Pandas DataFrame
-        df = pd.DataFrame(results)
-        
         # Save to CSV
-        output_file = "ragas_dataset.csv"
         df.to_csv(output_file, index=False)
-        
-        print(f"✅ Success! Dataset saved to {output_file}")
-        print("You can now load this CSV in your evaluation.py script.")
\ No newline at end of file
+
+        print(f"✅ Success! Dataset saved to {output_file} ({len(df)} of {len(test_cases)} questions)")
+        if failed:
+            print(f"{failed} question(s) failed; run the command again to retry them.")
+        print("You can now load this CSV in your evaluation.py script.")
+
+    @staticmethod
+    def _load_progress(progress_file: Path) -> dict:
+        """{question: row} saved by earlier runs; a line cut short by a crash is ignored."""
+        answered = {}
+        if not progress_file.exists():
+            return answered
+        with progress_file.open(encoding='utf-8') as progress:
+            for line in progress:
+                try:
+                    row = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                answered[row["question"]] = row
+        return answered
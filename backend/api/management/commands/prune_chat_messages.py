@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from api.chat_history import CHAT_HISTORY_MAX_MESSAGES, prune
+from api.models import ChatMessage
+
+
+class Command(BaseCommand):
+    help = 'Trim every document chat history to the newest N messages'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--keep', type=int, default=CHAT_HISTORY_MAX_MESSAGES,
+                            help='Messages to keep per document')
+
+    def handle(self, *args, **options):
+        keep = max(0, options['keep'])
+        document_ids = ChatMessage.objects.values_list('document_id', flat=True).distinct()
+        total = 0
+        for document_id in document_ids.iterator():
+            total += prune(document_id, keep=keep)
+        self.stdout.write(self.style.SUCCESS(f'Deleted {total} chat messages (keep={keep})'))
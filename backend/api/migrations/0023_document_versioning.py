@@ -0,0 +1,40 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0022_document_keyset_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='documentchangelog',
+            name='version',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='documentchangelog',
+            name='operations',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='documentchangelog',
+            index=models.Index(fields=['document', 'version'], name='changelog_doc_version_idx'),
+        ),
+        migrations.CreateModel(
+            name='DocumentSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.PositiveIntegerField()),
+                ('extracted_data', models.JSONField(default=dict)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('document', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='snapshots', to='api.document')),
+            ],
+            options={
+                'ordering': ['document', '-version'],
+                'constraints': [models.UniqueConstraint(fields=('document', 'version'), name='unique_document_snapshot_version')],
+            },
+        ),
+    ]
@@ -0,0 +1,60 @@
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+from django.utils.dateparse import parse_datetime
+
+
+def copy_chat_history(apps, schema_editor):
+    """Move each Document.chat_history blob into ChatMessage rows."""
+    Document = apps.get_model('api', 'Document')
+    ChatMessage = apps.get_model('api', 'ChatMessage')
+    now = django.utils.timezone.now()
+
+    documents = Document.objects.exclude(chat_history=[]).only('id', 'chat_history')
+    for document in documents.iterator(chunk_size=100):
+        rows = []
+        for message in (document.chat_history or [])[-200:]:
+            if not isinstance(message, dict):
+                continue
+            created_at = parse_datetime(str(message.get('timestamp') or '')) or now
+            if django.utils.timezone.is_naive(created_at):
+                created_at = django.utils.timezone.make_aware(created_at)
+            sender = message.get('sender')
+            rows.append(ChatMessage(
+                document_id=document.id,
+                sender=sender if sender in ('user', 'ai', 'system') else 'system',
+                text=str(message.get('text') or ''),
+                metadata={k: message[k] for k in ('chunks_count', 'citations') if message.get(k) is not None},
+                created_at=created_at,
+            ))
+        ChatMessage.objects.bulk_create(rows)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0023_document_versioning'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatMessage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sender', models.CharField(choices=[('user', 'User'), ('ai', 'AI'), ('system', 'System')], max_length=20)),
+                ('text', models.TextField()),
+                ('metadata', models.JSONField(blank=True, default=dict)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('document', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chat_messages', to='api.document')),
+            ],
+            options={
+                'ordering': ['id'],
+                'indexes': [models.Index(fields=['document', '-id'], name='chatmessage_doc_id_idx')],
+            },
+        ),
+        migrations.RunPython(copy_chat_history, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='document',
+            name='chat_history',
+        ),
+    ]
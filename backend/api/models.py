@@ -1,4 +1,5 @@
 from django.db import models
+from django.utils import timezone
 from django.contrib.postgres.fields import ArrayField
 import json
 from pgvector.django import VectorField, HnswIndex
@@ -8,6 +9,8 @@ class DocumentChunk(models.Model):
     document = models.ForeignKey('Document', on_delete=models.CASCADE, related_name='chunks')
     content = models.TextField()
     page_number = models.IntegerField()
+    # Every page this text appears on (near-duplicates are stored once)
+    page_numbers = ArrayField(models.IntegerField(), default=list, blank=True)
     embedding = VectorField(dimensions=1024)
     created_at = models.DateTimeField(auto_now_add=True)
     search_vector = SearchVectorField(null=True)
@@ -77,10 +80,6 @@ class Document(models.Model):
     # Extracted data (stored as JSON)
     extracted_data = models.JSONField(null=True, blank=True)
 
-    # Persisted chat history for the document (list of messages)
-    # Stored as JSON so the frontend can restore conversations when reopening.
-    chat_history = models.JSONField(default=list, blank=True)
-    
     # Optimized PDF file (containing only relevant pages)
     optimized_file = models.FileField(upload_to='optimized_documents/%Y/%m/%d/', null=True, blank=True)
     
@@ -98,6 +97,8 @@ class Document(models.Model):
         ordering = ['-uploaded_at']
         indexes = [
             models.Index(fields=['-uploaded_at']),
+            # Keyset pagination of the document list: (uploaded_at, id) descending
+            models.Index(fields=['-uploaded_at', '-id'], name='document_keyset_idx'),
             models.Index(fields=['status']),
             models.Index(fields=['rag_status']),
         ]
@@ -216,12 +217,106 @@ class DocumentChangeLog(models.Model):
     
     # Change details (stored as JSON)
     changes = models.JSONField(default=dict)  # {field_path: {old: value, new: value}}
+
+    # Edit number this entry produced (document.edit_count after the edit) and
+    # the exact JSON Patch that turns version-1 into version. Null on entries
+    # written before versioning existed.
+    version = models.PositiveIntegerField(null=True, blank=True)
+    operations = models.JSONField(null=True, blank=True)
     
     class Meta:
         ordering = ['-changed_at']
         indexes = [
             models.Index(fields=['document', '-changed_at']),
+            models.Index(fields=['document', 'version'], name='changelog_doc_version_idx'),
         ]
     
     def __str__(self):
         return f"Change for {self.document.file_name} at {self.changed_at}"
+
+
+class DocumentSnapshot(models.Model):
+    """
+    Full copy of extracted_data at a given edit number.
+
+    Taken before the first versioned edit and then every SNAPSHOT_INTERVAL
+    edits (see api.versioning), so any version is rebuilt from the nearest
+    snapshot plus a bounded number of change log deltas.
+    """
+    document = models.ForeignKey(Document, on_delete=models.CASCADE, related_name='snapshots')
+    version = models.PositiveIntegerField()
+    extracted_data = models.JSONField(default=dict)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['document', '-version']
+        constraints = [
+            models.UniqueConstraint(fields=['document', 'version'], name='unique_document_snapshot_version'),
+        ]
+
+    def __str__(self):
+        return f"Snapshot v{self.version} of {self.document.file_name}"
+
+
+class ChatMessage(models.Model):
+    """
+    One persisted chat message. Rows are only appended (one INSERT per turn)
+    and trimmed by background retention, never rewritten.
+    """
+    SENDER_CHOICES = [
+        ('user', 'User'),
+        ('ai', 'AI'),
+        ('system', 'System'),
+    ]
+
+    document = models.ForeignKey(Document, on_delete=models.CASCADE, related_name='chat_messages')
+    sender = models.CharField(max_length=20, choices=SENDER_CHOICES)
+    text = models.TextField()
+    # Extra per-message data the UI restores (chunks_count, citations)
+    metadata = models.JSONField(default=dict, blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ['id']
+        indexes = [
+            models.Index(fields=['document', '-id'], name='chatmessage_doc_id_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.sender} message on {self.document_id} at {self.created_at}"
+
+
+class ExtractionCacheEntry(models.Model):
+    """
+    Raw extraction JSON, keyed by everything that determines it: the PDF's
+    SHA-256, ocr_model, the provider model and a hash of the prompt/schema
+    (see api.extraction_cache). Re-processing an unchanged file with an
+    unchanged prompt reuses the stored result.
+    """
+    key = models.CharField(max_length=64, unique=True)
+    file_sha256 = models.CharField(max_length=64, db_index=True)
+    ocr_model = models.CharField(max_length=20)
+    model_name = models.CharField(max_length=100)
+    prompt_hash = models.CharField(max_length=64)
+    data = models.JSONField(default=dict)
+    hits = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"{self.ocr_model}/{self.model_name} extraction of {self.file_sha256[:12]}"
+
+
+class ProviderCooldown(models.Model):
+    """
+    Rate-limit cooldown and open circuit breaker of a provider endpoint,
+    shared between worker processes when PROVIDER_LIMITS_SHARED is set
+    (see api.provider_limits).
+    """
+    name = models.CharField(max_length=50, unique=True)
+    cooldown_until = models.DateTimeField(null=True, blank=True)
+    open_until = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name} cooldown until {self.cooldown_until}, open until {self.open_until}"
@@ -0,0 +1,116 @@
+"""
+Single-flight broker for remote OCR results.
+
+On upload, RAG ingestion and structured extraction run at the same time
+and both need Mistral OCR of the same PDF. Results are keyed by the SHA-256
+of the file and the 0-based page index: the first caller OCRs the pages
+nobody has claimed yet, and every other caller waits on the same futures
+instead of uploading the document again.
+
+Completed pages stay in memory for the OCR_BROKER_MAX_FILES most recently
+used files. Across restarts, callers can seed() pages back from a persisted
+markdown file (see RAGService._extract_content_for_rag).
+"""
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+OCR_BROKER_MAX_FILES = int(os.getenv('OCR_BROKER_MAX_FILES', '16'))
+
+_digest_cache: dict[tuple[str, int, int], str] = {}
+
+
+def file_sha256(path: str) -> str:
+    """SHA-256 of a file, cached by (path, size, mtime)."""
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    digest = _digest_cache.get(key)
+    if digest is None:
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        digest = _digest_cache[key] = h.hexdigest()
+    return digest
+
+
+class OCRBroker:
+    def __init__(self, max_files: int = OCR_BROKER_MAX_FILES):
+        self.max_files = max_files
+        self._lock = threading.Lock()
+        self._files: OrderedDict[str, dict[int, Future]] = OrderedDict()
+
+    def _entries(self, digest: str) -> dict[int, Future]:
+        # Caller holds the lock
+        entries = self._files.setdefault(digest, {})
+        self._files.move_to_end(digest)
+        while len(self._files) > self.max_files:
+            evicted, pages = self._files.popitem(last=False)
+            if any(not f.done() for f in pages.values()):
+                # Still in flight; keep it and stop evicting for now
+                self._files[evicted] = pages
+                self._files.move_to_end(evicted, last=False)
+                break
+        return entries
+
+    def seed(self, pdf_path: str, pages: dict[int, str]) -> None:
+        """Register already-known markdown for pages of `pdf_path`."""
+        if not pages:
+            return
+        digest = file_sha256(pdf_path)
+        with self._lock:
+            entries = self._entries(digest)
+            for page, markdown in pages.items():
+                if page not in entries:
+                    future = Future()
+                    future.set_result(markdown)
+                    entries[page] = future
+
+    def ocr_pages(self, pdf_path: str, pages: list[int], ocr: Callable[[list[int]], list[str]]) -> list[str]:
+        """
+        Markdown of the given 0-based pages of `pdf_path`, in sorted order.
+        `ocr(missing_pages)` is called only for pages that no other caller
+        has OCRed or is OCRing; it must return one string per page, in order.
+        """
+        pages = sorted(set(pages))
+        digest = file_sha256(pdf_path)
+        with self._lock:
+            entries = self._entries(digest)
+            owned = {page: Future() for page in pages if page not in entries}
+            entries.update(owned)
+            futures = [entries[page] for page in pages]
+
+        if owned:
+            shared = len(pages) - len(owned)
+            logger.info(
+                f"OCR broker: {os.path.basename(pdf_path)} - OCRing {len(owned)} page(s)"
+                + (f", {shared} shared" if shared else "")
+            )
+            try:
+                results = ocr(list(owned))
+                if len(results) != len(owned):
+                    raise ValueError(f"OCR returned {len(results)} pages for {len(owned)} requested")
+            except BaseException as e:
+                with self._lock:
+                    entries = self._files.get(digest, {})
+                    for page, future in owned.items():
+                        # Drop failed pages so the next caller retries them
+                        if entries.get(page) is future:
+                            del entries[page]
+                        future.set_exception(e)
+                raise
+            for future, markdown in zip(owned.values(), results):
+                future.set_result(markdown)
+        elif pages:
+            logger.info(f"OCR broker: {os.path.basename(pdf_path)} - {len(pages)} page(s) shared, no OCR")
+
+        return [future.result() for future in futures]
+
+
+broker = OCRBroker()
@@ -0,0 +1,150 @@
+"""
+Sharded, concurrent OCR of large PDFs.
+
+The PDF is cut into page-range shards with PyMuPDF and each shard is sent
+to the OCR provider on its own, at most OCR_SHARD_CONCURRENCY at a time.
+A failed shard is retried on its own (with backoff) instead of the whole
+document, and the per-shard results are stitched back in page order so
+callers can number pages globally. Retries stop as soon as the provider's
+circuit breaker is open (see provider_limits).
+"""
+import logging
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable
+
+import fitz  # PyMuPDF
+
+from .provider_limits import ProviderUnavailable
+
+logger = logging.getLogger(__name__)
+
+OCR_SHARD_PAGES = int(os.getenv('OCR_SHARD_PAGES', '20'))
+OCR_SHARD_CONCURRENCY = int(os.getenv('OCR_SHARD_CONCURRENCY', '4'))
+OCR_SHARD_MAX_ATTEMPTS = 4
+OCR_SHARD_BASE_WAIT_SECONDS = 2
+
+
+class ShardOCRError(RuntimeError):
+    """A shard still failed after OCR_SHARD_MAX_ATTEMPTS."""
+
+
+def page_ranges(page_count: int, shard_pages: int) -> list[tuple[int, int]]:
+    """[(first, last)] 0-based inclusive page ranges covering the document."""
+    shard_pages = max(1, shard_pages)
+    return [(start, min(start + shard_pages, page_count) - 1) for start in range(0, page_count, shard_pages)]
+
+
+def _runs(pages: list[int]) -> list[tuple[int, int]]:
+    """Consecutive runs of sorted page indices as (first, last) pairs."""
+    runs = []
+    for page in pages:
+        if runs and page == runs[-1][1] + 1:
+            runs[-1] = (runs[-1][0], page)
+        else:
+            runs.append((page, page))
+    return runs
+
+
+def shard_bytes(src: fitz.Document, pages: list[int]) -> bytes:
+    """The given pages of `src` (0-based, sorted) as a standalone PDF."""
+    shard = fitz.open()
+    try:
+        for first, last in _runs(pages):
+            shard.insert_pdf(src, from_page=first, to_page=last)
+        return shard.tobytes(garbage=3, deflate=True)
+    finally:
+        shard.close()
+
+
+def ocr_in_shards(
+    pdf_path: str,
+    ocr_shard: Callable[[bytes, str], list[str]],
+    pages: list[int] | None = None,
+    shard_pages: int = OCR_SHARD_PAGES,
+    concurrency: int = OCR_SHARD_CONCURRENCY,
+    max_attempts: int = OCR_SHARD_MAX_ATTEMPTS,
+) -> list[str]:
+    """
+    OCR `pdf_path` shard by shard and return one markdown string per page,
+    in document order (index 0 is page 1). Pass `pages` (0-based indices)
+    to OCR only those pages; the result then follows sorted(pages).
+
+    `ocr_shard(pdf_bytes, file_name)` must return the markdown of every
+    page of the shard it is given; a shard whose page count does not match
+    is treated as failed.
+    """
+    base_name = os.path.splitext(os.path.basename(pdf_path))[0]
+    with fitz.open(pdf_path) as src:
+        selected = sorted(set(pages)) if pages is not None else list(range(src.page_count))
+        if not selected:
+            return []
+        whole_document = len(selected) == src.page_count and len(selected) <= shard_pages
+        # Ranges index into `selected`, not into the document
+        ranges = page_ranges(len(selected), shard_pages)
+        shards = {} if whole_document else {
+            (first, last): shard_bytes(src, selected[first:last + 1]) for first, last in ranges
+        }
+    if whole_document:
+        with open(pdf_path, 'rb') as f:
+            shards[ranges[0]] = f.read()
+
+    results: dict[tuple[int, int], list[str]] = {}
+    pending = list(ranges)
+    errors: dict[tuple[int, int], Exception] = {}
+
+    def label(page_range):
+        first, last = page_range
+        return f"{selected[first] + 1}-{selected[last] + 1}"
+
+    def run(page_range):
+        first, last = page_range
+        markdown = ocr_shard(shards[page_range], f"{base_name}_p{label(page_range)}.pdf")
+        expected = last - first + 1
+        if len(markdown) != expected:
+            raise ValueError(f"OCR returned {len(markdown)} pages for a {expected}-page shard")
+        return markdown
+
+    for attempt in range(1, max_attempts + 1):
+        logger.info(
+            f"OCR {len(pending)}/{len(ranges)} shard(s) of {pdf_path} "
+            f"(attempt {attempt}/{max_attempts}, concurrency {concurrency})"
+        )
+        failed = []
+        with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(pending)))) as pool:
+            futures = {pool.submit(run, page_range): page_range for page_range in pending}
+            for future in as_completed(futures):
+                page_range = futures[future]
+                try:
+                    results[page_range] = future.result()
+                    errors.pop(page_range, None)
+                except Exception as e:
+                    errors[page_range] = e
+                    failed.append(page_range)
+                    logger.warning(f"OCR shard pages {label(page_range)} failed: {e}")
+
+        if not failed:
+            break
+        pending = sorted(failed)
+        unavailable = next((errors[r] for r in pending if isinstance(errors[r], ProviderUnavailable)), None)
+        if unavailable is not None:
+            # Circuit open: retrying now would only fail fast again
+            raise ShardOCRError(
+                f"OCR provider unavailable; {len(pending)} shard(s) not OCRed: {unavailable}"
+            ) from unavailable
+        if attempt < max_attempts:
+            wait = OCR_SHARD_BASE_WAIT_SECONDS * (2 ** (attempt - 1)) + random.uniform(0, 1.0)
+            logger.info(f"Retrying {len(pending)} failed OCR shard(s) in {wait:.1f}s...")
+            time.sleep(wait)
+    else:
+        raise ShardOCRError(
+            f"OCR failed for {len(pending)} shard(s) (first: pages {label(pending[0])}) "
+            f"after {max_attempts} attempts: {errors[pending[0]]}"
+        ) from errors[pending[0]]
+
+    merged: list[str] = []
+    for page_range in ranges:
+        merged.extend(results[page_range])
+    return merged
@@ -0,0 +1,131 @@
+"""
+Per-page OCR routing for RAG extraction.
+
+Most prospectus pages are born-digital and carry a usable text layer, so
+only pages that need it are sent to remote OCR:
+
+- 'ocr'  : scanned pages (sparse text layer, or mostly covered by images),
+           pages whose text layer is garbled (broken font encodings), and
+           table-heavy pages, where OCR gives proper markdown tables.
+- 'text' : everything else, read locally with PyMuPDF.
+
+The remote pages are OCRed as one sub-PDF (see ocr_sharding) and the
+results are stitched back with the local pages in page order.
+"""
+import logging
+import os
+import re
+from dataclasses import dataclass
+from typing import Callable
+
+import fitz  # PyMuPDF
+
+logger = logging.getLogger(__name__)
+
+PAGE_MARKER_RE = re.compile(r'^=== PAGE (\d+) ===$', re.MULTILINE)
+
+OCR_PAGE_ROUTING = os.getenv('OCR_PAGE_ROUTING', 'true').strip().lower() not in {'0', 'false', 'no'}
+
+# Fewer text-layer characters than this and the page is treated as scanned
+MIN_TEXT_CHARS = int(os.getenv('OCR_ROUTING_MIN_TEXT_CHARS', '200'))
+# Share of the page area covered by images above which the page is scanned,
+# unless the text layer is rich (a scan with an embedded OCR layer is still
+# re-OCRed; a digital page with a logo or chart is not)
+SCANNED_IMAGE_COVERAGE = float(os.getenv('OCR_ROUTING_IMAGE_COVERAGE', '0.5'))
+RICH_TEXT_CHARS = 1500
+# Ruled line segments above which a page is considered table-heavy
+TABLE_RULE_LINES = int(os.getenv('OCR_ROUTING_TABLE_LINES', '40'))
+# Share of unreadable characters (U+FFFD, control chars) in the text layer
+GARBLED_SHARE = 0.1
+
+
+@dataclass
+class PageRoute:
+    page: int          # 0-based
+    route: str         # 'text' or 'ocr'
+    reason: str
+    text: str = ''     # text layer, for 'text' pages
+
+
+def _image_coverage(page: fitz.Page) -> float:
+    area = abs(page.rect) or 1.0
+    covered = 0.0
+    for info in page.get_image_info():
+        bbox = fitz.Rect(info['bbox']) & page.rect
+        if not bbox.is_empty:
+            covered += abs(bbox)
+    return min(1.0, covered / area)
+
+
+def _rule_lines(page: fitz.Page) -> int:
+    """Horizontal/vertical line segments and thin rectangles (table rules)."""
+    count = 0
+    for drawing in page.get_drawings():
+        for item in drawing.get('items', ()):
+            kind = item[0]
+            if kind == 'l':
+                p1, p2 = item[1], item[2]
+                if abs(p1.x - p2.x) < 1 or abs(p1.y - p2.y) < 1:
+                    count += 1
+            elif kind == 're':
+                rect = item[1]
+                if min(rect.width, rect.height) < 2:
+                    count += 1
+    return count
+
+
+def _garbled_share(text: str) -> float:
+    visible = [ch for ch in text if not ch.isspace()]
+    if not visible:
+        return 0.0
+    bad = sum(1 for ch in visible if ch == '\ufffd' or ord(ch) < 32)
+    return bad / len(visible)
+
+
+def classify_page(page: fitz.Page) -> PageRoute:
+    text = page.get_text('text') or ''
+    chars = len(text.strip())
+
+    if chars < MIN_TEXT_CHARS:
+        return PageRoute(page.number, 'ocr', f'sparse text layer ({chars} chars)')
+    if _garbled_share(text) > GARBLED_SHARE:
+        return PageRoute(page.number, 'ocr', 'garbled text layer')
+    coverage = _image_coverage(page)
+    if coverage >= SCANNED_IMAGE_COVERAGE and chars < RICH_TEXT_CHARS:
+        return PageRoute(page.number, 'ocr', f'image coverage {coverage:.0%}')
+    rules = _rule_lines(page)
+    if rules >= TABLE_RULE_LINES:
+        return PageRoute(page.number, 'ocr', f'table-heavy ({rules} rules)')
+    return PageRoute(page.number, 'text', 'text layer', text.strip())
+
+
+def route_pages(pdf_path: str) -> list[PageRoute]:
+    with fitz.open(pdf_path) as doc:
+        return [classify_page(page) for page in doc]
+
+
+def routed_markdown(pdf_path: str, ocr_pages: Callable[[list[int]], list[str]]) -> str:
+    """
+    Combined markdown with `=== PAGE N ===` markers: digital pages from the
+    local text layer, the rest from `ocr_pages(page_indices)`, which must
+    return one markdown string per requested page, in order.
+    """
+    routes = route_pages(pdf_path)
+    remote = [r.page for r in routes if r.route == 'ocr']
+    logger.info(
+        f"OCR routing for {os.path.basename(pdf_path)}: "
+        f"{len(routes) - len(remote)} page(s) from text layer, {len(remote)} page(s) to OCR"
+    )
+
+    ocr_text = dict(zip(remote, ocr_pages(remote))) if remote else {}
+    full_markdown = ""
+    for r in routes:
+        body = ocr_text[r.page] if r.route == 'ocr' else r.text
+        full_markdown += f"\n\n=== PAGE {r.page + 1} ===\n{body}"
+    return full_markdown
+
+
+def split_page_markdown(markdown: str) -> dict[int, str]:
+    """Inverse of routed_markdown: {0-based page: body} from `=== PAGE N ===` sections."""
+    parts = PAGE_MARKER_RE.split(markdown or '')
+    return {int(number) - 1: body.strip('\n') for number, body in zip(parts[1::2], parts[2::2])}
@@ -0,0 +1,232 @@
+"""
+In-process progress bus for document processing and RAG ingestion.
+
+Workers publish progress here instead of writing every step to the DB;
+the SSE endpoints (DocumentViewSet.events / events_all) subscribe and push
+events to the browser as they happen. Under ASGI the streams wait on an
+asyncio queue (subscribe_async) instead of holding a thread each.
+
+With PROGRESS_BUS_BACKEND=postgres, events are also sent through
+LISTEN/NOTIFY so subscribers in other worker processes receive them.
+The default 'memory' backend only reaches subscribers in the same process
+(fine for runserver / a single worker).
+"""
+import asyncio
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+NOTIFY_CHANNEL = 'document_progress'
+
+# rag_progress is persisted at most this often per document (seconds),
+# plus on every jump of PROGRESS_DB_WRITE_STEP points; live updates go
+# through the bus.
+PROGRESS_DB_WRITE_INTERVAL = float(os.getenv('PROGRESS_DB_WRITE_INTERVAL', '2'))
+PROGRESS_DB_WRITE_STEP = 20
+
+SUBSCRIBER_QUEUE_SIZE = 256
+
+# A document's cached state is dropped once nothing is running for it
+ACTIVE_STATUSES = {'pending', 'processing'}
+ACTIVE_RAG_STATUSES = {'queued', 'running'}
+TERMINAL_STATUSES = {'completed', 'failed'}
+
+
+class AsyncSubscriber:
+    """asyncio.Queue of one event loop, fed from worker threads."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+
+    def put_nowait(self, event: dict):
+        try:
+            self.loop.call_soon_threadsafe(self._put, event)
+        except RuntimeError:
+            pass  # loop already closed; the stream is gone
+
+    def _put(self, event: dict):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            pass
+
+    async def get(self) -> dict:
+        return await self.queue.get()
+
+
+class ProgressBus:
+    """Fan-out of per-document progress events to subscriber queues."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers: dict = {}  # document_id (None = all) -> set[queue.Queue | AsyncSubscriber]
+        self._state: dict[int, dict] = {}
+        self._last_db_write: dict[int, tuple[float, int]] = {}
+        self._listener_started = False
+
+    # -- subscribing -------------------------------------------------------
+
+    def subscribe(self, document_id: int | None = None) -> queue.Queue:
+        """Queue receiving events for one document, or for all when None."""
+        self._ensure_listener()
+        q = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        with self._lock:
+            self._subscribers.setdefault(document_id, set()).add(q)
+        return q
+
+    def subscribe_async(self, document_id: int | None = None) -> AsyncSubscriber:
+        """subscribe() for async code: events arrive on the running event loop."""
+        self._ensure_listener()
+        subscriber = AsyncSubscriber(asyncio.get_running_loop())
+        with self._lock:
+            self._subscribers.setdefault(document_id, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, q, document_id: int | None = None):
+        with self._lock:
+            subs = self._subscribers.get(document_id)
+            if subs:
+                subs.discard(q)
+                if not subs:
+                    self._subscribers.pop(document_id, None)
+
+    def snapshot(self, document_id: int) -> dict | None:
+        """Latest known state of a document published in this process."""
+        with self._lock:
+            state = self._state.get(document_id)
+            return dict(state) if state else None
+
+    # -- publishing --------------------------------------------------------
+
+    def publish(self, document_id: int, **fields):
+        """
+        Publish a progress event, e.g. publish(7, rag_status='running', rag_progress=40).
+        Never raises; progress reporting must not break the worker.
+        """
+        event = {'document_id': document_id, 'ts': time.time(), **fields}
+        self._dispatch(event)
+        if _backend() == 'postgres':
+            try:
+                payload = json.dumps({**event, 'pid': os.getpid()}, default=str)
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT pg_notify(%s, %s)", [NOTIFY_CHANNEL, payload])
+            except Exception as e:
+                logger.debug(f"pg_notify failed: {e}")
+
+    def report_rag_progress(self, document_id: int, pct: int):
+        """
+        Publish rag_progress immediately; persist it only when throttling allows.
+        """
+        pct = max(0, min(100, int(pct)))
+        self.publish(document_id, rag_progress=pct)
+
+        now = time.monotonic()
+        with self._lock:
+            last_time, last_pct = self._last_db_write.get(document_id, (0.0, -100))
+            due = (
+                now - last_time >= PROGRESS_DB_WRITE_INTERVAL
+                or abs(pct - last_pct) >= PROGRESS_DB_WRITE_STEP
+            )
+            if due:
+                self._last_db_write[document_id] = (now, pct)
+        if not due:
+            return
+
+        from .models import Document
+        try:
+            Document.objects.filter(id=document_id).update(rag_progress=pct)
+        except Exception:
+            pass
+
+    def forget(self, document_id: int):
+        """Drop cached state for a finished document."""
+        with self._lock:
+            self._state.pop(document_id, None)
+            self._last_db_write.pop(document_id, None)
+
+    def _dispatch(self, event: dict):
+        document_id = event['document_id']
+        with self._lock:
+            state = self._state.setdefault(document_id, {})
+            state.update(event)
+            if _settled(event, state):
+                # Finished: later snapshots come from the database row
+                self._state.pop(document_id, None)
+                self._last_db_write.pop(document_id, None)
+            targets = list(self._subscribers.get(document_id, ())) + list(self._subscribers.get(None, ()))
+        for q in targets:
+            try:
+                q.put_nowait(event)
+            except queue.Full:
+                # A stalled client must not block workers; it will resync
+                # from the snapshot sent when it reconnects.
+                pass
+
+    # -- LISTEN/NOTIFY -----------------------------------------------------
+
+    def _ensure_listener(self):
+        if _backend() != 'postgres':
+            return
+        with self._lock:
+            if self._listener_started:
+                return
+            self._listener_started = True
+        threading.Thread(target=self._listen_forever, name='progress-listener', daemon=True).start()
+
+    def _listen_forever(self):
+        import psycopg
+        from psycopg.conninfo import make_conninfo
+
+        db = settings.DATABASES['default']
+        conninfo = make_conninfo(
+            dbname=db.get('NAME'),
+            user=db.get('USER') or None,
+            password=db.get('PASSWORD') or None,
+            host=db.get('HOST') or None,
+            port=db.get('PORT') or None,
+            **(db.get('OPTIONS') or {}),
+        )
+        own_pid = os.getpid()
+        while True:
+            try:
+                with psycopg.connect(conninfo, autocommit=True) as conn:
+                    conn.execute(f"LISTEN {NOTIFY_CHANNEL}")
+                    logger.info("Progress bus listening for NOTIFY events")
+                    for notify in conn.notifies():
+                        try:
+                            event = json.loads(notify.payload)
+                        except ValueError:
+                            continue
+                        # Events from this process were already dispatched locally.
+                        if event.pop('pid', None) == own_pid:
+                            continue
+                        self._dispatch(event)
+            except Exception as e:
+                logger.warning(f"Progress listener disconnected: {e}; retrying in 5s")
+                time.sleep(5)
+
+
+def _settled(event: dict, state: dict) -> bool:
+    """True when `event` finished a job and no other job is running for the document."""
+    finished = event.get('status') in TERMINAL_STATUSES or event.get('rag_status') in TERMINAL_STATUSES
+    return (
+        finished
+        and state.get('status') not in ACTIVE_STATUSES
+        and state.get('rag_status') not in ACTIVE_RAG_STATUSES
+    )
+
+
+def _backend() -> str:
+    return os.getenv('PROGRESS_BUS_BACKEND', 'memory').strip().lower()
+
+
+bus = ProgressBus()
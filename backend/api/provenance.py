@@ -0,0 +1,79 @@
+"""
+Provenance (source page / bounding box) of extracted_data values.
+
+Extracted fields are stored as {value, page, bbox}. The detail endpoint
+ships them without `bbox` by default; the boxes are served separately by
+DocumentViewSet.provenance for the views that draw highlights. Updates
+sent back without boxes keep the stored ones (restore_provenance).
+"""
+import copy
+
+# Keys dropped from structured fields unless provenance is requested inline
+PROVENANCE_KEYS = ('bbox',)
+
+
+def _escape(token) -> str:
+    return str(token).replace('~', '~0').replace('/', '~1')
+
+
+def is_located_field(obj) -> bool:
+    return isinstance(obj, dict) and 'value' in obj and 'bbox' in obj
+
+
+def strip_provenance(data):
+    """Copy of extracted_data with bbox removed from every structured field."""
+    if isinstance(data, dict):
+        return {
+            key: strip_provenance(value)
+            for key, value in data.items()
+            if not (key in PROVENANCE_KEYS and 'value' in data)
+        }
+    if isinstance(data, list):
+        return [strip_provenance(item) for item in data]
+    return copy.deepcopy(data)
+
+
+def restore_provenance(data, stored):
+    """
+    Copy of `data` where structured fields without a bbox get the stored
+    page/bbox of the field at the same path, so a GET -> edit -> PUT round
+    trip does not drop provenance.
+    """
+    if isinstance(data, dict):
+        if 'value' in data and 'bbox' not in data:
+            restored = copy.deepcopy(data)
+            if is_located_field(stored):
+                restored['bbox'] = copy.deepcopy(stored['bbox'])
+                restored.setdefault('page', stored.get('page'))
+            return restored
+        stored = stored if isinstance(stored, dict) else {}
+        return {key: restore_provenance(value, stored.get(key)) for key, value in data.items()}
+    if isinstance(data, list):
+        stored = stored if isinstance(stored, list) else []
+        return [
+            restore_provenance(item, stored[index] if index < len(stored) else None)
+            for index, item in enumerate(data)
+        ]
+    return copy.deepcopy(data)
+
+
+def collect_provenance(data, page: int | None = None) -> list[dict]:
+    """
+    Flat list of {path, page, bbox} for every located field, optionally
+    limited to one (raw) page. `path` is the JSON Pointer of the field.
+    """
+    located = []
+
+    def walk(obj, pointer):
+        if isinstance(obj, dict):
+            if is_located_field(obj) and obj.get('bbox') and (page is None or obj.get('page') == page):
+                located.append({'path': pointer, 'page': obj.get('page'), 'bbox': obj['bbox']})
+            for key, value in obj.items():
+                if key not in ('value', 'page', 'bbox'):
+                    walk(value, f"{pointer}/{_escape(key)}")
+        elif isinstance(obj, list):
+            for index, item in enumerate(obj):
+                walk(item, f"{pointer}/{index}")
+
+    walk(data or {}, '')
+    return located
@@ -0,0 +1,380 @@
+"""
+Process-wide rate limiting, 429 cooldowns and circuit breaking for provider calls.
+
+Every Mistral, Gemini and Ollama request goes through the limiter of its
+(provider, endpoint), e.g. ('mistral', 'ocr'), so concurrent documents
+share one budget per endpoint instead of each pacing and backing off on
+its own:
+
+- requests are spaced by a token bucket (PROVIDER_RPM_<PROVIDER>_<ENDPOINT>
+  requests per minute, bursts of PROVIDER_BURST);
+- a 429 puts the whole endpoint into a cooldown (the provider's retry hint
+  when it sends one) that every caller waits out once, after which the
+  bucket paces them again instead of letting them retry together;
+- after PROVIDER_BREAKER_FAILURES consecutive transient failures (5xx,
+  timeouts, dropped connections) the breaker opens: calls fail fast with
+  ProviderUnavailable for PROVIDER_BREAKER_RESET_SECONDS, then a single
+  probe call decides whether it closes again.
+
+call() retries rate-limited and transient failures up to max_attempts in
+total; any other error is raised at once. acall() is the same for
+coroutines (asyncio provider clients, see async_providers). With PROVIDER_LIMITS_SHARED=1
+cooldowns and open breakers are also recorded in the database
+(ProviderCooldown) so other worker processes honour them. Queue-wait
+metrics are available from metrics() (GET /api/documents/provider-metrics/).
+"""
+import asyncio
+import logging
+import os
+import random
+import re
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+
+PROVIDER_BURST = int(os.getenv('PROVIDER_BURST', '5'))
+PROVIDER_MAX_ATTEMPTS = int(os.getenv('PROVIDER_MAX_ATTEMPTS', '3'))
+PROVIDER_COOLDOWN_SECONDS = float(os.getenv('PROVIDER_COOLDOWN_SECONDS', '10'))
+PROVIDER_BREAKER_FAILURES = int(os.getenv('PROVIDER_BREAKER_FAILURES', '5'))
+PROVIDER_BREAKER_RESET_SECONDS = float(os.getenv('PROVIDER_BREAKER_RESET_SECONDS', '30'))
+PROVIDER_LIMITS_SHARED = os.getenv('PROVIDER_LIMITS_SHARED', 'false').strip().lower() in {'1', 'true', 'yes'}
+RETRY_BASE_WAIT_SECONDS = 1.0
+SHARED_REFRESH_SECONDS = 1.0
+
+# Requests per minute by (provider, endpoint); 0 = no pacing
+DEFAULT_RPM = {
+    ('mistral', 'ocr'): 60,
+    ('mistral', 'chat'): 60,
+    ('mistral', 'embeddings'): 120,
+    ('gemini', 'generate'): 60,
+    ('gemini', 'upload'): 60,
+    ('ollama', 'chat'): 0,
+}
+
+RATE_LIMIT_MARKERS = ('429', 'rate limit', 'resource_exhausted', 'too many requests')
+TRANSIENT_MARKERS = ('timeout', 'timed out', 'connection', 'unavailable', 'disconnected', 'overloaded')
+RETRY_HINT_RE = re.compile(r"retry(?:[ _-]?delay)?['\"]?\s*(?:in|:)?\s*['\"]?(\d+(?:\.\d+)?)\s*s", re.IGNORECASE)
+
+
+class ProviderUnavailable(RuntimeError):
+    """The provider's circuit breaker is open; the call was not attempted."""
+
+
+def status_code(error: BaseException) -> int | None:
+    """HTTP status of a provider SDK / requests error, when it carries one."""
+    for attr in ('status_code', 'code'):
+        value = getattr(error, attr, None)
+        if isinstance(value, int) and 100 <= value < 600:
+            return value
+    value = getattr(getattr(error, 'response', None), 'status_code', None)
+    return value if isinstance(value, int) else None
+
+
+def classify(error: BaseException) -> str:
+    """'rate_limited', 'transient' (worth retrying) or 'fatal'."""
+    if isinstance(error, ProviderUnavailable):
+        return 'fatal'
+    code = status_code(error)
+    text = str(error).lower()
+    if code == 429 or (code is None and any(marker in text for marker in RATE_LIMIT_MARKERS)):
+        return 'rate_limited'
+    if code is not None:
+        return 'transient' if code >= 500 or code == 408 else 'fatal'
+    if isinstance(error, (TimeoutError, ConnectionError)) or any(marker in text for marker in TRANSIENT_MARKERS):
+        return 'transient'
+    if isinstance(error, (TypeError, ValueError, KeyError, AttributeError)):
+        return 'fatal'
+    return 'transient'
+
+
+def retry_after(error: BaseException) -> float | None:
+    """Seconds the provider asked us to wait (Retry-After header or a retry hint in the message)."""
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    try:
+        value = headers.get('retry-after') or headers.get('Retry-After')
+        if value is not None:
+            return float(value)
+    except (TypeError, ValueError, AttributeError):
+        pass
+    match = RETRY_HINT_RE.search(str(error))
+    return float(match.group(1)) if match else None
+
+
+class TokenBucket:
+    """Not thread-safe on its own; ProviderLimiter holds its lock."""
+
+    def __init__(self, rate_per_minute: float, burst: int = PROVIDER_BURST):
+        self.rate = max(0.0, rate_per_minute) / 60.0
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+
+    def reserve(self, at: float) -> float:
+        """
+        Take a token for a call at monotonic time `at` or later, going into
+        debt if none is left, and return the monotonic time it is available.
+        """
+        if self.rate <= 0:
+            return at
+        at = max(at, self.updated)
+        self.tokens = min(self.capacity, self.tokens + (at - self.updated) * self.rate)
+        self.updated = at
+        self.tokens -= 1
+        return at if self.tokens >= 0 else at - self.tokens / self.rate
+
+    def drain(self) -> None:
+        """No burst after a cooldown: resume at the steady rate."""
+        self.tokens = min(self.tokens, 0.0)
+
+
+class ProviderLimiter:
+    def __init__(self, provider: str, endpoint: str, rpm: float, burst: int = PROVIDER_BURST):
+        self.name = f"{provider}.{endpoint}"
+        self.rpm = rpm
+        self.bucket = TokenBucket(rpm, burst)
+        self._lock = threading.Lock()
+        # Wall-clock times, so they can be shared with other processes
+        self.cooldown_until = 0.0
+        self.open_until = 0.0
+        self.failures = 0
+        self.probing = False
+        self._shared_checked = 0.0
+        self.stats = {
+            'calls': 0, 'successes': 0, 'rate_limited': 0, 'failures': 0, 'retries': 0,
+            'rejected': 0, 'waiting': 0, 'waited_calls': 0, 'wait_seconds_total': 0.0, 'wait_seconds_max': 0.0,
+        }
+
+    def _reserve(self) -> tuple[float, float]:
+        """(start, ready) monotonic times of this call's turn; raises ProviderUnavailable."""
+        with self._lock:
+            now = time.time()
+            if self.open_until > now:
+                self.stats['rejected'] += 1
+                raise ProviderUnavailable(
+                    f"{self.name} is unavailable (circuit open for another {self.open_until - now:.0f}s)"
+                )
+            if self.failures >= PROVIDER_BREAKER_FAILURES:
+                if self.probing:
+                    self.stats['rejected'] += 1
+                    raise ProviderUnavailable(f"{self.name} is unavailable (waiting for a probe call)")
+                self.probing = True
+            start = time.monotonic()
+            ready = self.bucket.reserve(start + max(0.0, self.cooldown_until - now))
+            self.stats['calls'] += 1
+            self.stats['waiting'] += 1
+        return start, ready
+
+    def _waited(self, start: float) -> float:
+        waited = time.monotonic() - start
+        with self._lock:
+            self.stats['waiting'] -= 1
+            if waited > 0.01:
+                self.stats['waited_calls'] += 1
+                self.stats['wait_seconds_total'] += waited
+                self.stats['wait_seconds_max'] = max(self.stats['wait_seconds_max'], waited)
+        return waited
+
+    def acquire(self) -> float:
+        """Wait for this call's turn and return the seconds waited; raises ProviderUnavailable."""
+        self._refresh_shared()
+        start, ready = self._reserve()
+        try:
+            delay = ready - start
+            while delay > 0:
+                time.sleep(delay)
+                # A 429 seen while we were queued extends the wait
+                delay = self.cooldown_until - time.time()
+        finally:
+            waited = self._waited(start)
+        return waited
+
+    async def aacquire(self) -> float:
+        """acquire() for coroutines: waits with asyncio.sleep instead of blocking the thread."""
+        if PROVIDER_LIMITS_SHARED:
+            from asgiref.sync import sync_to_async
+            await sync_to_async(self._refresh_shared)()
+        start, ready = self._reserve()
+        try:
+            delay = ready - start
+            while delay > 0:
+                await asyncio.sleep(delay)
+                delay = self.cooldown_until - time.time()
+        finally:
+            waited = self._waited(start)
+        return waited
+
+    def _on_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.probing = False
+            self.stats['successes'] += 1
+
+    def _on_error(self, error: Exception, attempt: int, max_attempts: int) -> tuple[str, tuple | None]:
+        """
+        Record a failed attempt. Returns the error kind and the (field, until)
+        to share with other processes, if any; raises when it must not be retried.
+        """
+        kind = classify(error)
+        shared = None
+        with self._lock:
+            if kind == 'rate_limited':
+                seconds = retry_after(error) or PROVIDER_COOLDOWN_SECONDS
+                self.cooldown_until = max(self.cooldown_until, time.time() + seconds)
+                self.bucket.drain()
+                self.probing = False
+                self.stats['rate_limited'] += 1
+                shared = ('cooldown_until', self.cooldown_until)
+            elif kind == 'transient':
+                self.failures += 1
+                self.probing = False
+                self.stats['failures'] += 1
+                if self.failures >= PROVIDER_BREAKER_FAILURES:
+                    self.open_until = time.time() + PROVIDER_BREAKER_RESET_SECONDS
+                    shared = ('open_until', self.open_until)
+            elif not isinstance(error, ProviderUnavailable):
+                # The provider responded (e.g. a 400): it is up, whatever the error
+                self.failures = 0
+                self.probing = False
+            if kind != 'fatal' and attempt < max_attempts:
+                self.stats['retries'] += 1
+
+        if kind == 'rate_limited':
+            logger.warning(
+                f"{self.name}: rate limited (attempt {attempt}/{max_attempts}); "
+                f"cooling down {shared[1] - time.time():.1f}s"
+            )
+        elif kind == 'transient':
+            logger.warning(f"{self.name}: call failed (attempt {attempt}/{max_attempts}): {error}")
+            if shared:
+                logger.warning(
+                    f"{self.name}: {PROVIDER_BREAKER_FAILURES}+ consecutive failures; "
+                    f"failing fast for {PROVIDER_BREAKER_RESET_SECONDS:.0f}s"
+                )
+        return kind, shared
+
+    def _backoff(self, attempt: int) -> float:
+        return RETRY_BASE_WAIT_SECONDS * (2 ** (attempt - 1)) + random.uniform(0, 1.0)
+
+    def call(self, fn: Callable[[], Any], max_attempts: int = PROVIDER_MAX_ATTEMPTS) -> Any:
+        """fn() under this limiter, retrying 429s and transient failures."""
+        for attempt in range(1, max_attempts + 1):
+            self.acquire()
+            try:
+                result = fn()
+            except Exception as e:
+                kind, shared = self._on_error(e, attempt, max_attempts)
+                if shared:
+                    self._share(*shared)
+                if kind == 'fatal' or attempt == max_attempts:
+                    raise
+                if kind == 'transient':
+                    time.sleep(self._backoff(attempt))
+                continue
+            self._on_success()
+            return result
+
+    async def acall(self, fn: Callable[[], Awaitable[Any]], max_attempts: int = PROVIDER_MAX_ATTEMPTS) -> Any:
+        """await fn() under this limiter; same retry policy as call()."""
+        for attempt in range(1, max_attempts + 1):
+            await self.aacquire()
+            try:
+                result = await fn()
+            except Exception as e:
+                kind, shared = self._on_error(e, attempt, max_attempts)
+                if shared and PROVIDER_LIMITS_SHARED:
+                    from asgiref.sync import sync_to_async
+                    await sync_to_async(self._share)(*shared)
+                if kind == 'fatal' or attempt == max_attempts:
+                    raise
+                if kind == 'transient':
+                    await asyncio.sleep(self._backoff(attempt))
+                continue
+            self._on_success()
+            return result
+
+    def _share(self, field: str, until: float) -> None:
+        if not PROVIDER_LIMITS_SHARED:
+            return
+        try:
+            from .models import ProviderCooldown
+            ProviderCooldown.objects.update_or_create(
+                name=self.name, defaults={field: datetime.fromtimestamp(until, tz=timezone.utc)}
+            )
+        except Exception as e:
+            logger.warning(f"Could not share {self.name} {field}: {e}")
+
+    def _refresh_shared(self) -> None:
+        now = time.time()
+        if not PROVIDER_LIMITS_SHARED or now - self._shared_checked < SHARED_REFRESH_SECONDS:
+            return
+        self._shared_checked = now
+        try:
+            from .models import ProviderCooldown
+            row = ProviderCooldown.objects.filter(name=self.name).values('cooldown_until', 'open_until').first()
+        except Exception as e:
+            logger.warning(f"Could not read shared state of {self.name}: {e}")
+            return
+        if not row:
+            return
+        with self._lock:
+            if row['cooldown_until']:
+                self.cooldown_until = max(self.cooldown_until, row['cooldown_until'].timestamp())
+            if row['open_until'] and row['open_until'].timestamp() > max(now, self.open_until):
+                self.open_until = row['open_until'].timestamp()
+                self.failures = max(self.failures, PROVIDER_BREAKER_FAILURES)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            now = time.time()
+            if self.open_until > now:
+                state = 'open'
+            elif self.failures >= PROVIDER_BREAKER_FAILURES:
+                state = 'half_open'
+            else:
+                state = 'closed'
+            stats = dict(self.stats)
+            cooldown = max(0.0, self.cooldown_until - now)
+        return {
+            'name': self.name,
+            'rpm': self.rpm,
+            'state': state,
+            'cooldown_seconds': round(cooldown, 1),
+            **stats,
+            'wait_seconds_total': round(stats['wait_seconds_total'], 3),
+            'wait_seconds_max': round(stats['wait_seconds_max'], 3),
+            'wait_seconds_avg': round(stats['wait_seconds_total'] / stats['calls'], 3) if stats['calls'] else 0.0,
+        }
+
+
+_registry_lock = threading.Lock()
+_limiters: dict[tuple[str, str], ProviderLimiter] = {}
+
+
+def limiter(provider: str, endpoint: str) -> ProviderLimiter:
+    key = (provider, endpoint)
+    with _registry_lock:
+        found = _limiters.get(key)
+        if found is None:
+            rpm = float(os.getenv(f"PROVIDER_RPM_{provider}_{endpoint}".upper(), DEFAULT_RPM.get(key, 60)))
+            found = _limiters[key] = ProviderLimiter(provider, endpoint, rpm)
+        return found
+
+
+def call(provider: str, endpoint: str, fn: Callable[[], Any], max_attempts: int = PROVIDER_MAX_ATTEMPTS) -> Any:
+    """fn() paced, cooled down and circuit-broken with the (provider, endpoint) limiter."""
+    return limiter(provider, endpoint).call(fn, max_attempts)
+
+
+async def acall(provider: str, endpoint: str, fn: Callable[[], Awaitable[Any]],
+                max_attempts: int = PROVIDER_MAX_ATTEMPTS) -> Any:
+    """Async call(): `fn` returns a coroutine; waits never block the event loop."""
+    return await limiter(provider, endpoint).acall(fn, max_attempts)
+
+
+def metrics() -> list[dict]:
+    with _registry_lock:
+        limiters = list(_limiters.values())
+    return [l.snapshot() for l in sorted(limiters, key=lambda l: l.name)]
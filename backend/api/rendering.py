@@ -0,0 +1,1128 @@
+"""
+Page rendering helpers for PDF previews.
+
+Pages are rendered one at a time and cached on disk under
+MEDIA_ROOT/page_cache so that listing endpoints only return metadata + URLs
+and every image request after the first one is a plain file read.
+"""
+import difflib
+import hashlib
+import io
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import unicodedata
+
+import fitz  # PyMuPDF
+import PIL.features
+import PIL.Image
+import PIL.ImageDraw
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+PAGE_CACHE_DIR = 'page_cache'
+
+# Full-size previews keep the DPI the old base64 endpoint used.
+FULL_PAGE_DPI = 150
+
+# Thumbnails only need to be legible in the dashboard grid.
+THUMBNAIL_WIDTH = 320
+THUMBNAIL_QUALITY = 70
+
+# Annotated previews kept per PDF (one file per distinct bbox list); the
+# least recently served ones are deleted beyond this.
+ANNOTATED_CACHE_MAX_FILES = int(os.getenv('ANNOTATED_CACHE_MAX_FILES', '200'))
+
+# Serialize renders of the same file/page so concurrent requests don't
+# rasterize the same page twice. Striped so the lock table stays bounded.
+_RENDER_LOCK_STRIPES = 64
+_render_locks = [threading.Lock() for _ in range(_RENDER_LOCK_STRIPES)]
+
+
+def _thumbnail_format() -> tuple[str, str, str]:
+    """Return (PIL format, extension, content type) for thumbnails."""
+    if PIL.features.check('webp'):
+        return 'WEBP', 'webp', 'image/webp'
+    return 'JPEG', 'jpg', 'image/jpeg'
+
+
+def page_cache_key(pdf_path: str) -> str:
+    """
+    Stable key for a PDF on disk.
+
+    Includes size + mtime so a reprocessed/replaced file never serves
+    stale images from an older render.
+    """
+    st = os.stat(pdf_path)
+    raw = f"{os.path.abspath(pdf_path)}:{st.st_size}:{st.st_mtime_ns}"
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()[:16]
+
+
+def _cache_dir(pdf_path: str) -> str:
+    return os.path.join(settings.MEDIA_ROOT, PAGE_CACHE_DIR, page_cache_key(pdf_path))
+
+
+def _lock_for(key: str) -> threading.Lock:
+    digest = hashlib.sha1(key.encode('utf-8')).digest()
+    return _render_locks[digest[0] % _RENDER_LOCK_STRIPES]
+
+
+def _atomic_write(path: str, data: bytes) -> None:
+    """Write via temp file + rename so readers never see a partial image."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except Exception:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def page_dimensions(page, dpi: int = FULL_PAGE_DPI) -> tuple[int, int]:
+    """Pixel size a page would have at `dpi`, without rasterizing it."""
+    rect = page.rect
+    scale = dpi / 72.0
+    return int(round(rect.width * scale)), int(round(rect.height * scale))
+
+
+def render_full_page(page) -> bytes:
+    """Render a loaded fitz page to PNG bytes at FULL_PAGE_DPI."""
+    pix = page.get_pixmap(dpi=FULL_PAGE_DPI)
+    return pix.tobytes('png')
+
+
+def render_thumbnail(page) -> bytes:
+    """Render a loaded fitz page to a small WebP (or JPEG) thumbnail."""
+    rect = page.rect
+    zoom = THUMBNAIL_WIDTH / max(float(rect.width), 1.0)
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+    image = PIL.Image.frombytes('RGB', (pix.width, pix.height), pix.samples)
+
+    pil_format, _, _ = _thumbnail_format()
+    buf = io.BytesIO()
+    image.save(buf, format=pil_format, quality=THUMBNAIL_QUALITY)
+    return buf.getvalue()
+
+
+def _cached_render(pdf_path: str, filename: str, produce) -> str:
+    """
+    Return the cache path for `filename`, calling produce() -> bytes on a miss.
+    """
+    out_path = os.path.join(_cache_dir(pdf_path), filename)
+    if os.path.exists(out_path):
+        return out_path
+
+    with _lock_for(out_path):
+        # Another thread may have finished the render while we waited.
+        if os.path.exists(out_path):
+            return out_path
+        _atomic_write(out_path, produce())
+        return out_path
+
+
+def _evict_annotated(cache_dir: str, keep: int, current: str) -> None:
+    """Delete the least recently used annotated_*.png beyond `keep` (never `current`)."""
+    entries = []
+    try:
+        names = os.listdir(cache_dir)
+    except OSError:
+        return
+    for name in names:
+        if not (name.startswith('annotated_') and name.endswith('.png')):
+            continue
+        path = os.path.join(cache_dir, name)
+        try:
+            entries.append((os.stat(path).st_mtime_ns, path))
+        except OSError:
+            continue
+    if len(entries) <= keep:
+        return
+    entries.sort()
+    for _, path in entries[:len(entries) - keep]:
+        if path == current:
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def cached_page_image(pdf_path: str, page_number: int, variant: str = 'full', doc=None) -> tuple[str, str]:
+    """
+    Return (file_path, content_type) of a rendered page, rendering on demand.
+
+    variant is 'full' (PNG at FULL_PAGE_DPI) or 'thumb' (small WebP/JPEG).
+    page_number is 1-based. An already opened fitz document can be passed
+    in to avoid reopening the PDF when rendering many pages.
+    """
+    if variant == 'thumb':
+        _, ext, content_type = _thumbnail_format()
+    else:
+        variant, ext, content_type = 'full', 'png', 'image/png'
+
+    def _produce() -> bytes:
+        target = doc if doc is not None else fitz.open(pdf_path)
+        try:
+            if page_number < 1 or page_number > len(target):
+                raise IndexError(f"Page {page_number} out of range (1-{len(target)})")
+            page = target.load_page(page_number - 1)
+            return render_thumbnail(page) if variant == 'thumb' else render_full_page(page)
+        finally:
+            if target is not doc:
+                target.close()
+
+    out_path = _cached_render(pdf_path, f"page_{page_number}_{variant}.{ext}", _produce)
+    return out_path, content_type
+
+
+def generate_thumbnails(pdf_path: str) -> int:
+    """
+    Pre-render thumbnails for every page of a PDF.
+    Returns the number of pages processed.
+    """
+    doc = fitz.open(pdf_path)
+    try:
+        total = len(doc)
+        for page_number in range(1, total + 1):
+            try:
+                cached_page_image(pdf_path, page_number, variant='thumb', doc=doc)
+            except Exception as e:
+                logger.warning(f"Thumbnail render failed for page {page_number} of {pdf_path}: {e}")
+        return total
+    finally:
+        doc.close()
+
+
+def generate_thumbnails_async(pdf_path: str) -> None:
+    """Fire-and-forget thumbnail generation (used after processing finishes)."""
+    def _task():
+        try:
+            count = generate_thumbnails(pdf_path)
+            logger.info(f"Generated {count} page thumbnails for {pdf_path}")
+        except Exception as e:
+            logger.warning(f"Thumbnail generation failed for {pdf_path}: {e}")
+
+    threading.Thread(target=_task, daemon=True).start()
+
+
+def purge_page_cache(pdf_path: str) -> None:
+    """Remove cached renders for a PDF (best-effort)."""
+    try:
+        cache_dir = _cache_dir(pdf_path)
+    except OSError:
+        return
+    shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+# ---------------------------------------------------------------------------
+# Highlight annotation
+# ---------------------------------------------------------------------------
+
+def _norm_for_match(s: str) -> str:
+    """Lowercase, strip diacritics and punctuation; keep tokens separated by spaces."""
+    s = str(s or "")
+    s = unicodedata.normalize('NFD', s)
+    s = ''.join(c for c in s if not unicodedata.combining(c))
+    s = s.replace('đ', 'd').replace('Đ', 'D')
+    s = s.lower()
+    s = re.sub(r"[^a-z0-9\s]", " ", s)
+    s = re.sub(r"\s+", " ", s).strip()
+    return s
+
+
+def _trigrams(s: str) -> set[str]:
+    return {s[i:i + 3] for i in range(len(s) - 2)}
+
+
+def ocr_best_rect(ocr_results, target_value: str):
+    """Find OCR boxes matching the target text and merge them.
+
+    Reference implementation: re-normalizes every OCR line on each call.
+    Previews use OcrTokenIndex, which gives the same result per bbox from
+    an index built once per page.
+
+    For long paragraphs the OCR engine returns many small boxes
+    (one per line / word).  We collect ALL boxes whose tokens
+    overlap significantly with the target, then return their
+    *union* bounding rectangle so the entire paragraph is
+    highlighted — not just a single fragment.
+    """
+    if not ocr_results:
+        return None
+    tv = _norm_for_match(target_value)
+    if not tv or len(tv) < 3:
+        return None
+
+    tv_tokens = set(tv.split())
+    if not tv_tokens:
+        return None
+
+    # Collect every OCR box that shares tokens with the target
+    matching_boxes = []  # list of (x0, y0, x1, y1)
+
+    for res in ocr_results:
+        try:
+            box, text, conf = res[0], res[1], res[2]
+        except Exception:
+            continue
+        if not text:
+            continue
+
+        ct = _norm_for_match(text)
+        if not ct:
+            continue
+
+        ct_tokens = set(ct.split())
+        if not ct_tokens:
+            continue
+
+        # Score: what fraction of THIS OCR fragment's tokens
+        # appear in the target value?
+        frag_overlap = len(ct_tokens & tv_tokens) / len(ct_tokens)
+
+        # Accept if ≥60 % of the fragment's tokens are in the target.
+        # This is deliberately lenient per-fragment because individual
+        # OCR lines are short (e.g. 5-10 words).
+        if frag_overlap >= 0.6:
+            xs = [p[0] for p in box]
+            ys = [p[1] for p in box]
+            matching_boxes.append((min(xs), min(ys), max(xs), max(ys)))
+
+    if not matching_boxes:
+        # Fallback: try exact / containment match for short values
+        best = None
+        best_score = 0.0
+        for res in ocr_results:
+            try:
+                box, text, conf = res[0], res[1], res[2]
+            except Exception:
+                continue
+            if not text:
+                continue
+            ct = _norm_for_match(text)
+            if not ct:
+                continue
+
+            score = 0.0
+            if tv == ct:
+                score = 1.0
+            elif tv in ct or ct in tv:
+                score = 0.9
+            if score > best_score:
+                xs = [p[0] for p in box]
+                ys = [p[1] for p in box]
+                best = (min(xs), min(ys), max(xs), max(ys))
+                best_score = score
+        if best and best_score >= 0.7:
+            return best
+        return None
+
+    # Check that enough of the TARGET tokens were found across
+    # all collected fragments (guards against false positives).
+    all_matched_tokens: set[str] = set()
+    for res in ocr_results:
+        try:
+            box, text, conf = res[0], res[1], res[2]
+        except Exception:
+            continue
+        if not text:
+            continue
+        ct = _norm_for_match(text)
+        ct_tokens = set(ct.split())
+        frag_overlap = len(ct_tokens & tv_tokens) / max(len(ct_tokens), 1)
+        if frag_overlap >= 0.6:
+            all_matched_tokens.update(ct_tokens & tv_tokens)
+
+    target_coverage = len(all_matched_tokens) / len(tv_tokens)
+    if target_coverage < 0.4:
+        return None
+
+    # Merge all matching boxes into a single union rectangle
+    x0 = min(b[0] for b in matching_boxes)
+    y0 = min(b[1] for b in matching_boxes)
+    x1 = max(b[2] for b in matching_boxes)
+    y1 = max(b[3] for b in matching_boxes)
+
+    return (x0, y0, x1, y1)
+
+
+class OcrTokenIndex:
+    """
+    Inverted index over one page's OCR output for highlight snapping.
+
+    Every OCR line is normalized once when the index is built; lookups then
+    only touch the lines that share at least one token with the target, via
+    a token -> line ids map. Matching rules are identical to ocr_best_rect(),
+    which is kept as the reference implementation.
+    """
+
+    def __init__(self, ocr_results):
+        self.rects: list[tuple] = []
+        self.texts: list[str] = []
+        self.token_sets: list[set[str]] = []
+        self.postings: dict[str, list[int]] = {}
+        # Containment fallback: first line per exact text, character
+        # trigram -> line ids, and lines too short to have a trigram
+        self.first_line_for_text: dict[str, int] = {}
+        self.gram_postings: dict[str, list[int]] = {}
+        self.gram_counts: list[int] = []
+        self.short_lines: list[int] = []
+
+        for res in ocr_results or []:
+            try:
+                box, text = res[0], res[1]
+            except Exception:
+                continue
+            if not text:
+                continue
+            ct = _norm_for_match(text)
+            if not ct:
+                continue
+            try:
+                xs = [p[0] for p in box]
+                ys = [p[1] for p in box]
+                rect = (min(xs), min(ys), max(xs), max(ys))
+            except Exception:
+                continue
+
+            line_id = len(self.rects)
+            tokens = set(ct.split())
+            self.rects.append(rect)
+            self.texts.append(ct)
+            self.token_sets.append(tokens)
+            for token in tokens:
+                self.postings.setdefault(token, []).append(line_id)
+
+            self.first_line_for_text.setdefault(ct, line_id)
+            grams = _trigrams(ct)
+            self.gram_counts.append(len(grams))
+            if not grams:
+                self.short_lines.append(line_id)
+            for gram in grams:
+                self.gram_postings.setdefault(gram, []).append(line_id)
+
+    def __len__(self) -> int:
+        return len(self.rects)
+
+    def best_rect(self, target_value: str):
+        """Union rect of OCR lines matching `target_value` (see ocr_best_rect)."""
+        if not self.rects:
+            return None
+        tv = _norm_for_match(target_value)
+        if not tv or len(tv) < 3:
+            return None
+
+        tv_tokens = set(tv.split())
+        if not tv_tokens:
+            return None
+
+        # overlap[line] = |line tokens ∩ target tokens|, from posting lists only
+        overlap: dict[int, int] = {}
+        for token in tv_tokens:
+            for line_id in self.postings.get(token, ()):
+                overlap[line_id] = overlap.get(line_id, 0) + 1
+
+        matching = [
+            line_id for line_id, count in overlap.items()
+            if count / len(self.token_sets[line_id]) >= 0.6
+        ]
+
+        if not matching:
+            # Fallback: exact / containment match for short values
+            return self._containment_rect(tv)
+
+        matched_tokens: set[str] = set()
+        for line_id in matching:
+            matched_tokens.update(self.token_sets[line_id] & tv_tokens)
+        if len(matched_tokens) / len(tv_tokens) < 0.4:
+            return None
+
+        rects = [self.rects[line_id] for line_id in matching]
+        return (
+            min(r[0] for r in rects),
+            min(r[1] for r in rects),
+            max(r[2] for r in rects),
+            max(r[3] for r in rects),
+        )
+
+    def _containment_rect(self, tv: str):
+        """
+        ocr_best_rect's fallback: the first line equal to the target, else
+        the first line containing it or contained in it. Candidates come from
+        the trigram postings (a substring shares all of its trigrams with the
+        containing string) and are then checked with `in`.
+        """
+        exact = self.first_line_for_text.get(tv)
+        if exact is not None:
+            return self.rects[exact]
+
+        tv_grams = _trigrams(tv)
+        hits: dict[int, int] = {}
+        for gram in tv_grams:
+            for line_id in self.gram_postings.get(gram, ()):
+                hits[line_id] = hits.get(line_id, 0) + 1
+
+        candidates = [
+            line_id for line_id, count in hits.items()
+            # target inside the line, or the line inside the target
+            if count == len(tv_grams) or count == self.gram_counts[line_id]
+        ]
+        for line_id in sorted(candidates + self.short_lines):
+            ct = self.texts[line_id]
+            if tv in ct or ct in tv:
+                return self.rects[line_id]
+        return None
+
+
+def normalize_bbox(bbox):
+    """
+    Normalize bbox coordinates handling potential format inconsistencies.
+    Expected format: [ymin, xmin, ymax, xmax] on 0-1000 scale.
+    
+    Common issues:
+    1. Model returns [xmin, ymin, xmax, ymax] instead
+    2. Values exceed 1000 (pixel coords instead of normalized)
+    3. Min/max swapped
+    """
+    if not bbox or len(bbox) != 4:
+        return None
+    
+    v0, v1, v2, v3 = [int(x) for x in bbox]
+    
+    # Check if any value exceeds 1000 significantly (might be pixel coords)
+    max_val = max(v0, v1, v2, v3)
+    if max_val > 1000:
+        # Try to normalize - assume it's based on a ~1000px dimension
+        scale = 1000.0 / max(max_val, 1)
+        v0 = int(v0 * scale)
+        v1 = int(v1 * scale)
+        v2 = int(v2 * scale)
+        v3 = int(v3 * scale)
+    
+    # Clamp all values to 0-1000
+    v0 = max(0, min(1000, v0))
+    v1 = max(0, min(1000, v1))
+    v2 = max(0, min(1000, v2))
+    v3 = max(0, min(1000, v3))
+    
+    # Expected: [ymin, xmin, ymax, xmax]
+    ymin, xmin, ymax, xmax = v0, v1, v2, v3
+    
+    # Ensure min < max
+    if ymin > ymax:
+        ymin, ymax = ymax, ymin
+    if xmin > xmax:
+        xmin, xmax = xmax, xmin
+    
+    # Sanity check: box should have some area
+    if xmax <= xmin or ymax <= ymin:
+        return None
+    
+    return (ymin, xmin, ymax, xmax)
+
+
+def merge_regions(rects: list) -> list:
+    """Merge overlapping (x0, y0, x1, y1) rectangles until none overlap."""
+    merged = [tuple(r) for r in rects if r[2] > r[0] and r[3] > r[1]]
+    changed = True
+    while changed:
+        changed = False
+        out = []
+        for rect in merged:
+            for i, other in enumerate(out):
+                if rect[0] <= other[2] and other[0] <= rect[2] and rect[1] <= other[3] and other[1] <= rect[3]:
+                    out[i] = (
+                        min(rect[0], other[0]), min(rect[1], other[1]),
+                        max(rect[2], other[2]), max(rect[3], other[3]),
+                    )
+                    changed = True
+                    break
+            else:
+                out.append(rect)
+        merged = out
+    return merged
+
+
+def stack_regions(image, regions: list, gap: int):
+    """
+    Paste crops of `image` into one white strip, top to bottom.
+
+    Returns (strip, placements) where each placement is
+    (strip_y0, strip_y1, page_x0, page_y0) for mapping results back.
+    """
+    width = max(x1 - x0 for x0, _, x1, _ in regions)
+    height = sum(y1 - y0 for _, y0, _, y1 in regions) + gap * (len(regions) - 1)
+    strip = PIL.Image.new("RGB", (width, height), (255, 255, 255))
+
+    placements = []
+    y = 0
+    for x0, y0, x1, y1 in regions:
+        strip.paste(image.crop((x0, y0, x1, y1)), (0, y))
+        placements.append((y, y + (y1 - y0), x0, y0))
+        y += (y1 - y0) + gap
+    return strip, placements
+
+
+def unstack_ocr_results(results, placements: list) -> list:
+    """Map OCR results on a stacked strip back to page coordinates."""
+    mapped = []
+    for res in results:
+        try:
+            box, text, conf = res[0], res[1], res[2]
+            cy = sum(p[1] for p in box) / len(box)
+        except Exception:
+            continue
+        for strip_y0, strip_y1, page_x0, page_y0 in placements:
+            if strip_y0 <= cy < strip_y1:
+                dy = page_y0 - strip_y0
+                mapped.append(([[p[0] + page_x0, p[1] + dy] for p in box], text, conf))
+                break
+        # Boxes centred in a gap between crops are dropped.
+    return mapped
+
+
+class AnnotationRenderer:
+    """
+    Renders a PDF page with extracted-field highlights burned in.
+
+    Only needs PyMuPDF, Pillow and the local RapidOCR engine, so previews
+    never construct a provider (Gemini/Mistral) client. Output is PNG bytes,
+    either returned directly or stored in the page render cache.
+    """
+
+    # Render: keep this consistent with what the frontend shows.
+    # Using a 2x scale (~144 DPI for A4) gives crisp previews.
+    RENDER_SCALE = 2
+
+    # Allow snap if OCR box center is within 30% of page dimension from original
+    MAX_SNAP_DISTANCE = 0.3
+
+    # Region OCR: padding around each bbox (fraction of page size), gap between
+    # stacked crops, and the crop/page area ratio above which we OCR the whole page.
+    REGION_PAD_FRACTION = 0.05
+    REGION_GAP_PX = 24
+    REGION_MAX_AREA_RATIO = 0.6
+
+    def __init__(self, ocr_mode: str | None = None):
+        # 'page' (default): OCR the whole rendered page.
+        # 'regions': OCR padded crops around the requested bboxes only, stacked
+        # into one strip. Opt-in until benchmarked against 'page': a tall strip
+        # is downscaled by RapidOCR's side-length limit, which can cost accuracy.
+        mode = (ocr_mode or os.getenv('PREVIEW_OCR_MODE', 'page')).strip().lower()
+        self.ocr_mode = mode if mode in {'regions', 'page'} else 'page'
+
+    def render(self, pdf_path: str, page_number: int, bboxes: list) -> bytes | None:
+        """
+        Render a page to PNG bytes and burn in highlights.
+
+        IMPORTANT: We draw in *pixel space* on top of the rendered pixmap.
+        This keeps Gemini's 0-1000 "visual" coordinates aligned with what the
+        user sees, and avoids PDF user-space quirks (rotation / cropbox offsets).
+
+        BBOX FORMAT: Gemini returns [ymin, xmin, ymax, xmax] on 0-1000 scale.
+        However, models sometimes return inconsistent formats. We try to detect
+        and correct common issues.
+        """
+        doc = fitz.open(pdf_path)
+        try:
+            page_idx = page_number - 1
+            if page_idx < 0 or page_idx >= len(doc):
+                return None
+
+            page = doc[page_idx]
+            pix = page.get_pixmap(matrix=fitz.Matrix(self.RENDER_SCALE, self.RENDER_SCALE), alpha=False)
+
+            rgb = PIL.Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+            base = rgb.convert("RGBA")
+            overlay = PIL.Image.new("RGBA", base.size, (0, 0, 0, 0))
+            draw = PIL.ImageDraw.Draw(overlay)
+
+            w, h = base.size
+            border_px = max(2, int(round(min(w, h) * 0.002)))
+
+            # Convert normalized 0-1000 coords to pixel coords
+            targets = []  # (pixel rect, value or None)
+            for item in bboxes or []:
+                bbox = item.get('bbox') if isinstance(item, dict) else None
+                if not bbox or len(bbox) != 4:
+                    continue
+
+                normalized = normalize_bbox(bbox)
+                if not normalized:
+                    continue
+
+                ymin, xmin, ymax, xmax = normalized
+                rect = (
+                    int(round((xmin / 1000.0) * w)),
+                    int(round((ymin / 1000.0) * h)),
+                    int(round((xmax / 1000.0) * w)),
+                    int(round((ymax / 1000.0) * h)),
+                )
+                val = item.get("value")
+                targets.append((rect, str(val) if val is not None and str(val).strip() else None))
+
+            # Optional: OCR-snap highlights to the exact rendered text positions.
+            # This helps when Gemini's 0-1000 coordinates are systematically biased.
+            ocr_index = None
+            snap_rects = [rect for rect, val in targets if val]
+            if snap_rects:
+                if self.ocr_mode == 'regions':
+                    ocr_results = self._run_region_ocr(rgb, snap_rects, page_number)
+                else:
+                    ocr_results = self._run_ocr(pix.tobytes("png"), page_number)
+                if ocr_results:
+                    ocr_index = OcrTokenIndex(ocr_results)
+
+            for rect, val in targets:
+                x0, y0, x1, y1 = rect
+
+                # Try OCR snap for more accurate positioning
+                if val:
+                    snapped = self._snap(ocr_index, val, rect, w, h)
+                    if snapped:
+                        x0, y0, x1, y1 = snapped
+                        logger.debug(f"OCR snapped bbox for '{val[:30]}...' on page {page_number}")
+
+                # Semi-transparent yellow fill + stronger border.
+                draw.rectangle([x0, y0, x1, y1], fill=(255, 255, 0, 80))
+                draw.rectangle([x0, y0, x1, y1], outline=(255, 200, 0, 255), width=border_px)
+
+            out = PIL.Image.alpha_composite(base, overlay).convert("RGB")
+            buf = io.BytesIO()
+            out.save(buf, format="PNG")
+            return buf.getvalue()
+        finally:
+            doc.close()
+
+    def render_cached(self, pdf_path: str, page_number: int, bboxes: list) -> str | None:
+        """
+        Like render(), but stores the PNG in the page render cache and returns its path.
+        The cache key covers the page and the exact bbox list being drawn; at
+        most ANNOTATED_CACHE_MAX_FILES renders are kept per PDF.
+        """
+        digest = hashlib.sha1(
+            json.dumps(bboxes or [], sort_keys=True, ensure_ascii=False, default=str).encode('utf-8')
+        ).hexdigest()[:16]
+
+        def _produce() -> bytes:
+            data = self.render(pdf_path, page_number, bboxes)
+            if data is None:
+                raise IndexError(f"Page {page_number} out of range")
+            return data
+
+        filename = f"annotated_{page_number}_{self.ocr_mode}_{digest}.png"
+        cached = os.path.exists(os.path.join(_cache_dir(pdf_path), filename))
+        try:
+            out_path = _cached_render(pdf_path, filename, _produce)
+        except IndexError:
+            return None
+
+        if cached:
+            # mtime doubles as last-used time for eviction
+            try:
+                os.utime(out_path)
+            except OSError:
+                pass
+        else:
+            _evict_annotated(os.path.dirname(out_path), ANNOTATED_CACHE_MAX_FILES, out_path)
+        return out_path
+
+    def _run_ocr(self, img_bytes: bytes, page_number: int):
+        from .services import ocr_engine
+
+        try:
+            result = ocr_engine(img_bytes)
+            if result and isinstance(result, tuple):
+                result = result[0]
+            return result or []
+        except Exception as ocr_error:
+            logger.debug(f"OCR snap failed for preview page {page_number}: {ocr_error}")
+            return None
+
+    def _run_region_ocr(self, image, rects: list, page_number: int):
+        """
+        OCR only padded crops around `rects`, in a single engine call.
+
+        Overlapping crops are merged, then stacked vertically into one strip
+        image; result boxes are mapped back to page pixel coordinates. Falls
+        back to full-page OCR when the crops would cover most of the page.
+        """
+        w, h = image.size
+        pad_x = int(round(w * self.REGION_PAD_FRACTION))
+        pad_y = int(round(h * self.REGION_PAD_FRACTION))
+        regions = merge_regions([
+            (max(0, x0 - pad_x), max(0, y0 - pad_y), min(w, x1 + pad_x), min(h, y1 + pad_y))
+            for x0, y0, x1, y1 in rects
+        ])
+        if not regions:
+            return []
+
+        crop_area = sum((x1 - x0) * (y1 - y0) for x0, y0, x1, y1 in regions)
+        if crop_area >= self.REGION_MAX_AREA_RATIO * w * h:
+            buf = io.BytesIO()
+            image.save(buf, format="PNG")
+            return self._run_ocr(buf.getvalue(), page_number)
+
+        strip, placements = stack_regions(image, regions, self.REGION_GAP_PX)
+        buf = io.BytesIO()
+        strip.save(buf, format="PNG")
+        results = self._run_ocr(buf.getvalue(), page_number)
+        if not results:
+            return results
+        return unstack_ocr_results(results, placements)
+
+    def _snap(self, ocr_index, value: str, rect: tuple, w: int, h: int):
+        """Return the OCR rect for `value` if it is close enough to `rect`, else None."""
+        if ocr_index is None:
+            return None
+        ocr_rect = ocr_index.best_rect(value)
+        if not ocr_rect:
+            return None
+
+        x0, y0, x1, y1 = rect
+        ox0, oy0, ox1, oy1 = [int(round(v)) for v in ocr_rect]
+        # Only use OCR snap if it's reasonably close to original bbox
+        # This prevents completely wrong snaps
+        dist_x = abs((ox0 + ox1) / 2 - (x0 + x1) / 2) / max(w, 1)
+        dist_y = abs((oy0 + oy1) / 2 - (y0 + y1) / 2) / max(h, 1)
+        if dist_x < self.MAX_SNAP_DISTANCE and dist_y < self.MAX_SNAP_DISTANCE:
+            return ox0, oy0, ox1, oy1
+        return None
+
+
+# ---------------------------------------------------------------------------
+# Quote localization
+# ---------------------------------------------------------------------------
+
+# Below this many text-layer words a page is treated as scanned and its
+# word boxes come from OCR instead.
+MIN_TEXT_LAYER_WORDS = 5
+
+OCR_WORDS_SCALE = 2
+
+
+def strip_markdown(text: str) -> str:
+    """Strip markdown formatting so quoted chunk text matches the PDF's raw content."""
+    text = re.sub(r'#{1,6}\s*', '', text)          # headings
+    text = re.sub(r'\*{1,3}([^*\n]+)\*{1,3}', r'\1', text)  # bold/italic
+    text = re.sub(r'`[^`]*`', '', text)             # inline code
+    text = re.sub(r'\|', ' ', text)                 # table pipes
+    text = re.sub(r'-{3,}', ' ', text)              # HR / table dividers
+    text = re.sub(r'!\[.*?\]\(.*?\)', '', text)     # images
+    text = re.sub(r'\[([^\]]+)\]\([^)]+\)', r'\1', text)  # links
+    text = re.sub(r'\s+', ' ', text).strip()
+    return text
+
+
+class PageWordIndex:
+    """
+    Normalized (diacritic-free, lowercase) words of one page with coordinates.
+
+    Boxes are [ymin, xmin, ymax, xmax] on the 0-1000 scale used everywhere
+    else for highlights; `lines` groups words so matches are reported one
+    rectangle per text line.
+    """
+
+    def __init__(self, tokens: list[str], boxes: list[list[float]], lines: list[int]):
+        self.tokens = tokens
+        self.boxes = boxes
+        self.lines = lines
+
+    def to_json(self) -> bytes:
+        return json.dumps({'tokens': self.tokens, 'boxes': self.boxes, 'lines': self.lines}).encode('utf-8')
+
+    @classmethod
+    def from_json(cls, raw: bytes) -> 'PageWordIndex':
+        data = json.loads(raw)
+        return cls(data['tokens'], data['boxes'], data['lines'])
+
+    @classmethod
+    def from_page(cls, page, allow_ocr: bool = True) -> 'PageWordIndex | None':
+        """
+        Build from the text layer, falling back to RapidOCR for scanned pages
+        (None for a scanned page when allow_ocr is False).
+        """
+        pw = max(float(page.rect.width), 1.0)
+        ph = max(float(page.rect.height), 1.0)
+        words = []  # (text, x0, y0, x1, y1, line key) in page units
+
+        try:
+            for x0, y0, x1, y1, text, block_no, line_no, _ in page.get_text("words"):
+                words.append((text, x0, y0, x1, y1, (block_no, line_no)))
+        except Exception:
+            words = []
+
+        if len(words) < MIN_TEXT_LAYER_WORDS:
+            if not allow_ocr:
+                return None
+            words = cls._ocr_words(page)
+
+        tokens, boxes, lines = [], [], []
+        line_ids: dict = {}
+        for text, x0, y0, x1, y1, line_key in words:
+            box = [
+                max(0.0, min(1000.0, y0 / ph * 1000)),
+                max(0.0, min(1000.0, x0 / pw * 1000)),
+                max(0.0, min(1000.0, y1 / ph * 1000)),
+                max(0.0, min(1000.0, x1 / pw * 1000)),
+            ]
+            line_id = line_ids.setdefault(line_key, len(line_ids))
+            # "2,0%" normalizes to two tokens; both share the word's box.
+            for token in _norm_for_match(text).split():
+                tokens.append(token)
+                boxes.append(box)
+                lines.append(line_id)
+        return cls(tokens, boxes, lines)
+
+    @staticmethod
+    def _ocr_words(page) -> list:
+        """Word boxes for a scanned page, estimated from RapidOCR line boxes."""
+        from .services import ocr_engine
+
+        try:
+            pix = page.get_pixmap(matrix=fitz.Matrix(OCR_WORDS_SCALE, OCR_WORDS_SCALE), alpha=False)
+            result = ocr_engine(pix.tobytes("png"))
+            if result and isinstance(result, tuple):
+                result = result[0]
+        except Exception as e:
+            logger.debug(f"OCR word extraction failed: {e}")
+            return []
+
+        words = []
+        for line_no, res in enumerate(result or []):
+            try:
+                box, text = res[0], res[1]
+                xs = [p[0] / OCR_WORDS_SCALE for p in box]
+                ys = [p[1] / OCR_WORDS_SCALE for p in box]
+            except Exception:
+                continue
+            parts = str(text or '').split()
+            total_chars = sum(len(p) for p in parts) + max(len(parts) - 1, 0)
+            if not parts or total_chars <= 0:
+                continue
+            # Spread words across the line box proportionally to their length.
+            x0, x1 = min(xs), max(xs)
+            y0, y1 = min(ys), max(ys)
+            char_w = (x1 - x0) / total_chars
+            cursor = x0
+            for part in parts:
+                wx1 = cursor + len(part) * char_w
+                words.append((part, cursor, y0, wx1, y1, ('ocr', line_no)))
+                cursor = wx1 + char_w
+        return words
+
+    # Candidate windows aligned in order, and how far an alignment may
+    # reach past the window for words the OCR inserted.
+    MAX_ALIGN_CANDIDATES = 8
+    ALIGN_SLACK_FRACTION = 0.25
+
+    def locate(self, quote: str, max_rects: int = 10, min_score: float = 0.5) -> list[list[float]]:
+        """
+        Find `quote` on the page; return one [ymin, xmin, ymax, xmax] per matched line.
+
+        One pass over the page tokens slides a window the length of the
+        quote and keeps a running multiset overlap with the quote tokens.
+        That overlap is only a filter: the best few windows are then aligned
+        with the quote in order (difflib.SequenceMatcher), so the same words
+        in a different order, as in tables and repeated boilerplate, do not
+        count as a match. OCR typos and dropped words only lower the score.
+        Returns [] if no alignment covers `min_score` of the quote.
+        """
+        quote_tokens = _norm_for_match(strip_markdown(quote or '')).split()
+        if not quote_tokens or not self.tokens:
+            return []
+
+        need: dict[str, int] = {}
+        for token in quote_tokens:
+            need[token] = need.get(token, 0) + 1
+
+        window = min(len(quote_tokens), len(self.tokens))
+        threshold = min_score * len(quote_tokens)
+        have: dict[str, int] = {}
+        matched = 0
+        scored = []  # (overlap, window start)
+
+        for i, token in enumerate(self.tokens):
+            have[token] = have.get(token, 0) + 1
+            if have[token] <= need.get(token, 0):
+                matched += 1
+            if i >= window:
+                old = self.tokens[i - window]
+                if have[old] <= need.get(old, 0):
+                    matched -= 1
+                have[old] -= 1
+            if i >= window - 1 and matched >= threshold:
+                scored.append((matched, i - window + 1))
+
+        # Overlap bounds the in-order score, so keep the highest-overlap
+        # windows, skipping starts that mostly cover a window already kept.
+        scored.sort(key=lambda item: (-item[0], item[1]))
+        candidates: list[int] = []
+        for _, start in scored:
+            if all(abs(start - kept) > window // 2 for kept in candidates):
+                candidates.append(start)
+                if len(candidates) >= self.MAX_ALIGN_CANDIDATES:
+                    break
+
+        slack = int(window * self.ALIGN_SLACK_FRACTION)
+        best_positions: list[int] = []
+        for start in sorted(candidates):
+            lo = max(0, start - slack)
+            hi = min(len(self.tokens), start + window + slack)
+            matcher = difflib.SequenceMatcher(None, quote_tokens, self.tokens[lo:hi], autojunk=False)
+            positions = [
+                lo + block.b + k
+                for block in matcher.get_matching_blocks()
+                for k in range(block.size)
+            ]
+            if len(positions) > len(best_positions):
+                best_positions = positions
+
+        if len(best_positions) < threshold:
+            return []
+
+        # Union the aligned words, line by line.
+        line_rects: dict[int, list[float]] = {}
+        for j in best_positions:
+            box = self.boxes[j]
+            rect = line_rects.get(self.lines[j])
+            if rect is None:
+                line_rects[self.lines[j]] = list(box)
+            else:
+                rect[0] = min(rect[0], box[0])
+                rect[1] = min(rect[1], box[1])
+                rect[2] = max(rect[2], box[2])
+                rect[3] = max(rect[3], box[3])
+
+        return list(line_rects.values())[:max_rects]
+
+
+class _NeedsOcr(Exception):
+    """Scanned page whose word index was requested without OCR."""
+
+
+def page_word_index(pdf_path: str, page_number: int, doc=None, allow_ocr: bool = True) -> PageWordIndex | None:
+    """
+    Word index for a page, cached as JSON next to the page's renders.
+    page_number is 1-based; raises IndexError when out of range. With
+    allow_ocr=False a scanned page that is not cached yet returns None
+    instead of running RapidOCR.
+    """
+    def _produce() -> bytes:
+        target = doc if doc is not None else fitz.open(pdf_path)
+        try:
+            if page_number < 1 or page_number > len(target):
+                raise IndexError(f"Page {page_number} out of range (1-{len(target)})")
+            index = PageWordIndex.from_page(target.load_page(page_number - 1), allow_ocr=allow_ocr)
+            if index is None:
+                raise _NeedsOcr(page_number)
+            return index.to_json()
+        finally:
+            if target is not doc:
+                target.close()
+
+    try:
+        path = _cached_render(pdf_path, f"page_{page_number}_words.json", _produce)
+    except _NeedsOcr:
+        return None
+    with open(path, 'rb') as f:
+        return PageWordIndex.from_json(f.read())
+
+
+def resolve_render_target(document, raw_page_num: int) -> tuple[str, int]:
+    """
+    Map a RAW (original) page number to (pdf_path, 1-based page) to render.
+
+    Uses the optimized PDF when the page was kept in it, otherwise the original.
+    """
+    data = document.extracted_data or {}
+    page_map = data.get('_optimized_page_map') if isinstance(data, dict) else None
+
+    if document.optimized_file and isinstance(page_map, list):
+        try:
+            idx = page_map.index(raw_page_num)
+            return document.optimized_file.path, idx + 1  # Convert 0-based index to 1-based page
+        except ValueError:
+            pass
+
+    return document.file.path, raw_page_num
+
+
+def locate_citations(document, citations: list[dict], allow_ocr: bool = True) -> list[dict]:
+    """
+    Resolve many {page, quote} pairs (RAW page numbers) to highlight boxes.
+
+    Each PDF is opened once and each page's word index built once, however
+    many quotes point at it. Returns one dict per input, in order:
+    {render_page_number, version, width, height, matched_bboxes}, or
+    {error} for pages that can't be resolved. With allow_ocr=False, scanned
+    pages without a cached word index get {error} instead of an OCR pass.
+    """
+    targets = []
+    for cit in citations:
+        try:
+            raw_page = int(cit.get('page'))
+        except (TypeError, ValueError):
+            targets.append(None)
+            continue
+        targets.append((raw_page,) + resolve_render_target(document, raw_page))
+
+    results: list[dict | None] = [None] * len(citations)
+    by_pdf: dict[str, list[int]] = {}
+    for i, target in enumerate(targets):
+        if target is None:
+            results[i] = {'error': 'Invalid page number'}
+        else:
+            by_pdf.setdefault(target[1], []).append(i)
+
+    for pdf_path, indices in by_pdf.items():
+        try:
+            doc = fitz.open(pdf_path)
+        except Exception as e:
+            logger.warning(f"Could not open {pdf_path} for citations: {e}")
+            for i in indices:
+                results[i] = {'error': 'File not found'}
+            continue
+
+        try:
+            version = page_cache_key(pdf_path)
+            indexes: dict[int, PageWordIndex | None] = {}
+            for i in indices:
+                _, _, page_number = targets[i]
+                if page_number < 1 or page_number > len(doc):
+                    results[i] = {'error': 'Page number out of range'}
+                    continue
+                if page_number not in indexes:
+                    indexes[page_number] = page_word_index(pdf_path, page_number, doc=doc, allow_ocr=allow_ocr)
+                if indexes[page_number] is None:
+                    results[i] = {'error': 'Page needs OCR'}
+                    continue
+                width, height = page_dimensions(doc.load_page(page_number - 1))
+                quote = citations[i].get('quote') or ''
+                results[i] = {
+                    'render_page_number': page_number,
+                    'version': version,
+                    'width': width,
+                    'height': height,
+                    'matched_bboxes': indexes[page_number].locate(quote) if quote else [],
+                }
+        except Exception as e:
+            logger.error(f"Citation lookup failed for {pdf_path}: {e}")
+            for i in indices:
+                if results[i] is None:
+                    results[i] = {'error': str(e)}
+        finally:
+            doc.close()
+
+    return results
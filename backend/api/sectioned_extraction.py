@@ -0,0 +1,182 @@
+"""
+Map-reduce ("sectioned") structured extraction for long prospectuses.
+
+Instead of one request carrying the whole optimized PDF and the full
+schema, the pages create_optimized_pdf kept are grouped by the keyword
+category that selected them (identity, fees, tables). Each section is
+extracted concurrently with the subset of top-level keys it is responsible
+for, and the partial JSONs are merged in a fixed section order, so the
+result does not depend on which request finished first. A failed section
+only loses its own keys.
+
+The identity section is submitted first and reported through `on_section`
+as soon as it finishes, so callers can persist fund name/code early.
+"""
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+SECTIONED_EXTRACTION = os.getenv('SECTIONED_EXTRACTION', 'false').strip().lower() in {'1', 'true', 'yes'}
+SECTION_CONCURRENCY = int(os.getenv('SECTION_CONCURRENCY', '3'))
+SECTION_MAX_ATTEMPTS = 2
+
+SECTION_ORDER = ('identity', 'fees', 'tables')
+
+# Top-level keys of the extraction schema, by the section that extracts them
+SECTION_KEYS = {
+    'identity': (
+        'fund_name', 'fund_code', 'fund_type', 'legal_structure', 'license_number', 'regulator',
+        'management_company', 'custodian_bank', 'fund_supervisor', 'auditor', 'inception_date',
+        'investment_objective', 'investment_strategy', 'investment_style', 'sector_focus', 'benchmark',
+        'investment_restrictions', 'borrowing_limit', 'leverage_limit', 'risk_factors',
+        'operational_details', 'valuation', 'investor_rights', 'distribution_agent', 'sales_channels',
+        'risk_profile',
+    ),
+    'fees': ('fees', 'minimum_investment'),
+    'tables': ('portfolio', 'asset_allocation', 'nav_history', 'dividend_history', 'performance'),
+}
+
+# Cover/general-information pages always belong to the identity section
+IDENTITY_LEADING_PAGES = 4
+
+
+def section_prompt_note(keys: list[str]) -> str:
+    """Appended to an extraction prompt when it covers one section only."""
+    return (
+        "\n\n### THIS REQUEST COVERS ONE SECTION OF THE DOCUMENT ###\n"
+        "You are given only some pages of the prospectus. Return a JSON object with ONLY these "
+        f"top-level keys: {', '.join(keys)}. Omit every other key. "
+        "Page numbers refer to the pages you were given (the first one is page 1)."
+    )
+
+
+def section_pages(page_count: int, categories: dict[int, set[str]]) -> dict[str, list[int]]:
+    """
+    0-based pages of each section. Pages without a category go to identity;
+    a section whose category matched no page gets every page.
+    """
+    sections = {name: set() for name in SECTION_ORDER}
+    for page in range(page_count):
+        matched = categories.get(page) or set()
+        if page < IDENTITY_LEADING_PAGES or not matched:
+            sections['identity'].add(page)
+        for name in matched & set(SECTION_ORDER):
+            sections[name].add(page)
+    return {
+        name: sorted(pages) if pages else list(range(page_count))
+        for name, pages in sections.items()
+    }
+
+
+def remap_pages(obj, page_map: list[int]):
+    """
+    In place: replace 1-based `page` values of located fields ({page, bbox})
+    by page_map[page - 1]. Out-of-range pages are left alone.
+    """
+    if isinstance(obj, dict):
+        if 'page' in obj and 'bbox' in obj:
+            page = obj['page']
+            if isinstance(page, int) and 1 <= page <= len(page_map):
+                obj['page'] = page_map[page - 1]
+        for value in obj.values():
+            remap_pages(value, page_map)
+    elif isinstance(obj, list):
+        for item in obj:
+            remap_pages(item, page_map)
+    return obj
+
+
+def _is_empty(value) -> bool:
+    if isinstance(value, dict) and 'value' in value:
+        return value.get('value') in (None, '')
+    return value in (None, '', [], {})
+
+
+def _merge_value(current, incoming):
+    if isinstance(current, dict) and isinstance(incoming, dict) and 'value' not in current:
+        merged = dict(current)
+        for key, value in incoming.items():
+            merged[key] = _merge_value(merged[key], value) if key in merged else value
+        return merged
+    return incoming if _is_empty(current) and not _is_empty(incoming) else current
+
+
+def merge_sections(partials: dict[str, dict]) -> dict:
+    """
+    Merge section results deterministically: sections in SECTION_ORDER, a
+    section's own keys first, then keys it returned anyway fill gaps only.
+    """
+    merged: dict = {}
+    for own_keys_pass in (True, False):
+        for name in SECTION_ORDER:
+            partial = partials.get(name)
+            if not isinstance(partial, dict):
+                continue
+            for key, value in partial.items():
+                if (key in SECTION_KEYS[name]) != own_keys_pass:
+                    continue
+                merged[key] = _merge_value(merged[key], value) if key in merged else value
+    return merged
+
+
+def extract_sectioned(
+    page_count: int,
+    categories: dict[int, set[str]],
+    extract_section: Callable[[list[int], list[str]], dict],
+    on_section: Callable[[str, dict], None] | None = None,
+    concurrency: int = SECTION_CONCURRENCY,
+) -> dict:
+    """
+    Run `extract_section(pages, keys)` for every section and merge the results.
+
+    `pages` are 0-based pages of the document the categories describe; the
+    returned JSON numbers pages within the section (1 = pages[0]) and is
+    remapped here to 1-based document pages. Raises only when every
+    section failed.
+    """
+    pages_by_section = section_pages(page_count, categories)
+    logger.info(
+        "Sectioned extraction: " + ", ".join(f"{name}={len(pages_by_section[name])}p" for name in SECTION_ORDER)
+    )
+
+    def run(name):
+        pages = pages_by_section[name]
+        last_error = None
+        for attempt in range(1, SECTION_MAX_ATTEMPTS + 1):
+            try:
+                partial = extract_section(pages, list(SECTION_KEYS[name]))
+                if not isinstance(partial, dict) or set(partial) == {'error', 'raw_text'}:
+                    raise ValueError(f"section returned no JSON object: {str(partial)[:200]}")
+                return remap_pages(partial, [p + 1 for p in pages])
+            except Exception as e:
+                last_error = e
+                logger.warning(f"Section '{name}' extraction failed (attempt {attempt}/{SECTION_MAX_ATTEMPTS}): {e}")
+        raise last_error
+
+    partials: dict[str, dict] = {}
+    errors: dict[str, Exception] = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(SECTION_ORDER)))) as pool:
+        # Submission order = SECTION_ORDER, so identity starts first
+        futures = {pool.submit(run, name): name for name in SECTION_ORDER}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                partials[name] = future.result()
+            except Exception as e:
+                errors[name] = e
+                continue
+            if on_section:
+                try:
+                    on_section(name, partials[name])
+                except Exception as e:
+                    logger.warning(f"on_section callback failed for '{name}': {e}")
+
+    if not partials:
+        first = errors[SECTION_ORDER[0]]
+        raise RuntimeError(f"Sectioned extraction failed for every section: {first}") from first
+    if errors:
+        logger.warning(f"Sectioned extraction: sections without data: {sorted(errors)}")
+    return merge_sections(partials)
@@ -1,5 +1,37 @@
 from rest_framework import serializers
 from .models import Document, ExtractedFundData, DocumentChangeLog
+from .provenance import strip_provenance
+
+
+def _csv_param(request, name) -> list[str]:
+    if request is None:
+        return []
+    raw = request.query_params.get(name, '')
+    return [part.strip() for part in raw.split(',') if part.strip()]
+
+
+def selected_fields(request, available) -> list[str]:
+    """Fields left after applying ?fields=a,b and ?exclude=c to `available`."""
+    only = set(_csv_param(request, 'fields'))
+    exclude = set(_csv_param(request, 'exclude'))
+    return [name for name in available if (not only or name in only) and name not in exclude]
+
+
+class SparseFieldsetMixin:
+    """
+    Honour ?fields= / ?exclude= on read-only use of a serializer.
+    Serializers built with `data=` (writes) always keep every field.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if 'data' in kwargs:
+            return
+        request = self.context.get('request')
+        keep = set(selected_fields(request, list(self.fields)))
+        for name in list(self.fields):
+            if name not in keep:
+                self.fields.pop(name)
 
 
 class ExtractedFundDataSerializer(serializers.ModelSerializer):
@@ -33,8 +65,8 @@ class DocumentChangeLogSerializer(serializers.ModelSerializer):
     
     class Meta:
         model = DocumentChangeLog
-        fields = ['id', 'document', 'changed_at', 'user_comment', 'changes']
-        read_only_fields = ['id', 'document', 'changed_at']
+        fields = ['id', 'document', 'changed_at', 'user_comment', 'changes', 'version']
+        read_only_fields = ['id', 'document', 'changed_at', 'version']
 
 
 class ChatRequestSerializer(serializers.Serializer):
@@ -43,6 +75,13 @@ class ChatRequestSerializer(serializers.Serializer):
     history = serializers.ListField(required=False, default=list, allow_empty=True)
 
 
+class ChatBatchRequestSerializer(serializers.Serializer):
+    """Serializer for batch RAG question answering (no history)"""
+    questions = serializers.ListField(
+        child=serializers.CharField(max_length=1000), allow_empty=False, max_length=50
+    )
+
+
 class ChatResponseSerializer(serializers.Serializer):
     """Serializer for RAG chat responses"""
     answer = serializers.CharField()
@@ -56,8 +95,24 @@ class ChatHistorySerializer(serializers.Serializer):
     history = serializers.ListField(required=True, allow_empty=True)
 
 
-class DocumentSerializer(serializers.ModelSerializer):
-    """Serializer for document metadata and extracted data"""
+class CitationQuerySerializer(serializers.Serializer):
+    """One (page, quote) pair to resolve to highlight boxes"""
+    page = serializers.IntegerField(min_value=1)
+    quote = serializers.CharField(required=False, allow_blank=True, default='', max_length=5000)
+
+
+class CitationContextRequestSerializer(serializers.Serializer):
+    """Serializer for batch citation resolution requests"""
+    citations = CitationQuerySerializer(many=True, allow_empty=False, max_length=50)
+
+
+class DocumentSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
+    """
+    Serializer for document metadata and extracted data.
+
+    extracted_data is returned without bounding boxes unless the request
+    has ?provenance=inline; use /documents/{id}/provenance/ for the boxes.
+    """
     fund_data = ExtractedFundDataSerializer(read_only=True)
     file_url = serializers.SerializerMethodField()
     optimized_file_url = serializers.SerializerMethodField()
@@ -104,6 +159,14 @@ class DocumentSerializer(serializers.ModelSerializer):
             'rag_completed_at',
         ]
     
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        request = self.context.get('request')
+        inline = request is not None and request.query_params.get('provenance') == 'inline'
+        if 'extracted_data' in data and not inline:
+            data['extracted_data'] = strip_provenance(data['extracted_data'])
+        return data
+
     def get_file_url(self, obj):
         """Get the full URL for the uploaded file"""
         request = self.context.get('request')
@@ -166,26 +229,20 @@ class DocumentUploadSerializer(serializers.ModelSerializer):
 
 
 class DocumentListSerializer(serializers.ModelSerializer):
-    """Lightweight serializer for document list view"""
-    fund_name = serializers.SerializerMethodField()
-    fund_code = serializers.SerializerMethodField()
+    """
+    Lightweight serializer for document list view.
+
+    fund_name/fund_code are annotated onto the queryset by the list view
+    (fund_data columns, falling back to the extracted_data keys), so no row
+    touches the fund_data relation or loads the extracted_data blob.
+    """
+    fund_name = serializers.CharField(read_only=True, allow_null=True)
+    fund_code = serializers.CharField(read_only=True, allow_null=True)
     
     class Meta:
         model = Document
         fields = ['id', 'file_name', 'uploaded_at', 'status', 'rag_status', 'rag_progress', 'fund_name', 'fund_code', 'edit_count', 'last_edited_at']
         read_only_fields = ['id', 'file_name', 'uploaded_at', 'status', 'rag_status', 'rag_progress', 'edit_count', 'last_edited_at']
-    
-    def get_fund_name(self, obj):
-        """Get fund name from related fund_data or extracted_data"""
-        if hasattr(obj, 'fund_data') and obj.fund_data:
-            return obj.fund_data.fund_name
-        return obj.extracted_data.get('fund_name') if obj.extracted_data else None
-    
-    def get_fund_code(self, obj):
-        """Get fund code from related fund_data or extracted_data"""
-        if hasattr(obj, 'fund_data') and obj.fund_data:
-            return obj.fund_data.fund_code
-        return obj.extracted_data.get('fund_code') if obj.extracted_data else None
 
 
 class MessageSerializer(serializers.Serializer):
@@ -1,6 +1,8 @@
 """
 Service layer for OCR using Gemini 2.0 Flash
 """
+import asyncio
+import copy
 import os
 import json
 import logging
@@ -17,12 +19,22 @@ import tempfile
 import fitz  # PyMuPDF
 from rapidocr_onnxruntime import RapidOCR
 from .models import Document, ExtractedFundData, DocumentChunk
+from .progress import bus as progress_bus
+from .text_cleaning import clean_text_for_rag
+from .dedup import collapse_chunks
+from . import async_providers, extraction_cache, gemini_uploads, job_lock, provider_limits
+from .ocr_broker import broker as ocr_broker, file_sha256
+from .ocr_sharding import ocr_in_shards, shard_bytes
+from .sectioned_extraction import (
+    SECTION_KEYS, SECTIONED_EXTRACTION, extract_sectioned, remap_pages, section_prompt_note,
+)
+from .page_routing import OCR_PAGE_ROUTING, routed_markdown, split_page_markdown
 from django.db.models import F
 from django.db import close_old_connections
+from asgiref.sync import async_to_sync, sync_to_async
 from pgvector.django import CosineDistance
 from langchain_text_splitters import MarkdownHeaderTextSplitter, RecursiveCharacterTextSplitter
 import PIL.Image
-import PIL.ImageDraw
 from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
 from django.db.models import F
 from unidecode import unidecode
@@ -35,6 +47,9 @@ except Exception:  # pragma: no cover
 
 logger = logging.getLogger(__name__)
 
+# Queries per embeddings request in RAGService.chat_batch() (ingestion embeds 50 chunks per request)
+QUERY_EMBED_BATCH_SIZE = 50
+
 
 def _lazy_import_genai():
     """Lazy import google.genai (new SDK) to avoid top-level import overhead."""
@@ -102,13 +117,16 @@ except Exception as e:
     logger.warning(f"Could not initialize RapidOCR with GPU, falling back to CPU: {e}")
     ocr_engine = RapidOCR(lang_list=['en', 'vi'], gpu_id=-1)
 
-def create_optimized_pdf(original_pdf_path: str) -> str:
+def create_optimized_pdf(original_pdf_path: str, page_categories: dict | None = None) -> str:
     """
     Hỗ trợ cả PDF dạng Text và PDF dạng Scanned Image.
     Sử dụng RapidOCR để 'đọc lướt' tìm keyword trên các trang ảnh.
     
     Args:
         original_pdf_path: Path to the original PDF file
+        page_categories: Optional dict filled with {original 0-based page:
+            set of keyword categories ("identity", "fees", "tables")} for
+            the scanned pages that matched (used by sectioned extraction)
         
     Returns:
         Tuple of (path, page_map) where page_map is a list of original
@@ -244,19 +262,22 @@ def create_optimized_pdf(original_pdf_path: str) -> str:
             # Normalize text for comparison (handles OCR without diacritics)
             normalized_text = normalize_text_for_matching(text)
             
-            is_relevant = False
-            for category, normalized_keys in normalized_keywords.items():
+            matched = [
+                category for category, normalized_keys in normalized_keywords.items()
                 # Avoid selecting tons of pages just because identity keywords appear in headers.
-                if category == "identity" and page_num > max_identity_page:
-                    continue
-
-                if any(k in normalized_text for k in normalized_keys):
-                    is_relevant = True
-                    logger.debug(f"Page {page_num}: Matched category '{category}'")
-                    # Logic lấy thêm trang sau nếu là bảng biểu
-                    if category == "tables" and page_num + 1 < total_pages:
-                        selected_pages.add(page_num + 1)
-                    break
+                if not (category == "identity" and page_num > max_identity_page)
+                and any(k in normalized_text for k in normalized_keys)
+            ]
+            is_relevant = bool(matched)
+            if matched:
+                logger.debug(f"Page {page_num}: Matched categories {matched}")
+                if page_categories is not None:
+                    page_categories.setdefault(page_num, set()).update(matched)
+                # Logic lấy thêm trang sau nếu là bảng biểu
+                if matched[0] == "tables" and page_num + 1 < total_pages:
+                    selected_pages.add(page_num + 1)
+                    if page_categories is not None:
+                        page_categories.setdefault(page_num + 1, set()).add("tables")
             
             if is_relevant:
                 selected_pages.add(page_num)
@@ -276,19 +297,31 @@ def create_optimized_pdf(original_pdf_path: str) -> str:
         page_map = [p + 1 for p in sorted_pages]  # convert 0-based to 1-based
 
         # Tạo file PDF mới
-        doc.select(sorted_pages)
-        fd, temp_path = tempfile.mkstemp(suffix=".pdf")
-        os.close(fd)
-        # Save with cleanup/compression to reduce size (important for scanned PDFs)
-        doc.save(temp_path, garbage=4, deflate=True)
-        doc.close()
-        
-        return temp_path, page_map
+        return _save_page_subset(doc, sorted_pages), page_map
 
     except Exception as e:
         logger.error(f"Error optimizing PDF: {str(e)}")
         return original_pdf_path, None
 
+
+def _save_page_subset(doc, pages: list[int]) -> str:
+    """Write the given 0-based pages of `doc` to a temp PDF and close `doc`."""
+    doc.select(pages)
+    fd, temp_path = tempfile.mkstemp(suffix=".pdf")
+    os.close(fd)
+    # Save with cleanup/compression to reduce size (important for scanned PDFs)
+    doc.save(temp_path, garbage=4, deflate=True)
+    doc.close()
+    return temp_path
+
+
+def optimized_pdf_from_page_map(original_pdf_path: str, page_map: list[int]) -> str:
+    """
+    Rebuild the optimized PDF from a known page map (1-based original
+    pages), without scanning or OCRing the document again.
+    """
+    return _save_page_subset(fitz.open(original_pdf_path), [p - 1 for p in page_map])
+
 class GeminiOCRService:
     """Service for OCR using Gemini 2.5 Flash Lite API"""
     
@@ -303,32 +336,27 @@ class GeminiOCRService:
         self._genai = genai  # Keep reference for types access
         self._model_name = 'gemini-2.5-flash-lite'
     
-    def extract_structured_data(self, pdf_path: str) -> dict:
+    def extraction_fingerprint(self) -> tuple[str, str]:
+        """(model name, prompt/schema hash) identifying this extraction for the cache."""
+        return self._model_name, extraction_cache.prompt_hash(self._get_extraction_prompt())
+
+    def prefetch_upload(self, pdf_path: str):
+        """Start uploading `pdf_path` in the background (see gemini_uploads)."""
+        return gemini_uploads.prefetch(self._client, self._genai.types, pdf_path)
+
+    def extract_structured_data(self, pdf_path: str, keys: list[str] | None = None) -> dict:
         """
         Extract financial data from PDF using Gemini 2.5 Flash Lite OCR.
-        Always uploads the PDF directly to Gemini (no image conversion).
+        Always uploads the PDF directly to Gemini (no image conversion);
+        an upload of the same content that is cached or in flight is reused.
+        `keys` limits the schema to those top-level fields.
         Returns a dictionary of extracted data.
         """
         try:
-            file_size = os.path.getsize(pdf_path)
-            logger.info(f"Uploading PDF to Gemini: {pdf_path} (Size: {file_size} bytes)")
-            
-            uploaded_file = self._client.files.upload(
-                file=pdf_path,
-                config=self._genai.types.UploadFileConfig(mime_type="application/pdf"),
-            )
-            logger.info(f"Uploaded file URI: {uploaded_file.uri}")
-
-            # Wait for processing to finish before generating content
-            import time
-            while uploaded_file.state.name == "PROCESSING":
-                time.sleep(2)
-                uploaded_file = self._client.files.get(name=uploaded_file.name)
+            uploaded_file = gemini_uploads.get_active_file(self._client, self._genai.types, pdf_path)
+            logger.info(f"Using Gemini file URI: {uploaded_file.uri}")
 
-            if uploaded_file.state.name == "FAILED":
-                raise ValueError("File processing failed on Gemini API")
-
-            prompt = self._get_extraction_prompt()
+            prompt = self._get_extraction_prompt(keys)
 
             try:
                 # Use temperature=0 and top_p=0 for maximum deterministic, consistent results
@@ -338,22 +366,21 @@ class GeminiOCRService:
                     top_k=1,
                     response_mime_type="application/json",
                 )
-                response = self._client.models.generate_content(
+                response = provider_limits.call('gemini', 'generate', lambda: self._client.models.generate_content(
                     model=self._model_name,
                     contents=[uploaded_file, prompt],
                     config=generation_config,
-                )
+                ))
             except Exception as gen_error:
                 logger.error(f"Gemini generate_content failed: {gen_error}")
-                # If it's a 400 error, it might be due to the optimized PDF being weird.
-                # But we can't easily retry with original here without passing it in.
+                # If it's a 400 error, it might be due to the optimized PDF being weird;
+                # the caller retries with the original (usually prefetched by then).
+                # Don't reuse this upload in case Gemini no longer has it.
+                gemini_uploads.forget(pdf_path)
                 raise gen_error
 
-            # Cleanup uploaded file
-            try:
-                self._client.files.delete(name=uploaded_file.name)
-            except Exception as cleanup_error:
-                logger.warning(f"Failed to cleanup uploaded file: {cleanup_error}")
+            # The upload is kept for reuse (re-processing the same PDF);
+            # Gemini deletes it after 48 hours.
 
             json_text = self._clean_response(response.text)
             try:
@@ -366,6 +393,21 @@ class GeminiOCRService:
         except Exception as e:
             logger.error(f"Error extracting text from PDF: {str(e)}")
             raise
+
+    def extract_section(self, pdf_path: str, pages: list[int], keys: list[str]) -> dict:
+        """
+        Sectioned extraction: upload only `pages` (0-based) of `pdf_path` and
+        extract `keys`. Page numbers in the result are 1-based within the section.
+        """
+        with fitz.open(pdf_path) as src:
+            content = shard_bytes(src, pages)
+        fd, section_path = tempfile.mkstemp(suffix=".pdf")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            return self.extract_structured_data(section_path, keys)
+        finally:
+            os.remove(section_path)
     
     def _get_extraction_schema(self) -> dict:
         """Define the expected JSON schema with Bounding Boxes"""
@@ -586,13 +628,20 @@ class GeminiOCRService:
             "required": ["fund_name", "fund_code"]
         }
     
-    def _get_extraction_prompt(self) -> str:
+    def _get_extraction_prompt(self, keys: list[str] | None = None) -> str:
         """
-        Generate detailed extraction prompt with schema for GeminiOCRService
+        Generate detailed extraction prompt with schema for GeminiOCRService.
+        With `keys`, the schema is limited to those top-level fields.
         """
         schema = self._get_extraction_schema()
+        if keys:
+            schema = {
+                **schema,
+                'properties': {k: v for k, v in schema['properties'].items() if k in keys},
+                'required': [k for k in schema.get('required', []) if k in keys],
+            }
         
-        return f"""You are an expert financial document analyst specializing in Vietnamese investment fund prospectuses.
+        prompt = f"""You are an expert financial document analyst specializing in Vietnamese investment fund prospectuses.
 
 
 Extract ALL relevant financial information from this prospectus document and structure it according to the following JSON schema:
@@ -827,6 +876,9 @@ Always extract the same data from the same document. Do not vary your responses.
 Return ONLY valid JSON matching the schema above. Do not include any explanatory text before or after the JSON.
 
 Now extract the data from the provided document."""
+        if keys:
+            prompt += section_prompt_note(keys)
+        return prompt
 
     def _clean_response(self, text: str) -> str:
         """Clean markdown formatting from response"""
@@ -840,286 +892,90 @@ Now extract the data from the provided document."""
     
     def generate_annotated_image(self, pdf_path: str, page_number: int, bboxes: list) -> str:
         """
-        Render a page to an image and burn in highlights.
+        Render a page with highlights burned in and return the cached PNG path.
 
-        IMPORTANT: We draw in *pixel space* on top of the rendered pixmap.
-        This keeps Gemini's 0-1000 "visual" coordinates aligned with what the
-        user sees, and avoids PDF user-space quirks (rotation / cropbox offsets).
-        
-        BBOX FORMAT: Gemini returns [ymin, xmin, ymax, xmax] on 0-1000 scale.
-        However, models sometimes return inconsistent formats. We try to detect
-        and correct common issues.
+        Kept for backwards compatibility; the work is done by
+        rendering.AnnotationRenderer, which needs no Gemini client.
         """
-        try:
-            doc = fitz.open(pdf_path)
-            try:
-                page_idx = page_number - 1
-                if page_idx < 0 or page_idx >= len(doc):
-                    return None
-
-                page = doc[page_idx]
-
-                # Render: keep this consistent with what the frontend shows.
-                # Using a 2x scale (~144 DPI for A4) gives crisp previews.
-                pix = page.get_pixmap(matrix=fitz.Matrix(2, 2), alpha=False)
-
-                base = PIL.Image.frombytes("RGB", (pix.width, pix.height), pix.samples).convert("RGBA")
-                overlay = PIL.Image.new("RGBA", base.size, (0, 0, 0, 0))
-                draw = PIL.ImageDraw.Draw(overlay)
-
-                w, h = base.size
-                border_px = max(2, int(round(min(w, h) * 0.002)))
-
-                # Optional: OCR-snap highlights to the exact rendered text positions.
-                # This helps when Gemini's 0-1000 coordinates are systematically biased.
-                ocr_results = None
-                wants_ocr_snap = any(
-                    isinstance(it, dict) and str(it.get("value") or "").strip()
-                    for it in (bboxes or [])
-                )
-                if wants_ocr_snap:
-                    try:
-                        img_bytes = pix.tobytes("png")
-                        result = ocr_engine(img_bytes)
-                        if result and isinstance(result, tuple):
-                            result = result[0]
-                        ocr_results = result or []
-                    except Exception as ocr_error:
-                        logger.debug(f"OCR snap failed for preview page {page_number}: {ocr_error}")
-                        ocr_results = None
-
-                def _norm_for_match(s: str) -> str:
-                    s = str(s or "")
-                    # keep alnum + spaces so we can do token-ish matching
-                    s = unicodedata.normalize('NFD', s)
-                    s = ''.join(c for c in s if not unicodedata.combining(c))
-                    s = s.replace('đ', 'd').replace('Đ', 'D')
-                    s = s.lower()
-                    s = re.sub(r"[^a-z0-9\s]", " ", s)
-                    s = re.sub(r"\s+", " ", s).strip()
-                    return s
-
-                def _ocr_best_rect(target_value: str):
-                    """Find OCR boxes matching the target text and merge them.
-
-                    For long paragraphs the OCR engine returns many small boxes
-                    (one per line / word).  We collect ALL boxes whose tokens
-                    overlap significantly with the target, then return their
-                    *union* bounding rectangle so the entire paragraph is
-                    highlighted — not just a single fragment.
-                    """
-                    if not ocr_results:
-                        return None
-                    tv = _norm_for_match(target_value)
-                    if not tv or len(tv) < 3:
-                        return None
-
-                    tv_tokens = set(tv.split())
-                    if not tv_tokens:
-                        return None
-
-                    # Collect every OCR box that shares tokens with the target
-                    matching_boxes = []  # list of (x0, y0, x1, y1)
-
-                    for res in ocr_results:
-                        try:
-                            box, text, conf = res[0], res[1], res[2]
-                        except Exception:
-                            continue
-                        if not text:
-                            continue
-
-                        ct = _norm_for_match(text)
-                        if not ct:
-                            continue
-
-                        ct_tokens = set(ct.split())
-                        if not ct_tokens:
-                            continue
-
-                        # Score: what fraction of THIS OCR fragment's tokens
-                        # appear in the target value?
-                        frag_overlap = len(ct_tokens & tv_tokens) / len(ct_tokens)
-
-                        # Accept if ≥60 % of the fragment's tokens are in the target.
-                        # This is deliberately lenient per-fragment because individual
-                        # OCR lines are short (e.g. 5-10 words).
-                        if frag_overlap >= 0.6:
-                            xs = [p[0] for p in box]
-                            ys = [p[1] for p in box]
-                            matching_boxes.append((min(xs), min(ys), max(xs), max(ys)))
-
-                    if not matching_boxes:
-                        # Fallback: try exact / containment match for short values
-                        best = None
-                        best_score = 0.0
-                        for res in ocr_results:
-                            try:
-                                box, text, conf = res[0], res[1], res[2]
-                            except Exception:
-                                continue
-                            if not text:
-                                continue
-                            ct = _norm_for_match(text)
-                            if not ct:
-                                continue
-
-                            score = 0.0
-                            if tv == ct:
-                                score = 1.0
-                            elif tv in ct or ct in tv:
-                                score = 0.9
-                            if score > best_score:
-                                xs = [p[0] for p in box]
-                                ys = [p[1] for p in box]
-                                best = (min(xs), min(ys), max(xs), max(ys))
-                                best_score = score
-                        if best and best_score >= 0.7:
-                            return best
-                        return None
-
-                    # Check that enough of the TARGET tokens were found across
-                    # all collected fragments (guards against false positives).
-                    all_matched_tokens: set[str] = set()
-                    for res in ocr_results:
-                        try:
-                            box, text, conf = res[0], res[1], res[2]
-                        except Exception:
-                            continue
-                        if not text:
-                            continue
-                        ct = _norm_for_match(text)
-                        ct_tokens = set(ct.split())
-                        frag_overlap = len(ct_tokens & tv_tokens) / max(len(ct_tokens), 1)
-                        if frag_overlap >= 0.6:
-                            all_matched_tokens.update(ct_tokens & tv_tokens)
-
-                    target_coverage = len(all_matched_tokens) / len(tv_tokens)
-                    if target_coverage < 0.4:
-                        return None
-
-                    # Merge all matching boxes into a single union rectangle
-                    x0 = min(b[0] for b in matching_boxes)
-                    y0 = min(b[1] for b in matching_boxes)
-                    x1 = max(b[2] for b in matching_boxes)
-                    y1 = max(b[3] for b in matching_boxes)
-
-                    return (x0, y0, x1, y1)
-
-                def _normalize_bbox(bbox):
-                    """
-                    Normalize bbox coordinates handling potential format inconsistencies.
-                    Expected format: [ymin, xmin, ymax, xmax] on 0-1000 scale.
-                    
-                    Common issues:
-                    1. Model returns [xmin, ymin, xmax, ymax] instead
-                    2. Values exceed 1000 (pixel coords instead of normalized)
-                    3. Min/max swapped
-                    """
-                    if not bbox or len(bbox) != 4:
-                        return None
-                    
-                    v0, v1, v2, v3 = [int(x) for x in bbox]
-                    
-                    # Check if any value exceeds 1000 significantly (might be pixel coords)
-                    max_val = max(v0, v1, v2, v3)
-                    if max_val > 1000:
-                        # Try to normalize - assume it's based on a ~1000px dimension
-                        scale = 1000.0 / max(max_val, 1)
-                        v0 = int(v0 * scale)
-                        v1 = int(v1 * scale)
-                        v2 = int(v2 * scale)
-                        v3 = int(v3 * scale)
-                    
-                    # Clamp all values to 0-1000
-                    v0 = max(0, min(1000, v0))
-                    v1 = max(0, min(1000, v1))
-                    v2 = max(0, min(1000, v2))
-                    v3 = max(0, min(1000, v3))
-                    
-                    # Expected: [ymin, xmin, ymax, xmax]
-                    # Try to detect if format is [xmin, ymin, xmax, ymax] based on aspect ratio heuristics
-                    # For text: typically wider than tall, so (xmax-xmin) > (ymax-ymin)
-                    
-                    # Assume [ymin, xmin, ymax, xmax] format first
-                    ymin, xmin, ymax, xmax = v0, v1, v2, v3
-                    
-                    # Ensure min < max
-                    if ymin > ymax:
-                        ymin, ymax = ymax, ymin
-                    if xmin > xmax:
-                        xmin, xmax = xmax, xmin
-                    
-                    # Sanity check: box should have some area
-                    if xmax <= xmin or ymax <= ymin:
-                        return None
-                    
-                    return (ymin, xmin, ymax, xmax)
+        from .rendering import AnnotationRenderer
 
-                for item in bboxes or []:
-                    bbox = item.get('bbox') if isinstance(item, dict) else None
-                    if not bbox or len(bbox) != 4:
-                        continue
+        try:
+            return AnnotationRenderer().render_cached(pdf_path, page_number, bboxes)
+        except Exception as e:
+            logger.error(f"Failed to generate annotation: {e}")
+            return None
 
-                    normalized = _normalize_bbox(bbox)
-                    if not normalized:
-                        continue
-                    
-                    ymin, xmin, ymax, xmax = normalized
-
-                    # Convert normalized 0-1000 coords to pixel coords
-                    x0 = int(round((xmin / 1000.0) * w))
-                    x1 = int(round((xmax / 1000.0) * w))
-                    y0 = int(round((ymin / 1000.0) * h))
-                    y1 = int(round((ymax / 1000.0) * h))
-
-                    # Try OCR snap for more accurate positioning
-                    snapped = False
-                    if isinstance(item, dict):
-                        val = item.get("value")
-                        if val is not None and str(val).strip():
-                            ocr_rect = _ocr_best_rect(str(val))
-                            if ocr_rect:
-                                ox0, oy0, ox1, oy1 = [int(round(v)) for v in ocr_rect]
-                                # Only use OCR snap if it's reasonably close to original bbox
-                                # This prevents completely wrong snaps
-                                orig_center_x = (x0 + x1) / 2
-                                orig_center_y = (y0 + y1) / 2
-                                ocr_center_x = (ox0 + ox1) / 2
-                                ocr_center_y = (oy0 + oy1) / 2
-                                
-                                # Allow snap if OCR box center is within 30% of page dimension from original
-                                dist_x = abs(ocr_center_x - orig_center_x) / max(w, 1)
-                                dist_y = abs(ocr_center_y - orig_center_y) / max(h, 1)
-                                
-                                if dist_x < 0.3 and dist_y < 0.3:
-                                    x0, y0, x1, y1 = ox0, oy0, ox1, oy1
-                                    snapped = True
-                                    logger.debug(f"OCR snapped bbox for '{val[:30]}...' on page {page_number}")
-                    
-                    if not snapped:
-                        logger.debug(f"Using original bbox for page {page_number}: [{ymin}, {xmin}, {ymax}, {xmax}]")
+def mistral_ocr_pages(client, pdf_path: str, pages: list[int] | None = None) -> list[str]:
+    """
+    Markdown of every page of a PDF via Mistral OCR (index 0 = page 1), or
+    of the given 0-based `pages` only, in sorted order.
+    Large PDFs are OCRed as concurrent page-range shards; see ocr_sharding.
+    Pages already OCRed (or being OCRed) by another caller are shared
+    through ocr_broker instead of being sent again.
+    """
+    def ocr_shard_once(content: bytes, file_name: str) -> list[str]:
+        uploaded_file = client.files.upload(
+            file={
+                "file_name": file_name,
+                "content": content,
+            },
+            purpose="ocr"
+        )
+        signed_url = client.files.get_signed_url(file_id=uploaded_file.id)
+        ocr_response = client.ocr.process(
+            model="mistral-ocr-latest",
+            document={
+                "type": "document_url",
+                "document_url": signed_url.url,
+            },
+            include_image_base64=False
+        )
+        return [page.markdown for page in ocr_response.pages]
 
-                    # Semi-transparent yellow fill + stronger border.
-                    draw.rectangle([x0, y0, x1, y1], fill=(255, 255, 0, 80))
-                    draw.rectangle([x0, y0, x1, y1], outline=(255, 200, 0, 255), width=border_px)
+    def ocr_shard(content: bytes, file_name: str) -> list[str]:
+        # Paced and circuit-broken with other Mistral OCR calls; failed
+        # shards are retried by ocr_in_shards, not here
+        return provider_limits.call('mistral', 'ocr', lambda: ocr_shard_once(content, file_name), max_attempts=1)
 
-                out = PIL.Image.alpha_composite(base, overlay).convert("RGB")
+    if pages is None:
+        with fitz.open(pdf_path) as doc:
+            pages = list(range(doc.page_count))
+    return ocr_broker.ocr_pages(
+        pdf_path, pages, lambda missing: ocr_in_shards(pdf_path, ocr_shard, pages=missing)
+    )
 
-                pdf_name = os.path.splitext(os.path.basename(pdf_path))[0]
-                safe_pdf_name = re.sub(r"[^a-zA-Z0-9_-]", "_", pdf_name)[:80] or "document"
-                output_filename = f"annotated_{safe_pdf_name}_page_{page_number}.png"
-                output_path = os.path.join(settings.MEDIA_ROOT, 'temp', output_filename)
-                os.makedirs(os.path.dirname(output_path), exist_ok=True)
 
-                out.save(output_path, format="PNG")
-                return output_path
-            finally:
-                doc.close()
+def mistral_extract_section(client, model: str, system_prompt: str, prompt: str,
+                            pdf_path: str, pages: list[int], keys: list[str]) -> dict:
+    """
+    Sectioned extraction with Mistral: OCR `pages` (0-based; shared with
+    other callers through ocr_broker) and ask `model` for `keys` only.
+    Pages are numbered 1..n within the section.
+    """
+    markdown_pages = mistral_ocr_pages(client, pdf_path, pages)
+    full_markdown = ""
+    for i, page_markdown in enumerate(markdown_pages):
+        full_markdown += f"\n\n--- PAGE {i+1} ---\n{page_markdown}"
+
+    chat_response = provider_limits.call('mistral', 'chat', lambda: client.chat.complete(
+        model=model,
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {
+                "role": "user",
+                "content": f"{prompt}{section_prompt_note(keys)}\n\n--- DOCUMENT CONTENT (Markdown from OCR) ---\n{full_markdown}"
+            }
+        ],
+        response_format={"type": "json_object"},
+        temperature=0
+    ))
+    response_content = chat_response.choices[0].message.content
+    try:
+        return json.loads(response_content)
+    except json.JSONDecodeError:
+        logger.error(f"Failed to parse section JSON: {response_content[:200]}...")
+        return {"error": "Failed to parse JSON", "raw_text": response_content}
 
-        except Exception as e:
-            logger.error(f"Failed to generate annotation: {e}")
-            return None
 
 class MistralOCRSmallService:
     """
@@ -1136,46 +992,31 @@ class MistralOCRSmallService:
         # We use the specific OCR endpoint, not a chat model name for step 1
         self.extraction_model = "mistral-small-latest"  
     
-    def extract_structured_data(self, pdf_path: str) -> dict:
+    def extraction_fingerprint(self) -> tuple[str, str]:
+        """(model name, prompt hash) identifying this extraction for the cache."""
+        return f"mistral-ocr-latest+{self.extraction_model}", extraction_cache.prompt_hash(self._get_extraction_prompt())
+
+    def extract_structured_data(self, pdf_path: str, pages: list[int] | None = None) -> dict:
+        """
+        `pages` (0-based) limits OCR to those pages of `pdf_path`; they are
+        numbered 1..n in the prompt, like the pages of an optimized PDF.
+        """
         try:
-            logger.info(f"Uploading PDF to Mistral OCR: {pdf_path}")
-            
-            # --- STEP 1: Upload file to Mistral (Required for OCR API) ---
-            with open(pdf_path, "rb") as f:
-                uploaded_file = self.client.files.upload(
-                    file={
-                        "file_name": os.path.basename(pdf_path),
-                        "content": f,
-                    },
-                    purpose="ocr"
-                )
-            
-            # Get signed URL
-            signed_url = self.client.files.get_signed_url(file_id=uploaded_file.id)
-            
-            # --- STEP 2: Run Native Mistral OCR ---
-            logger.info("Running Mistral OCR...")
-            ocr_response = self.client.ocr.process(
-                model="mistral-ocr-latest",
-                document={
-                    "type": "document_url",
-                    "document_url": signed_url.url,
-                },
-                include_image_base64=False 
-            )
+            # --- STEP 1+2: Upload and run native Mistral OCR (sharded for large PDFs) ---
+            logger.info(f"Running Mistral OCR: {pdf_path}")
+            pages = mistral_ocr_pages(self.client, pdf_path, pages)
             
             # Combine markdown from all pages
-            # Mistral OCR returns pages with 'markdown' content
             full_markdown = ""
-            for i, page in enumerate(ocr_response.pages):
-                full_markdown += f"\n\n--- PAGE {i+1} ---\n{page.markdown}"
+            for i, page_markdown in enumerate(pages):
+                full_markdown += f"\n\n--- PAGE {i+1} ---\n{page_markdown}"
             
             logger.info(f"OCR Success. Extracted {len(full_markdown)} characters.")
 
             # --- STEP 3: Parse with Mistral Small ---
             prompt = self._get_extraction_prompt()
             
-            chat_response = self.client.chat.complete(
+            chat_response = provider_limits.call('mistral', 'chat', lambda: self.client.chat.complete(
                 model=self.extraction_model,
                 messages=[
                     {
@@ -1189,7 +1030,7 @@ class MistralOCRSmallService:
                 ],
                 response_format={"type": "json_object"},
                 temperature=0
-            )
+            ))
 
             response_content = chat_response.choices[0].message.content
             
@@ -1206,6 +1047,18 @@ class MistralOCRSmallService:
             logger.error(f"Error in Mistral OCR+Small pipeline: {str(e)}")
             raise
 
+    def extract_section(self, pdf_path: str, pages: list[int], keys: list[str]) -> dict:
+        """Sectioned extraction of `keys` from `pages` (0-based) of `pdf_path`."""
+        return mistral_extract_section(
+            self.client,
+            self.extraction_model,
+            "You are a financial data extraction assistant specializing in Vietnamese mutual fund documents. Extract structured data accurately and return ONLY valid JSON.",
+            self._get_extraction_prompt(),
+            pdf_path,
+            pages,
+            keys,
+        )
+
     def _get_extraction_prompt(self) -> str:
         """Get the extraction prompt - matches Gemini's detailed instructions"""
         return """You are extracting structured data from a Vietnamese mutual fund prospectus (Bản cáo bạch quỹ mở).
@@ -1325,126 +1178,47 @@ class MistralOCRService:
         # Model used for the JSON extraction (chat) step
         self.extraction_model = self.model
     
+    def extraction_fingerprint(self) -> tuple[str, str]:
+        """(model name, prompt hash) identifying this extraction for the cache."""
+        return self.extraction_model, extraction_cache.prompt_hash(self._get_extraction_prompt())
+
     def get_markdown(self, pdf_path: str) -> str:
         """
         Run Mistral OCR on the PDF and return the Combined Markdown text.
-        """
-        import random
-        import time
-
-        last_error: Exception | None = None
-        max_attempts = 4
-        base_wait_seconds = 2
-
-        for attempt in range(1, max_attempts + 1):
-            try:
-                logger.info(
-                    f"Uploading PDF to Mistral OCR (Markdown Only): {pdf_path} (attempt {attempt}/{max_attempts})"
-                )
-
-                with open(pdf_path, "rb") as f:
-                    uploaded_file = self.client.files.upload(
-                        file={
-                            "file_name": os.path.basename(pdf_path),
-                            "content": f,
-                        },
-                        purpose="ocr"
-                    )
-
-                signed_url = self.client.files.get_signed_url(file_id=uploaded_file.id)
-
-                logger.info(f"Running Mistral OCR... (attempt {attempt}/{max_attempts})")
-                ocr_response = self.client.ocr.process(
-                    model="mistral-ocr-latest",
-                    document={
-                        "type": "document_url",
-                        "document_url": signed_url.url,
-                    },
-                    include_image_base64=False
-                )
-
-                full_markdown = ""
-                for i, page in enumerate(ocr_response.pages):
-                    full_markdown += f"\n\n=== PAGE {i + 1} ===\n{page.markdown}"
-
-                if not full_markdown.strip():
-                    raise ValueError("Mistral OCR returned empty markdown")
-
-                return full_markdown
-
-            except Exception as e:
-                last_error = e
-                message = str(e)
-                logger.warning(f"Mistral OCR markdown attempt {attempt} failed: {message}")
-
-                if attempt == max_attempts:
-                    break
-
-                wait = base_wait_seconds * (2 ** (attempt - 1)) + random.uniform(0, 1.0)
-                logger.info(f"Retrying Mistral OCR in {wait:.1f}s...")
-                time.sleep(wait)
-
-        logger.error(f"Error in Mistral OCR Markdown extraction after {max_attempts} attempts: {last_error}")
-        raise last_error
-
-    def extract_structured_data(self, pdf_path: str) -> dict:
-        import random
-        import time
 
+        The PDF is OCRed in concurrent page-range shards; only failed
+        shards are retried. Page markers use global page numbers.
+        """
         try:
-            # Retry upload + OCR step (transient disconnects happen)
-            last_error: Exception | None = None
-            max_attempts = 4
-            base_wait_seconds = 2
-
-            ocr_response = None
-            for attempt in range(1, max_attempts + 1):
-                try:
-                    logger.info(
-                        f"Uploading PDF to Mistral OCR: {pdf_path} (attempt {attempt}/{max_attempts})"
-                    )
+            pages = mistral_ocr_pages(self.client, pdf_path)
+        except Exception as e:
+            logger.error(f"Error in Mistral OCR Markdown extraction: {e}")
+            raise
 
-                    # BƯỚC 1: Upload file lên Mistral (Bắt buộc cho OCR API)
-                    with open(pdf_path, "rb") as f:
-                        uploaded_file = self.client.files.upload(
-                            file={
-                                "file_name": os.path.basename(pdf_path),
-                                "content": f,
-                            },
-                            purpose="ocr"
-                        )
+        full_markdown = ""
+        for i, page_markdown in enumerate(pages):
+            full_markdown += f"\n\n=== PAGE {i + 1} ===\n{page_markdown}"
 
-                    # Lấy signed URL để xử lý
-                    signed_url = self.client.files.get_signed_url(file_id=uploaded_file.id)
+        if not full_markdown.strip():
+            raise ValueError("Mistral OCR returned empty markdown")
 
-                    # BƯỚC 2: Gọi Native OCR API (Dùng hàm ocr.process)
-                    logger.info(f"Running Mistral OCR... (attempt {attempt}/{max_attempts})")
-                    ocr_response = self.client.ocr.process(
-                        model="mistral-ocr-latest",
-                        document={
-                            "type": "document_url",
-                            "document_url": signed_url.url,
-                        },
-                        include_image_base64=False
-                    )
+        return full_markdown
 
-                    break
-                except Exception as e:
-                    last_error = e
-                    logger.warning(f"Mistral OCR attempt {attempt} failed: {e}")
-                    if attempt == max_attempts:
-                        raise
-                    wait = base_wait_seconds * (2 ** (attempt - 1)) + random.uniform(0, 1.0)
-                    logger.info(f"Retrying Mistral OCR in {wait:.1f}s...")
-                    time.sleep(wait)
-
-            if ocr_response is None:
-                raise ValueError(f"Mistral OCR did not return a response. Last error: {last_error}")
+    def extract_structured_data(self, pdf_path: str, pages: list[int] | None = None) -> dict:
+        """
+        `pages` (0-based) limits OCR to those pages of `pdf_path`; they are
+        numbered 1..n in the prompt, like the pages of an optimized PDF.
+        """
+        try:
+            # BƯỚC 1+2: Upload + OCR theo từng nhóm trang song song;
+            # chỉ nhóm lỗi mới được thử lại (transient disconnects happen)
+            logger.info(f"Running Mistral OCR: {pdf_path}")
+            pages = mistral_ocr_pages(self.client, pdf_path, pages)
             
             # Gộp kết quả Markdown từ các trang
             full_markdown = ""
-            for i, page in enumerate(ocr_response.pages):
-                full_markdown += f"\n\n--- PAGE {i+1} ---\n{page.markdown}"
+            for i, page_markdown in enumerate(pages):
+                full_markdown += f"\n\n--- PAGE {i+1} ---\n{page_markdown}"
             
             logger.info(f"OCR Success. Extracted {len(full_markdown)} characters.")
 
@@ -1452,7 +1226,7 @@ class MistralOCRService:
             # (Lúc này mới dùng chat.complete)
             prompt = self._get_extraction_prompt()
             
-            chat_response = self.client.chat.complete(
+            chat_response = provider_limits.call('mistral', 'chat', lambda: self.client.chat.complete(
                 model=self.extraction_model,
                 messages=[
                     {
@@ -1466,7 +1240,7 @@ class MistralOCRService:
                 ],
                 response_format={"type": "json_object"},
                 temperature=0
-            )
+            ))
 
             response_content = chat_response.choices[0].message.content
             
@@ -1478,6 +1252,18 @@ class MistralOCRService:
             if "Invalid model" in str(e) or "400" in str(e):
                 logger.error("HINT: Ensure your Mistral account has Billing enabled for OCR models.")
             raise
+
+    def extract_section(self, pdf_path: str, pages: list[int], keys: list[str]) -> dict:
+        """Sectioned extraction of `keys` from `pages` (0-based) of `pdf_path`."""
+        return mistral_extract_section(
+            self.client,
+            self.extraction_model,
+            "You are a financial data assistant. Extract data from the provided Markdown content into valid JSON.",
+            self._get_extraction_prompt(),
+            pdf_path,
+            pages,
+            keys,
+        )
     
     def _get_extraction_schema(self) -> dict:
         """Define the expected JSON schema for extraction"""
@@ -1836,66 +1622,194 @@ class DocumentProcessingService:
             self._mistral_ocr_small_service = MistralOCRSmallService()
         return self._mistral_ocr_small_service
     
-    def process_document(self, document_id: int):
+    def process_document(self, document_id: int, force: bool = False):
+        """Process in a background thread; `force` bypasses the extraction cache."""
         thread = threading.Thread(
             target=self._process_document_task,
-            args=(document_id,),
+            args=(document_id, force),
             daemon=True
         )
         thread.start()
         logger.info(f"Started processing thread for document {document_id}")
     
-    def _process_document_task(self, document_id: int):
+    def _extract_sectioned(self, document, optimized_pdf_path: str, page_map: list[int],
+                           page_categories: dict[int, set[str]]) -> dict:
+        """
+        Map-reduce extraction (SECTIONED_EXTRACTION): one request per keyword
+        section of the optimized PDF. Page numbers in the result refer to the
+        optimized PDF, like a single-request extraction.
+        """
+        if document.ocr_model in ('mistral', 'mistral-ocr'):
+            service = self._get_mistral_service() if document.ocr_model == 'mistral' else self._get_mistral_ocr_small_service()
+            # OCR the original's pages so RAG ingestion can share them (ocr_broker)
+            extract = lambda pages, keys: service.extract_section(
+                document.file.path, [page_map[p] - 1 for p in pages], keys
+            )
+        else:
+            gemini = self._get_gemini_service()
+            extract = lambda pages, keys: gemini.extract_section(optimized_pdf_path, pages, keys)
+
+        categories = {i: page_categories.get(page - 1, set()) for i, page in enumerate(page_map)}
+
+        def on_section(name, partial):
+            if name == 'identity':
+                self._persist_identity_preview(document.id, partial, page_map)
+
+        return extract_sectioned(len(page_map), categories, extract, on_section=on_section)
+
+    def _persist_identity_preview(self, document_id: int, partial: dict, page_map: list[int]):
+        """
+        Save the identity section as soon as it is extracted, so the UI can
+        show fund name/code before the remaining sections finish. The full
+        result overwrites it when processing completes.
+        """
+        preview = remap_pages(copy.deepcopy(partial), page_map)
+
+        def value(key):
+            field = preview.get(key)
+            field = field.get('value') if isinstance(field, dict) else field
+            if field is None:
+                return None
+            max_len = ExtractedFundData._meta.get_field(key).max_length
+            return str(field)[:max_len]
+
+        identity = {key: value(key) for key in ('fund_name', 'fund_code', 'management_company', 'custodian_bank')}
+        close_old_connections()
+        Document.objects.filter(id=document_id).update(extracted_data=preview)
+        ExtractedFundData.objects.update_or_create(document_id=document_id, defaults=identity)
+        progress_bus.publish(document_id, extracted_sections=['identity'],
+                             fund_name=identity['fund_name'], fund_code=identity['fund_code'])
+        logger.info(f"Saved identity preview for document {document_id}: {identity['fund_name']}")
+
+    def _extraction_cache_identity(self, document) -> tuple:
+        """(file sha256, ocr_model, model name, prompt hash, variant) for extraction_cache."""
+        if document.ocr_model == 'mistral':
+            service = self._get_mistral_service()
+        elif document.ocr_model == 'mistral-ocr':
+            service = self._get_mistral_ocr_small_service()
+        else:
+            service = self._get_gemini_service()
+        model_name, prompt_digest = service.extraction_fingerprint()
+        # The page selection limits decide which pages the provider sees
+        variant = {
+            'sectioned': SECTIONED_EXTRACTION,
+            'max_optimized_pages': getattr(settings, 'MAX_OPTIMIZED_PDF_PAGES', 60),
+            'max_identity_scan_pages': getattr(settings, 'MAX_IDENTITY_SCAN_PAGES', 40),
+        }
+        if SECTIONED_EXTRACTION:
+            variant['sections'] = extraction_cache.prompt_hash(
+                json.dumps(SECTION_KEYS, sort_keys=True), section_prompt_note(['{keys}'])
+            )
+        return file_sha256(document.file.path), document.ocr_model, model_name, prompt_digest, variant
+
+    def _process_document_task(self, document_id: int, force: bool = False):
+        # A second processing request while one is running waits for it
+        # instead of running the extraction again.
+        return job_lock.run_exclusive('process', document_id, lambda: self._run_processing(document_id, force))
+
+    def _run_processing(self, document_id: int, force: bool = False):
         optimized_pdf_path = None
         try:
             document = Document.objects.get(id=document_id)
             document.status = 'processing'
             document.save(update_fields=['status'])
+            progress_bus.publish(document_id, status='processing')
 
-            # --- STEP 1: Optimize PDF (Page Segmentation) ---
-            optimized_page_map = None
+            # Same file, model, prompt and page selection settings as an earlier
+            # run: reuse its JSON and the page map it was made with
+            cache_identity = cache_key = cached = None
             try:
-                # This function returns (temp_path, page_map)
-                optimized_pdf_path, optimized_page_map = create_optimized_pdf(document.file.path)
-                logger.info(f"Optimized PDF created at: {optimized_pdf_path}")
-                if optimized_page_map:
-                    logger.info(f"Page map: {len(optimized_page_map)} optimized pages -> original pages")
+                cache_identity = self._extraction_cache_identity(document)
+                cache_key = extraction_cache.cache_key(*cache_identity)
+                cached_entry = None if force else extraction_cache.lookup(cache_key)
+                if cached_entry is not None:
+                    cached = extraction_cache.use(cached_entry)
             except Exception as e:
-                logger.warning(f"PDF optimization failed, using original file: {e}")
+                logger.warning(f"Extraction cache unavailable: {e}")
+
+            # Upload the original to Gemini while the PDF is being optimized, so
+            # the fallback below (or a short PDF used as-is) finds it ready.
+            if document.ocr_model not in ('mistral', 'mistral-ocr') and cached is None:
+                try:
+                    self._get_gemini_service().prefetch_upload(document.file.path)
+                except Exception as e:
+                    logger.warning(f"Could not start Gemini upload of the original PDF: {e}")
+
+            # --- STEP 1: Optimize PDF (Page Segmentation) ---
+            extracted_data = None
+            optimized_page_map = None
+            page_categories: dict[int, set[str]] = {}
+            if cached is not None:
+                # The page map is known: only cut the pages out, no scan/OCR
+                extracted_data, optimized_page_map, page_categories = cached
+                logger.info(f">> Extraction cache hit ({cache_key[:12]}); skipped PDF optimization and {document.ocr_model} extraction")
                 optimized_pdf_path = document.file.path
+                if optimized_page_map:
+                    try:
+                        optimized_pdf_path = optimized_pdf_from_page_map(document.file.path, optimized_page_map)
+                    except Exception as e:
+                        logger.warning(f"Could not rebuild the optimized PDF from the cached page map: {e}")
+            else:
+                try:
+                    # This function returns (temp_path, page_map)
+                    optimized_pdf_path, optimized_page_map = create_optimized_pdf(document.file.path, page_categories)
+                    logger.info(f"Optimized PDF created at: {optimized_pdf_path}")
+                    if optimized_page_map:
+                        logger.info(f"Page map: {len(optimized_page_map)} optimized pages -> original pages")
+                except Exception as e:
+                    logger.warning(f"PDF optimization failed, using original file: {e}")
+                    optimized_pdf_path = document.file.path
 
             # --- STEP 2: Call AI Service ---
             import time
             start_time = time.time()
             
-            try:
-                logger.info(f"Starting extraction with model: {document.ocr_model}")
-                if document.ocr_model == 'mistral':
-                    extracted_data = self._get_mistral_service().extract_structured_data(optimized_pdf_path)
-                elif document.ocr_model == 'mistral-ocr':
-                    extracted_data = self._get_mistral_ocr_small_service().extract_structured_data(optimized_pdf_path)
-                else:
-                    extracted_data = self._get_gemini_service().extract_structured_data(optimized_pdf_path)
-                
-                extraction_time = time.time() - start_time
-                logger.info(f">> Extraction completed with {document.ocr_model} in {extraction_time:.2f} seconds")
-                
-            except Exception as e:
-                # If optimization caused an issue (e.g. 400 error), try original file as fallback
-                if optimized_pdf_path != document.file.path:
-                    logger.warning(f"Extraction failed with optimized PDF, retrying with original: {e}")
-                    start_time = time.time()
-                    if document.ocr_model == 'mistral':
-                        extracted_data = self._get_mistral_service().extract_structured_data(document.file.path)
+            # Mistral OCR the selected pages of the ORIGINAL file rather than the
+            # optimized copy, so the OCR broker can share them with RAG ingestion
+            # (which OCRs the original at the same time). Numbering is unchanged.
+            source_pages = [p - 1 for p in optimized_page_map] if optimized_page_map else None
+
+            if extracted_data is None:
+                try:
+                    logger.info(f"Starting extraction with model: {document.ocr_model}")
+                    if SECTIONED_EXTRACTION and optimized_page_map:
+                        extracted_data = self._extract_sectioned(
+                            document, optimized_pdf_path, optimized_page_map, page_categories
+                        )
+                    elif document.ocr_model == 'mistral':
+                        extracted_data = self._get_mistral_service().extract_structured_data(document.file.path, source_pages)
                     elif document.ocr_model == 'mistral-ocr':
-                        extracted_data = self._get_mistral_ocr_small_service().extract_structured_data(document.file.path)
+                        extracted_data = self._get_mistral_ocr_small_service().extract_structured_data(document.file.path, source_pages)
                     else:
-                        extracted_data = self._get_gemini_service().extract_structured_data(document.file.path)
+                        extracted_data = self._get_gemini_service().extract_structured_data(optimized_pdf_path)
+                
                     extraction_time = time.time() - start_time
-                    logger.info(f">> Extraction completed (fallback) with {document.ocr_model} in {extraction_time:.2f} seconds")
-                else:
-                    raise e
-            
+                    logger.info(f">> Extraction completed with {document.ocr_model} in {extraction_time:.2f} seconds")
+
+                    if cache_key:
+                        try:
+                            extraction_cache.store(
+                                cache_key, *cache_identity[:4], extracted_data, optimized_page_map, page_categories
+                            )
+                        except Exception as e:
+                            logger.warning(f"Could not store extraction in cache: {e}")
+                
+                except Exception as e:
+                    # If optimization caused an issue (e.g. 400 error), try original file as fallback
+                    if optimized_pdf_path != document.file.path:
+                        logger.warning(f"Extraction failed with optimized PDF, retrying with original: {e}")
+                        start_time = time.time()
+                        if document.ocr_model == 'mistral':
+                            extracted_data = self._get_mistral_service().extract_structured_data(document.file.path)
+                        elif document.ocr_model == 'mistral-ocr':
+                            extracted_data = self._get_mistral_ocr_small_service().extract_structured_data(document.file.path)
+                        else:
+                            extracted_data = self._get_gemini_service().extract_structured_data(document.file.path)
+                        extraction_time = time.time() - start_time
+                        logger.info(f">> Extraction completed (fallback) with {document.ocr_model} in {extraction_time:.2f} seconds")
+                    else:
+                        raise e
+
             # extracted_data is now a dict (or should be)
             if not isinstance(extracted_data, dict):
                  # Fallback if something went wrong and we got a string or something else
@@ -1916,20 +1830,7 @@ class DocumentProcessingService:
                 # Remap all bbox "page" values from optimized index to original page number.
                 # The AI wrote page numbers based on the optimized PDF; convert them back to
                 # original so the frontend can navigate to the correct page.
-                def remap_pages(obj):
-                    """Recursively remap 'page' fields inside extracted data."""
-                    if isinstance(obj, dict):
-                        if 'page' in obj and 'bbox' in obj:
-                            opt_page = obj['page']  # 1-based optimized page number from AI
-                            if isinstance(opt_page, int) and 1 <= opt_page <= len(optimized_page_map):
-                                obj['page'] = optimized_page_map[opt_page - 1]  # map to original
-                        for v in obj.values():
-                            remap_pages(v)
-                    elif isinstance(obj, list):
-                        for item in obj:
-                            remap_pages(item)
-
-                remap_pages(extracted_data)
+                remap_pages(extracted_data, optimized_page_map)
                 logger.info(f"Remapped page numbers in extracted_data using optimized_page_map ({len(optimized_page_map)} pages)")
 
                 document.extracted_data = extracted_data
@@ -2119,6 +2020,16 @@ class DocumentProcessingService:
             document.save(update_fields=['status', 'processed_at', 'extracted_data', 'optimized_file'])
             
             logger.info(f"Successfully processed document {document_id}")
+            progress_bus.publish(document_id, status='completed')
+
+            # Pre-render dashboard thumbnails in the background so the page grid
+            # paints from small cached images instead of full renders.
+            if document.optimized_file:
+                try:
+                    from . import rendering
+                    rendering.generate_thumbnails_async(document.optimized_file.path)
+                except Exception as e:
+                    logger.warning(f"Could not start thumbnail generation for document {document_id}: {e}")
 
             # --- STEP 4: Auto RAG ingestion (chunk + embed) ---
             # Goal: user can chat without waiting 5-7 minutes after clicking a separate "process" button.
@@ -2127,25 +2038,20 @@ class DocumentProcessingService:
             auto_rag_enabled = auto_rag_raw not in {"0", "false", "no", "off"}
             if auto_rag_enabled:
                 # If RAG was already kicked off at upload time, don't start again here.
-                try:
-                    current = Document.objects.only('rag_status').get(id=document_id).rag_status
-                except Exception:
-                    current = None
-                if current in {'queued', 'running', 'completed'}:
-                    logger.info(f"Auto RAG: document {document_id} already {current}; skipping post-processing trigger")
+                # Compare-and-swap: only one caller can move the status to 'queued'.
+                queued = Document.objects.filter(id=document_id).exclude(
+                    rag_status__in=['queued', 'running', 'completed']
+                ).update(
+                    rag_status='queued',
+                    rag_progress=0,
+                    rag_error_message=None,
+                    rag_started_at=None,
+                    rag_completed_at=None,
+                )
+                if not queued:
+                    logger.info(f"Auto RAG: document {document_id} already queued/running/completed; skipping post-processing trigger")
                     return
-
-                try:
-                    Document.objects.filter(id=document_id).update(
-                        rag_status='queued',
-                        rag_progress=0,
-                        rag_error_message=None,
-                        rag_started_at=None,
-                        rag_completed_at=None,
-                    )
-                except Exception:
-                    # Best-effort only
-                    pass
+                progress_bus.publish(document_id, rag_status='queued', rag_progress=0)
 
                 def _rag_task(doc_id: int):
                     try:
@@ -2164,6 +2070,7 @@ class DocumentProcessingService:
                                 )
                             except Exception:
                                 pass
+                            progress_bus.publish(doc_id, rag_status='completed', rag_progress=100)
                             return
 
                         logger.info(f"Auto RAG: starting ingestion for document {doc_id}")
@@ -2184,6 +2091,7 @@ class DocumentProcessingService:
                 document.status = 'failed'
                 document.error_message = str(e)
                 document.save(update_fields=['status', 'error_message'])
+                progress_bus.publish(document_id, status='failed', error_message=str(e))
             except Exception as save_error:
                 logger.error(f"Failed to update document status: {str(save_error)}")
         
@@ -2215,6 +2123,7 @@ class RAGService:
         if not mistral_key:
             raise ValueError("MISTRAL_API_KEY environment variable is not set")
 
+        self.mistral_api_key = mistral_key  # async calls use per-loop clients (async_providers)
         self.mistral_client = Mistral(api_key=mistral_key)
         self.embedding_model = "mistral-embed-2312"
         
@@ -2229,6 +2138,8 @@ class RAGService:
         self.flashrank_model = os.getenv('FLASHRANK_MODEL', 'ms-marco-MiniLM-L-12-v2').strip()
         self.rerank_top_k = int(os.getenv('RAG_RERANK_TOP_K', '5'))
         self.retrieval_candidates_k = int(os.getenv('RAG_RETRIEVAL_CANDIDATES_K', '15'))
+        # Questions of one chat_batch() call answered at the same time
+        self.batch_concurrency = max(1, int(os.getenv('RAG_BATCH_CONCURRENCY', '8')))
         self.reranker = None
 
         if self.enable_rerank:
@@ -2253,6 +2164,7 @@ class RAGService:
             api_key = os.getenv('GEMINI_API_KEY')
             if not api_key:
                 raise ValueError("GEMINI_API_KEY not set (required when RAG_CHAT_PROVIDER=gemini)")
+            self.gemini_api_key = api_key
             self._gemini_client = genai.Client(api_key=api_key)
             self._genai = genai  # Keep for types access
             self.gemini_model_name = 'gemini-2.5-flash-lite'
@@ -2266,36 +2178,24 @@ class RAGService:
 
     def _clean_text_for_rag(self, text: str) -> str:
         """Removes repetitive headers/footers and fixes extraction glitches."""
-        # 1. Remove common headers
-        lines = text.split('\n')
-        cleaned_lines: list[str] = []
-        for line in lines:
-            # Skip standard headers
-            if "ỦY BAN CHỨNG KHOÁN NHÀ NƯỚC" in line:
-                continue
-            if "CỘNG HÒA XÃ HỘI CHỦ NGHĨA VIỆT NAM" in line:
-                continue
-            if "Độc lập - Tự do - Hạnh phúc" in line:
-                continue
-            if "BẢN CÁO BẠCH" in line:
-                continue
-            cleaned_lines.append(line)
-
-        text = "\n".join(cleaned_lines)
-
-        # 2. Fix the "looping phrase" glitch (heuristic)
-        # If a line repeats itself within a short window, cut it.
-        # (This handles the "sở hữu của một Quỹ..." loop)
-        import re
-        # This regex looks for phrases of 10+ chars that repeat immediately
-        text = re.sub(r'(.{10,})\1+', r'\1', text)
-        return text
+        return clean_text_for_rag(text)
 
     def ingest_document(self, document_id: int) -> bool:
         """
         Process a document into vector chunks for RAG.
         Returns True if successful.
+
+        Only one ingestion per document runs at a time (see job_lock); a
+        concurrent call waits for the running one and shares its outcome.
         """
+        return job_lock.run_exclusive(
+            'rag_ingest',
+            document_id,
+            lambda: self._ingest_document(document_id),
+            attach=lambda: Document.objects.filter(id=document_id, rag_status='completed').exists(),
+        )
+
+    def _ingest_document(self, document_id: int) -> bool:
         try:
             document = Document.objects.get(id=document_id)
             logger.info(f"Starting RAG ingestion for Doc {document_id}")
@@ -2311,16 +2211,14 @@ class RAGService:
                 )
             except Exception:
                 pass
+            progress_bus.publish(document_id, rag_status='running', rag_progress=0)
 
             # 1. Check if already ingested to avoid duplicates
             if document.chunks.exists():
                 logger.info(f"Document {document_id} already ingested. Deleting old chunks...")
                 document.chunks.all().delete()
 
-            try:
-                Document.objects.filter(id=document_id).update(rag_progress=5)
-            except Exception:
-                pass
+            progress_bus.report_rag_progress(document_id, 5)
 
             # 2. Extract Raw Content (optimized for Scanned PDFs)
             # Since Mistral/Gemini services return JSON, we might not have the full text saved.
@@ -2343,10 +2241,7 @@ class RAGService:
             except Exception as e:
                 logger.warning(f"Failed to save debug markdown: {e}")
 
-            try:
-                Document.objects.filter(id=document_id).update(rag_progress=15)
-            except Exception:
-                pass
+            progress_bus.report_rag_progress(document_id, 15)
 
             # 3. Chunking Strategy
             # Parse page markers (supports both formats: "--- PAGE X ---" and "=== PAGE X ===")
@@ -2410,10 +2305,12 @@ class RAGService:
             
             logger.info(f"Created {len(all_chunks_with_pages)} chunks from document.")
 
-            try:
-                Document.objects.filter(id=document_id).update(rag_progress=30)
-            except Exception:
-                pass
+            # Disclaimers, definitions and table headers repeat across pages;
+            # embed each near-duplicate once and remember all its pages.
+            if os.getenv("CHUNK_DEDUP", "1").strip().lower() not in {"0", "false", "no"}:
+                all_chunks_with_pages = collapse_chunks(all_chunks_with_pages)
+
+            progress_bus.report_rag_progress(document_id, 30)
 
             # 4. Generate Embeddings & Save (Batch Processing)
             batch_size = 50  # Increased for fewer API calls
@@ -2426,45 +2323,22 @@ class RAGService:
                 batch = all_chunks_with_pages[i:i + batch_size]
                 batch_texts = [d.page_content for d in batch]
 
-                # Progress: 30% -> 95% across embedding work
-                try:
-                    done = min(i + batch_size, total_chunks)
-                    pct = 30 + int((done / total_chunks) * 65)
-                    Document.objects.filter(id=document_id).update(rag_progress=min(max(pct, 30), 95))
-                except Exception:
-                    pass
-                
-                # Call Gemini Embedding API with retry logic
-                max_retries = 3
-                retry_count = 0
-                embeddings = None
+                # Progress: 30% -> 95% across embedding work (DB writes are throttled by the bus)
+                done = min(i + batch_size, total_chunks)
+                pct = 30 + int((done / total_chunks) * 65)
+                progress_bus.report_rag_progress(document_id, min(max(pct, 30), 95))
                 
-                while retry_count < max_retries:
-                    try:
-                        logger.info(f"Embedding batch {i//batch_size + 1}/{(len(all_chunks_with_pages) + batch_size - 1)//batch_size} ({len(batch)} chunks)")
-
-                        resp = self.mistral_client.embeddings.create(
-                            model=self.embedding_model,
-                            inputs=batch_texts,
-                        )
-                        embeddings = [item.embedding for item in resp.data]
-                        break  # Success, exit retry loop
-                        
-                    except Exception as e:
-                        retry_count += 1
-                        import random
-                        import time
-                        message = str(e)
-
-                        if retry_count < max_retries:
-                            wait_time = (2 ** retry_count) + random.uniform(0, 1.0)  # jitter
-                            logger.warning(
-                                f"Embedding API error (attempt {retry_count}/{max_retries}): {message}. Retrying in {wait_time}s..."
-                            )
-                            time.sleep(wait_time)
-                        else:
-                            logger.error(f"Failed to embed batch after {max_retries} attempts: {str(e)}")
-                            raise
+                # Paced, 429-aware and retried with every other embedding call (provider_limits)
+                logger.info(f"Embedding batch {i//batch_size + 1}/{(len(all_chunks_with_pages) + batch_size - 1)//batch_size} ({len(batch)} chunks)")
+                try:
+                    resp = provider_limits.call('mistral', 'embeddings', lambda: self.mistral_client.embeddings.create(
+                        model=self.embedding_model,
+                        inputs=batch_texts,
+                    ))
+                except Exception as e:
+                    logger.error(f"Failed to embed batch: {str(e)}")
+                    raise
+                embeddings = [item.embedding for item in resp.data]
                 
                 # Prepare DB objects
                 for j, doc_chunk in enumerate(batch):
@@ -2485,6 +2359,7 @@ class RAGService:
                         content=final_content,
                         content_ascii=unidecode(final_content),
                         page_number=page_num,
+                        page_numbers=doc_chunk.metadata.get('page_numbers') or [page_num],
                         embedding=embeddings[j]
                     ))
                 
@@ -2535,6 +2410,8 @@ class RAGService:
                 )
             except Exception:
                 pass
+            progress_bus.publish(document_id, rag_status='completed', rag_progress=100)
+            progress_bus.forget(document_id)
             
             return True
 
@@ -2547,6 +2424,8 @@ class RAGService:
                 )
             except Exception:
                 pass
+            progress_bus.publish(document_id, rag_status='failed', rag_error_message=str(e))
+            progress_bus.forget(document_id)
             raise
 
     def chat(self, document_id: int, user_query: str, history: list = None, return_source=False, **kwargs) -> dict|str:
@@ -2560,43 +2439,145 @@ class RAGService:
 
             document = Document.objects.get(id=document_id)
 
-            def get_value(field_data):
-                if isinstance(field_data, dict) and 'value' in field_data:
-                    return field_data['value']
-                return field_data
+            # 1. Lấy dữ liệu cấu trúc đã trích xuất ("Phao cứu sinh" cho câu hỏi về phí, tên, mã...)
+            structured_info = self._structured_info(document)
 
-            def safe_text(val, max_len: int = 1200) -> str:
-                if val is None:
-                    return "Không có"
-                if isinstance(val, (dict, list)):
-                    try:
-                        val = json.dumps(val, ensure_ascii=False)
-                    except Exception:
-                        val = str(val)
-                val = str(val)
-                val = val.strip()
-                if not val:
-                    return "Không có"
-                return val if len(val) <= max_len else (val[:max_len] + " …")
+            # 2. Hybrid Search (Vector + Keyword via RRF) cho câu hỏi giải thích / chiến lược / rủi ro...
+            retrieved_chunks = self._retrieve(document_id, user_query)
 
-            # 1. Lấy dữ liệu cấu trúc đã trích xuất ("Phao cứu sinh" cho câu hỏi về phí, tên, mã...)
-            structured_info = ""
+            # 3. Tổng hợp Prompt: dùng cả JSON + Vector
+            system_prompt = self._system_prompt(structured_info, self._rag_context(retrieved_chunks), user_query)
+            response_text = self._generate(system_prompt, history, user_query)
 
-            extracted_data = document.extracted_data or {}
-            minimum_investment = extracted_data.get('minimum_investment')
-            investment_objective = extracted_data.get('investment_objective')
-            asset_allocation = extracted_data.get('asset_allocation')
-            inception_date = extracted_data.get('inception_date')
-            effective_date = extracted_data.get('effective_date')
+            if return_source:
+                return self._answer_payload(document, response_text, retrieved_chunks, structured_info)
+            return response_text
 
-            fees_extracted = extracted_data.get('fees') or {}
-            operational_details = extracted_data.get('operational_details') or {}
-            valuation = extracted_data.get('valuation') or {}
-            risk_factors = extracted_data.get('risk_factors') or {}
+        except Exception as e:
+            return self._chat_error(e, return_source)
 
-            try:
-                fund_data = ExtractedFundData.objects.get(document_id=document_id)
-                structured_info = f"""
+    async def achat(self, document_id: int, user_query: str, history: list = None, return_source=False) -> dict|str:
+        """
+        chat() for async views: provider calls are awaited (async_providers)
+        and ORM / reranking work runs in worker threads, so the event loop
+        stays free while the LLM answers.
+        """
+        try:
+            document = await Document.objects.aget(id=document_id)
+            structured_info = await sync_to_async(self._structured_info)(document)
+            retrieved_chunks = await self._aretrieve(document_id, user_query)
+            system_prompt = self._system_prompt(structured_info, self._rag_context(retrieved_chunks), user_query)
+            response_text = await self._agenerate(system_prompt, history, user_query)
+
+            if return_source:
+                # Citation boxes only read files, so they need not queue on the ORM thread
+                return await sync_to_async(self._answer_payload, thread_sensitive=False)(
+                    document, response_text, retrieved_chunks, structured_info
+                )
+            return response_text
+
+        except Exception as e:
+            return self._chat_error(e, return_source)
+
+    def chat_batch(self, document_id: int, questions: list[str]) -> list[dict]:
+        """
+        Answer independent questions (no history) about one document.
+        Returns one chat(return_source=True) payload per question, in order.
+        """
+        return async_to_sync(self.achat_batch)(document_id, questions)
+
+    async def achat_batch(self, document_id: int, questions: list[str]) -> list[dict]:
+        """
+        chat_batch() for async views. Structured context is loaded once and
+        the questions are embedded together (QUERY_EMBED_BATCH_SIZE per
+        request); searches, reranking and LLM calls then run concurrently,
+        at most RAG_BATCH_CONCURRENCY questions at a time. A failing question
+        gets the usual error payload without failing the others.
+        """
+        if not questions:
+            return []
+        try:
+            document = await Document.objects.aget(id=document_id)
+            structured_info = await sync_to_async(self._structured_info)(document)
+        except Exception as e:
+            return [self._chat_error(e, True) for _ in questions]
+
+        try:
+            embeddings = []
+            for i in range(0, len(questions), QUERY_EMBED_BATCH_SIZE):
+                embeddings += await async_providers.mistral_embed(
+                    self.mistral_api_key, self.embedding_model, questions[i:i + QUERY_EMBED_BATCH_SIZE]
+                )
+        except Exception as e:
+            # Same as a failed retrieval in chat(): answer from the structured data only
+            logger.warning(f"RAG batch query embedding failed for document {document_id}: {str(e)}")
+            embeddings = [None] * len(questions)
+
+        semaphore = asyncio.Semaphore(self.batch_concurrency)
+
+        async def answer(user_query: str, query_embedding: list[float] | None) -> dict:
+            async with semaphore:
+                try:
+                    retrieved_chunks = await self._aretrieve_with_embedding(document_id, user_query, query_embedding)
+                    system_prompt = self._system_prompt(structured_info, self._rag_context(retrieved_chunks), user_query)
+                    response_text = await self._agenerate(system_prompt, None, user_query)
+                    return await sync_to_async(self._answer_payload, thread_sensitive=False)(
+                        document, response_text, retrieved_chunks, structured_info
+                    )
+                except Exception as e:
+                    return self._chat_error(e, True)
+
+        return list(await asyncio.gather(*(answer(q, emb) for q, emb in zip(questions, embeddings))))
+
+    def _chat_error(self, e: Exception, return_source: bool) -> dict|str:
+        logger.error(f"RAG Chat Error: {str(e)}")
+        if return_source:
+            return {
+                "text": "Xin lỗi, tôi gặp sự cố khi xử lý câu hỏi.",
+                "contexts": [],
+                "structured_data_used": "",
+                "error": str(e)
+            }
+        return "Xin lỗi, tôi gặp sự cố khi xử lý câu hỏi."
+
+    def _structured_info(self, document) -> str:
+        """Extracted fields of the document, formatted as prompt context (NGUỒN 1)."""
+        def get_value(field_data):
+            if isinstance(field_data, dict) and 'value' in field_data:
+                return field_data['value']
+            return field_data
+
+        def safe_text(val, max_len: int = 1200) -> str:
+            if val is None:
+                return "Không có"
+            if isinstance(val, (dict, list)):
+                try:
+                    val = json.dumps(val, ensure_ascii=False)
+                except Exception:
+                    val = str(val)
+            val = str(val)
+            val = val.strip()
+            if not val:
+                return "Không có"
+            return val if len(val) <= max_len else (val[:max_len] + " …")
+
+        structured_info = ""
+
+        extracted_data = document.extracted_data or {}
+        minimum_investment = extracted_data.get('minimum_investment')
+        investment_objective = extracted_data.get('investment_objective')
+        asset_allocation = extracted_data.get('asset_allocation')
+        inception_date = extracted_data.get('inception_date')
+        effective_date = extracted_data.get('effective_date')
+
+        fees_extracted = extracted_data.get('fees') or {}
+        operational_details = extracted_data.get('operational_details') or {}
+        valuation = extracted_data.get('valuation') or {}
+        risk_factors = extracted_data.get('risk_factors') or {}
+
+        try:
+            fund_data = ExtractedFundData.objects.get(document_id=document.id)
+            structured_info = f"""
 THÔNG TIN CƠ BẢN ĐÃ ĐƯỢC TRÍCH XUẤT (ƯU TIÊN DÙNG CHO CÂU HỎI VỀ PHÍ / TÊN / MÃ / NGÂN HÀNG):
 - Tên quỹ: {fund_data.fund_name}
 - Mã quỹ: {fund_data.fund_code}
@@ -2652,8 +2633,8 @@ THÔNG TIN CƠ BẢN ĐÃ ĐƯỢC TRÍCH XUẤT (ƯU TIÊN DÙNG CHO CÂU HỎI
 - Cơ cấu phân bổ tài sản: {json.dumps(asset_allocation or {}, ensure_ascii=False)}
 - Danh mục đầu tư (trích xuất): {json.dumps(fund_data.portfolio or [], ensure_ascii=False)}
 """.strip()
-            except ExtractedFundData.DoesNotExist:
-                structured_info = f"""
+        except ExtractedFundData.DoesNotExist:
+            structured_info = f"""
 THÔNG TIN CƠ BẢN ĐÃ ĐƯỢC TRÍCH XUẤT (từ Document.extracted_data):
 - Ngày thành lập/quỹ bắt đầu hoạt động (inception_date): {inception_date or 'Không có'}
 - Ngày hiệu lực (effective_date): {effective_date or 'Không có'}
@@ -2668,31 +2649,71 @@ THÔNG TIN CƠ BẢN ĐÃ ĐƯỢC TRÍCH XUẤT (từ Document.extracted_data):
 - Số tiền đầu tư tối thiểu (ban đầu / bổ sung): {json.dumps(minimum_investment or {}, ensure_ascii=False)}
 - Cơ cấu phân bổ tài sản: {json.dumps(asset_allocation or {}, ensure_ascii=False)}
 """.strip()
+        return structured_info
 
-            # 2. Hybrid Search (Vector + Keyword via RRF) cho câu hỏi giải thích / chiến lược / rủi ro...
-            retrieved_chunks = []
-            rag_context = ""
-            try:
-                candidate_chunks = self.hybrid_search(
-                    document_id,
-                    user_query,
-                    top_k=max(self.retrieval_candidates_k, self.rerank_top_k),
-                )
-                retrieved_chunks = self._rerank_chunks(
-                    user_query=user_query,
-                    chunks=candidate_chunks,
-                    top_k=self.rerank_top_k,
-                )
-                rag_context = "\n\n---\n\n".join(
-                    [f"=== PAGE {c.page_number} ===\n{c.content}" for c in retrieved_chunks]
-                )
-            except Exception as e:
-                logger.warning(f"RAG retrieval failed for document {document_id}: {str(e)}")
+    def _retrieve(self, document_id: int, user_query: str) -> list:
+        """Hybrid search candidates, reranked; [] when retrieval fails."""
+        try:
+            candidate_chunks = self.hybrid_search(
+                document_id,
+                user_query,
+                top_k=max(self.retrieval_candidates_k, self.rerank_top_k),
+            )
+            return self._rerank_chunks(user_query=user_query, chunks=candidate_chunks, top_k=self.rerank_top_k)
+        except Exception as e:
+            logger.warning(f"RAG retrieval failed for document {document_id}: {str(e)}")
+            return []
 
-            # 3. Tổng hợp Prompt: dùng cả JSON + Vector
-            # ...existing code...
+    async def _aretrieve_with_embedding(self, document_id: int, user_query: str,
+                                        query_embedding: list[float] | None) -> list:
+        """_aretrieve() for an already embedded query; [] without an embedding or on failure."""
+        if query_embedding is None:
+            return []
+        try:
+            # ORM queries stay on the thread-sensitive executor (see ahybrid_search),
+            # so no pooled thread keeps a database connection open
+            candidate_chunks = await sync_to_async(self._search_with_embedding)(
+                document_id,
+                user_query,
+                query_embedding,
+                top_k=max(self.retrieval_candidates_k, self.rerank_top_k),
+            )
+            # FlashRank is CPU-bound and needs no database: rerank questions in parallel
+            return await sync_to_async(self._rerank_chunks, thread_sensitive=False)(
+                user_query=user_query, chunks=candidate_chunks, top_k=self.rerank_top_k
+            )
+        except Exception as e:
+            logger.warning(f"RAG retrieval failed for document {document_id}: {str(e)}")
+            return []
+
+    async def asearch(self, document_id: int, query_text: str, top_k: int) -> list:
+        """Top `top_k` chunks for the query: hybrid search candidates, reranked."""
+        candidate_chunks = await self.ahybrid_search(
+            document_id,
+            query_text,
+            top_k=max(self.retrieval_candidates_k, top_k),
+        )
+        # FlashRank is CPU-bound; keep it off the event loop
+        return await sync_to_async(self._rerank_chunks, thread_sensitive=False)(
+            user_query=query_text, chunks=candidate_chunks, top_k=top_k
+        )
+
+    async def _aretrieve(self, document_id: int, user_query: str) -> list:
+        try:
+            return await self.asearch(document_id, user_query, self.rerank_top_k)
+        except Exception as e:
+            logger.warning(f"RAG retrieval failed for document {document_id}: {str(e)}")
+            return []
+
+    @staticmethod
+    def _rag_context(retrieved_chunks: list) -> str:
+        return "\n\n---\n\n".join(
+            [f"=== PAGE {c.page_number} ===\n{c.content}" for c in retrieved_chunks]
+        )
 
-            system_prompt = f"""
+    @staticmethod
+    def _system_prompt(structured_info: str, rag_context: str, user_query: str) -> str:
+        return f"""
 Bạn là một Trợ lý Tài chính Chuyên nghiệp. Hãy trả lời câu hỏi bằng tiếng Việt dựa TRÊN MỨC ĐỘ ƯU TIÊN của NGUỒN 1 và NGUỒN 2.
 
 ### QUY TẮC CỐT LÕI (BẮT BUỘC):
@@ -2708,19 +2729,42 @@ NGUỒN 2 (Văn bản RAG): {rag_context}
 
 CÂU HỎI CỦA NGƯỜI DÙNG: {user_query}
 """
-            # Generate response based on provider
-            response_text = ""
+
+    @staticmethod
+    def _chat_messages(system_prompt: str, history: list | None, user_query: str) -> list[dict]:
+        """OpenAI-style messages (Ollama, Mistral)."""
+        messages = [{"role": "system", "content": system_prompt}]
+        if history:
+            for h in history:
+                role = "user" if h.get('sender') == 'user' else "assistant"
+                messages.append({"role": role, "content": h.get('text', '')})
+        messages.append({"role": "user", "content": f"CÂU HỎI: {user_query}"})
+        return messages
+
+    def _gemini_history(self, history: list | None) -> list:
+        # Prepare chat history for Gemini (new SDK uses Content/Part objects)
+        chat_history = []
+        if history:
+            for h in history:
+                role = "user" if h.get('sender') == 'user' else "model"
+                chat_history.append(
+                    self._genai.types.Content(
+                        role=role,
+                        parts=[self._genai.types.Part.from_text(text=h.get('text', ''))],
+                    )
+                )
+        return chat_history
+
+    def _generate(self, system_prompt: str, history: list | None, user_query: str) -> str:
+        """Answer with the configured chat provider."""
+        response_text = ""
+        
+        if self.chat_provider == 'ollama':
+            # Use Ollama API (OpenAI-compatible)
+            messages = self._chat_messages(system_prompt, history, user_query)
             
-            if self.chat_provider == 'ollama':
-                # Use Ollama API (OpenAI-compatible)
-                messages = [{"role": "system", "content": system_prompt}]
-                if history:
-                    for h in history:
-                        role = "user" if h.get('sender') == 'user' else "assistant"
-                        messages.append({"role": role, "content": h.get('text', '')})
-                messages.append({"role": "user", "content": f"CÂU HỎI: {user_query}"})
-                
-                try:
+            try:
+                def ollama_chat():
                     response = requests.post(
                         f"{self.ollama_base_url}/api/chat",
                         json={
@@ -2732,78 +2776,99 @@ CÂU HỎI CỦA NGƯỜI DÙNG: {user_query}
                         timeout=60
                     )
                     response.raise_for_status()
-                    response_text = response.json().get('message', {}).get('content', '')
-                except Exception as ollama_error:
-                    logger.error(f"Ollama API error: {ollama_error}")
-                    raise
-                    
-            elif self.chat_provider == 'mistral':
-                # Use Mistral API
-                messages = [{"role": "system", "content": system_prompt}]
-                if history:
-                    for h in history:
-                        role = "user" if h.get('sender') == 'user' else "assistant"
-                        messages.append({"role": role, "content": h.get('text', '')})
-                messages.append({"role": "user", "content": f"CÂU HỎI: {user_query}"})
-                
-                chat_response = self.mistral_client.chat.complete(
-                    model=self.mistral_chat_model,
-                    messages=messages,
-                    temperature=0
-                )
-                response_text = chat_response.choices[0].message.content
-                
-            else:  # gemini
-                # Prepare chat history for Gemini (new SDK uses Content/Part objects)
-                chat_history = []
-                if history:
-                    for h in history:
-                        role = "user" if h.get('sender') == 'user' else "model"
-                        chat_history.append(
-                            self._genai.types.Content(
-                                role=role,
-                                parts=[self._genai.types.Part.from_text(text=h.get('text', ''))],
-                            )
-                        )
+                    return response
 
-                # Start chat session
-                chat = self._gemini_client.chats.create(
-                    model=self.gemini_model_name,
-                    history=chat_history,
-                )
-                response = chat.send_message(f"{system_prompt}\n\nCÂU HỎI: {user_query}")
-                response_text = response.text
+                response = provider_limits.call('ollama', 'chat', ollama_chat)
+                response_text = response.json().get('message', {}).get('content', '')
+            except Exception as ollama_error:
+                logger.error(f"Ollama API error: {ollama_error}")
+                raise
+                
+        elif self.chat_provider == 'mistral':
+            # Use Mistral API
+            messages = self._chat_messages(system_prompt, history, user_query)
             
-            if return_source:
-                citations = []
-                for chunk in retrieved_chunks:
-                    try:
-                        citations.append({
-                            "chunk_id": chunk.id,
-                            "page": chunk.page_number,
-                            "quote": (chunk.content or "")[:800]
-                        })
-                    except Exception:
-                        continue
+            chat_response = provider_limits.call('mistral', 'chat', lambda: self.mistral_client.chat.complete(
+                model=self.mistral_chat_model,
+                messages=messages,
+                temperature=0
+            ))
+            response_text = chat_response.choices[0].message.content
+            
+        else:  # gemini
+            # Start chat session
+            chat = self._gemini_client.chats.create(
+                model=self.gemini_model_name,
+                history=self._gemini_history(history),
+            )
+            response = provider_limits.call(
+                'gemini', 'generate', lambda: chat.send_message(f"{system_prompt}\n\nCÂU HỎI: {user_query}")
+            )
+            response_text = response.text
+        return response_text
 
-                return {
-                    "text": response_text,
-                    "contexts": [c.content for c in retrieved_chunks],
-                    "structured_data_used": structured_info,
-                    "citations": citations,
-                }
-            return response_text
+    async def _agenerate(self, system_prompt: str, history: list | None, user_query: str) -> str:
+        if self.chat_provider == 'ollama':
+            return await async_providers.ollama_chat(
+                self.ollama_base_url, self.ollama_model, self._chat_messages(system_prompt, history, user_query)
+            )
+        if self.chat_provider == 'mistral':
+            return await async_providers.mistral_chat(
+                self.mistral_api_key, self.mistral_chat_model, self._chat_messages(system_prompt, history, user_query)
+            )
+        return await async_providers.gemini_chat(
+            self.gemini_api_key, self.gemini_model_name, self._gemini_history(history),
+            f"{system_prompt}\n\nCÂU HỎI: {user_query}",
+        )
 
+    def _answer_payload(self, document, response_text: str, retrieved_chunks: list, structured_info: str) -> dict:
+        """Answer with its contexts and citations (page + highlight boxes)."""
+        citations = []
+        for chunk in retrieved_chunks:
+            try:
+                citations.append({
+                    "chunk_id": chunk.id,
+                    "page": chunk.page_number,
+                    "pages": chunk.page_numbers or [chunk.page_number],
+                    "quote": (chunk.content or "")[:800]
+                })
+            except Exception:
+                continue
+
+        # Precompute highlight boxes so the UI can open every source
+        # without a page-context round trip per citation. Text-layer pages
+        # only: scanned pages would need RapidOCR on the answer path, so
+        # their citations are resolved when opened (citation-context).
+        try:
+            from . import rendering
+            located = rendering.locate_citations(document, citations, allow_ocr=False)
+            for citation, loc in zip(citations, located):
+                if 'error' not in loc:
+                    citation.update(loc)
         except Exception as e:
-            logger.error(f"RAG Chat Error: {str(e)}")
-            if return_source:
-                return {
-                    "text": "Xin lỗi, tôi gặp sự cố khi xử lý câu hỏi.",
-                    "contexts": [],
-                    "structured_data_used": "",
-                    "error": str(e)
-                }
-            return "Xin lỗi, tôi gặp sự cố khi xử lý câu hỏi."
+            logger.warning(f"Citation bbox lookup failed: {e}")
+
+        return {
+            "text": response_text,
+            "contexts": [c.content for c in retrieved_chunks],
+            "structured_data_used": structured_info,
+            "citations": citations,
+        }
+
+    def _persisted_ocr_pages(self, document, name_prefix: str) -> dict[int, str]:
+        """
+        {0-based page: markdown} from the document's saved OCR markdown, if
+        it was produced from the file named `name_prefix` (e.g. "abc_ocr").
+        """
+        markdown_file = getattr(document, 'markdown_file', None)
+        if not markdown_file or not os.path.basename(markdown_file.name).startswith(name_prefix):
+            return {}
+        try:
+            with markdown_file.open('rb') as f:
+                return split_page_markdown(f.read().decode('utf-8'))
+        except Exception as e:
+            logger.warning(f"Could not reuse saved OCR markdown for document {document.id}: {e}")
+            return {}
 
     def _extract_content_for_rag(self, document) -> str:
         """
@@ -2847,19 +2912,33 @@ CÂU HỎI CỦA NGƯỜI DÙNG: {user_query}
                     f"No PDF file found on disk for RAG extraction. original={original_path}, optimized={optimized_path}"
                 )
             
-            # MISTRAL OCR Integration (ALWAYS ON for RAG per requirement)
-            # Try Mistral OCR first for highest quality extraction
+            # MISTRAL OCR Integration
+            # Digital pages are read from the text layer; only scanned or
+            # table-heavy pages go to Mistral OCR (OCR_PAGE_ROUTING=0 sends all)
             try:
                 from django.core.files.base import ContentFile
-                logger.info(f"Using Mistral OCR for RAG extraction (forced for all documents)")
-                mistral_service = MistralOCRService()
-                markdown_text = mistral_service.get_markdown(chosen_path)
-                    
-                # Save to markdown_file
                 base_name = os.path.basename(chosen_path)
                 name_without_ext = os.path.splitext(base_name)[0]
                 markdown_filename = f"{name_without_ext}_ocr.md"
-                    
+
+                if OCR_PAGE_ROUTING:
+                    logger.info("Using per-page routing (text layer / Mistral OCR) for RAG extraction")
+
+                    def ocr_routed_pages(pages):
+                        # Reuse pages OCRed by an earlier run of this file; pages
+                        # extraction is OCRing right now are shared by the broker.
+                        persisted = self._persisted_ocr_pages(document, f"{name_without_ext}_ocr")
+                        ocr_broker.seed(chosen_path, {p: persisted[p] for p in pages if p in persisted})
+                        return mistral_ocr_pages(MistralOCRService().client, chosen_path, pages)
+
+                    markdown_text = routed_markdown(chosen_path, ocr_routed_pages)
+                    if not markdown_text.strip():
+                        raise ValueError("Routed extraction returned empty markdown")
+                else:
+                    logger.info("Using Mistral OCR for RAG extraction (all pages)")
+                    markdown_text = MistralOCRService().get_markdown(chosen_path)
+
+                # Save to markdown_file
                 document.markdown_file.save(markdown_filename, ContentFile(markdown_text.encode('utf-8')), save=True)
                 logger.info(f"Saved Mistral OCR Markdown to {document.markdown_file.path}")
 
@@ -2930,39 +3009,33 @@ CÂU HỎI CỦA NGƯỜI DÙNG: {user_query}
                         last_error = f"Render page {i + 1} failed: {e}"
                         logger.warning(last_error)
                 
-                # Gọi Gemini với cơ chế Retry (thử lại nếu lỗi mạng)
+                # Gọi Gemini qua provider_limits (giãn cách, chờ khi bị 429, thử lại khi lỗi mạng)
                 if ocr_pages_in_batch > 0:
                     batch_text = ""
-                    for attempt in range(3):
+                    for attempt in range(2):  # a second try only for empty responses
                         try:
-                            response = self._gemini_client.models.generate_content(
+                            response = provider_limits.call('gemini', 'generate', lambda: self._gemini_client.models.generate_content(
                                 model=self.gemini_model_name,
                                 contents=model_inputs,
-                            )
-                            batch_text = response.text or ""
-                            if batch_text.strip():
-                                break  # success
-                            last_error = f"Gemini OCR returned empty text for batch {batch_start + 1}-{batch_end} (attempt {attempt + 1})"
-                            logger.warning(last_error)
+                            ))
                         except Exception as e:
-                            wait = (attempt + 1) * 5
-                            last_error = f"Gemini OCR failed for batch {batch_start + 1}-{batch_end} (attempt {attempt + 1}): {e}"
-                            logger.warning(f"{last_error}. Retrying in {wait}s...")
-                            time.sleep(wait)
+                            last_error = f"Gemini OCR failed for batch {batch_start + 1}-{batch_end}: {e}"
+                            logger.warning(last_error)
+                            break
+                        batch_text = response.text or ""
+                        if batch_text.strip():
+                            break  # success
+                        last_error = f"Gemini OCR returned empty text for batch {batch_start + 1}-{batch_end} (attempt {attempt + 1})"
+                        logger.warning(last_error)
 
                     if batch_text.strip():
                         batch_parts.append(batch_text.strip())
                     else:
-                        logger.error(
-                            f"Failed to extract OCR text for pages {batch_start + 1}-{batch_end} after 3 attempts."
-                        )
+                        logger.error(f"Failed to extract OCR text for pages {batch_start + 1}-{batch_end}.")
 
                 if batch_parts:
                     full_text += "\n\n".join(batch_parts) + "\n\n"
 
-                # Nghỉ 2 giây giữa các batch để tránh lỗi 429 (Rate Limit)
-                time.sleep(2)
-
             if doc is not None:
                 doc.close()
             
@@ -2991,11 +3064,19 @@ CÂU HỎI CỦA NGƯỜI DÙNG: {user_query}
         """
     Performs Hybrid Search (Vector + Keyword) using Reciprocal Rank Fusion (RRF).
     """
-        # 1. Semantic Search: Captures meaning
-        query_embedding = self.mistral_client.embeddings.create(
+        query_embedding = provider_limits.call('mistral', 'embeddings', lambda: self.mistral_client.embeddings.create(
             model=self.embedding_model,
             inputs=[query_text],
-        ).data[0].embedding
+        )).data[0].embedding
+        return self._search_with_embedding(document_id, query_text, query_embedding, top_k, k_fusion)
+
+    async def ahybrid_search(self, document_id: int, query_text: str, top_k=10, k_fusion=60):
+        """hybrid_search() for async views: the query embedding is awaited."""
+        query_embedding = (await async_providers.mistral_embed(self.mistral_api_key, self.embedding_model, [query_text]))[0]
+        return await sync_to_async(self._search_with_embedding)(document_id, query_text, query_embedding, top_k, k_fusion)
+
+    def _search_with_embedding(self, document_id: int, query_text: str, query_embedding: list[float], top_k=10, k_fusion=60):
+        # 1. Semantic Search: Captures meaning
         # Get top 50 semantic results (fetch more than top_k to allow fusion to work)
         semantic_results = DocumentChunk.objects.filter(document_id=document_id) \
         .annotate(distance=CosineDistance('embedding', query_embedding)) \
@@ -0,0 +1,89 @@
+"""
+Dashboard statistics: one aggregate query over documents, cached briefly.
+
+The dashboard polls /api/documents/stats/ every few seconds, so the result
+is kept in the Django cache for STATS_CACHE_SECONDS and dropped whenever a
+Document row is saved or deleted (see ApiConfig.ready). Status changes made
+through queryset.update() (RAG progress) are picked up when the TTL expires.
+"""
+import os
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.db.models import Aggregate, Count, DurationField, ExpressionWrapper, F, Q
+from django.utils import timezone
+
+from .models import Document
+
+STATS_CACHE_KEY = 'api:document_stats'
+STATS_CACHE_SECONDS = int(os.getenv('STATS_CACHE_SECONDS', '5'))
+
+# Window used for throughput figures
+THROUGHPUT_WINDOW_HOURS = 24
+
+
+class Median(Aggregate):
+    """PostgreSQL median via percentile_cont (works for numbers and intervals)."""
+    function = 'percentile_cont'
+    name = 'Median'
+    template = '%(function)s(0.5) WITHIN GROUP (ORDER BY %(expressions)s)'
+
+
+def _seconds(value):
+    return round(value.total_seconds(), 1) if value is not None else None
+
+
+def compute_document_stats() -> dict:
+    """Processing + RAG counts and throughput in a single query."""
+    now = timezone.now()
+    window_start = now - timedelta(hours=THROUGHPUT_WINDOW_HOURS)
+    processed_recently = Q(status='completed', processed_at__gte=window_start)
+    ingested_recently = Q(rag_status='completed', rag_completed_at__gte=window_start)
+
+    aggregates = {
+        'total': Count('id'),
+        'completed_last_hour': Count('id', filter=Q(status='completed', processed_at__gte=now - timedelta(hours=1))),
+        'completed_window': Count('id', filter=processed_recently),
+        'median_processing': Median(
+            ExpressionWrapper(F('processed_at') - F('uploaded_at'), output_field=DurationField()),
+            filter=processed_recently,
+            output_field=DurationField(),
+        ),
+        'median_rag': Median(
+            ExpressionWrapper(F('rag_completed_at') - F('rag_started_at'), output_field=DurationField()),
+            filter=ingested_recently & Q(rag_started_at__isnull=False),
+            output_field=DurationField(),
+        ),
+    }
+    for value, _ in Document.STATUS_CHOICES:
+        aggregates[value] = Count('id', filter=Q(status=value))
+    for value, _ in Document.RAG_STATUS_CHOICES:
+        aggregates[f'rag_{value}'] = Count('id', filter=Q(rag_status=value))
+
+    row = Document.objects.aggregate(**aggregates)
+
+    stats = {'total': row['total']}
+    stats.update({value: row[value] for value, _ in Document.STATUS_CHOICES})
+    stats['rag'] = {value: row[f'rag_{value}'] for value, _ in Document.RAG_STATUS_CHOICES}
+    stats['throughput'] = {
+        'window_hours': THROUGHPUT_WINDOW_HOURS,
+        'completed_last_hour': row['completed_last_hour'],
+        'docs_per_hour': round(row['completed_window'] / THROUGHPUT_WINDOW_HOURS, 2),
+        'median_processing_seconds': _seconds(row['median_processing']),
+        'median_rag_seconds': _seconds(row['median_rag']),
+    }
+    stats['generated_at'] = now.isoformat()
+    return stats
+
+
+def get_document_stats() -> dict:
+    stats = cache.get(STATS_CACHE_KEY)
+    if stats is None:
+        stats = compute_document_stats()
+        cache.set(STATS_CACHE_KEY, stats, STATS_CACHE_SECONDS)
+    return stats
+
+
+def invalidate_document_stats(*args, **kwargs):
+    """Signal-compatible cache buster."""
+    cache.delete(STATS_CACHE_KEY)
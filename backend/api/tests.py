@@ -1,3 +1,1520 @@
-from django.test import TestCase
+import asyncio
+import os
+import shutil
+import tempfile
+import threading
+from unittest import mock
 
-# Create your tests here.
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+
+from . import (
+    async_providers, async_views, chat_history, dedup, extraction_cache, gemini_uploads, job_lock, ocr_broker,
+    ocr_sharding, page_routing, progress, provider_limits, rendering, sectioned_extraction, text_cleaning,
+    versioning,
+)
+from .models import (
+    ChatMessage, Document, DocumentChangeLog, DocumentChunk, DocumentSnapshot, ExtractedFundData,
+    ExtractionCacheEntry,
+)
+from .services import DocumentProcessingService, RAGService
+
+
+class DocumentListTests(TestCase):
+    """Document list: keyset pagination and a constant number of queries."""
+
+    @classmethod
+    def setUpTestData(cls):
+        for i in range(12):
+            doc = Document.objects.create(
+                file=f'documents/test_{i}.pdf',
+                file_name=f'test_{i}.pdf',
+                status='completed',
+                extracted_data={'fund_name': f'Blob Fund {i}', 'fund_code': f'BLOB{i}'},
+            )
+            # Half the documents have normalized fund data, half only the JSON blob.
+            if i % 2 == 0:
+                ExtractedFundData.objects.create(document=doc, fund_name=f'Fund {i}', fund_code=f'F{i}')
+
+    def test_list_runs_single_query(self):
+        url = reverse('document-list')
+        with self.assertNumQueries(1):
+            response = self.client.get(url, {'limit': 100})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['results']), 12)
+        self.assertEqual(response.json()['count'], 12)
+
+    def test_fund_fields_fall_back_to_extracted_data(self):
+        response = self.client.get(reverse('document-list'), {'limit': 100})
+        by_name = {row['file_name']: row for row in response.json()['results']}
+        self.assertEqual(by_name['test_0.pdf']['fund_name'], 'Fund 0')
+        self.assertEqual(by_name['test_0.pdf']['fund_code'], 'F0')
+        self.assertEqual(by_name['test_1.pdf']['fund_name'], 'Blob Fund 1')
+        self.assertEqual(by_name['test_1.pdf']['fund_code'], 'BLOB1')
+
+    def test_structured_fields_fall_back_to_their_value(self):
+        Document.objects.create(
+            file='documents/structured.pdf', file_name='structured.pdf', status='completed',
+            extracted_data={
+                'fund_name': {'value': 'Quỹ Đầu tư Cổ phiếu', 'page': 1, 'bbox': [10, 10, 40, 300]},
+                'fund_code': {'value': None, 'page': None, 'bbox': None},
+            },
+        )
+        response = self.client.get(reverse('document-list'), {'limit': 100})
+        row = next(r for r in response.json()['results'] if r['file_name'] == 'structured.pdf')
+        self.assertEqual(row['fund_name'], 'Quỹ Đầu tư Cổ phiếu')
+        self.assertIsNone(row['fund_code'])
+        self.assertEqual(response.json()['count'], 13)
+
+    def test_keyset_pages_cover_all_documents_once(self):
+        url = reverse('document-list')
+        seen = []
+        cursor = None
+        while True:
+            params = {'limit': 5}
+            if cursor:
+                params['cursor'] = cursor
+            with self.assertNumQueries(1):
+                payload = self.client.get(url, params).json()
+            seen.extend(row['id'] for row in payload['results'])
+            self.assertEqual(payload['count'], 12)
+            cursor = payload['next_cursor']
+            if not cursor:
+                break
+
+        expected = list(Document.objects.order_by('-uploaded_at', '-id').values_list('id', flat=True))
+        self.assertEqual(seen, expected)
+
+    def test_invalid_cursor_is_rejected(self):
+        response = self.client.get(reverse('document-list'), {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 400)
+
+
+class DocumentStatsTests(TestCase):
+    """Dashboard stats: one aggregate query, then served from cache."""
+
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()
+        for i, (doc_status, rag_status) in enumerate([
+            ('completed', 'completed'),
+            ('completed', 'running'),
+            ('failed', 'not_started'),
+            ('pending', 'queued'),
+        ]):
+            Document.objects.create(
+                file=f'documents/stats_{i}.pdf',
+                file_name=f'stats_{i}.pdf',
+                status=doc_status,
+                rag_status=rag_status,
+            )
+
+    def test_stats_single_query_and_counts(self):
+        url = reverse('document-stats')
+        with self.assertNumQueries(1):
+            payload = self.client.get(url).json()
+        self.assertEqual(payload['total'], 4)
+        self.assertEqual(payload['completed'], 2)
+        self.assertEqual(payload['failed'], 1)
+        self.assertEqual(payload['pending'], 1)
+        self.assertEqual(payload['rag']['completed'], 1)
+        self.assertEqual(payload['rag']['queued'], 1)
+        self.assertIn('docs_per_hour', payload['throughput'])
+
+        with self.assertNumQueries(0):
+            self.client.get(url)
+
+    def test_saving_a_document_invalidates_stats(self):
+        url = reverse('document-stats')
+        self.client.get(url)
+        Document.objects.create(file='documents/stats_new.pdf', file_name='stats_new.pdf')
+        self.assertEqual(self.client.get(url).json()['total'], 5)
+
+
+class DocumentDetailTests(TestCase):
+    """Document detail: sparse fieldsets and bounding boxes served separately."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.document = Document.objects.create(
+            file='documents/detail.pdf',
+            file_name='detail.pdf',
+            status='completed',
+            extracted_data={
+                'fund_name': {'value': 'Alpha', 'page': 1, 'bbox': [10, 20, 30, 40]},
+                'fees': {'management_fee': {'value': '1.5%', 'page': 3, 'bbox': [50, 60, 70, 80]}},
+            },
+        )
+        ExtractedFundData.objects.create(document=cls.document, fund_name='Alpha')
+        cls.url = reverse('document-detail', kwargs={'pk': cls.document.pk})
+
+    def test_bboxes_are_left_out_by_default(self):
+        data = self.client.get(self.url).json()
+        self.assertEqual(data['extracted_data']['fund_name'], {'value': 'Alpha', 'page': 1})
+        self.assertEqual(data['fund_data']['fund_name'], 'Alpha')
+
+        inline = self.client.get(self.url, {'provenance': 'inline'}).json()
+        self.assertEqual(inline['extracted_data']['fund_name']['bbox'], [10, 20, 30, 40])
+
+    def test_fields_and_exclude(self):
+        data = self.client.get(self.url, {'fields': 'id,status,fund_data', 'exclude': 'fund_data'}).json()
+        self.assertEqual(set(data), {'id', 'status'})
+
+    def test_fund_data_is_joined_in_one_query(self):
+        with self.assertNumQueries(1):
+            self.client.get(self.url)
+
+    def test_provenance_endpoint(self):
+        url = reverse('document-provenance', kwargs={'pk': self.document.pk})
+        fields = self.client.get(url, {'page': 3}).json()['fields']
+        self.assertEqual(fields, [{'path': '/fees/management_fee', 'page': 3, 'bbox': [50, 60, 70, 80]}])
+
+    def test_round_trip_without_bboxes_keeps_provenance(self):
+        extracted = self.client.get(self.url).json()['extracted_data']
+        extracted['fund_name']['value'] = 'Alpha Prime'
+        response = self.client.patch(self.url, data={'extracted_data': extracted}, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+
+        self.document.refresh_from_db()
+        self.assertEqual(
+            self.document.extracted_data['fund_name'], {'value': 'Alpha Prime', 'page': 1, 'bbox': [10, 20, 30, 40]}
+        )
+        self.assertEqual(self.document.extracted_data['fees']['management_fee']['bbox'], [50, 60, 70, 80])
+        log = DocumentChangeLog.objects.get(document=self.document)
+        self.assertEqual(log.changes, {'fund_name': {'old': 'Alpha', 'new': 'Alpha Prime'}})
+        self.assertEqual([op['path'] for op in log.operations], ['/fund_name/value'])
+
+    def test_inline_provenance_updates_are_taken_as_is(self):
+        extracted = self.client.get(self.url, {'provenance': 'inline'}).json()['extracted_data']
+        del extracted['fund_name']['bbox']
+        url = f"{self.url}?provenance=inline"
+        self.client.patch(url, data={'extracted_data': extracted}, content_type='application/json')
+
+        self.document.refresh_from_db()
+        self.assertEqual(self.document.extracted_data['fund_name'], {'value': 'Alpha', 'page': 1})
+
+
+class ExtractedDataPatchTests(TestCase):
+    """JSON Patch edits of extracted_data."""
+
+    def setUp(self):
+        self.document = Document.objects.create(
+            file='documents/patch.pdf',
+            file_name='patch.pdf',
+            status='completed',
+            extracted_data={
+                'fund_name': {'value': 'Old Fund', 'page': 1},
+                'fees': {'management_fee': {'value': '2%', 'page': 4}},
+                'portfolio': [],
+            },
+        )
+        ExtractedFundData.objects.create(
+            document=self.document, fund_name='Old Fund', management_fee='2%'
+        )
+        self.url = reverse('document-patch-extracted-data', kwargs={'pk': self.document.pk})
+
+    def _patch(self, body, content_type='application/json-patch+json'):
+        import json
+        return self.client.patch(self.url, data=json.dumps(body), content_type=content_type)
+
+    def test_replace_logs_path_and_syncs_only_affected_columns(self):
+        response = self._patch([
+            {'op': 'replace', 'path': '/fees/management_fee/value', 'value': '1.5%'},
+        ])
+        self.assertEqual(response.status_code, 200)
+        payload = response.json()
+        self.assertEqual(payload['changes'], {'fees.management_fee': {'old': '2%', 'new': '1.5%'}})
+        self.assertIn('management_fee', payload['updated_columns'])
+        self.assertNotIn('fund_name', payload['updated_columns'])
+
+        self.document.refresh_from_db()
+        self.assertEqual(self.document.extracted_data['fees']['management_fee'], {'value': '1.5%', 'page': 4})
+        self.assertEqual(self.document.edit_count, 1)
+        self.assertEqual(ExtractedFundData.objects.get(document=self.document).management_fee, '1.5%')
+        log = DocumentChangeLog.objects.get(document=self.document)
+        self.assertEqual(list(log.changes), ['fees.management_fee'])
+
+    def test_object_body_with_comment(self):
+        response = self._patch(
+            {'operations': [{'op': 'add', 'path': '/portfolio/-', 'value': {'name': 'VNM'}}],
+             'user_comment': 'add holding'},
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(DocumentChangeLog.objects.get(document=self.document).user_comment, 'add holding')
+        self.assertEqual(ExtractedFundData.objects.get(document=self.document).portfolio, [{'name': 'VNM'}])
+
+    def test_failed_test_op_changes_nothing(self):
+        response = self._patch([
+            {'op': 'replace', 'path': '/fund_name/value', 'value': 'New Fund'},
+            {'op': 'test', 'path': '/fees/management_fee/value', 'value': '9%'},
+        ])
+        self.assertEqual(response.status_code, 409)
+        self.document.refresh_from_db()
+        self.assertEqual(self.document.extracted_data['fund_name']['value'], 'Old Fund')
+        self.assertEqual(self.document.edit_count, 0)
+
+    def test_malformed_patch_is_rejected(self):
+        response = self._patch([{'op': 'replace', 'path': 'fund_name'}])
+        self.assertEqual(response.status_code, 400)
+
+
+class ExtractedDataVersioningTests(TestCase):
+    """Snapshots + deltas: as-of reads and rollback."""
+
+    def setUp(self):
+        patcher = mock.patch.object(versioning, 'SNAPSHOT_INTERVAL', 3)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.document = Document.objects.create(
+            file='documents/versions.pdf',
+            file_name='versions.pdf',
+            status='completed',
+            extracted_data={'fund_code': {'value': 'V0', 'page': 1}},
+        )
+        patch_url = reverse('document-patch-extracted-data', kwargs={'pk': self.document.pk})
+        for i in range(1, 8):
+            self.client.patch(
+                patch_url,
+                data=[{'op': 'replace', 'path': '/fund_code/value', 'value': f'V{i}'}],
+                content_type='application/json',
+            )
+        self.as_of_url = reverse('document-extracted-data-as-of', kwargs={'pk': self.document.pk})
+
+    def test_snapshots_are_periodic(self):
+        versions = sorted(DocumentSnapshot.objects.filter(document=self.document).values_list('version', flat=True))
+        self.assertEqual(versions, [0, 3, 6])
+
+    def test_every_version_is_reconstructed(self):
+        for version in range(0, 8):
+            payload = self.client.get(self.as_of_url, {'version': version}).json()
+            self.assertEqual(payload['extracted_data']['fund_code'], {'value': f'V{version}', 'page': 1})
+
+    def test_replay_is_bounded_by_snapshot_interval(self):
+        document = Document.objects.get(pk=self.document.pk)
+        # snapshot lookup + at most SNAPSHOT_INTERVAL - 1 deltas in one query
+        with self.assertNumQueries(2):
+            versioning.data_as_of(document, 5)
+
+    def test_as_of_timestamp(self):
+        log = DocumentChangeLog.objects.get(document=self.document, version=4)
+        payload = self.client.get(self.as_of_url, {'at': log.changed_at.isoformat()}).json()
+        self.assertEqual(payload['version'], 4)
+
+    def test_future_version_is_404(self):
+        self.assertEqual(self.client.get(self.as_of_url, {'version': 99}).status_code, 404)
+
+    def test_rollback_is_recorded_as_new_edit(self):
+        url = reverse('document-rollback', kwargs={'pk': self.document.pk})
+        response = self.client.post(url, {'version': 2}, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['edit_count'], 8)
+
+        self.document.refresh_from_db()
+        self.assertEqual(self.document.extracted_data['fund_code']['value'], 'V2')
+        self.assertEqual(ExtractedFundData.objects.get(document=self.document).fund_code, 'V2')
+        # The pre-rollback state is still reachable
+        payload = self.client.get(self.as_of_url, {'version': 7}).json()
+        self.assertEqual(payload['extracted_data']['fund_code']['value'], 'V7')
+
+
+class ChatHistoryTests(TestCase):
+    """Chat history: append-only rows, paginated reads, bounded retention."""
+
+    def setUp(self):
+        self.document = Document.objects.create(file='documents/chat.pdf', file_name='chat.pdf')
+        self.url = reverse('document-chat-history', kwargs={'pk': self.document.pk})
+        patcher = mock.patch.object(chat_history, 'schedule_prune')
+        self.schedule_prune = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _append(self, count):
+        history = [{'sender': 'user' if i % 2 == 0 else 'ai', 'text': f'm{i}'} for i in range(count)]
+        return self.client.post(self.url, {'history': history}, content_type='application/json')
+
+    def test_append_is_a_single_insert(self):
+        self._append(4)
+        # document lookup + one INSERT, regardless of how long the history is
+        with self.assertNumQueries(2):
+            response = self._append(2)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(ChatMessage.objects.filter(document=self.document).count(), 6)
+        self.schedule_prune.assert_called_with(self.document.id)
+
+    def test_pages_walk_back_from_newest(self):
+        self._append(7)
+        first = self.client.get(self.url, {'limit': 3}).json()
+        self.assertEqual([m['text'] for m in first['history']], ['m4', 'm5', 'm6'])
+
+        second = self.client.get(self.url, {'limit': 3, 'before': first['next_before']}).json()
+        self.assertEqual([m['text'] for m in second['history']], ['m1', 'm2', 'm3'])
+
+        last = self.client.get(self.url, {'limit': 3, 'before': second['next_before']}).json()
+        self.assertEqual([m['text'] for m in last['history']], ['m0'])
+        self.assertIsNone(last['next_before'])
+
+    def test_prune_keeps_newest(self):
+        self._append(10)
+        self.assertEqual(chat_history.prune(self.document.id, keep=4), 6)
+        texts = list(ChatMessage.objects.filter(document=self.document).values_list('text', flat=True))
+        self.assertEqual(texts, ['m6', 'm7', 'm8', 'm9'])
+
+    def test_put_replaces_history(self):
+        self._append(3)
+        response = self.client.put(
+            self.url, {'history': [{'sender': 'ai', 'text': 'only', 'chunks_count': 5}]},
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 200)
+        history = self.client.get(self.url).json()['history']
+        self.assertEqual(len(history), 1)
+        self.assertEqual(history[0]['chunks_count'], 5)
+
+
+class RagTextCleaningTests(SimpleTestCase):
+    """Loop-glitch and header/footer removal before chunking."""
+
+    def test_repeated_phrase_is_collapsed(self):
+        loop = 'sở hữu của một Quỹ '
+        text = f'Tài sản {loop * 6}được giám sát'
+        self.assertEqual(text_cleaning.collapse_repeats(text), f'Tài sản {loop}được giám sát')
+
+    def test_long_near_repeating_line_is_left_alone(self):
+        line = ''.join('ab'[(i * i) % 7 % 2] for i in range(20000))
+        cleaned = text_cleaning.collapse_repeats(line)
+        self.assertLessEqual(len(cleaned), len(line))
+
+    def test_running_headers_and_footers_are_removed(self):
+        pages = [
+            f'=== PAGE {n} ===\nCÔNG TY QUẢN LÝ QUỸ ABC\nĐiều {n}. Nội dung riêng của trang {n}\n'
+            f'Phí quản lý {n}%\nGhi chú {"xyz" * n}\nTrang {n}/10'
+            for n in range(1, 11)
+        ]
+        cleaned = text_cleaning.strip_page_boilerplate('\n'.join(pages))
+        self.assertNotIn('CÔNG TY QUẢN LÝ QUỸ ABC', cleaned)
+        self.assertNotIn('Trang 3/10', cleaned)
+        self.assertIn('Điều 3. Nội dung riêng của trang 3', cleaned)
+        self.assertEqual(cleaned.count('=== PAGE'), 10)
+
+
+class ChunkDedupTests(SimpleTestCase):
+    """Near-duplicate chunks are embedded once and keep every page."""
+
+    class Chunk:
+        def __init__(self, text, page):
+            self.page_content = text
+            self.metadata = {'page_number': page}
+
+    def test_near_duplicates_collapse_to_first_occurrence(self):
+        disclaimer = ('Nhà đầu tư cần đọc kỹ bản cáo bạch và điều lệ quỹ trước khi quyết định đầu tư. '
+                      'Giá trị chứng chỉ quỹ có thể tăng hoặc giảm và kết quả hoạt động trong quá khứ '
+                      'không đảm bảo cho kết quả trong tương lai của quỹ đầu tư.')
+        chunks = [
+            self.Chunk(disclaimer, 2),
+            self.Chunk('Phí quản lý là 1,5% giá trị tài sản ròng mỗi năm, trả hàng tháng cho công ty quản lý quỹ.', 3),
+            self.Chunk(disclaimer.replace('tăng hoặc giảm', 'tăng/giảm'), 9),
+            self.Chunk(disclaimer, 14),
+        ]
+        kept = dedup.collapse_chunks(chunks)
+        self.assertEqual(len(kept), 2)
+        self.assertIs(kept[0], chunks[0])
+        self.assertEqual(kept[0].metadata['page_numbers'], [2, 9, 14])
+        self.assertEqual(kept[1].metadata['page_numbers'], [3])
+
+    def test_distinct_chunks_are_kept(self):
+        texts = [f'Điều {i}: quỹ được phép đầu tư tối đa {i * 5}% vào cổ phiếu nhóm {i}' for i in range(1, 6)]
+        self.assertEqual(len(dedup.near_duplicate_groups(texts)), 5)
+
+    def test_tables_differing_only_in_numbers_are_kept(self):
+        rows = ['Phí phát hành', 'Phí mua lại', 'Phí chuyển đổi', 'Phí quản lý', 'Phí giám sát', 'Phí lưu ký']
+        table = ' | '.join(f'{row} | tối đa {{}}% giá trị giao dịch' for row in rows)
+        class_a = table.format('1,5', '1,0', '0,5', '1,9', '0,02', '0,06')
+        class_b = table.format('2,5', '1,0', '0,5', '1,9', '0,02', '0,06')
+        self.assertGreaterEqual(dedup.jaccard(dedup.shingles(class_a), dedup.shingles(class_b)), 0.85)
+
+        kept = dedup.collapse_chunks([self.Chunk(class_a, 5), self.Chunk(class_b, 6), self.Chunk(class_a, 20)])
+        self.assertEqual([chunk.metadata['page_numbers'] for chunk in kept], [[5, 20], [6]])
+
+
+class ShardedOcrTests(SimpleTestCase):
+    """Large PDFs are OCRed in page-range shards; only failed shards are retried."""
+
+    def setUp(self):
+        import fitz
+
+        pdf = fitz.open()
+        for number in range(1, 46):
+            pdf.new_page().insert_text((72, 72), f'PAGE-{number}')
+        handle, self.pdf_path = tempfile.mkstemp(suffix='.pdf')
+        os.close(handle)
+        pdf.save(self.pdf_path)
+        pdf.close()
+        self.addCleanup(os.remove, self.pdf_path)
+
+    def test_pages_keep_global_order_and_failed_shard_is_retried_alone(self):
+        import fitz
+
+        calls = []
+
+        def fake_ocr(content, file_name):
+            calls.append(file_name)
+            if file_name.endswith('_p21-40.pdf') and calls.count(file_name) == 1:
+                raise RuntimeError('connection reset')
+            with fitz.open(stream=content, filetype='pdf') as shard:
+                return [page.get_text().strip() for page in shard]
+
+        with mock.patch('api.ocr_sharding.time.sleep'):
+            pages = ocr_sharding.ocr_in_shards(self.pdf_path, fake_ocr, shard_pages=20, concurrency=3)
+
+        self.assertEqual(pages, [f'PAGE-{n}' for n in range(1, 46)])
+        self.assertEqual(len(calls), 4)
+        self.assertEqual(sum(name.endswith('_p21-40.pdf') for name in calls), 2)
+
+    def test_gives_up_after_max_attempts(self):
+        def always_fails(content, file_name):
+            raise RuntimeError('unavailable')
+
+        with mock.patch('api.ocr_sharding.time.sleep'):
+            with self.assertRaises(ocr_sharding.ShardOCRError):
+                ocr_sharding.ocr_in_shards(self.pdf_path, always_fails, shard_pages=20, max_attempts=2)
+
+
+class PageRoutingTests(SimpleTestCase):
+    """Digital pages are read locally; only scanned/table pages are OCRed."""
+
+    def setUp(self):
+        import fitz
+
+        pdf = fitz.open()
+        body = 'Quy dau tu co phieu ABC. Phi quan ly 1,5%/nam. ' * 10
+        # Page 1: digital text
+        pdf.new_page().insert_textbox(fitz.Rect(72, 72, 540, 700), f'DIGITAL-1 {body}')
+        # Page 2: "scanned" - a full-page image, no text layer
+        scan = pdf.new_page()
+        pixmap = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, 60, 80), False)
+        pixmap.clear_with(200)
+        scan.insert_image(scan.rect, pixmap=pixmap)
+        # Page 3: text inside a ruled table
+        table = pdf.new_page()
+        table.insert_textbox(fitz.Rect(72, 72, 540, 700), f'TABLE-3 {body}')
+        for row in range(30):
+            table.draw_line((72, 100 + row * 15), (540, 100 + row * 15))
+        for col in range(12):
+            table.draw_line((72 + col * 39, 100), (72 + col * 39, 535))
+        # Page 4: digital text
+        pdf.new_page().insert_textbox(fitz.Rect(72, 72, 540, 700), f'DIGITAL-4 {body}')
+
+        handle, self.pdf_path = tempfile.mkstemp(suffix='.pdf')
+        os.close(handle)
+        pdf.save(self.pdf_path)
+        pdf.close()
+        self.addCleanup(os.remove, self.pdf_path)
+
+    def test_classification(self):
+        routes = page_routing.route_pages(self.pdf_path)
+        self.assertEqual([r.route for r in routes], ['text', 'ocr', 'ocr', 'text'])
+
+    def test_only_routed_pages_are_ocred_and_order_is_kept(self):
+        requested = []
+
+        def fake_ocr(pages):
+            requested.extend(pages)
+            return [f'OCR-{p + 1}' for p in pages]
+
+        markdown = page_routing.routed_markdown(self.pdf_path, fake_ocr)
+
+        self.assertEqual(requested, [1, 2])
+        markers = [markdown.index(f'=== PAGE {n} ===') for n in range(1, 5)]
+        self.assertEqual(markers, sorted(markers))
+        self.assertIn('DIGITAL-1', markdown)
+        self.assertIn('OCR-2', markdown)
+        self.assertIn('OCR-3', markdown)
+        self.assertIn('DIGITAL-4', markdown)
+
+    def test_subset_shards_contain_only_requested_pages(self):
+        import fitz
+
+        def fake_ocr(content, file_name):
+            with fitz.open(stream=content, filetype='pdf') as shard:
+                return [page.get_text().split(' ')[0].strip() or 'IMAGE' for page in shard]
+
+        pages = ocr_sharding.ocr_in_shards(self.pdf_path, fake_ocr, pages=[2, 1], shard_pages=20)
+        self.assertEqual(pages, ['IMAGE', 'TABLE-3'])
+
+
+class OCRBrokerTests(SimpleTestCase):
+    """Concurrent callers share one OCR per (file hash, page)."""
+
+    def setUp(self):
+        handle, self.pdf_path = tempfile.mkstemp(suffix='.pdf')
+        with os.fdopen(handle, 'wb') as f:
+            f.write(b'%PDF-1.4 broker test')
+        self.addCleanup(os.remove, self.pdf_path)
+        self.broker = ocr_broker.OCRBroker()
+
+    def test_concurrent_callers_share_pages(self):
+        calls = []
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_ocr(pages):
+            calls.append(list(pages))
+            started.set()
+            release.wait(5)
+            return [f'md-{p}' for p in pages]
+
+        results = {}
+        first = threading.Thread(
+            target=lambda: results.setdefault('first', self.broker.ocr_pages(self.pdf_path, [0, 1, 2], slow_ocr))
+        )
+        first.start()
+        started.wait(5)
+        second = threading.Thread(
+            target=lambda: results.setdefault('second', self.broker.ocr_pages(self.pdf_path, [1, 2, 3], slow_ocr))
+        )
+        second.start()
+        release.set()
+        first.join(5)
+        second.join(5)
+
+        self.assertEqual(calls, [[0, 1, 2], [3]])
+        self.assertEqual(results['first'], ['md-0', 'md-1', 'md-2'])
+        self.assertEqual(results['second'], ['md-1', 'md-2', 'md-3'])
+
+    def test_failed_pages_are_retried_by_the_next_caller(self):
+        def failing(pages):
+            raise RuntimeError('upload failed')
+
+        with self.assertRaises(RuntimeError):
+            self.broker.ocr_pages(self.pdf_path, [0], failing)
+        self.assertEqual(self.broker.ocr_pages(self.pdf_path, [0], lambda pages: ['ok']), ['ok'])
+
+    def test_seeded_pages_skip_ocr(self):
+        markdown = '\n\n=== PAGE 1 ===\nfirst\n\n=== PAGE 2 ===\nsecond'
+        self.assertEqual(page_routing.split_page_markdown(markdown), {0: 'first', 1: 'second'})
+
+        self.broker.seed(self.pdf_path, page_routing.split_page_markdown(markdown))
+        calls = []
+        pages = self.broker.ocr_pages(self.pdf_path, [0, 1, 2], lambda p: calls.append(p) or ['third'])
+        self.assertEqual(pages, ['first', 'second', 'third'])
+        self.assertEqual(calls, [[2]])
+
+
+class JobLockTests(TestCase):
+    """Only one ingestion/processing job per document runs at a time."""
+
+    def test_concurrent_caller_attaches_to_running_job(self):
+        started = threading.Event()
+        release = threading.Event()
+        runs = []
+
+        def job():
+            runs.append(1)
+            started.set()
+            release.wait(5)
+            return 'done'
+
+        results = []
+        attached = threading.Event()
+        with mock.patch.object(job_lock, 'advisory_lock') as lock, \
+                mock.patch.object(job_lock.logger, 'info', side_effect=lambda msg: attached.set()):
+            lock.return_value.__enter__.return_value = True
+            owner = threading.Thread(target=lambda: results.append(job_lock.run_exclusive('rag_ingest', 1, job)))
+            owner.start()
+            started.wait(5)
+            self.assertTrue(job_lock.is_running('rag_ingest', 1))
+            waiter = threading.Thread(target=lambda: results.append(job_lock.run_exclusive('rag_ingest', 1, job)))
+            waiter.start()
+            attached.wait(5)
+            release.set()
+            owner.join(5)
+            waiter.join(5)
+
+        self.assertEqual(runs, [1])
+        self.assertEqual(results, ['done', 'done'])
+        self.assertFalse(job_lock.is_running('rag_ingest', 1))
+
+    def test_advisory_lock_is_exclusive(self):
+        with job_lock.advisory_lock('rag_ingest', 42) as first:
+            with job_lock.advisory_lock('rag_ingest', 42) as second:
+                self.assertTrue(first)
+                self.assertFalse(second)
+            with job_lock.advisory_lock('process', 42) as other_kind:
+                self.assertTrue(other_kind)
+        with job_lock.advisory_lock('rag_ingest', 42) as again:
+            self.assertTrue(again)
+
+
+class GeminiUploadTests(SimpleTestCase):
+    """Gemini uploads are reused by content hash and polled with backoff."""
+
+    class FakeFiles:
+        def __init__(self, processing_polls=2):
+            self.uploads = []
+            self.polls = {}
+            self.processing_polls = processing_polls
+
+        def _file(self, name, state):
+            # `name` is a Mock constructor argument, so set it afterwards
+            uploaded = mock.Mock(uri=f'files/{name}', state=mock.Mock())
+            uploaded.name = name
+            uploaded.state.name = state
+            return uploaded
+
+        def upload(self, file, config):
+            name = f'f{len(self.uploads)}'
+            self.uploads.append(file)
+            self.polls[name] = 0
+            return self._file(name, 'PROCESSING')
+
+        def get(self, name):
+            self.polls[name] += 1
+            return self._file(name, 'PROCESSING' if self.polls[name] < self.processing_polls else 'ACTIVE')
+
+    def setUp(self):
+        gemini_uploads._uploads.clear()
+        self.addCleanup(gemini_uploads._uploads.clear)
+        self.client = mock.Mock(files=self.FakeFiles())
+        self.types = mock.Mock()
+        handle, self.pdf_path = tempfile.mkstemp(suffix='.pdf')
+        with os.fdopen(handle, 'wb') as f:
+            f.write(b'%PDF-1.4 gemini upload test')
+        self.addCleanup(os.remove, self.pdf_path)
+
+    def test_polls_with_exponential_backoff(self):
+        with mock.patch('api.gemini_uploads.time.sleep') as sleep:
+            uploaded = gemini_uploads.get_active_file(self.client, self.types, self.pdf_path)
+        self.assertEqual(uploaded.state.name, 'ACTIVE')
+        self.assertEqual([c.args[0] for c in sleep.call_args_list], [0.5, 1.0])
+
+    def test_same_content_is_uploaded_once(self):
+        with mock.patch('api.gemini_uploads.time.sleep'):
+            gemini_uploads.prefetch(self.client, self.types, self.pdf_path).result(5)
+            first = gemini_uploads.get_active_file(self.client, self.types, self.pdf_path)
+            second = gemini_uploads.get_active_file(self.client, self.types, self.pdf_path)
+        self.assertEqual(len(self.client.files.uploads), 1)
+        self.assertEqual(first.name, second.name)
+
+    def test_forgotten_or_expired_uploads_are_redone(self):
+        with mock.patch('api.gemini_uploads.time.sleep'):
+            gemini_uploads.get_active_file(self.client, self.types, self.pdf_path)
+            gemini_uploads.forget(self.pdf_path)
+            gemini_uploads.get_active_file(self.client, self.types, self.pdf_path)
+            with mock.patch.object(gemini_uploads, 'GEMINI_UPLOAD_TTL_SECONDS', -1):
+                gemini_uploads.forget(self.pdf_path)
+                gemini_uploads.get_active_file(self.client, self.types, self.pdf_path)
+                gemini_uploads.get_active_file(self.client, self.types, self.pdf_path)
+        self.assertEqual(len(self.client.files.uploads), 4)
+
+
+class SectionedExtractionTests(SimpleTestCase):
+    """Map-reduce extraction by keyword section, merged deterministically."""
+
+    def test_section_pages(self):
+        categories = {4: {'fees'}, 5: {'tables'}, 6: {'tables', 'fees'}}
+        sections = sectioned_extraction.section_pages(8, categories)
+        self.assertEqual(sections['identity'], [0, 1, 2, 3, 7])
+        self.assertEqual(sections['fees'], [4, 6])
+        self.assertEqual(sections['tables'], [5, 6])
+        # A category that matched nothing gets the whole document
+        self.assertEqual(sectioned_extraction.section_pages(3, {})['fees'], [0, 1, 2])
+
+    def test_merge_prefers_each_sections_own_keys(self):
+        partials = {
+            'tables': {'portfolio': [{'security_code': {'value': 'VIC'}}], 'fund_name': {'value': 'Wrong'}},
+            'identity': {'fund_name': {'value': 'Quỹ ABC', 'page': 1}, 'fees': {'management_fee': None}},
+            'fees': {'fees': {'management_fee': {'value': '1,5%'}, 'switching_fee': {'value': 'N/A'}}},
+        }
+        merged = sectioned_extraction.merge_sections(partials)
+        self.assertEqual(merged['fund_name']['value'], 'Quỹ ABC')
+        self.assertEqual(merged['fees'], {'management_fee': {'value': '1,5%'}, 'switching_fee': {'value': 'N/A'}})
+        self.assertEqual(merged['portfolio'][0]['security_code']['value'], 'VIC')
+
+    def test_extract_sectioned_remaps_pages_and_survives_a_failed_section(self):
+        calls = []
+        previews = []
+
+        def extract(pages, keys):
+            calls.append(tuple(pages))
+            if 'portfolio' in keys:
+                raise RuntimeError('timeout')
+            if 'fees' in keys:
+                return {'fees': {'management_fee': {'value': '1%', 'page': 2, 'bbox': [1, 2, 3, 4]}}}
+            return {'fund_name': {'value': 'ABC', 'page': 1, 'bbox': [1, 2, 3, 4]}}
+
+        result = sectioned_extraction.extract_sectioned(
+            6, {4: {'fees'}, 5: {'fees'}}, extract,
+            on_section=lambda name, partial: previews.append(name),
+        )
+
+        # Section-local page 2 of the fees section is document page 6
+        self.assertEqual(result['fees']['management_fee']['page'], 6)
+        self.assertEqual(result['fund_name']['page'], 1)
+        self.assertNotIn('portfolio', result)
+        self.assertEqual(sorted(previews), ['fees', 'identity'])
+        # The failing section was retried once
+        self.assertEqual(calls.count(tuple(range(6))), sectioned_extraction.SECTION_MAX_ATTEMPTS)
+
+
+class ExtractionCacheTests(TestCase):
+    def setUp(self):
+        self.digest = extraction_cache.prompt_hash('prompt v1')
+        self.key = extraction_cache.cache_key('a' * 64, 'gemini', 'gemini-2.5-flash-lite', self.digest, {'sectioned': False})
+
+    def store(self, data, page_map=(1, 2, 5), page_categories=None):
+        extraction_cache.store(self.key, 'a' * 64, 'gemini', 'gemini-2.5-flash-lite', self.digest,
+                               data, list(page_map) if page_map else None, page_categories)
+
+    def test_key_changes_with_prompt_model_and_file(self):
+        same = extraction_cache.cache_key('a' * 64, 'gemini', 'gemini-2.5-flash-lite', self.digest, {'sectioned': False})
+        self.assertEqual(same, self.key)
+        others = [
+            extraction_cache.cache_key('a' * 64, 'gemini', 'gemini-2.5-flash-lite',
+                                       extraction_cache.prompt_hash('prompt v2'), {'sectioned': False}),
+            extraction_cache.cache_key('a' * 64, 'mistral', 'gemini-2.5-flash-lite', self.digest, {'sectioned': False}),
+            extraction_cache.cache_key('b' * 64, 'gemini', 'gemini-2.5-flash-lite', self.digest, {'sectioned': False}),
+            extraction_cache.cache_key('a' * 64, 'gemini', 'gemini-2.5-flash-lite', self.digest, {'sectioned': True}),
+        ]
+        self.assertNotIn(self.key, others)
+
+    def test_hit_returns_copy_and_counts(self):
+        self.store({'fund_name': {'value': 'Quỹ A', 'page': 2, 'bbox': [0, 0, 1, 1]}}, page_categories={4: {'fees'}})
+        data, page_map, page_categories = extraction_cache.use(extraction_cache.lookup(self.key))
+        self.assertEqual(data['fund_name']['page'], 2)
+        self.assertEqual(page_map, [1, 2, 5])
+        self.assertEqual(page_categories, {4: {'fees'}})
+        data['fund_name']['page'] = 5  # remapping the result must not touch the entry
+
+        again, _, _ = extraction_cache.use(extraction_cache.lookup(self.key))
+        self.assertEqual(again['fund_name']['page'], 2)
+        self.assertEqual(ExtractionCacheEntry.objects.get(key=self.key).hits, 2)
+
+    def test_page_selection_limits_are_part_of_the_key(self):
+        service = DocumentProcessingService()
+        service._get_gemini_service = mock.Mock(return_value=mock.Mock(
+            extraction_fingerprint=mock.Mock(return_value=('gemini-2.5-flash-lite', self.digest))
+        ))
+        document = mock.Mock(ocr_model='gemini', file=mock.Mock(path='unused.pdf'))
+        with mock.patch('api.services.file_sha256', return_value='a' * 64):
+            key = extraction_cache.cache_key(*service._extraction_cache_identity(document))
+            with override_settings(MAX_OPTIMIZED_PDF_PAGES=20):
+                self.assertNotEqual(extraction_cache.cache_key(*service._extraction_cache_identity(document)), key)
+            with override_settings(MAX_IDENTITY_SCAN_PAGES=10):
+                self.assertNotEqual(extraction_cache.cache_key(*service._extraction_cache_identity(document)), key)
+
+    def test_parse_failures_are_not_cached(self):
+        self.store({'error': 'Failed to parse JSON', 'raw_text': '...'})
+        self.assertIsNone(extraction_cache.lookup(self.key))
+
+    def test_hit_skips_optimization_and_extraction(self):
+        import fitz
+
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, True)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        os.makedirs(os.path.join(media_root, 'documents'))
+        pdf = fitz.open()
+        for number in range(1, 9):
+            pdf.new_page().insert_text((72, 72), f'PAGE-{number}')
+        pdf.save(os.path.join(media_root, 'documents', 'cached.pdf'))
+        pdf.close()
+        document = Document.objects.create(file='documents/cached.pdf', file_name='cached.pdf', ocr_model='gemini')
+        self.store({'fund_name': {'value': 'Quỹ A', 'page': 3, 'bbox': [1, 2, 3, 4]}}, page_map=(1, 2, 7), page_categories={6: {'identity'}})
+
+        service = DocumentProcessingService()
+        identity = ('a' * 64, 'gemini', 'gemini-2.5-flash-lite', self.digest, {'sectioned': False})
+        with mock.patch.object(service, '_extraction_cache_identity', return_value=identity), \
+                mock.patch.object(service, '_get_gemini_service') as gemini, \
+                mock.patch('api.services.create_optimized_pdf') as optimize, \
+                mock.patch('api.rendering.generate_thumbnails_async'), \
+                mock.patch.dict(os.environ, {'AUTO_RAG_INGEST_ON_UPLOAD': '0'}):
+            service._run_processing(document.id)
+
+        optimize.assert_not_called()
+        gemini.assert_not_called()
+        document.refresh_from_db()
+        self.assertEqual(document.status, 'completed')
+        self.assertEqual(document.extracted_data['fund_name'], {'value': 'Quỹ A', 'page': 7, 'bbox': [1, 2, 3, 4]})
+        self.assertEqual(document.extracted_data['_optimized_page_map'], [1, 2, 7])
+        with fitz.open(document.optimized_file.path) as optimized:
+            self.assertEqual([page.get_text().strip() for page in optimized], ['PAGE-1', 'PAGE-2', 'PAGE-7'])
+
+    def test_reprocess_passes_force(self):
+        document = Document.objects.create(file='documents/cache.pdf', file_name='cache.pdf', status='completed')
+        url = reverse('document-reprocess', kwargs={'pk': document.pk})
+        with mock.patch('api.views.DocumentProcessingService') as service:
+            self.client.post(url, {'force': True}, content_type='application/json')
+            service.return_value.process_document.assert_called_with(document.id, force=True)
+            self.client.post(url)
+            service.return_value.process_document.assert_called_with(document.id, force=False)
+
+
+class ProviderError(Exception):
+    """Stand-in for an SDK error carrying an HTTP status."""
+
+    def __init__(self, status_code, headers=None):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+        self.response = mock.Mock(status_code=status_code, headers=headers or {})
+
+
+class ProviderLimitsTests(SimpleTestCase):
+    def setUp(self):
+        self.limiter = provider_limits.ProviderLimiter('test', 'endpoint', rpm=0)
+        patcher = mock.patch('api.provider_limits.random.uniform', return_value=0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(provider_limits, 'RETRY_BASE_WAIT_SECONDS', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_classify(self):
+        self.assertEqual(provider_limits.classify(ProviderError(429)), 'rate_limited')
+        self.assertEqual(provider_limits.classify(Exception('429 RESOURCE_EXHAUSTED')), 'rate_limited')
+        self.assertEqual(provider_limits.classify(ProviderError(503)), 'transient')
+        self.assertEqual(provider_limits.classify(ConnectionError('reset by peer')), 'transient')
+        self.assertEqual(provider_limits.classify(ProviderError(400)), 'fatal')
+        self.assertEqual(provider_limits.retry_after(ProviderError(429, {'retry-after': '7'})), 7.0)
+        self.assertEqual(provider_limits.retry_after(Exception("429 ... 'retryDelay': '12s'")), 12.0)
+
+    def test_token_bucket_spaces_calls_after_burst(self):
+        bucket = provider_limits.TokenBucket(rate_per_minute=60, burst=2)
+        now = bucket.updated
+        ready = [bucket.reserve(now) - now for _ in range(4)]
+        self.assertEqual([round(r, 3) for r in ready], [0, 0, 1.0, 2.0])
+
+    def test_rate_limit_cools_down_and_retries(self):
+        calls = []
+
+        def fn():
+            calls.append(1)
+            if len(calls) == 1:
+                raise ProviderError(429, {'retry-after': '0.05'})
+            return 'ok'
+
+        self.assertEqual(self.limiter.call(fn), 'ok')
+        stats = self.limiter.snapshot()
+        self.assertEqual((stats['rate_limited'], stats['retries'], stats['failures']), (1, 1, 0))
+        self.assertGreaterEqual(stats['wait_seconds_max'], 0.04)
+
+    def test_client_errors_are_not_retried(self):
+        fn = mock.Mock(side_effect=ProviderError(400))
+        with self.assertRaises(ProviderError):
+            self.limiter.call(fn)
+        self.assertEqual(fn.call_count, 1)
+
+    def test_breaker_fails_fast_then_probes(self):
+        with mock.patch.object(provider_limits, 'PROVIDER_BREAKER_FAILURES', 2):
+            down = mock.Mock(side_effect=ProviderError(503))
+            with self.assertRaises(ProviderError):
+                self.limiter.call(down, max_attempts=2)
+            self.assertEqual(self.limiter.snapshot()['state'], 'open')
+
+            with self.assertRaises(provider_limits.ProviderUnavailable):
+                self.limiter.call(down)
+            self.assertEqual(down.call_count, 2)
+
+            self.limiter.open_until = 0  # reset period over: one probe goes through
+            self.assertEqual(self.limiter.call(lambda: 'up'), 'up')
+            self.assertEqual(self.limiter.snapshot()['state'], 'closed')
+
+    def test_acall_retries_transient_errors(self):
+        attempts = []
+
+        async def fn():
+            attempts.append(1)
+            if len(attempts) == 1:
+                raise ProviderError(503)
+            return 'ok'
+
+        self.assertEqual(asyncio.run(self.limiter.acall(fn)), 'ok')
+        self.assertEqual(self.limiter.snapshot()['retries'], 1)
+
+
+class AsyncProviderClientsTests(SimpleTestCase):
+    """Async provider clients live as long as their event loop."""
+
+    def test_clients_are_per_loop_and_closed_with_it(self):
+        async def clients():
+            first, again = await async_providers.loop_clients(), await async_providers.loop_clients()
+            self.assertIs(first, again)
+            self.assertIs(first.mistral('key'), first.mistral('key'))
+            return first
+
+        first, second = asyncio.run(clients()), asyncio.run(clients())
+        self.assertIsNot(first, second)
+        self.assertTrue(first.http.is_closed)
+        self.assertTrue(second.http.is_closed)
+
+
+class AsyncRAGViewTests(TestCase):
+    """chat / rag_status / search are async views with the DRF endpoints' payloads."""
+
+    def setUp(self):
+        self.document = Document.objects.create(file='documents/async.pdf', file_name='async.pdf', status='completed')
+        patcher = mock.patch.object(async_views, '_shared_service', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def add_chunk(self):
+        DocumentChunk.objects.create(document=self.document, content='Phí quản lý 1,5%/năm', page_number=3, embedding=[0.0] * 1024)
+
+    def test_rag_status(self):
+        self.add_chunk()
+        response = self.client.get(reverse('document-rag-status', kwargs={'pk': self.document.pk}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['chunks_count'], 1)
+        self.assertTrue(response.json()['is_ingested'])
+        self.assertEqual(self.client.get(reverse('document-rag-status', kwargs={'pk': 999999})).status_code, 404)
+
+    def test_chat_requires_ingestion_and_query(self):
+        url = reverse('document-chat', kwargs={'pk': self.document.pk})
+        self.assertEqual(self.client.post(url, {'query': 'Phí?'}, content_type='application/json').status_code, 400)
+        self.add_chunk()
+        response = self.client.post(url, {}, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('query', response.json())
+
+    def test_chat_awaits_service_and_persists_turn(self):
+        self.add_chunk()
+        service = mock.Mock()
+        service.achat = mock.AsyncMock(return_value={'text': 'Phí quản lý là 1,5%/năm [Trang 3]', 'citations': [{'page': 3}]})
+        with mock.patch('api.async_views.RAGService', return_value=service):
+            response = self.client.post(
+                reverse('document-chat', kwargs={'pk': self.document.pk}),
+                {'query': 'Phí quản lý?', 'history': []}, content_type='application/json',
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['answer'], 'Phí quản lý là 1,5%/năm [Trang 3]')
+        service.achat.assert_awaited_once_with(self.document.id, 'Phí quản lý?', [], return_source=True)
+        self.assertEqual(ChatMessage.objects.filter(document=self.document).count(), 2)
+
+    def test_configured_permission_classes_apply(self):
+        from rest_framework.permissions import IsAuthenticated
+
+        self.add_chunk()
+        url = reverse('document-chat', kwargs={'pk': self.document.pk})
+        with mock.patch.object(async_views.chat.cls, 'permission_classes', [IsAuthenticated]), \
+                mock.patch('api.async_views.RAGService') as factory:
+            response = self.client.post(url, {'query': 'Phí?'}, content_type='application/json')
+        self.assertEqual(response.status_code, 403)
+        factory.assert_not_called()
+
+    def test_malformed_json_uses_drf_errors(self):
+        self.add_chunk()
+        response = self.client.post(
+            reverse('document-chat', kwargs={'pk': self.document.pk}), '{"query": ', content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('JSON parse error', response.json()['detail'])
+
+    def test_service_is_built_once_per_process(self):
+        self.add_chunk()
+        service = mock.Mock()
+        service.achat = mock.AsyncMock(return_value={'text': 'ok', 'citations': []})
+        url = reverse('document-chat', kwargs={'pk': self.document.pk})
+        with mock.patch('api.async_views.RAGService', return_value=service) as factory:
+            for _ in range(2):
+                self.client.post(url, {'query': 'Phí?'}, content_type='application/json')
+        factory.assert_called_once_with()
+        self.assertEqual(service.achat.await_count, 2)
+
+    def test_search(self):
+        self.add_chunk()
+        url = reverse('document-search', kwargs={'pk': self.document.pk})
+        self.assertEqual(self.client.get(url).status_code, 400)
+
+        chunk = DocumentChunk.objects.get(document=self.document)
+        service = mock.Mock()
+        service.asearch = mock.AsyncMock(return_value=[chunk])
+        with mock.patch('api.async_views.RAGService', return_value=service):
+            response = self.client.get(url, {'q': 'phí quản lý', 'top_k': '3'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['results'][0]['page'], 3)
+        service.asearch.assert_awaited_once_with(self.document.id, 'phí quản lý', 3)
+
+    def test_chat_batch(self):
+        self.add_chunk()
+        url = reverse('document-chat-batch', kwargs={'pk': self.document.pk})
+        self.assertEqual(self.client.post(url, {'questions': []}, content_type='application/json').status_code, 400)
+
+        service = mock.Mock()
+        service.achat_batch = mock.AsyncMock(return_value=[
+            {'text': 'Phí quản lý là 1,5%/năm [Trang 3]', 'contexts': ['Phí quản lý 1,5%/năm'], 'citations': [{'page': 3}]},
+            {'text': 'Xin lỗi, tôi gặp sự cố khi xử lý câu hỏi.', 'contexts': [], 'error': 'timeout'},
+        ])
+        with mock.patch('api.async_views.RAGService', return_value=service):
+            response = self.client.post(url, {'questions': ['Phí quản lý?', 'Ngân hàng giám sát?']}, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        results = response.json()['results']
+        self.assertEqual([r['query'] for r in results], ['Phí quản lý?', 'Ngân hàng giám sát?'])
+        self.assertEqual(results[0]['contexts'], ['Phí quản lý 1,5%/năm'])
+        self.assertEqual(results[1]['error'], 'timeout')
+        service.achat_batch.assert_awaited_once_with(self.document.id, ['Phí quản lý?', 'Ngân hàng giám sát?'])
+        # Batch answers are not part of the chat conversation
+        self.assertFalse(ChatMessage.objects.filter(document=self.document).exists())
+
+
+class RAGChatBatchTests(TestCase):
+    """chat_batch embeds all questions in one request and answers them concurrently, in order."""
+
+    def setUp(self):
+        self.document = Document.objects.create(file='documents/batch.pdf', file_name='batch.pdf', status='completed')
+        self.service = RAGService.__new__(RAGService)
+        self.service.mistral_api_key = 'key'
+        self.service.embedding_model = 'mistral-embed-2312'
+        self.service.batch_concurrency = 2
+
+    def test_shares_context_and_bounds_parallelism(self):
+        in_flight = peak = 0
+
+        async def generate(system_prompt, history, user_query):
+            nonlocal in_flight, peak
+            in_flight += 1
+            peak = max(peak, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+            if user_query == 'q3':
+                raise RuntimeError('boom')
+            return f'answer {user_query}'
+
+        questions = ['q1', 'q2', 'q3', 'q4', 'q5']
+        embed = mock.AsyncMock(return_value=[[float(i)] for i in range(len(questions))])
+        with mock.patch.object(self.service, '_structured_info', return_value='info') as structured, \
+                mock.patch.object(self.service, '_aretrieve_with_embedding', return_value=[]) as retrieve, \
+                mock.patch.object(self.service, '_agenerate', side_effect=generate), \
+                mock.patch.object(self.service, '_answer_payload',
+                                  side_effect=lambda document, text, chunks, info: {'text': text, 'contexts': []}), \
+                mock.patch('api.services.async_providers.mistral_embed', embed):
+            payloads = self.service.chat_batch(self.document.id, questions)
+
+        structured.assert_called_once()
+        embed.assert_awaited_once_with(self.service.mistral_api_key, 'mistral-embed-2312', questions)
+        retrieve.assert_any_call(self.document.id, 'q1', [0.0])
+        self.assertEqual([p['text'] for p in payloads[:2] + payloads[3:]], ['answer q1', 'answer q2', 'answer q4', 'answer q5'])
+        self.assertEqual(payloads[2]['error'], 'boom')
+        self.assertEqual(peak, 2)
+
+    def test_embedding_failure_answers_without_retrieval(self):
+        with mock.patch.object(self.service, '_structured_info', return_value='info'), \
+                mock.patch.object(self.service, '_search_with_embedding') as search, \
+                mock.patch.object(self.service, '_agenerate', return_value='answer'), \
+                mock.patch.object(self.service, '_answer_payload',
+                                  side_effect=lambda document, text, chunks, info: {'text': text, 'contexts': chunks}), \
+                mock.patch('api.services.async_providers.mistral_embed', side_effect=ProviderError(503)):
+            payloads = self.service.chat_batch(self.document.id, ['q1', 'q2'])
+
+        search.assert_not_called()
+        self.assertEqual(payloads, [{'text': 'answer', 'contexts': []}] * 2)
+
+    def test_searches_stay_on_the_thread_sensitive_executor(self):
+        search_threads, rerank_threads = [], []
+
+        def search(document_id, query, embedding, top_k):
+            search_threads.append(threading.current_thread())
+            return []
+
+        def rerank(user_query, chunks, top_k):
+            rerank_threads.append(threading.current_thread())
+            return chunks
+
+        self.service.retrieval_candidates_k = self.service.rerank_top_k = 5
+        with mock.patch.object(self.service, '_structured_info', return_value='info'), \
+                mock.patch.object(self.service, '_search_with_embedding', side_effect=search), \
+                mock.patch.object(self.service, '_rerank_chunks', side_effect=rerank), \
+                mock.patch.object(self.service, '_agenerate', return_value='answer'), \
+                mock.patch.object(self.service, '_answer_payload',
+                                  side_effect=lambda document, text, chunks, info: {'text': text, 'contexts': chunks}), \
+                mock.patch('api.services.async_providers.mistral_embed', mock.AsyncMock(return_value=[[0.0], [1.0]])):
+            payloads = self.service.chat_batch(self.document.id, ['q1', 'q2'])
+
+        self.assertEqual([p['text'] for p in payloads], ['answer', 'answer'])
+        self.assertEqual((len(search_threads), len(rerank_threads)), (2, 2))
+        # Database work runs where the request's connection lives; only FlashRank is pooled
+        self.assertEqual(set(search_threads), {threading.current_thread()})
+        self.assertNotIn(threading.current_thread(), rerank_threads)
+
+
+class OptimizedPagesTests(TestCase):
+    """optimized_pages returns page metadata in offset/limit windows with versioned image URLs."""
+
+    def setUp(self):
+        import fitz
+
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, True)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        os.makedirs(os.path.join(self.media_root, 'optimized_documents'))
+        self.pdf_path = os.path.join(self.media_root, 'optimized_documents', 'paged.pdf')
+        pdf = fitz.open()
+        for number in range(1, 31):
+            pdf.new_page().insert_text((72, 72), f'PAGE-{number}')
+        pdf.save(self.pdf_path)
+        pdf.close()
+
+        self.document = Document.objects.create(
+            file='documents/paged.pdf', file_name='paged.pdf', status='completed',
+            optimized_file='optimized_documents/paged.pdf',
+            extracted_data={'_optimized_page_map': list(range(101, 131))},
+        )
+        self.url = reverse('document-optimized-pages', kwargs={'pk': self.document.pk})
+
+    def test_pages_are_windowed_with_next_offset(self):
+        first = self.client.get(self.url, {'offset': 0, 'limit': 24}).json()
+        self.assertEqual(first['total_pages'], 30)
+        self.assertEqual(len(first['pages']), 24)
+        self.assertEqual(first['next_offset'], 24)
+        self.assertEqual(first['pages'][0]['raw_page_number'], 101)
+
+        rest = self.client.get(self.url, {'offset': first['next_offset'], 'limit': 24}).json()
+        self.assertEqual([p['page_number'] for p in rest['pages']], list(range(25, 31)))
+        self.assertIsNone(rest['next_offset'])
+
+        version = rendering.page_cache_key(self.pdf_path)
+        self.assertTrue(first['pages'][0]['image'].endswith(f'size=thumb&v={version}'))
+
+    def test_limit_is_clamped_and_validated(self):
+        self.assertEqual(len(self.client.get(self.url, {'limit': 1000}).json()['pages']), 30)
+        self.assertEqual(self.client.get(self.url, {'limit': 'all'}).status_code, 400)
+
+    def test_page_cache_key_changes_when_file_changes(self):
+        key = rendering.page_cache_key(self.pdf_path)
+        self.assertEqual(rendering.page_cache_key(self.pdf_path), key)
+        with open(self.pdf_path, 'ab') as handle:
+            handle.write(b'\n%% appended\n')
+        self.assertNotEqual(rendering.page_cache_key(self.pdf_path), key)
+
+
+class AnnotatedCacheTests(SimpleTestCase):
+    """Annotated previews are cached per bbox list and evicted least-recently-used first."""
+
+    def setUp(self):
+        import fitz
+
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, True)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.pdf_path = os.path.join(self.media_root, 'annotated.pdf')
+        pdf = fitz.open()
+        pdf.new_page()
+        pdf.save(self.pdf_path)
+        pdf.close()
+
+    def test_oldest_renders_are_evicted_beyond_the_cap(self):
+        renderer = rendering.AnnotationRenderer(ocr_mode='page')
+        boxes = [[[0, 0, 10 * n, 10 * n]] for n in range(1, 4)]
+        with mock.patch.object(rendering, 'ANNOTATED_CACHE_MAX_FILES', 2), \
+                mock.patch.object(rendering.AnnotationRenderer, 'render', return_value=b'png') as render:
+            first = renderer.render_cached(self.pdf_path, 1, boxes[0])
+            second = renderer.render_cached(self.pdf_path, 1, boxes[1])
+            os.utime(first, ns=(1, 1))
+            os.utime(second, ns=(2, 2))
+
+            # Serving the first again makes it the most recently used
+            self.assertEqual(renderer.render_cached(self.pdf_path, 1, boxes[0]), first)
+            third = renderer.render_cached(self.pdf_path, 1, boxes[2])
+
+        self.assertEqual(render.call_count, 3)
+        self.assertTrue(os.path.exists(first))
+        self.assertFalse(os.path.exists(second))
+        self.assertTrue(os.path.exists(third))
+
+
+class OcrTokenIndexTests(SimpleTestCase):
+    """OcrTokenIndex.best_rect returns exactly what the reference ocr_best_rect does."""
+
+    WORDS = [
+        'Quỹ', 'đầu', 'tư', 'cổ', 'phiếu', 'TCSME', 'phí', 'quản', 'lý', '2,0%/năm', 'NAV',
+        'BIDV', 'Chi', 'nhánh', 'Hà', 'Thành', '250/GCN-UBCK', '23/8/2022', 'a', 'ty',
+    ]
+
+    def ocr_results(self, rng, lines: int):
+        results = []
+        for n in range(lines):
+            text = ' '.join(rng.choice(self.WORDS) for _ in range(rng.randint(1, 6)))
+            x, y = rng.randint(0, 800), 30 * n
+            results.append(([[x, y], [x + 120, y], [x + 120, y + 20], [x, y + 20]], text, 0.9))
+        # Noise the reference skips: empty text, punctuation only, malformed entries
+        results += [([[0, 0], [1, 0], [1, 1], [0, 1]], '', 0.5), ([[0, 0], [1, 0], [1, 1], [0, 1]], '---', 0.5), (None,)]
+        return results
+
+    def targets(self, rng, results):
+        texts = [r[1] for r in results if len(r) > 1 and r[1]]
+        yield from texts  # exact lines
+        for text in texts:
+            yield text[1:-1]  # partial words: containment fallback
+            yield text + ' ' + rng.choice(self.WORDS)
+        for _ in range(50):
+            yield ' '.join(rng.choice(self.WORDS) for _ in range(rng.randint(1, 8)))
+        yield from ['', 'ab', 'không có trong trang', 'nh', 'ành']
+
+    def test_matches_reference_over_fixed_token_sets(self):
+        import random
+
+        for seed in range(20):
+            rng = random.Random(seed)
+            results = self.ocr_results(rng, lines=rng.randint(1, 40))
+            index = rendering.OcrTokenIndex(results)
+            for target in self.targets(rng, results):
+                with self.subTest(seed=seed, target=target):
+                    self.assertEqual(index.best_rect(target), rendering.ocr_best_rect(results, target))
+
+    def test_containment_fallback(self):
+        box = [[10, 10], [50, 10], [50, 30], [10, 30]]
+        results = [(box, 'Ngân hàng giám sát', 0.9), ([[0, 40], [9, 40], [9, 50], [0, 50]], 'sát', 0.9)]
+        index = rendering.OcrTokenIndex(results)
+        # Too few shared tokens for the token match, but contained in the first line
+        self.assertEqual(index.best_rect('gân hàng gi'), (10, 10, 50, 30))
+        self.assertIsNone(index.best_rect('xyz'))
+
+
+class RegionOcrMappingTests(SimpleTestCase):
+    """Region OCR: merged crops are stacked into a strip and results map back to page pixels."""
+
+    def test_merge_regions(self):
+        merged = rendering.merge_regions([
+            (0, 0, 10, 10), (5, 5, 20, 20), (18, 18, 30, 30),  # chain -> one region
+            (100, 100, 110, 110),
+            (50, 50, 50, 60),  # no area
+        ])
+        self.assertEqual(sorted(merged), [(0, 0, 30, 30), (100, 100, 110, 110)])
+
+    def test_stack_and_unstack_round_trip(self):
+        import PIL.Image
+
+        page = PIL.Image.new('RGB', (400, 600), (255, 255, 255))
+        regions = rendering.merge_regions([(40, 50, 140, 90), (200, 300, 380, 360), (10, 500, 60, 590)])
+        for n, (x0, y0, x1, y1) in enumerate(regions):
+            page.putpixel((x0 + 5, y0 + 7), (n, 0, 0))
+
+        strip, placements = rendering.stack_regions(page, regions, gap=24)
+        self.assertEqual(strip.size, (180, 40 + 60 + 90 + 2 * 24))
+
+        results = []
+        for n, (strip_y0, _, page_x0, page_y0) in enumerate(placements):
+            # The crop's pixels sit at the placement offset in the strip
+            self.assertEqual(strip.getpixel((5, strip_y0 + 7)), (n, 0, 0))
+            box = [[5, strip_y0 + 7], [25, strip_y0 + 7], [25, strip_y0 + 17], [5, strip_y0 + 17]]
+            results.append((box, f'region {n}', 0.9))
+        # A box centred in the gap between the first two crops is dropped
+        gap_y = placements[0][1] + 12
+        results.append(([[0, gap_y - 2], [10, gap_y - 2], [10, gap_y + 2], [0, gap_y + 2]], 'gap', 0.9))
+
+        mapped = rendering.unstack_ocr_results(results, placements)
+        self.assertEqual([text for _, text, _ in mapped], [f'region {n}' for n in range(len(regions))])
+        for (box, _, _), (x0, y0, _, _) in zip(mapped, regions):
+            self.assertEqual(box[0], [x0 + 5, y0 + 7])
+            self.assertEqual(box[2], [x0 + 25, y0 + 17])
+
+    def test_page_mode_is_default(self):
+        with mock.patch.dict(os.environ, {}, clear=False):
+            os.environ.pop('PREVIEW_OCR_MODE', None)
+            self.assertEqual(rendering.AnnotationRenderer().ocr_mode, 'page')
+        self.assertEqual(rendering.AnnotationRenderer(ocr_mode='regions').ocr_mode, 'regions')
+
+
+class PageWordIndexLocateTests(SimpleTestCase):
+    """locate() aligns the quote with the page words in order and reports one rect per line."""
+
+    def index(self, lines: list[str]):
+        tokens, boxes, line_ids = [], [], []
+        for line_id, text in enumerate(lines):
+            for n, token in enumerate(text.split()):
+                tokens.append(token)
+                boxes.append([line_id * 50, n * 100, line_id * 50 + 20, n * 100 + 80])
+                line_ids.append(line_id)
+        return rendering.PageWordIndex(tokens, boxes, line_ids)
+
+    def test_exact_quote_spanning_lines(self):
+        index = self.index(['ban cao bach quy', 'phi quan ly 2 0 nam', 'tinh tren nav', 'ngan hang giam sat'])
+        self.assertEqual(
+            index.locate('Phí quản lý 2,0%/năm tính trên NAV'),
+            [[50, 0, 70, 580], [100, 0, 120, 280]],
+        )
+
+    def test_word_order_matters(self):
+        # Same words in another order earlier on the page (a table row)
+        index = self.index(['nam 2 0 ly quan phi', 'dieu le quy', 'phi quan ly 2 0 nam'])
+        self.assertEqual(index.locate('phí quản lý 2,0%/năm'), [[100, 0, 120, 580]])
+
+    def test_shuffled_words_alone_do_not_match(self):
+        index = self.index(['sat giam hang ngan nhanh chi thanh ha'])
+        self.assertEqual(index.locate('Ngân hàng giám sát Chi nhánh Hà Thành'), [])
+
+    def test_tolerates_ocr_typos_and_inserted_words(self):
+        index = self.index(['ngan hang tmcp dau tu va phat trien viet nam', 'chi nhanh ha thanh'])
+        rects = index.locate('Ngân hàng TMCP Đầu tư và Phát trlển Việt Nam - Chi nhánh Hà Thành')
+        self.assertEqual(rects, [[0, 0, 20, 980], [50, 0, 70, 380]])
+
+    def test_no_match_and_rect_limit(self):
+        index = self.index([f'dong {n} noi dung' for n in range(30)])
+        self.assertEqual(index.locate('không có trong trang'), [])
+        quote = ' '.join(f'dong {n} noi dung' for n in range(30))
+        self.assertEqual(len(index.locate(quote)), 10)
+
+
+class LocateCitationsTests(TestCase):
+    """locate_citations resolves many (page, quote) pairs with one PDF open per file."""
+
+    def setUp(self):
+        import fitz
+
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, True)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        os.makedirs(os.path.join(self.media_root, 'documents'))
+        pdf = fitz.open()
+        pdf.new_page().insert_text((72, 72), 'Phi quan ly 2,0% NAV moi nam cua Quy')
+        pdf.new_page()  # scanned: no text layer
+        pdf.save(os.path.join(self.media_root, 'documents', 'cite.pdf'))
+        pdf.close()
+        self.document = Document.objects.create(file='documents/cite.pdf', file_name='cite.pdf', status='completed')
+
+    def test_resolves_quotes_and_reports_errors_per_citation(self):
+        results = rendering.locate_citations(self.document, [
+            {'page': 1, 'quote': 'Phí quản lý 2,0% NAV'},
+            {'page': 1, 'quote': ''},
+            {'page': 9, 'quote': 'x'},
+            {'page': 'abc', 'quote': 'x'},
+        ])
+        self.assertEqual(results[0]['render_page_number'], 1)
+        self.assertEqual(len(results[0]['matched_bboxes']), 1)
+        self.assertEqual(results[1]['matched_bboxes'], [])
+        self.assertEqual(results[2], {'error': 'Page number out of range'})
+        self.assertEqual(results[3], {'error': 'Invalid page number'})
+
+    def test_failure_keeps_earlier_per_citation_errors(self):
+        with mock.patch.object(rendering, 'page_word_index', side_effect=RuntimeError('boom')):
+            results = rendering.locate_citations(self.document, [{'page': 9, 'quote': 'x'}, {'page': 1, 'quote': 'x'}])
+        self.assertEqual(results, [{'error': 'Page number out of range'}, {'error': 'boom'}])
+
+    def test_scanned_pages_are_not_ocred_without_allow_ocr(self):
+        with mock.patch.object(rendering.PageWordIndex, '_ocr_words', return_value=[]) as ocr_words:
+            results = rendering.locate_citations(self.document, [{'page': 2, 'quote': 'x'}], allow_ocr=False)
+            self.assertEqual(results, [{'error': 'Page needs OCR'}])
+            ocr_words.assert_not_called()
+
+            results = rendering.locate_citations(self.document, [{'page': 2, 'quote': 'x'}])
+            self.assertEqual(results[0]['matched_bboxes'], [])
+            ocr_words.assert_called_once()
+
+
+class ProgressBusTests(SimpleTestCase):
+    """In-process fan-out, per-document state and its cleanup."""
+
+    def setUp(self):
+        self.bus = progress.ProgressBus()
+
+    def test_publish_reaches_document_and_all_subscribers(self):
+        one, every = self.bus.subscribe(7), self.bus.subscribe(None)
+        self.bus.publish(7, rag_progress=40)
+        self.bus.publish(8, rag_progress=10)
+
+        self.assertEqual(one.get_nowait()['rag_progress'], 40)
+        self.assertTrue(one.empty())
+        self.assertEqual([every.get_nowait()['document_id'] for _ in range(2)], [7, 8])
+
+    def test_full_queue_drops_events_instead_of_blocking(self):
+        q = self.bus.subscribe(7)
+        with mock.patch.object(progress, 'SUBSCRIBER_QUEUE_SIZE', 1):
+            slow = self.bus.subscribe(7)
+        for pct in range(5):
+            self.bus.publish(7, rag_progress=pct)
+        self.assertEqual(slow.qsize(), 1)
+        self.assertEqual(q.qsize(), 5)
+
+    def test_async_subscriber_receives_events_from_worker_threads(self):
+        async def receive():
+            subscriber = self.bus.subscribe_async(7)
+            threading.Thread(target=self.bus.publish, args=(7,), kwargs={'rag_progress': 55}).start()
+            event = await asyncio.wait_for(subscriber.get(), timeout=5)
+            self.bus.unsubscribe(subscriber, 7)
+            return event
+
+        self.assertEqual(asyncio.run(receive())['rag_progress'], 55)
+        self.assertEqual(self.bus._subscribers, {})
+
+    def test_unsubscribe_removes_empty_subscriber_sets(self):
+        q = self.bus.subscribe(7)
+        self.bus.unsubscribe(q, 7)
+        self.assertEqual(self.bus._subscribers, {})
+
+    def test_forget_drops_cached_state(self):
+        self.bus.publish(7, status='processing')
+        self.assertEqual(self.bus.snapshot(7)['status'], 'processing')
+        self.bus.forget(7)
+        self.assertIsNone(self.bus.snapshot(7))
+
+    def test_state_is_evicted_once_nothing_runs_for_the_document(self):
+        self.bus.publish(7, status='processing')
+        self.bus.publish(7, rag_status='queued', rag_progress=0)
+        self.bus.publish(7, status='completed')
+        # RAG ingestion is still queued, so the state stays.
+        self.assertEqual(self.bus.snapshot(7)['status'], 'completed')
+
+        self.bus.publish(7, rag_status='completed', rag_progress=100)
+        self.assertIsNone(self.bus.snapshot(7))
+        self.assertEqual(self.bus._state, {})
+
+
+class ProgressEventsTests(TestCase):
+    """SSE endpoints: snapshot on connect, then live events from the bus."""
+
+    def setUp(self):
+        self.document = Document.objects.create(
+            file='documents/events.pdf', file_name='events.pdf', status='completed',
+            rag_status='running', rag_progress=20,
+        )
+        self.url = reverse('document-events', kwargs={'pk': self.document.id})
+        bus = progress.ProgressBus()
+        patcher = mock.patch('api.views.progress_bus', bus)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.bus = bus
+
+    def test_wsgi_stream_sends_snapshot_then_progress(self):
+        response = self.client.get(self.url)
+        chunks = iter(response.streaming_content)
+        self.assertEqual(next(chunks), b'retry: 3000\n\n')
+        snapshot = next(chunks).decode()
+        self.assertTrue(snapshot.startswith('event: snapshot\n'))
+        self.assertIn('"rag_progress": 20', snapshot)
+
+        self.bus.publish(self.document.id, rag_progress=60)
+        event = next(chunks).decode()
+        self.assertTrue(event.startswith('event: progress\n'))
+        self.assertIn('"rag_progress": 60', event)
+
+        response.close()
+        self.assertEqual(self.bus._subscribers, {})
+
+    async def test_asgi_stream_waits_on_the_event_loop(self):
+        response = await self.async_client.get(self.url)
+        chunks = aiter(response.streaming_content)
+        self.assertEqual(await anext(chunks), b'retry: 3000\n\n')
+        self.assertIn('"rag_progress": 20', (await anext(chunks)).decode())
+
+        threading.Thread(
+            target=self.bus.publish, args=(self.document.id,), kwargs={'rag_progress': 60},
+        ).start()
+        event = await asyncio.wait_for(anext(chunks), timeout=5)
+        self.assertIn('"rag_progress": 60', event.decode())
+
+        # A client disconnect cancels the task waiting on the stream.
+        pending = asyncio.ensure_future(anext(chunks))
+        await asyncio.sleep(0.05)
+        pending.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await pending
+        self.assertEqual(self.bus._subscribers, {})
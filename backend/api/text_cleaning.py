@@ -0,0 +1,158 @@
+"""
+Linear-time cleanup of OCR/markdown text before RAG chunking.
+
+- collapse_repeats: removes "looping phrase" glitches (a phrase of 10+
+  characters repeated back to back) without the backtracking regex
+  `(.{10,})\\1+`, which goes quadratic or worse on long near-repeating lines.
+- strip_page_boilerplate: drops running headers/footers, found as lines
+  that recur at the top or bottom of many pages.
+"""
+import re
+from collections import Counter
+
+MIN_REPEAT_LENGTH = 10
+
+# Lines inspected at each end of a page when looking for headers/footers
+BOILERPLATE_EDGE_LINES = 3
+# A line is boilerplate when it appears at a page edge on at least this
+# share of pages (and on at least BOILERPLATE_MIN_PAGES pages)
+BOILERPLATE_MIN_SHARE = 0.4
+BOILERPLATE_MIN_PAGES = 3
+
+# Always dropped, also on documents too short for the statistics
+KNOWN_BOILERPLATE = (
+    "ỦY BAN CHỨNG KHOÁN NHÀ NƯỚC",
+    "CỘNG HÒA XÃ HỘI CHỦ NGHĨA VIỆT NAM",
+    "Độc lập - Tự do - Hạnh phúc",
+    "BẢN CÁO BẠCH",
+)
+
+PAGE_MARKER_RE = re.compile(r'^\s*(?:---|===) PAGE \d+ (?:---|===)\s*$')
+
+_MOD = (1 << 61) - 1
+_BASE = 1_000_003
+
+
+def _prefix_hashes(text: str):
+    hashes = [0] * (len(text) + 1)
+    powers = [1] * (len(text) + 1)
+    h = 0
+    p = 1
+    for i, ch in enumerate(text):
+        h = (h * _BASE + ord(ch)) % _MOD
+        p = (p * _BASE) % _MOD
+        hashes[i + 1] = h
+        powers[i + 1] = p
+    return hashes, powers
+
+
+def _collapse_line(line: str, min_len: int) -> str:
+    n = len(line)
+    if n < 2 * min_len:
+        return line
+
+    hashes, powers = _prefix_hashes(line)
+
+    def sub(start, end):
+        return (hashes[end] - hashes[start] * powers[end - start]) % _MOD
+
+    out = []
+    emitted = 0          # line[:emitted] is already in `out`
+    seen = {}            # hash of a min_len window -> an earlier start at least min_len back
+    j = 0
+    while j + min_len <= n:
+        key = sub(j, j + min_len)
+        prev = seen.get(key)
+        if prev is not None and j - prev >= min_len:
+            period = j - prev
+            end = j + period
+            if end <= n and sub(prev, j) == sub(j, end) and line[prev:j] == line[j:end]:
+                # line[prev:j] repeats right after itself; skip every extra copy
+                while end + period <= n and sub(end, end + period) == sub(prev, j) \
+                        and line[end:end + period] == line[prev:j]:
+                    end += period
+                out.append(line[emitted:j])
+                emitted = end
+                j = end
+                seen.clear()
+                continue
+        if prev is None or j - prev >= min_len:
+            # Keep an older occurrence while it is still closer than min_len,
+            # so short-period runs ("aaaa...") are caught at period >= min_len.
+            seen[key] = j
+        j += 1
+    out.append(line[emitted:])
+    return ''.join(out)
+
+
+def collapse_repeats(text: str, min_len: int = MIN_REPEAT_LENGTH) -> str:
+    """
+    Replace a phrase of at least `min_len` characters that is immediately
+    repeated (any number of times) by a single copy, line by line.
+
+    Windows of `min_len` characters are matched by rolling hash, so each
+    line is scanned once; candidate repeats are confirmed by comparing the
+    text before anything is removed.
+    """
+    if not text:
+        return text
+    return '\n'.join(_collapse_line(line, min_len) for line in text.split('\n'))
+
+
+def _normalize(line: str) -> str:
+    # Page numbers and dates vary from page to page; compare the rest.
+    return re.sub(r'\s+', ' ', re.sub(r'\d+', '#', line)).strip().lower()
+
+
+def _split_pages(lines: list[str]) -> list[list[int]]:
+    """Line indices of each page's content (page markers excluded)."""
+    pages: list[list[int]] = [[]]
+    for index, line in enumerate(lines):
+        if PAGE_MARKER_RE.match(line):
+            pages.append([])
+        else:
+            pages[-1].append(index)
+    return [page for page in pages if page]
+
+
+def _edge_lines(lines: list[str], page: list[int], edge: int) -> list[int]:
+    content = [i for i in page if lines[i].strip()]
+    if len(content) <= 2 * edge:
+        # Short page: only its first and last line can be header/footer
+        return content[:1] + content[-1:] if len(content) > 1 else content
+    return content[:edge] + content[-edge:]
+
+
+def strip_page_boilerplate(text: str) -> str:
+    """
+    Remove running headers/footers: lines that, once digits are masked,
+    appear near the top or bottom of a large share of the pages. Lines in
+    KNOWN_BOILERPLATE are removed everywhere. Page markers are kept.
+    """
+    if not text:
+        return text
+    lines = text.split('\n')
+    pages = _split_pages(lines)
+
+    drop: set[int] = set()
+    if len(pages) >= BOILERPLATE_MIN_PAGES:
+        edges = [_edge_lines(lines, page, BOILERPLATE_EDGE_LINES) for page in pages]
+        counts = Counter()
+        for edge in edges:
+            # Markdown table rows repeat on continuation pages but are content
+            counts.update({_normalize(lines[i]) for i in edge if not lines[i].lstrip().startswith('|')})
+        threshold = max(BOILERPLATE_MIN_PAGES, BOILERPLATE_MIN_SHARE * len(pages))
+        boilerplate = {line for line, count in counts.items() if line and count >= threshold}
+        if boilerplate:
+            for edge in edges:
+                drop.update(i for i in edge if _normalize(lines[i]) in boilerplate)
+
+    return '\n'.join(
+        line for index, line in enumerate(lines)
+        if index not in drop and not any(marker in line for marker in KNOWN_BOILERPLATE)
+    )
+
+
+def clean_text_for_rag(text: str) -> str:
+    """Header/footer removal followed by loop-glitch removal."""
+    return collapse_repeats(strip_page_boilerplate(text or ''))
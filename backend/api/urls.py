@@ -1,12 +1,18 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from . import views
+from . import async_views, views
 
 # Create router for ViewSets
 router = DefaultRouter()
 router.register(r'documents', views.DocumentViewSet, basename='document')
 
 urlpatterns = [
+    # RAG endpoints that wait on LLM / embedding providers are async views
+    path('documents/<int:pk>/chat/', async_views.chat, name='document-chat'),
+    path('documents/<int:pk>/chat_batch/', async_views.chat_batch, name='document-chat-batch'),
+    path('documents/<int:pk>/rag_status/', async_views.rag_status, name='document-rag-status'),
+    path('documents/<int:pk>/search/', async_views.search, name='document-search'),
+
     # API endpoints
     path('', include(router.urls)),
     
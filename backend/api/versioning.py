@@ -0,0 +1,172 @@
+"""
+Versioned history of extracted_data: periodic snapshots plus per-edit deltas.
+
+Every edit is written as a DocumentChangeLog carrying its edit number
+(`version`) and the exact JSON Patch that produced it. A DocumentSnapshot
+is stored before the first versioned edit and after every
+SNAPSHOT_INTERVAL edits, so rebuilding any version replays at most
+SNAPSHOT_INTERVAL - 1 patches on top of the nearest snapshot.
+"""
+import copy
+import logging
+import os
+
+from django.utils import timezone
+
+from . import json_patch
+from .models import DocumentChangeLog, DocumentSnapshot
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_INTERVAL = int(os.getenv('SNAPSHOT_INTERVAL', '20'))
+
+
+class VersionNotAvailable(LookupError):
+    """The requested version predates the recorded history or does not exist yet."""
+
+
+def _pointer(tokens) -> str:
+    return ''.join('/' + str(t).replace('~', '~0').replace('/', '~1') for t in tokens)
+
+
+def _find(doc, tokens):
+    """(found, value) at a token path."""
+    current = doc
+    for token in tokens:
+        if isinstance(current, dict) and token in current:
+            current = current[token]
+        elif isinstance(current, list) and str(token).isdigit() and int(token) < len(current):
+            current = current[int(token)]
+        else:
+            return False, None
+    return True, current
+
+
+def diff_operations(old, new, tokens=()) -> list[dict]:
+    """
+    Minimal JSON Patch turning `old` into `new`.
+
+    Objects are diffed key by key; any other differing value (lists,
+    scalars) is replaced wholesale. Unlike _detect_changes this also sees
+    page/bbox-only edits of structured fields, so replaying it is exact.
+    """
+    if isinstance(old, dict) and isinstance(new, dict):
+        operations = []
+        for key in old:
+            if key not in new:
+                operations.append({'op': 'remove', 'path': _pointer(tokens + (key,))})
+        for key, value in new.items():
+            if key not in old:
+                operations.append({'op': 'add', 'path': _pointer(tokens + (key,)), 'value': copy.deepcopy(value)})
+            elif old[key] != value:
+                operations.extend(diff_operations(old[key], value, tokens + (key,)))
+        return operations
+    if old != new:
+        return [{'op': 'replace', 'path': _pointer(tokens), 'value': copy.deepcopy(new)}]
+    return []
+
+
+def raw_changes(operations: list[dict], old_data, new_data) -> dict:
+    """Change-log entries ({path: {old, new}}) straight from patch paths."""
+    changes = {}
+    for op in operations:
+        tokens = json_patch.parse_pointer(op['path'])
+        key = '.'.join(tokens) or '(root)'
+        changes[key] = {'old': _find(old_data, tokens)[1], 'new': _find(new_data, tokens)[1]}
+    return changes
+
+
+def record_edit(document, old_data: dict, new_data: dict, changes: dict, operations: list[dict],
+                user_comment: str = '') -> DocumentChangeLog:
+    """
+    Bump document.edit_count/last_edited_at and persist the edit's history.
+
+    The document itself is not saved; callers save it along with the new
+    extracted_data (inside the same transaction).
+    """
+    previous = document.edit_count or 0
+
+    # Baseline: the state right before the first versioned edit.
+    if not DocumentSnapshot.objects.filter(document=document).exists():
+        DocumentSnapshot.objects.create(document=document, version=previous, extracted_data=old_data or {})
+
+    document.edit_count = previous + 1
+    document.last_edited_at = timezone.now()
+
+    log = DocumentChangeLog.objects.create(
+        document=document,
+        user_comment=user_comment,
+        changes=changes,
+        version=document.edit_count,
+        operations=[op for op in operations if op.get('op') != 'test'],
+    )
+
+    if document.edit_count % SNAPSHOT_INTERVAL == 0:
+        DocumentSnapshot.objects.update_or_create(
+            document=document,
+            version=document.edit_count,
+            defaults={'extracted_data': new_data},
+        )
+    return log
+
+
+def reset_history(document):
+    """Drop snapshots after extracted_data was regenerated (reprocess)."""
+    DocumentSnapshot.objects.filter(document=document).delete()
+
+
+def version_at(document, when) -> int:
+    """Edit number that was current at timestamp `when`."""
+    log = (
+        DocumentChangeLog.objects
+        .filter(document=document, version__isnull=False, changed_at__lte=when)
+        .order_by('-version')
+        .only('version')
+        .first()
+    )
+    if log is not None:
+        return log.version
+    baseline = DocumentSnapshot.objects.filter(document=document).order_by('version').only('version').first()
+    if baseline is None:
+        return document.edit_count or 0
+    return baseline.version
+
+
+def data_as_of(document, version: int) -> dict:
+    """
+    extracted_data as it was right after edit number `version`.
+
+    Starts from the nearest snapshot at or below `version` and replays the
+    logged patches after it.
+    """
+    current = document.edit_count or 0
+    if version > current:
+        raise VersionNotAvailable(f"Version {version} does not exist (current is {current})")
+    if version == current:
+        return copy.deepcopy(document.extracted_data or {})
+
+    snapshot = (
+        DocumentSnapshot.objects
+        .filter(document=document, version__lte=version)
+        .order_by('-version')
+        .first()
+    )
+    if snapshot is None:
+        raise VersionNotAvailable(f"No history recorded for version {version}")
+
+    data = copy.deepcopy(snapshot.extracted_data or {})
+    logs = (
+        DocumentChangeLog.objects
+        .filter(document=document, version__gt=snapshot.version, version__lte=version)
+        .order_by('version')
+        .only('version', 'operations')
+    )
+    expected = snapshot.version + 1
+    for log in logs:
+        if log.version != expected or log.operations is None:
+            raise VersionNotAvailable(f"History for version {expected} is incomplete")
+        data, _ = json_patch.apply_patch(data, log.operations)
+        expected += 1
+    if expected != version + 1:
+        raise VersionNotAvailable(f"History for version {expected} is incomplete")
+    return data
@@ -2,17 +2,31 @@ from rest_framework.decorators import api_view, parser_classes
 from rest_framework.response import Response
 from rest_framework import status, viewsets
 from rest_framework.parsers import MultiPartParser, FormParser
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.parsers import JSONParser
 from rest_framework.decorators import action
-from django.http import FileResponse, Http404, HttpResponse
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
+from django.urls import reverse
 from django.utils import timezone
-from django.db import models as dj_models
+from django.db import models as dj_models, transaction
+from django.db.models import Case, F, Func, Q, Subquery, When
+from django.db.models.fields.json import KeyTextTransform, KeyTransform
+from django.db.models.functions import Coalesce
+from django.utils.dateparse import parse_datetime
+import asyncio
+import json
 import logging
 import os
+import queue
 import threading
+import time
 import fitz
 import io
 import base64
+import copy
 
 from .models import Document, ExtractedFundData, DocumentChangeLog
 from .serializers import (
@@ -22,14 +36,184 @@ from .serializers import (
     DocumentListSerializer,
     ExtractedFundDataSerializer,
     DocumentChangeLogSerializer,
-    ChatRequestSerializer,
-    ChatResponseSerializer,
-    ChatHistorySerializer
+    ChatHistorySerializer,
+    CitationContextRequestSerializer,
+    selected_fields,
 )
 from .services import DocumentProcessingService, RAGService
+from . import rendering
+from .stats import get_document_stats
+from .fund_data import FUND_DATA_COLUMNS, columns_for_keys, fund_data_values, get_value
+from . import chat_history as chat_store, json_patch, provider_limits, versioning
+from .provenance import collect_provenance, restore_provenance
+from .progress import bus as progress_bus
 
 logger = logging.getLogger(__name__)
 
+OPTIMIZED_PAGES_DEFAULT_LIMIT = 24
+OPTIMIZED_PAGES_MAX_LIMIT = 100
+
+DOCUMENT_LIST_DEFAULT_LIMIT = 50
+DOCUMENT_LIST_MAX_LIMIT = 200
+
+# Only these columns are loaded for the list; the JSON blobs stay in the DB.
+DOCUMENT_LIST_COLUMNS = (
+    'id', 'file_name', 'uploaded_at', 'status', 'rag_status', 'rag_progress',
+    'edit_count', 'last_edited_at',
+)
+
+
+# Server-sent progress events
+SSE_KEEPALIVE_SECONDS = 15
+# Streams are closed after this long; EventSource reconnects and gets a fresh snapshot.
+SSE_MAX_SECONDS = 30 * 60
+
+PROGRESS_FIELDS = ('id', 'status', 'error_message', 'rag_status', 'rag_progress', 'rag_error_message')
+
+
+class EventStreamRenderer(BaseRenderer):
+    """Lets DRF content negotiation accept `Accept: text/event-stream`."""
+    media_type = 'text/event-stream'
+    format = 'event-stream'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return json.dumps(data).encode('utf-8') if not isinstance(data, (bytes, str)) else data
+
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+def _progress_snapshots(snapshot_queryset) -> list[dict]:
+    return [
+        {'document_id': row.pop('id'), **row}
+        for row in snapshot_queryset.values(*PROGRESS_FIELDS)
+    ]
+
+
+def _progress_events(document_id, snapshot_queryset):
+    """Event stream for WSGI: each open stream holds a worker thread."""
+    # Subscribe before reading the snapshot so nothing published in between is lost.
+    q = progress_bus.subscribe(document_id)
+    snapshots = _progress_snapshots(snapshot_queryset)
+
+    def _events():
+        try:
+            yield "retry: 3000\n\n"
+            for snap in snapshots:
+                yield _sse('snapshot', snap)
+            deadline = time.monotonic() + SSE_MAX_SECONDS
+            while time.monotonic() < deadline:
+                try:
+                    event = q.get(timeout=SSE_KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                yield _sse('progress', event)
+        finally:
+            progress_bus.unsubscribe(q, document_id)
+
+    return _events()
+
+
+async def _aprogress_events(document_id, snapshot_queryset):
+    """
+    Event stream for ASGI: waits on an asyncio queue, so an open stream
+    holds no thread (Django would otherwise drain a sync generator on the
+    thread that runs every sync view).
+    """
+    subscriber = progress_bus.subscribe_async(document_id)
+    try:
+        snapshots = await sync_to_async(_progress_snapshots)(snapshot_queryset)
+        yield "retry: 3000\n\n"
+        for snap in snapshots:
+            yield _sse('snapshot', snap)
+        deadline = time.monotonic() + SSE_MAX_SECONDS
+        while time.monotonic() < deadline:
+            try:
+                event = await asyncio.wait_for(subscriber.get(), timeout=SSE_KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            yield _sse('progress', event)
+    finally:
+        progress_bus.unsubscribe(subscriber, document_id)
+
+
+def _progress_stream(request, document_id, snapshot_queryset) -> StreamingHttpResponse:
+    """
+    Stream progress events for one document (or all when document_id is None).
+    """
+    if isinstance(getattr(request, '_request', request), ASGIRequest):
+        events = _aprogress_events(document_id, snapshot_queryset)
+    else:
+        events = _progress_events(document_id, snapshot_queryset)
+
+    response = StreamingHttpResponse(events, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # disable proxy buffering (nginx)
+    return response
+
+
+class JSONPatchParser(JSONParser):
+    """Parses `application/json-patch+json` request bodies (RFC 6902)."""
+    media_type = 'application/json-patch+json'
+
+
+def _lookup(doc, tokens):
+    """Value at a token path, or None if any segment is missing."""
+    current = doc
+    for token in tokens:
+        if isinstance(current, dict):
+            current = current.get(token)
+        elif isinstance(current, list) and token.isdigit() and int(token) < len(current):
+            current = current[int(token)]
+        else:
+            return None
+    return current
+
+
+def _field_tokens(pointer: str) -> list[str]:
+    """Tokens of the logged field for a patch path: '/fees/x/value' logs as 'fees.x'."""
+    tokens = json_patch.parse_pointer(pointer)
+    # Structured fields log their value; appends ('/list/-') log the whole list.
+    if len(tokens) > 1 and tokens[-1] in ('value', '-'):
+        tokens = tokens[:-1]
+    return tokens
+
+
+def _extracted_text(key: str):
+    """
+    extracted_data[key] as text: the 'value' of structured (Gemini) fields
+    {"value", "page", "bbox"}, otherwise the plain value.
+    """
+    return Case(
+        When(**{f'extracted_data__{key}__has_key': 'value'},
+             then=KeyTextTransform('value', KeyTransform(key, 'extracted_data'))),
+        default=KeyTextTransform(key, 'extracted_data'),
+        output_field=dj_models.CharField(),
+    )
+
+
+def _encode_list_cursor(document) -> str:
+    raw = f"{document.uploaded_at.isoformat()}|{document.pk}"
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def _decode_list_cursor(cursor: str):
+    """Return (uploaded_at, id) from an opaque list cursor; raises ValueError."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        uploaded_at_raw, pk_raw = raw.rsplit('|', 1)
+        uploaded_at = parse_datetime(uploaded_at_raw)
+        pk = int(pk_raw)
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {e}")
+    if uploaded_at is None:
+        raise ValueError("Invalid cursor")
+    return uploaded_at, pk
+
 
 class DocumentViewSet(viewsets.ModelViewSet):
     """
@@ -38,6 +222,17 @@ class DocumentViewSet(viewsets.ModelViewSet):
     queryset = Document.objects.all()
     serializer_class = DocumentSerializer
     
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action == 'retrieve':
+            # Only load what the requested fieldset needs
+            names = selected_fields(self.request, DocumentSerializer.Meta.fields)
+            if 'extracted_data' not in names:
+                queryset = queryset.defer('extracted_data')
+            if 'fund_data' in names:
+                queryset = queryset.select_related('fund_data')
+        return queryset
+
     def get_serializer_class(self):
         """Return appropriate serializer based on action"""
         if self.action == 'list':
@@ -47,12 +242,63 @@ class DocumentViewSet(viewsets.ModelViewSet):
         return DocumentSerializer
     
     def list(self, request, *args, **kwargs):
-        """List all documents with basic info"""
-        queryset = self.get_queryset()
-        serializer = self.get_serializer(queryset, many=True)
+        """
+        List documents with basic info, newest first (keyset paginated).
+        GET /api/documents/?limit=50&cursor=...
+
+        Pass next_cursor from the previous response to get the next page;
+        it is null on the last page. `count` is the total number of
+        documents. Runs a single query per page.
+        """
+        try:
+            limit = int(request.query_params.get('limit', DOCUMENT_LIST_DEFAULT_LIMIT))
+            limit = min(max(limit, 1), DOCUMENT_LIST_MAX_LIMIT)
+        except (TypeError, ValueError):
+            return Response({'error': 'limit must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Total number of documents as a scalar subquery, so `count` stays
+        # in the same single query as the page.
+        total = Document.objects.order_by().annotate(n=Func(F('id'), function='COUNT')).values('n')
+        queryset = (
+            Document.objects
+            .only(*DOCUMENT_LIST_COLUMNS)
+            .annotate(
+                fund_name=Coalesce(
+                    'fund_data__fund_name',
+                    _extracted_text('fund_name'),
+                    output_field=dj_models.CharField(),
+                ),
+                fund_code=Coalesce(
+                    'fund_data__fund_code',
+                    _extracted_text('fund_code'),
+                    output_field=dj_models.CharField(),
+                ),
+                total_count=Subquery(total, output_field=dj_models.IntegerField()),
+            )
+            .order_by('-uploaded_at', '-id')
+        )
+
+        cursor = request.query_params.get('cursor')
+        if cursor:
+            try:
+                uploaded_at, pk = _decode_list_cursor(cursor)
+            except ValueError as e:
+                return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            queryset = queryset.filter(
+                Q(uploaded_at__lt=uploaded_at) | Q(uploaded_at=uploaded_at, id__lt=pk)
+            )
+
+        # Fetch one extra row to know whether there is a next page.
+        documents = list(queryset[:limit + 1])
+        has_more = len(documents) > limit
+        documents = documents[:limit]
+
+        serializer = self.get_serializer(documents, many=True)
         return Response({
-            'count': queryset.count(),
-            'results': serializer.data
+            'count': documents[0].total_count if documents else Document.objects.count(),
+            'results': serializer.data,
+            'limit': limit,
+            'next_cursor': _encode_list_cursor(documents[-1]) if has_more else None,
         })
     
     def create(self, request, *args, **kwargs):
@@ -81,6 +327,7 @@ class DocumentViewSet(viewsets.ModelViewSet):
                 )
             except Exception:
                 pass
+            progress_bus.publish(document.id, rag_status='queued', rag_progress=0)
 
             def _rag_task(doc_id: int):
                 try:
@@ -114,6 +361,7 @@ class DocumentViewSet(viewsets.ModelViewSet):
             document.status = 'failed'
             document.error_message = f"Failed to start processing: {str(e)}"
             document.save()
+            progress_bus.publish(document.id, status='failed', error_message=document.error_message)
         
         # Return response with document details
         response_serializer = DocumentSerializer(document, context={'request': request})
@@ -123,146 +371,78 @@ class DocumentViewSet(viewsets.ModelViewSet):
         )
     
     def retrieve(self, request, *args, **kwargs):
-        """Get detailed information about a specific document"""
+        """
+        Get detailed information about a specific document
+        GET /api/documents/{id}/?fields=id,status,extracted_data&exclude=fund_data
+
+        Bounding boxes are left out of extracted_data unless ?provenance=inline.
+        """
         instance = self.get_object()
         serializer = DocumentSerializer(instance, context={'request': request})
         return Response(serializer.data)
     
     def update(self, request, *args, **kwargs):
-        """Update document - supports updating extracted_data"""
+        """
+        Update document - supports updating extracted_data
+
+        GET leaves bounding boxes out, so fields sent back without a bbox
+        keep their stored page/bbox; with ?provenance=inline the body is
+        taken as-is.
+        """
         partial = kwargs.pop('partial', False)
         instance = self.get_object()
         
         # Store old data for change tracking
         old_extracted_data = instance.extracted_data.copy() if instance.extracted_data else {}
         user_comment = request.data.get('user_comment', '')
+
+        data = request.data
+        if (
+            isinstance(data.get('extracted_data'), dict)
+            and request.query_params.get('provenance') != 'inline'
+        ):
+            data = {**data, 'extracted_data': restore_provenance(data['extracted_data'], old_extracted_data)}
         
-        serializer = self.get_serializer(instance, data=request.data, partial=partial)
+        serializer = self.get_serializer(instance, data=data, partial=partial)
         serializer.is_valid(raise_exception=True)
         
         # If extracted_data was updated, increment edit count and track changes
-        if 'extracted_data' in request.data:
-            new_extracted_data = request.data['extracted_data']
+        if 'extracted_data' in data:
+            new_extracted_data = data['extracted_data']
             
             # Detect changes
             changes = self._detect_changes(old_extracted_data, new_extracted_data)
+            operations = versioning.diff_operations(old_extracted_data, new_extracted_data)
             
-            if changes:
-                instance.edit_count += 1
-                instance.last_edited_at = timezone.now()
-                
-                # Create change log entry
-                DocumentChangeLog.objects.create(
-                    document=instance,
+            if operations:
+                # Page/bbox-only edits don't show up in _detect_changes
+                if not changes:
+                    changes = versioning.raw_changes(operations, old_extracted_data, new_extracted_data)
+                # Bumps edit_count and logs the edit with its exact patch
+                versioning.record_edit(
+                    instance,
+                    old_extracted_data,
+                    new_extracted_data,
+                    changes,
+                    operations,
                     user_comment=user_comment,
-                    changes=changes
                 )
         
         self.perform_update(serializer)
         
         # If extracted_data was updated, sync with ExtractedFundData
-        if 'extracted_data' in request.data:
+        if 'extracted_data' in data:
             try:
-                from .services import DocumentProcessingService
-                # Re-sync the structured data
-                extracted_data = instance.extracted_data
-                
-                # Helper to get value from structured or flat format
-                def get_value(field_data):
-                    if isinstance(field_data, dict) and 'value' in field_data:
-                        return field_data['value']
-                    return field_data
-
-                def truncate_defaults_for_model(model_cls, defaults: dict) -> dict:
-                    """Ensure values fit DB column limits (e.g., CharField max_length)."""
-                    sanitized = dict(defaults)
-                    for field_name, field_value in sanitized.items():
-                        if not isinstance(field_value, str) or field_value is None:
-                            continue
-                        try:
-                            model_field = model_cls._meta.get_field(field_name)
-                        except Exception:
-                            continue
-                        if not isinstance(model_field, dj_models.CharField):
-                            continue
-                        max_len = getattr(model_field, 'max_length', None)
-                        if max_len and len(field_value) > max_len:
-                            logger.warning(
-                                f"Truncating {model_cls.__name__}.{field_name}: {len(field_value)} -> {max_len} chars"
-                            )
-                            sanitized[field_name] = field_value[:max_len]
-                    return sanitized
-                
-                # Update ExtractedFundData
-                fund_defaults = {
-                        'fund_name': get_value(extracted_data.get('fund_name')),
-                        'fund_code': get_value(extracted_data.get('fund_code')),
-                        'fund_type': get_value(extracted_data.get('fund_type')),
-                        'legal_structure': get_value(extracted_data.get('legal_structure')),
-                        'license_number': get_value(extracted_data.get('license_number')),
-                        'regulator': get_value(extracted_data.get('regulator')),
-                        'management_company': get_value(extracted_data.get('management_company')),
-                        'custodian_bank': get_value(extracted_data.get('custodian_bank')),
-                        'fund_supervisor': get_value(extracted_data.get('fund_supervisor')),
-                        'management_fee': str(get_value(extracted_data.get('fees', {}).get('management_fee'))) if extracted_data.get('fees', {}).get('management_fee') else None,
-                        'subscription_fee': str(get_value(extracted_data.get('fees', {}).get('subscription_fee'))) if extracted_data.get('fees', {}).get('subscription_fee') else None,
-                        'redemption_fee': str(get_value(extracted_data.get('fees', {}).get('redemption_fee'))) if extracted_data.get('fees', {}).get('redemption_fee') else None,
-                        'switching_fee': str(get_value(extracted_data.get('fees', {}).get('switching_fee'))) if extracted_data.get('fees', {}).get('switching_fee') else None,
-                        'total_expense_ratio': str(get_value(extracted_data.get('fees', {}).get('total_expense_ratio'))) if extracted_data.get('fees', {}).get('total_expense_ratio') else None,
-                        'custody_fee': str(get_value(extracted_data.get('fees', {}).get('custody_fee'))) if extracted_data.get('fees', {}).get('custody_fee') else None,
-                        'audit_fee': str(get_value(extracted_data.get('fees', {}).get('audit_fee'))) if extracted_data.get('fees', {}).get('audit_fee') else None,
-                        'supervisory_fee': str(get_value(extracted_data.get('fees', {}).get('supervisory_fee'))) if extracted_data.get('fees', {}).get('supervisory_fee') else None,
-                        'other_expenses': str(get_value(extracted_data.get('fees', {}).get('other_expenses'))) if extracted_data.get('fees', {}).get('other_expenses') else None,
-
-                        'investment_objective': get_value(extracted_data.get('investment_objective')),
-                        'investment_strategy': get_value(extracted_data.get('investment_strategy')),
-                        'investment_style': get_value(extracted_data.get('investment_style')),
-                        'sector_focus': get_value(extracted_data.get('sector_focus')),
-                        'benchmark': get_value(extracted_data.get('benchmark')),
-
-                        'valuation_method': get_value(extracted_data.get('valuation', {}).get('valuation_method')) if extracted_data.get('valuation') else get_value(extracted_data.get('valuation_method')),
-                        'pricing_source': get_value(extracted_data.get('valuation', {}).get('pricing_source')) if extracted_data.get('valuation') else get_value(extracted_data.get('pricing_source')),
-
-                        'investment_restrictions': get_value(extracted_data.get('investment_restrictions')),
-                        'borrowing_limit': get_value(extracted_data.get('borrowing_limit')),
-                        'leverage_limit': get_value(extracted_data.get('leverage_limit')),
-
-                        'investor_rights': get_value(extracted_data.get('investor_rights')),
-                        'distribution_agent': get_value(extracted_data.get('distribution_agent')),
-                        'sales_channels': get_value(extracted_data.get('sales_channels')),
-
-                        'concentration_risk': get_value(extracted_data.get('risk_factors', {}).get('concentration_risk')) if extracted_data.get('risk_factors') else get_value(extracted_data.get('concentration_risk')),
-                        'liquidity_risk': get_value(extracted_data.get('risk_factors', {}).get('liquidity_risk')) if extracted_data.get('risk_factors') else get_value(extracted_data.get('liquidity_risk')),
-                        'interest_rate_risk': get_value(extracted_data.get('risk_factors', {}).get('interest_rate_risk')) if extracted_data.get('risk_factors') else get_value(extracted_data.get('interest_rate_risk')),
-
-                        'trading_frequency': get_value(extracted_data.get('operational_details', {}).get('trading_frequency')) if extracted_data.get('operational_details') else get_value(extracted_data.get('trading_frequency')),
-                        'cut_off_time': get_value(extracted_data.get('operational_details', {}).get('cut_off_time')) if extracted_data.get('operational_details') else get_value(extracted_data.get('cut_off_time')),
-                        'nav_calculation_frequency': get_value(extracted_data.get('operational_details', {}).get('nav_calculation_frequency')) if extracted_data.get('operational_details') else get_value(extracted_data.get('nav_calculation_frequency')),
-                        'nav_publication': get_value(extracted_data.get('operational_details', {}).get('nav_publication')) if extracted_data.get('operational_details') else get_value(extracted_data.get('nav_publication')),
-                        'settlement_cycle': get_value(extracted_data.get('operational_details', {}).get('settlement_cycle')) if extracted_data.get('operational_details') else get_value(extracted_data.get('settlement_cycle')),
-
-                        'auditor': get_value(extracted_data.get('governance', {}).get('auditor')) if extracted_data.get('governance') else get_value(extracted_data.get('auditor')),
-
-                        'asset_allocation': extracted_data.get('asset_allocation') if isinstance(extracted_data.get('asset_allocation'), dict) else {},
-                        'minimum_investment': extracted_data.get('minimum_investment') if isinstance(extracted_data.get('minimum_investment'), dict) else {},
-                        'portfolio': extracted_data.get('portfolio', []),
-                        'nav_history': extracted_data.get('nav_history', []),
-                        'dividend_history': extracted_data.get('dividend_history', []),
-
-                }
-
-                fund_defaults = truncate_defaults_for_model(ExtractedFundData, fund_defaults)
-
                 ExtractedFundData.objects.update_or_create(
                     document=instance,
-                    defaults=fund_defaults,
+                    defaults=fund_data_values(instance.extracted_data),
                 )
                 
                 logger.info(f"Document {instance.id} edited. Total edits: {instance.edit_count}")
             except Exception as e:
                 logger.error(f"Error syncing ExtractedFundData: {e}")
         
-        return Response(serializer.data)
+        return Response(DocumentSerializer(instance, context={'request': request}).data)
     
     def _detect_changes(self, old_data, new_data, prefix=''):
         """Recursively detect changes between old and new data"""
@@ -304,17 +484,225 @@ class DocumentViewSet(viewsets.ModelViewSet):
         
         return changes
     
+    @action(detail=True, methods=['patch'], url_path='extracted-data',
+            parser_classes=[JSONPatchParser, JSONParser])
+    def patch_extracted_data(self, request, pk=None):
+        """
+        Apply an RFC 6902 JSON Patch to extracted_data.
+        PATCH /api/documents/{id}/extracted-data/
+        Body: [{"op": "replace", "path": "/fees/management_fee/value", "value": "1.5%"}]
+           or {"operations": [...], "user_comment": "..."}
+
+        Only the touched paths are logged and only the ExtractedFundData
+        columns that read from them are rewritten.
+        """
+        body = request.data
+        if isinstance(body, dict):
+            operations = body.get('operations')
+            user_comment = body.get('user_comment', '') or ''
+        else:
+            operations = body
+            user_comment = request.query_params.get('user_comment', '')
+
+        try:
+            json_patch.validate_patch(operations)
+        except json_patch.InvalidJsonPatch as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        with transaction.atomic():
+            # Lock the row so concurrent patches apply one after another.
+            instance = get_object_or_404(
+                Document.objects.select_for_update().only('id', 'extracted_data', 'edit_count', 'last_edited_at'),
+                pk=pk,
+            )
+            original = instance.extracted_data if isinstance(instance.extracted_data, dict) else {}
+            # Patch a copy: the baseline snapshot needs the pre-edit state.
+            data = copy.deepcopy(original)
+
+            old_values = {}
+            touched = []
+            try:
+                for op in operations:
+                    for pointer in (op.get('from'), op['path']):
+                        if pointer is None or op['op'] == 'test':
+                            continue
+                        key = tuple(_field_tokens(pointer))
+                        if key not in old_values:
+                            old_values[key] = get_value(_lookup(data, key))
+                    data, op_touched = json_patch.apply_patch(data, [op])
+                    touched.extend(op_touched)
+            except json_patch.JsonPatchConflict as e:
+                return Response({'error': str(e)}, status=status.HTTP_409_CONFLICT)
+
+            if not isinstance(data, dict):
+                return Response(
+                    {'error': 'extracted_data must remain a JSON object'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+
+            changes = {}
+            for key, old_value in old_values.items():
+                new_value = get_value(_lookup(data, key))
+                if old_value != new_value:
+                    changes['.'.join(key) or '(root)'] = {'old': old_value, 'new': new_value}
+
+            if not touched:
+                return Response({'changes': {}, 'updated_columns': [], 'edit_count': instance.edit_count})
+
+            update_fields = ['extracted_data']
+            if data != original:
+                if not changes:
+                    changes = versioning.raw_changes(
+                        [op for op in operations if op['op'] != 'test'], original, data
+                    )
+                versioning.record_edit(
+                    instance, original, data, changes, operations, user_comment=user_comment
+                )
+                update_fields += ['edit_count', 'last_edited_at']
+            instance.extracted_data = data
+            instance.save(update_fields=update_fields)
+
+            # Re-derive only the columns fed by the touched top-level keys.
+            top_keys = {json_patch.parse_pointer(p)[0] if p else None for p in touched}
+            columns = list(FUND_DATA_COLUMNS) if None in top_keys else columns_for_keys(top_keys)
+            updated_columns = []
+            fund = ExtractedFundData.objects.filter(document=instance).first()
+            if fund is None:
+                ExtractedFundData.objects.create(document=instance, **fund_data_values(data))
+                updated_columns = list(FUND_DATA_COLUMNS)
+            elif columns:
+                for column, value in fund_data_values(data, columns).items():
+                    if getattr(fund, column) != value:
+                        setattr(fund, column, value)
+                        updated_columns.append(column)
+                if updated_columns:
+                    fund.save(update_fields=updated_columns + ['updated_at'])
+
+        logger.info(f"Document {instance.id} patched ({len(touched)} paths). Total edits: {instance.edit_count}")
+        return Response({
+            'changes': changes,
+            'updated_columns': updated_columns,
+            'edit_count': instance.edit_count,
+            'last_edited_at': instance.last_edited_at,
+        })
+
+    @action(detail=True, methods=['get'], url_path='extracted-data/as-of')
+    def extracted_data_as_of(self, request, pk=None):
+        """
+        extracted_data as of an edit number or a point in time.
+        GET /api/documents/{id}/extracted-data/as-of/?version=3
+        GET /api/documents/{id}/extracted-data/as-of/?at=2026-01-31T12:00:00Z
+
+        Rebuilt from the nearest snapshot plus the logged patches after it.
+        """
+        document = self.get_object()
+        raw_version = request.query_params.get('version')
+        raw_at = request.query_params.get('at')
+
+        try:
+            if raw_version is not None:
+                version = int(raw_version)
+                if version < 0:
+                    raise ValueError
+            elif raw_at:
+                when = parse_datetime(raw_at)
+                if when is None:
+                    raise ValueError
+                if timezone.is_naive(when):
+                    when = timezone.make_aware(when)
+                version = versioning.version_at(document, when)
+            else:
+                return Response(
+                    {'error': 'Pass either version or at'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+        except ValueError:
+            return Response(
+                {'error': 'version must be a non-negative integer and at an ISO 8601 timestamp'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        try:
+            data = versioning.data_as_of(document, version)
+        except (versioning.VersionNotAvailable, json_patch.JsonPatchConflict) as e:
+            return Response({'error': str(e)}, status=status.HTTP_404_NOT_FOUND)
+
+        return Response({
+            'version': version,
+            'current_version': document.edit_count,
+            'extracted_data': data,
+        })
+
+    @action(detail=True, methods=['post'])
+    def rollback(self, request, pk=None):
+        """
+        Restore extracted_data to an earlier edit number.
+        POST /api/documents/{id}/rollback/
+        Body: {"version": 3, "user_comment": "..."}
+
+        The rollback is recorded as a new edit, so it can itself be undone.
+        """
+        try:
+            version = int(request.data.get('version'))
+        except (TypeError, ValueError):
+            return Response({'error': 'version must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+        user_comment = request.data.get('user_comment') or f'Rollback to version {version}'
+
+        with transaction.atomic():
+            document = get_object_or_404(Document.objects.select_for_update(), pk=pk)
+            try:
+                target = versioning.data_as_of(document, version)
+            except (versioning.VersionNotAvailable, json_patch.JsonPatchConflict) as e:
+                return Response({'error': str(e)}, status=status.HTTP_404_NOT_FOUND)
+
+            current = document.extracted_data if isinstance(document.extracted_data, dict) else {}
+            changes = self._detect_changes(current, target)
+            operations = versioning.diff_operations(current, target)
+            if operations:
+                versioning.record_edit(
+                    document,
+                    current,
+                    target,
+                    changes or versioning.raw_changes(operations, current, target),
+                    operations,
+                    user_comment=user_comment,
+                )
+                document.extracted_data = target
+                document.save(update_fields=['extracted_data', 'edit_count', 'last_edited_at'])
+                ExtractedFundData.objects.update_or_create(
+                    document=document,
+                    defaults=fund_data_values(target),
+                )
+
+        return Response({
+            'restored_version': version,
+            'edit_count': document.edit_count,
+            'last_edited_at': document.last_edited_at,
+            'changes': changes,
+        })
+
     def partial_update(self, request, *args, **kwargs):
         """Partial update (PATCH)"""
         kwargs['partial'] = True
         return self.update(request, *args, **kwargs)
+
+    def perform_destroy(self, instance):
+        """Delete the document and its cached page renders"""
+        for file_field in (instance.file, instance.optimized_file):
+            if file_field:
+                try:
+                    rendering.purge_page_cache(file_field.path)
+                except Exception:
+                    pass
+        instance.delete()
     
     @action(detail=True, methods=['post'])
     def reprocess(self, request, pk=None):
         """
-        Reprocess a document
+        Reprocess a document. `force` (body or query) skips the extraction cache.
         """
         document = self.get_object()
+        force = str(request.data.get('force', request.query_params.get('force', ''))).strip().lower() in {'1', 'true', 'yes'}
         
         # Check if document can be reprocessed
         if document.status == 'processing':
@@ -323,15 +711,25 @@ class DocumentViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
         
+        # Old renders of the optimized PDF are useless once it is regenerated
+        if document.optimized_file:
+            try:
+                rendering.purge_page_cache(document.optimized_file.path)
+            except Exception:
+                pass
+
         # Reset status and trigger processing
         document.status = 'pending'
         document.error_message = None
         document.extracted_data = None
         document.save()
+        # Old snapshots describe data that is about to be regenerated
+        versioning.reset_history(document)
+        progress_bus.publish(document.id, status='pending')
         
         # Start processing
         processing_service = DocumentProcessingService()
-        processing_service.process_document(document.id)
+        processing_service.process_document(document.id, force=force)
 
         # Optional: also auto-ingest for RAG on reprocess
         auto_rag = os.getenv("AUTO_RAG_INGEST_ON_UPLOAD", "").strip().lower() in {"1", "true", "yes"}
@@ -352,7 +750,11 @@ class DocumentViewSet(viewsets.ModelViewSet):
     @action(detail=True, methods=['get'])
     def optimized_pages(self, request, pk=None):
         """
-        Get all pages from the optimized PDF as images (base64)
+        List pages of the optimized PDF (metadata + image URLs, paginated).
+        GET /api/documents/{id}/optimized_pages/?offset=0&limit=24
+
+        Images are served by optimized_page_image, so this response stays
+        small no matter how many pages the optimized PDF has.
         """
         document = self.get_object()
         
@@ -361,6 +763,16 @@ class DocumentViewSet(viewsets.ModelViewSet):
                 {'error': 'No optimized PDF available for this document'},
                 status=status.HTTP_404_NOT_FOUND
             )
+
+        try:
+            offset = max(int(request.query_params.get('offset', 0)), 0)
+            limit = int(request.query_params.get('limit', OPTIMIZED_PAGES_DEFAULT_LIMIT))
+            limit = min(max(limit, 1), OPTIMIZED_PAGES_MAX_LIMIT)
+        except (TypeError, ValueError):
+            return Response(
+                {'error': 'offset and limit must be integers'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
         
         try:
             # Get the page map (optimized index -> raw page number)
@@ -368,43 +780,106 @@ class DocumentViewSet(viewsets.ModelViewSet):
             if isinstance(document.extracted_data, dict):
                 page_map = document.extracted_data.get('_optimized_page_map')
             
-            doc = fitz.open(document.optimized_file.path)
-            pages = []
-            
-            for page_num in range(len(doc)):
-                page = doc.load_page(page_num)
-                # Render page to image at 150 DPI for preview
-                pix = page.get_pixmap(dpi=150)
-                img_bytes = pix.tobytes("png")
-                
-                # Convert to base64 for JSON transmission
-                img_base64 = base64.b64encode(img_bytes).decode('utf-8')
-                
-                # Get raw page number from map if available
-                raw_page_num = page_map[page_num] if isinstance(page_map, list) and page_num < len(page_map) else page_num + 1
-                
-                pages.append({
-                    'page_number': page_num + 1,
-                    'raw_page_number': raw_page_num,
-                    'image': f'data:image/png;base64,{img_base64}',
-                    'width': pix.width,
-                    'height': pix.height
-                })
-            
-            doc.close()
-            
+            pdf_path = document.optimized_file.path
+            version = rendering.page_cache_key(pdf_path)
+            doc = fitz.open(pdf_path)
+            try:
+                total_pages = len(doc)
+                pages = []
+                for page_num in range(offset, min(offset + limit, total_pages)):
+                    page = doc.load_page(page_num)
+                    width, height = rendering.page_dimensions(page)
+
+                    # Get raw page number from map if available
+                    raw_page_num = page_map[page_num] if isinstance(page_map, list) and page_num < len(page_map) else page_num + 1
+
+                    image_url = request.build_absolute_uri(reverse(
+                        'document-optimized-page-image',
+                        kwargs={'pk': document.pk, 'page_num': page_num + 1},
+                    ))
+                    pages.append({
+                        'page_number': page_num + 1,
+                        'raw_page_number': raw_page_num,
+                        'image': f"{image_url}?size=thumb&v={version}",
+                        'full_image': f"{image_url}?size=full&v={version}",
+                        'width': width,
+                        'height': height
+                    })
+            finally:
+                doc.close()
+
+            next_offset = offset + limit if offset + limit < total_pages else None
             return Response({
-                'total_pages': len(pages),
+                'total_pages': total_pages,
+                'offset': offset,
+                'limit': limit,
+                'next_offset': next_offset,
                 'pages': pages
             })
             
         except Exception as e:
-            logger.error(f"Error extracting optimized pages: {str(e)}")
+            logger.error(f"Error listing optimized pages: {str(e)}")
             return Response(
-                {'error': f'Failed to extract pages: {str(e)}'},
+                {'error': f'Failed to list pages: {str(e)}'},
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
+
+    @action(detail=True, methods=['get'], url_path='optimized-pages/(?P<page_num>[0-9]+)/image')
+    def optimized_page_image(self, request, pk=None, page_num=None):
+        """
+        Binary image of one optimized PDF page.
+        GET /api/documents/{id}/optimized-pages/{page_num}/image/?size=thumb|full
+
+        Thumbnails are pre-generated after processing; anything missing is
+        rendered on demand and cached on disk.
+        """
+        document = self.get_object()
+
+        if not document.optimized_file:
+            raise Http404("No optimized PDF available for this document")
+
+        variant = 'thumb' if request.query_params.get('size') == 'thumb' else 'full'
+        try:
+            image_path, content_type = rendering.cached_page_image(
+                document.optimized_file.path, int(page_num), variant=variant
+            )
+        except IndexError:
+            return Response({'error': 'Page number out of range'}, status=status.HTTP_400_BAD_REQUEST)
+        except FileNotFoundError:
+            raise Http404("File not found")
+        except Exception as e:
+            logger.error(f"Error rendering optimized page {page_num}: {str(e)}")
+            return Response(
+                {'error': f'Failed to render page: {str(e)}'},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+
+        response = FileResponse(open(image_path, 'rb'), content_type=content_type)
+        # URLs carry a version param tied to the file, so they can be cached hard.
+        response['Cache-Control'] = 'private, max-age=86400'
+        return response
     
+    @action(detail=True, methods=['get'])
+    def provenance(self, request, pk=None):
+        """
+        Source page and bounding box of every extracted field.
+        GET /api/documents/{id}/provenance/?page=3
+
+        Returns {"edit_count": N, "fields": [{"path": "/fees/management_fee", "page": 3, "bbox": [...]}]}.
+        `path` is the JSON Pointer of the field inside extracted_data.
+        """
+        page = request.query_params.get('page')
+        try:
+            page = int(page) if page not in (None, '') else None
+        except ValueError:
+            return Response({'error': 'page must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+
+        document = get_object_or_404(Document.objects.only('id', 'extracted_data', 'edit_count'), pk=pk)
+        return Response({
+            'edit_count': document.edit_count,
+            'fields': collect_provenance(document.extracted_data, page=page),
+        })
+
     @action(detail=True, methods=['get'], url_path='preview-page/(?P<page_num>[0-9]+)')
     def preview_page(self, request, pk=None, page_num=None):
         """
@@ -445,28 +920,15 @@ class DocumentViewSet(viewsets.ModelViewSet):
         
         logger.info(f"Found {len(bboxes_to_draw)} bboxes to draw on raw page {raw_page_num}")
 
-        # 2. Map raw page number to optimized page number if we have an optimized file
-        page_map = data.get('_optimized_page_map') if isinstance(data, dict) else None
-        optimized_page_num = None
-        
-        if document.optimized_file and isinstance(page_map, list):
-            try:
-                idx = page_map.index(raw_page_num)
-                optimized_page_num = idx + 1  # Convert 0-based index to 1-based page
-            except ValueError:
-                optimized_page_num = None
-        
-        # Determine which PDF to use and which page number
-        if document.optimized_file and optimized_page_num is not None:
-            pdf_path = document.optimized_file.path
-            render_page_num = optimized_page_num
-        else:
-            pdf_path = document.file.path
-            render_page_num = raw_page_num
-        
-        from .services import GeminiOCRService
-        service = GeminiOCRService()
-        image_path = service.generate_annotated_image(pdf_path, render_page_num, bboxes_to_draw)
+        # 2. Map raw page number to the PDF/page we actually render
+        pdf_path, render_page_num = rendering.resolve_render_target(document, raw_page_num)
+
+        # 3. Render (or reuse the cached render) without any provider client
+        try:
+            image_path = rendering.AnnotationRenderer().render_cached(pdf_path, render_page_num, bboxes_to_draw)
+        except Exception as e:
+            logger.error(f"Failed to generate annotation: {e}")
+            image_path = None
         
         if not image_path or not os.path.exists(image_path):
             return Response(
@@ -474,7 +936,7 @@ class DocumentViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
-        # 3. Return the image as a file response
+        # 4. Return the image as a file response
         return FileResponse(open(image_path, 'rb'), content_type='image/png')
 
     @action(detail=True, methods=['get'])
@@ -513,42 +975,51 @@ class DocumentViewSet(viewsets.ModelViewSet):
     @action(detail=False, methods=['get'])
     def stats(self, request):
         """
-        Get processing statistics
+        Get processing + RAG statistics and throughput
+        GET /api/documents/stats/
+
+        Computed in one aggregate query and cached for a few seconds, so the
+        dashboard can poll it cheaply.
         """
-        total = Document.objects.count()
-        pending = Document.objects.filter(status='pending').count()
-        processing = Document.objects.filter(status='processing').count()
-        completed = Document.objects.filter(status='completed').count()
-        failed = Document.objects.filter(status='failed').count()
-        
-        return Response({
-            'total': total,
-            'pending': pending,
-            'processing': processing,
-            'completed': completed,
-            'failed': failed
-        })
+        return Response(get_document_stats())
 
-    @action(detail=True, methods=['get'])
-    def rag_status(self, request, pk=None):
+    @action(detail=False, methods=['get'], url_path='provider-metrics')
+    def provider_metrics(self, request):
+        """
+        Rate limiter and circuit breaker state of each provider endpoint
+        GET /api/documents/provider-metrics/
+
+        Counts are per process: calls, retries, 429s, fail-fast rejections
+        and the time calls spent queued for their turn.
+        """
+        return Response({'providers': provider_limits.metrics()})
+
+    @action(detail=True, methods=['get'], renderer_classes=[EventStreamRenderer, JSONRenderer])
+    def events(self, request, pk=None):
         """
-        Check if document is already ingested for RAG
-        GET /api/documents/{id}/rag_status/
+        Server-sent events with processing + RAG progress of one document.
+        GET /api/documents/{id}/events/
+
+        Sends a `snapshot` event with the current state, then a `progress`
+        event for every change (status, rag_status, rag_progress, errors).
         """
         document = self.get_object()
-        chunks_count = document.chunks.count()
-        
-        return Response({
-            'is_ingested': chunks_count > 0,
-            'chunks_count': chunks_count,
-            'document_id': document.id,
-            'rag_status': getattr(document, 'rag_status', None),
-            'rag_progress': getattr(document, 'rag_progress', None),
-            'rag_error_message': getattr(document, 'rag_error_message', None),
-            'rag_started_at': getattr(document, 'rag_started_at', None),
-            'rag_completed_at': getattr(document, 'rag_completed_at', None),
-        })
-    
+        return _progress_stream(request, document.id, Document.objects.filter(id=document.id))
+
+    @action(detail=False, methods=['get'], url_path='events', url_name='events-all',
+            renderer_classes=[EventStreamRenderer, JSONRenderer])
+    def events_all(self, request):
+        """
+        Server-sent progress events for every document (dashboard).
+        GET /api/documents/events/
+
+        The snapshot covers only documents that are still in flight.
+        """
+        in_flight = Document.objects.filter(
+            Q(status__in=['pending', 'processing']) | Q(rag_status__in=['queued', 'running'])
+        )
+        return _progress_stream(request, None, in_flight)
+
     @action(detail=True, methods=['post'])
     def ingest_for_rag(self, request, pk=None):
         """
@@ -593,81 +1064,121 @@ class DocumentViewSet(viewsets.ModelViewSet):
                 status=http_status
             )
 
-    @action(detail=True, methods=['post'])
-    def chat(self, request, pk=None):
-        """
-        Chat with document using RAG
-        POST /api/documents/{id}/chat/
-        Body: {"query": "What is the management fee?", "history": [...]}
+    @action(detail=True, methods=['get', 'post', 'put', 'delete'], url_path='chat_history')
+    def chat_history(self, request, pk=None):
+        """Persist / restore chat history for a document.
+
+        GET    /api/documents/{id}/chat_history/?before=<id>&limit=50
+               -> {"history": [...oldest to newest], "next_before": <id or null>}
+        POST   /api/documents/{id}/chat_history/ with body {"history": [...]} to append.
+        PUT    /api/documents/{id}/chat_history/ with body {"history": [...]} to overwrite.
+        DELETE /api/documents/{id}/chat_history/ to clear.
+
+        Turns sent through /chat/ are stored automatically.
         """
         document = self.get_object()
-        
-        # Check if document has been ingested
-        if not document.chunks.exists():
-            return Response(
-                {
-                    'error': 'Document not ingested yet for RAG. Please call /documents/{id}/ingest_for_rag/ first.',
-                    'chunks_count': 0
-                },
-                status=status.HTTP_400_BAD_REQUEST
-            )
-        
-        # Validate request data
-        serializer = ChatRequestSerializer(data=request.data)
+        method = request.method.lower()
+
+        if method == 'get':
+            try:
+                limit = int(request.query_params.get('limit', chat_store.CHAT_HISTORY_PAGE_SIZE))
+                before = request.query_params.get('before')
+                before = int(before) if before not in (None, '') else None
+            except ValueError:
+                return Response({'error': 'limit and before must be integers'}, status=status.HTTP_400_BAD_REQUEST)
+            limit = max(1, min(limit, chat_store.CHAT_HISTORY_MAX_PAGE_SIZE))
+
+            rows, next_before = chat_store.page(document.id, before=before, limit=limit)
+            return Response({
+                'history': [chat_store.serialize_message(m) for m in rows],
+                'next_before': next_before,
+            })
+
+        if method == 'delete':
+            document.chat_messages.all().delete()
+            return Response(status=status.HTTP_204_NO_CONTENT)
+
+        serializer = ChatHistorySerializer(data=request.data)
         if not serializer.is_valid():
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
-        
-        user_query = serializer.validated_data['query']
-        history = serializer.validated_data.get('history', [])
-        
-        try:
-            logger.info(f"RAG chat query for document {document.id}: {user_query[:50]}...")
-            rag_service = RAGService()
-            answer_payload = rag_service.chat(document.id, user_query, history, return_source=True)
 
-            answer_text = answer_payload.get('text') if isinstance(answer_payload, dict) else str(answer_payload)
-            citations = answer_payload.get('citations', []) if isinstance(answer_payload, dict) else []
+        history = [m for m in serializer.validated_data.get('history', []) if isinstance(m, dict)]
+        if method == 'post':
+            rows = chat_store.append_messages(document.id, history)
+            return Response(
+                {'history': [chat_store.serialize_message(m) for m in rows]},
+                status=status.HTTP_201_CREATED,
+            )
 
-            response_data = {
-                'answer': answer_text,
-                'query': user_query,
-                'chunks_count': document.chunks.count(),
-                'citations': citations,
-            }
-            
-            return Response(response_data)
+        with transaction.atomic():
+            rows = chat_store.replace_history(document.id, history)
+        return Response({'history': [chat_store.serialize_message(m) for m in rows]})
+
+    @action(detail=True, methods=['get'], url_path='pages/(?P<page_num>[0-9]+)/image')
+    def page_image(self, request, pk=None, page_num=None):
+        """
+        Binary full-size image of a RAW (original) page number.
+        GET /api/documents/{id}/pages/{page_num}/image/?v=...
+
+        Renders from the optimized PDF when the page was kept in it, like
+        page_context, but as a cacheable file instead of base64 JSON.
+        """
+        document = self.get_object()
+        pdf_path, render_page_num = rendering.resolve_render_target(document, int(page_num))
+
+        try:
+            image_path, content_type = rendering.cached_page_image(pdf_path, render_page_num, variant='full')
+        except IndexError:
+            return Response({'error': 'Page number out of range'}, status=status.HTTP_400_BAD_REQUEST)
+        except FileNotFoundError:
+            raise Http404("File not found")
         except Exception as e:
-            logger.error(f"RAG chat error for document {document.id}: {str(e)}")
+            logger.error(f"Error rendering page {page_num}: {str(e)}")
             return Response(
-                {'error': f'Failed to process chat: {str(e)}'},
+                {'error': f'Failed to render page: {str(e)}'},
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
-    @action(detail=True, methods=['get', 'put'], url_path='chat_history')
-    def chat_history(self, request, pk=None):
-        """Persist / restore chat history for a document.
+        response = FileResponse(open(image_path, 'rb'), content_type=content_type)
+        # The raw->optimized mapping changes on reprocess; only versioned URLs are cached hard.
+        response['Cache-Control'] = 'private, max-age=86400' if request.query_params.get('v') else 'no-cache'
+        return response
 
-        GET  /api/documents/{id}/chat_history/ -> {"history": [...]}
-        PUT  /api/documents/{id}/chat_history/ with body {"history": [...]} to overwrite.
+    @action(detail=True, methods=['post'], url_path='citation-context')
+    def citation_context(self, request, pk=None):
+        """
+        Resolve many chat citations to page images + highlight boxes at once.
+        POST /api/documents/{id}/citation-context/
+        Body: {"citations": [{"page": 12, "quote": "..."}, ...]}
         """
         document = self.get_object()
-
-        if request.method.lower() == 'get':
-            return Response({'history': document.chat_history or []})
-
-        serializer = ChatHistorySerializer(data=request.data)
+        serializer = CitationContextRequestSerializer(data=request.data)
         if not serializer.is_valid():
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-        history = serializer.validated_data.get('history', [])
-        # Keep it bounded to avoid unbounded DB growth.
-        max_messages = 200
-        if isinstance(history, list) and len(history) > max_messages:
-            history = history[-max_messages:]
+        citations = serializer.validated_data['citations']
+        try:
+            located = rendering.locate_citations(document, citations)
+        except Exception as e:
+            logger.error(f"Error resolving citations: {str(e)}")
+            return Response(
+                {'error': f'Failed to resolve citations: {str(e)}'},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+
+        results = []
+        for citation, loc in zip(citations, located):
+            item = {'page': citation['page'], 'quote': citation.get('quote', '')}
+            item.update(loc)
+            if 'error' not in loc:
+                image_url = request.build_absolute_uri(reverse(
+                    'document-page-image',
+                    kwargs={'pk': document.pk, 'page_num': citation['page']},
+                ))
+                item['image'] = f"{image_url}?v={loc['version']}"
+            results.append(item)
 
-        document.chat_history = history
-        document.save(update_fields=['chat_history'])
-        return Response({'history': document.chat_history or []})
+        return Response({'results': results})
 
     @action(detail=True, methods=['get'], url_path='page-context/(?P<page_num>[0-9]+)')
     def page_context(self, request, pk=None, page_num=None):
@@ -680,119 +1191,31 @@ class DocumentViewSet(viewsets.ModelViewSet):
         raw_page_num = int(page_num)
         quote = (request.query_params.get('quote') or '').strip()
 
-        data = document.extracted_data or {}
-        page_map = data.get('_optimized_page_map') if isinstance(data, dict) else None
-        optimized_page_num = None
+        pdf_path, render_page_num = rendering.resolve_render_target(document, raw_page_num)
 
-        if document.optimized_file and isinstance(page_map, list):
-            try:
-                idx = page_map.index(raw_page_num)
-                optimized_page_num = idx + 1
-            except ValueError:
-                optimized_page_num = None
+        try:
+            with fitz.open(pdf_path) as doc:
+                if render_page_num < 1 or render_page_num > len(doc):
+                    return Response({'error': 'Page number out of range'}, status=status.HTTP_400_BAD_REQUEST)
 
-        if document.optimized_file and optimized_page_num is not None:
-            pdf_path = document.optimized_file.path
-            render_page_num = optimized_page_num
-        else:
-            pdf_path = document.file.path
-            render_page_num = raw_page_num
+                page = doc.load_page(render_page_num - 1)
+                width, height = rendering.page_dimensions(page)
+                image_path, _ = rendering.cached_page_image(pdf_path, render_page_num, 'full', doc=doc)
 
-        try:
-            import re as _re
+                matched_bboxes = []
+                if quote:
+                    word_index = rendering.page_word_index(pdf_path, render_page_num, doc=doc)
+                    matched_bboxes = word_index.locate(quote)
 
-            doc = fitz.open(pdf_path)
-            if render_page_num < 1 or render_page_num > len(doc):
-                doc.close()
-                return Response({'error': 'Page number out of range'}, status=status.HTTP_400_BAD_REQUEST)
-
-            page = doc.load_page(render_page_num - 1)
-            pix = page.get_pixmap(dpi=150)
-            img_bytes = pix.tobytes('png')
-            img_base64 = base64.b64encode(img_bytes).decode('utf-8')
-
-            matched_bboxes = []
-            if quote:
-                # Strip markdown formatting so the text matches the PDF's raw content
-                def _strip_markdown(text):
-                    text = _re.sub(r'#{1,6}\s*', '', text)          # headings
-                    text = _re.sub(r'\*{1,3}([^*\n]+)\*{1,3}', r'\1', text)  # bold/italic
-                    text = _re.sub(r'`[^`]*`', '', text)             # inline code
-                    text = _re.sub(r'\|', ' ', text)                 # table pipes
-                    text = _re.sub(r'-{3,}', ' ', text)              # HR / table dividers
-                    text = _re.sub(r'!\[.*?\]\(.*?\)', '', text)     # images
-                    text = _re.sub(r'\[([^\]]+)\]\([^)]+\)', r'\1', text)  # links
-                    text = _re.sub(r'\s+', ' ', text).strip()
-                    return text
-
-                clean_quote = _strip_markdown(quote)
-
-                # Build a list of increasingly short candidates to try
-                candidates = []
-                # 1. Full cleaned quote (up to 200 chars to keep search fast)
-                if clean_quote:
-                    candidates.append(clean_quote[:200])
-                # 2. First 100 chars
-                if len(clean_quote) > 60:
-                    candidates.append(clean_quote[:100])
-                # 3. First 12 words
-                words = clean_quote.split()
-                if len(words) >= 6:
-                    candidates.append(' '.join(words[:12]))
-                # 4. First 8 words
-                if len(words) >= 4:
-                    candidates.append(' '.join(words[:8]))
-                # 5. Each sentence that is >= 25 chars
-                for sent in _re.split(r'(?<=[.!?。])\s+', clean_quote):
-                    sent = sent.strip()
-                    if 25 <= len(sent) <= 200:
-                        candidates.append(sent)
-                # 6. Per-line candidates (Mistral OCR produces clean lines per record)
-                for line in clean_quote.splitlines():
-                    line = line.strip()
-                    if 20 <= len(line) <= 200:
-                        candidates.append(line)
-
-                # Deduplicate while preserving order
-                seen = set()
-                deduped = []
-                for c in candidates:
-                    key = c.lower()
-                    if key not in seen:
-                        seen.add(key)
-                        deduped.append(c)
-
-                rects = []
-                for q in deduped:
-                    if not q:
-                        continue
-                    try:
-                        found = page.search_for(q, quads=False)
-                    except Exception:
-                        found = []
-                    if found:
-                        rects = found
-                        break
-
-                pr = page.rect
-                pw = max(float(pr.width), 1.0)
-                ph = max(float(pr.height), 1.0)
-                for r in rects[:10]:
-                    matched_bboxes.append([
-                        max(0, min(1000, float(r.y0) / ph * 1000)),
-                        max(0, min(1000, float(r.x0) / pw * 1000)),
-                        max(0, min(1000, float(r.y1) / ph * 1000)),
-                        max(0, min(1000, float(r.x1) / pw * 1000)),
-                    ])
-
-            doc.close()
+            with open(image_path, 'rb') as f:
+                img_base64 = base64.b64encode(f.read()).decode('utf-8')
 
             return Response({
                 'raw_page_number': raw_page_num,
                 'render_page_number': render_page_num,
                 'image': f'data:image/png;base64,{img_base64}',
-                'width': pix.width,
-                'height': pix.height,
+                'width': width,
+                'height': height,
                 'quote': quote,
                 'matched_bboxes': matched_bboxes,
             })
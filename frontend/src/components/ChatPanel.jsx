@@ -183,6 +183,11 @@ function SourcesPanel({ citations, activeChunkId, onViewChunk }) {
                 <div className="flex items-center justify-between px-3 py-1.5 border-b border-inherit">
                   <span className={`font-semibold ${ isActive ? 'text-blue-700' : 'text-gray-600' }`}>
                     Trang {citation.page}
+                    {Array.isArray(citation.pages) && citation.pages.length > 1 && (
+                      <span className="ml-1 font-normal text-gray-400">
+                        (cũng ở trang {citation.pages.filter((p) => p !== citation.page).join(', ')})
+                      </span>
+                    )}
                   </span>
                   <button
                     type="button"
@@ -231,6 +236,8 @@ function ChatPanel({ document, onClose }) {
   const [isLoading, setIsLoading] = useState(false);
   const [isLoadingHistory, setIsLoadingHistory] = useState(false);
   const [isHistoryLoaded, setIsHistoryLoaded] = useState(false);
+  const [historyBefore, setHistoryBefore] = useState(null);  // id to page back from, null = no older messages
+  const [isLoadingEarlier, setIsLoadingEarlier] = useState(false);
   const [isCheckingRagStatus, setIsCheckingRagStatus] = useState(false);
   const [isIngesting, setIsIngesting] = useState(false);
   const [isIngested, setIsIngested] = useState(false);
@@ -244,11 +251,18 @@ function ChatPanel({ document, onClose }) {
   const [pageContext, setPageContext] = useState(null);         // response from getPageContext
   const [loadingPageCtx, setLoadingPageCtx] = useState(false);
   const messagesEndRef = useRef(null);
-  const hasLoadedHistoryRef = useRef(false);
-  const saveDebounceRef = useRef(null);
   const historyLoadTokenRef = useRef(0);
   const ragStatusTokenRef = useRef(0);
 
+  const toUiMessage = (m) => ({
+    id: m.id,
+    sender: m.sender,
+    text: m.text,
+    timestamp: m.timestamp ? new Date(m.timestamp) : new Date(),
+    chunks_count: m.chunks_count,
+    citations: Array.isArray(m.citations) ? m.citations : undefined,
+  });
+
   const loadChatHistory = useCallback(async () => {
     if (!document?.id) return;
 
@@ -263,27 +277,35 @@ function ChatPanel({ document, onClose }) {
 
       if (token !== historyLoadTokenRef.current) return;
 
+      setHistoryBefore(res?.next_before ?? null);
       if (saved.length > 0) {
-        setMessages(
-          saved.map((m) => ({
-            sender: m.sender,
-            text: m.text,
-            timestamp: m.timestamp ? new Date(m.timestamp) : new Date(),
-            chunks_count: m.chunks_count,
-          }))
-        );
+        setMessages(saved.map(toUiMessage));
       }
     } catch (err) {
       console.warn('Failed to load chat history:', err);
     } finally {
       if (token === historyLoadTokenRef.current) {
-        hasLoadedHistoryRef.current = true;
         setIsLoadingHistory(false);
         setIsHistoryLoaded(true);
       }
     }
   }, [document?.id]);
 
+  const loadEarlierMessages = async () => {
+    if (!document?.id || !historyBefore || isLoadingEarlier) return;
+    setIsLoadingEarlier(true);
+    try {
+      const res = await api.getChatHistory(document.id, { before: historyBefore });
+      const older = Array.isArray(res?.history) ? res.history : [];
+      setHistoryBefore(res?.next_before ?? null);
+      setMessages((prev) => [...older.map(toUiMessage), ...prev]);
+    } catch (err) {
+      console.warn('Failed to load earlier messages:', err);
+    } finally {
+      setIsLoadingEarlier(false);
+    }
+  };
+
   const checkIngestionStatus = useCallback(async () => {
     if (!document?.id) return;
 
@@ -342,8 +364,8 @@ function ChatPanel({ document, onClose }) {
 
   useEffect(() => {
     // Load persisted chat history (if any) then check ingestion.
-    hasLoadedHistoryRef.current = false;
     setMessages([]);
+    setHistoryBefore(null);
     setError(null);
     setIsHistoryLoaded(false);
     setIsCheckingRagStatus(false);
@@ -352,10 +374,23 @@ function ChatPanel({ document, onClose }) {
   }, [document?.id, loadChatHistory, checkIngestionStatus]);
 
   useEffect(() => {
-    // Poll RAG status while it is queued/running.
+    // Follow RAG progress via server-sent events while it is queued/running.
     if (!document?.id) return;
     if (!(ragStatus === 'queued' || ragStatus === 'running' || isIngesting)) return;
 
+    const unsubscribe = api.subscribeProgress(document.id, (event) => {
+      if (typeof event.rag_progress === 'number') setRagProgress(event.rag_progress);
+      if (event.rag_error_message !== undefined) setRagErrorMessage(event.rag_error_message);
+      if (event.rag_status === 'completed' || event.rag_status === 'failed') {
+        // Terminal state: one regular status call fills in chunk counts.
+        checkIngestionStatus();
+      } else if (event.rag_status) {
+        setRagStatus(event.rag_status);
+      }
+    });
+    if (unsubscribe) return unsubscribe;
+
+    // No EventSource support: fall back to polling.
     const id = setInterval(() => {
       checkIngestionStatus();
     }, 5000);
@@ -364,38 +399,9 @@ function ChatPanel({ document, onClose }) {
   }, [document?.id, ragStatus, isIngesting, checkIngestionStatus]);
 
   useEffect(() => {
-    // Persist chat history (debounced) whenever messages change.
-    if (!document?.id) return;
-    if (!hasLoadedHistoryRef.current) return;
-
-    if (saveDebounceRef.current) {
-      clearTimeout(saveDebounceRef.current);
-    }
-
-    saveDebounceRef.current = setTimeout(() => {
-      const historyToSave = (messages || []).map((m) => ({
-        sender: m.sender,
-        text: m.text,
-        timestamp: m.timestamp ? new Date(m.timestamp).toISOString() : new Date().toISOString(),
-        chunks_count: m.chunks_count,
-      }));
-
-      api.saveChatHistory(document.id, historyToSave).catch((err) => {
-        console.warn('Failed to save chat history:', err);
-      });
-    }, 500);
-
-    return () => {
-      if (saveDebounceRef.current) {
-        clearTimeout(saveDebounceRef.current);
-      }
-    };
-  }, [messages, document?.id]);
-
-  useEffect(() => {
-    // Auto-scroll to bottom when new messages arrive
+    // Auto-scroll to bottom when new messages arrive (not when older ones are prepended)
     scrollToBottom();
-  }, [messages]);
+  }, [messages[messages.length - 1]]);
 
   const scrollToBottom = () => {
     messagesEndRef.current?.scrollIntoView({ behavior: 'smooth' });
@@ -414,16 +420,17 @@ function ChatPanel({ document, onClose }) {
       setRagStatus('completed');
       setRagProgress(100);
       setRagErrorMessage(null);
-      setMessages((prev) => {
-        if (Array.isArray(prev) && prev.length > 0) return prev;
-        return [
-          {
-            sender: 'system',
-            text: `Document processed (Đã xử lý tài liệu)! Created ${result.chunks_count} knowledge chunks (Đã tạo ${result.chunks_count} đoạn kiến thức). You can now ask questions about this document (Bạn có thể hỏi về tài liệu này).`,
-            timestamp: new Date(),
-          },
-        ];
-      });
+      if (messages.length === 0) {
+        const notice = {
+          sender: 'system',
+          text: `Document processed (Đã xử lý tài liệu)! Created ${result.chunks_count} knowledge chunks (Đã tạo ${result.chunks_count} đoạn kiến thức). You can now ask questions about this document (Bạn có thể hỏi về tài liệu này).`,
+          timestamp: new Date(),
+        };
+        setMessages((prev) => (Array.isArray(prev) && prev.length > 0 ? prev : [notice]));
+        api.appendChatMessages(document.id, [{ ...notice, timestamp: notice.timestamp.toISOString() }]).catch((err) => {
+          console.warn('Failed to save chat history:', err);
+        });
+      }
     } catch (err) {
       console.error('Ingestion error:', err);
       setError(err.message || 'Failed to process document for chat (Xử lý tài liệu để trò chuyện thất bại)');
@@ -434,22 +441,9 @@ function ChatPanel({ document, onClose }) {
     }
   };
 
-  const handleClose = async () => {
-    try {
-      if (document?.id && hasLoadedHistoryRef.current) {
-        const historyToSave = (messages || []).map((m) => ({
-          sender: m.sender,
-          text: m.text,
-          timestamp: m.timestamp ? new Date(m.timestamp).toISOString() : new Date().toISOString(),
-          chunks_count: m.chunks_count,
-        }));
-        await api.saveChatHistory(document.id, historyToSave);
-      }
-    } catch (err) {
-      console.warn('Failed to save chat history on close:', err);
-    } finally {
-      onClose();
-    }
+  const handleClose = () => {
+    // Chat turns are persisted server-side by /chat/, nothing to flush here.
+    onClose();
   };
 
   const handleSendMessage = async () => {
@@ -505,12 +499,43 @@ function ChatPanel({ document, onClose }) {
     }
   };
 
-  const openPageFromChat = async (pageNum, quote = '', chunkId = null) => {
+  const showCitation = (citation) => {
+    setPageContext({
+      image: api.getPageImageUrl(document.id, citation.page, citation.version),
+      width: citation.width,
+      height: citation.height,
+      quote: citation.quote,
+      matched_bboxes: citation.matched_bboxes || [],
+    });
+  };
+
+  const openPageFromChat = async (pageNum, quote = '', chunkId = null, message = null) => {
     if (!document?.id) return;
     setActiveCitation({ page: pageNum, quote, chunkId });
+
+    // Citations from new answers already carry their highlight boxes.
+    const citations = message?.citations || [];
+    const findCitation = (list) => list.find((c) => c.page === pageNum && (chunkId == null || c.chunk_id === chunkId));
+    const known = findCitation(citations);
+    if (known?.version && Array.isArray(known.matched_bboxes)) {
+      showCitation(known);
+      return;
+    }
+
     setLoadingPageCtx(true);
     setPageContext(null);
     try {
+      if (citations.length > 0) {
+        // Older messages: resolve every source of the answer in one request.
+        const { results } = await api.resolveCitations(document.id, citations);
+        const resolved = citations.map((c, i) => ({ ...c, ...(results?.[i] || {}) }));
+        setMessages((prev) => prev.map((m) => (m === message ? { ...m, citations: resolved } : m)));
+        const hit = findCitation(resolved);
+        if (hit?.version) {
+          showCitation(hit);
+          return;
+        }
+      }
       const ctx = await api.getPageContext(document.id, pageNum, quote);
       setPageContext(ctx);
     } catch (err) {
@@ -703,6 +728,18 @@ function ChatPanel({ document, onClose }) {
                 </div>
               )}
 
+              {historyBefore && (
+                <div className="flex justify-center">
+                  <button
+                    onClick={loadEarlierMessages}
+                    disabled={isLoadingEarlier}
+                    className="px-3 py-1 text-xs text-blue-600 bg-white border border-gray-300 rounded-full hover:bg-blue-50 disabled:opacity-50"
+                  >
+                    {isLoadingEarlier ? 'Loading... (Đang tải...)' : 'Load earlier messages (Tải tin nhắn cũ hơn)'}
+                  </button>
+                </div>
+              )}
+
               {messages.map((message, idx) => (
                 <div
                   key={idx}
@@ -738,13 +775,13 @@ function ChatPanel({ document, onClose }) {
                               citations={message.citations || []}
                               onPageClick={(p) => {
                                 const cit = (message.citations || []).find(c => c.page === p);
-                                openPageFromChat(p, cit?.quote || '', cit?.chunk_id ?? null);
+                                openPageFromChat(p, cit?.quote || '', cit?.chunk_id ?? null, message);
                               }}
                             />
                             <SourcesPanel
                               citations={message.citations || []}
                               activeChunkId={activeCitation?.chunkId}
-                              onViewChunk={(cit) => openPageFromChat(cit.page, cit.quote, cit.chunk_id ?? null)}
+                              onViewChunk={(cit) => openPageFromChat(cit.page, cit.quote, cit.chunk_id ?? null, message)}
                             />
                           </>
                         ) : (
@@ -14,18 +14,26 @@ import { PdfNavigationContext } from './dashboard/PdfNavigationContext';
  * Dashboard Component - Professional Design with Tailwind CSS
  * Displays processed documents and their extracted data
  */
+const DOCUMENTS_PAGE_SIZE = 50;
+const OPTIMIZED_PAGES_PAGE_SIZE = 24;
+
 function Dashboard({ refreshTrigger }) {
   const [documents, setDocuments] = useState([]);
+  const documentsRef = useRef(documents);
+  documentsRef.current = documents;
+  const [nextCursor, setNextCursor] = useState(null);
+  const [loadingMore, setLoadingMore] = useState(false);
   const [selectedDoc, setSelectedDoc] = useState(null);
   const [loading, setLoading] = useState(true);
   const [stats, setStats] = useState(null);
   const [optimizedPages, setOptimizedPages] = useState(null);
-  const [_loadingPages, setLoadingPages] = useState(false);
+  const [loadingPages, setLoadingPages] = useState(false);
   const [selectedPage, setSelectedPage] = useState(null);
   const [loadingPreview, setLoadingPreview] = useState(false);
   const [hoveredField, setHoveredField] = useState(null); // For highlighting data fields (hover effect)
   const [isEditMode, setIsEditMode] = useState(false);
   const [editedData, setEditedData] = useState(null);
+  const [pendingOps, setPendingOps] = useState([]); // JSON Patch ops for the current edit session
   const [isSaving, setIsSaving] = useState(false);
   const [userComment, setUserComment] = useState('');
   const [changeLogs, setChangeLogs] = useState([]);
@@ -105,22 +113,26 @@ function Dashboard({ refreshTrigger }) {
   }, [optimizedPages?.pages, selectedDoc]);
 
   useEffect(() => {
-    const processingDocs = documents.filter(
-      doc => doc.status === 'pending' || doc.status === 'processing'
-    );
-
-    if (processingDocs.length > 0) {
-      const interval = setInterval(() => {
+    // Live progress for every document via server-sent events (no polling).
+    const unsubscribe = api.subscribeProgress(null, (event) => {
+      const { document_id: docId, ts: _ts, ...fields } = event;
+      setDocuments((prev) => prev.map((doc) => (doc.id === docId ? { ...doc, ...fields } : doc)));
+      if (fields.status === 'completed' || fields.status === 'failed') {
+        // Fund name/code only exist once processing finishes.
         loadDocuments();
-      }, 3000);
-      return () => clearInterval(interval);
-    }
-  }, [documents]);
+        loadStats();
+      }
+    });
+    return () => unsubscribe?.();
+  }, []);
 
   const loadDocuments = async () => {
     try {
-      const response = await api.getDocuments();
+      // Refresh everything already on screen in one request (the API caps limit at 200).
+      const limit = Math.min(Math.max(DOCUMENTS_PAGE_SIZE, documentsRef.current.length), 200);
+      const response = await api.getDocuments({ limit });
       setDocuments(response.results || []);
+      setNextCursor(response.next_cursor || null);
     } catch (error) {
       console.error('Error loading documents:', error);
     } finally {
@@ -128,6 +140,45 @@ function Dashboard({ refreshTrigger }) {
     }
   };
 
+  const loadMoreDocuments = async () => {
+    if (!nextCursor || loadingMore) return;
+    setLoadingMore(true);
+    try {
+      const response = await api.getDocuments({ cursor: nextCursor, limit: DOCUMENTS_PAGE_SIZE });
+      setDocuments((prev) => {
+        const seen = new Set(prev.map((d) => d.id));
+        return [...prev, ...(response.results || []).filter((d) => !seen.has(d.id))];
+      });
+      setNextCursor(response.next_cursor || null);
+    } catch (error) {
+      console.error('Error loading more documents:', error);
+    } finally {
+      setLoadingMore(false);
+    }
+  };
+
+  const loadMorePages = async () => {
+    if (!selectedDoc || optimizedPages?.next_offset == null || loadingPages) return;
+    const docId = selectedDoc.id;
+    setLoadingPages(true);
+    try {
+      const pagesData = await api.getOptimizedPages(docId, { offset: optimizedPages.next_offset, limit: OPTIMIZED_PAGES_PAGE_SIZE });
+      setOptimizedPages((prev) => {
+        if (!prev || prev.document_id !== docId) return prev;
+        const seen = new Set(prev.pages.map((p) => p.page_number));
+        return {
+          ...pagesData,
+          document_id: docId,
+          pages: [...prev.pages, ...(pagesData.pages || []).filter((p) => !seen.has(p.page_number))],
+        };
+      });
+    } catch (error) {
+      console.error('Error loading more optimized pages:', error);
+    } finally {
+      setLoadingPages(false);
+    }
+  };
+
   const loadStats = async () => {
     try {
       const statsData = await api.getStats();
@@ -152,7 +203,8 @@ function Dashboard({ refreshTrigger }) {
 
   const handleDocumentClick = async (doc) => {
     try {
-      const fullDoc = await api.getDocument(doc.id);
+      // fund_data duplicates extracted_data and is not shown here
+      const fullDoc = await api.getDocument(doc.id, { exclude: ['fund_data'] });
       setSelectedDoc(fullDoc);
       setOptimizedPages(null);
       setSelectedPage(null);
@@ -161,8 +213,8 @@ function Dashboard({ refreshTrigger }) {
       if (fullDoc.optimized_file_url) {
         setLoadingPages(true);
         try {
-          const pagesData = await api.getOptimizedPages(doc.id);
-          setOptimizedPages(pagesData);
+          const pagesData = await api.getOptimizedPages(doc.id, { limit: OPTIMIZED_PAGES_PAGE_SIZE });
+          setOptimizedPages({ ...pagesData, document_id: doc.id });
         } catch (error) {
           console.error('Error loading optimized pages:', error);
         } finally {
@@ -207,12 +259,14 @@ function Dashboard({ refreshTrigger }) {
   const handleEdit = () => {
     setIsEditMode(true);
     setEditedData(JSON.parse(JSON.stringify(selectedDoc.extracted_data))); // Deep copy
+    setPendingOps([]);
     setUserComment('');
   };
 
   const handleCancelEdit = () => {
     setIsEditMode(false);
     setEditedData(null);
+    setPendingOps([]);
     setUserComment('');
   };
 
@@ -226,24 +280,44 @@ function Dashboard({ refreshTrigger }) {
   const handleSave = async () => {
     if (!editedData || !selectedDoc) return;
 
+    // Later edits of the same path supersede earlier ones; parents stay first.
+    const ops = [];
+    const indexByPath = new Map();
+    pendingOps.forEach((op) => {
+      if (indexByPath.has(op.path)) {
+        ops[indexByPath.get(op.path)] = op;
+      } else {
+        indexByPath.set(op.path, ops.length);
+        ops.push(op);
+      }
+    });
+
+    if (ops.length === 0) {
+      handleCancelEdit();
+      return;
+    }
+
     setIsSaving(true);
     try {
-      // Update the document with new extracted data and comment
-      const response = await api.updateDocument(selectedDoc.id, {
-        extracted_data: editedData,
-        user_comment: userComment
-      });
+      // Send only the edited paths, not the whole extracted_data document
+      const response = await api.patchExtractedData(selectedDoc.id, ops, userComment);
       
       // Update local state with new edit count and timestamp
-      setSelectedDoc(response);
+      setSelectedDoc({
+        ...selectedDoc,
+        extracted_data: editedData,
+        edit_count: response.edit_count,
+        last_edited_at: response.last_edited_at ?? selectedDoc.last_edited_at,
+      });
       setIsEditMode(false);
       setEditedData(null);
+      setPendingOps([]);
       setUserComment('');
       
       // Refresh document list and change logs
       loadDocuments();
       if (response.edit_count > 0) {
-        loadChangeLogs(response.id);
+        loadChangeLogs(selectedDoc.id);
       }
       
       alert('Changes saved successfully! (Đã lưu thay đổi thành công!)');
@@ -256,9 +330,30 @@ function Dashboard({ refreshTrigger }) {
   };
 
   const updateEditedField = (fieldPath, value) => {
+    const escape = (key) => String(key).replace(/~/g, '~0').replace(/\//g, '~1');
+    const keys = fieldPath.split('.');
+    const ops = [];
+
+    // Walk the current draft to decide which JSON Patch ops this edit needs
+    let probe = editedData;
+    for (let i = 0; i < keys.length - 1; i++) {
+      const next = probe ? probe[keys[i]] : undefined;
+      if (!next) {
+        ops.push({ op: 'add', path: '/' + keys.slice(0, i + 1).map(escape).join('/'), value: {} });
+      }
+      probe = next;
+    }
+    const pointer = '/' + keys.map(escape).join('/');
+    const target = probe ? probe[keys[keys.length - 1]] : undefined;
+    if (target && typeof target === 'object' && 'value' in target) {
+      ops.push({ op: 'replace', path: `${pointer}/value`, value });
+    } else {
+      ops.push({ op: 'add', path: pointer, value });
+    }
+    setPendingOps((prev) => [...prev, ...ops]);
+
     setEditedData(prevData => {
       const newData = JSON.parse(JSON.stringify(prevData)); // Deep copy
-      const keys = fieldPath.split('.');
       let current = newData;
       
       // Navigate to the parent of the target field
@@ -339,6 +434,17 @@ function Dashboard({ refreshTrigger }) {
                     loadingLogs={loadingLogs}
                   />
                 ))}
+                {nextCursor && (
+                  <div className="p-3 text-center">
+                    <button
+                      onClick={loadMoreDocuments}
+                      disabled={loadingMore}
+                      className="text-sm text-blue-600 hover:text-blue-800 disabled:text-gray-400"
+                    >
+                      {loadingMore ? 'Loading... (Đang tải...)' : 'Load more (Tải thêm)'}
+                    </button>
+                  </div>
+                )}
               </div>
             )}
           </div>
@@ -1048,6 +1154,7 @@ function Dashboard({ refreshTrigger }) {
                               <img
                                 src={page.image}
                                 alt={`Page ${page.raw_page_number || page.page_number}`}
+                                loading="lazy"
                                 className="w-full h-auto"
                               />
                               <div className="p-2 bg-gray-50 text-center">
@@ -1056,6 +1163,19 @@ function Dashboard({ refreshTrigger }) {
                             </div>
                           ))}
                         </div>
+                        {optimizedPages.next_offset != null && (
+                          <div className="mt-4 text-center">
+                            <button
+                              onClick={loadMorePages}
+                              disabled={loadingPages}
+                              className="text-sm text-blue-600 hover:text-blue-800 disabled:text-gray-400"
+                            >
+                              {loadingPages
+                                ? 'Loading... (Đang tải...)'
+                                : `Load more pages (Tải thêm trang) — ${optimizedPages.pages.length}/${optimizedPages.total_pages}`}
+                            </button>
+                          </div>
+                        )}
                       </div>
                     )}
                   </div>
@@ -1136,8 +1256,9 @@ function Dashboard({ refreshTrigger }) {
                   setLoadingPreview(false);
                   // Fallback to original image if preview generation fails
                   console.warn('Preview generation failed, falling back to original image');
-                  if (selectedPage.image) {
-                    e.target.src = selectedPage.image;
+                  const fallbackSrc = selectedPage.full_image || selectedPage.image;
+                  if (fallbackSrc && e.target.src !== fallbackSrc) {
+                    e.target.src = fallbackSrc;
                   }
                 }}
               />
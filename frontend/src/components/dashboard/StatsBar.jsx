@@ -23,14 +23,32 @@ const StatsBar = ({ stats, loading }) => {
     { label: 'Failed (Thất bại)', value: stats.failed, color: 'text-red-600', bgColor: 'bg-red-50' },
   ];
 
+  const rag = stats.rag || {};
+  const throughput = stats.throughput || {};
+  const formatSeconds = (s) => {
+    if (s == null) return '—';
+    if (s < 90) return `${Math.round(s)}s`;
+    return `${(s / 60).toFixed(1)} min`;
+  };
+
   return (
-    <div className="grid grid-cols-2 md:grid-cols-5 gap-4 mb-6">
-      {statItems.map((stat, index) => (
-        <div key={index} className={`${stat.bgColor} p-4 rounded-lg shadow border border-gray-200 transition-transform hover:scale-105`}>
-          <p className="text-xs font-medium text-gray-600 uppercase tracking-wide">{stat.label}</p>
-          <p className={`text-2xl font-bold ${stat.color} mt-1`}>{stat.value}</p>
+    <div className="mb-6">
+      <div className="grid grid-cols-2 md:grid-cols-5 gap-4">
+        {statItems.map((stat, index) => (
+          <div key={index} className={`${stat.bgColor} p-4 rounded-lg shadow border border-gray-200 transition-transform hover:scale-105`}>
+            <p className="text-xs font-medium text-gray-600 uppercase tracking-wide">{stat.label}</p>
+            <p className={`text-2xl font-bold ${stat.color} mt-1`}>{stat.value}</p>
+          </div>
+        ))}
+      </div>
+      {stats.throughput && (
+        <div className="flex flex-wrap gap-x-6 gap-y-1 mt-3 text-xs text-gray-600">
+          <span>RAG: {rag.completed ?? 0} ready · {(rag.running ?? 0) + (rag.queued ?? 0)} in progress · {rag.failed ?? 0} failed</span>
+          <span>Throughput ({throughput.window_hours}h): {throughput.docs_per_hour} docs/hour</span>
+          <span>Median processing (Thời gian xử lý trung vị): {formatSeconds(throughput.median_processing_seconds)}</span>
+          <span>Median RAG ingest: {formatSeconds(throughput.median_rag_seconds)}</span>
         </div>
-      ))}
+      )}
     </div>
   );
 };
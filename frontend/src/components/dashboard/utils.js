@@ -62,12 +62,13 @@ export const isEffectivelyNA = (value) => {
 
 /**
  * Utility: Get page and bbox info from structured field
+ * The document detail omits bbox by default (see api.getProvenance), so bbox may be null.
  * @param {*} field - The field data
  * @returns {Object|null} {page, bbox} or null if not available
  */
 export const getFieldInfo = (field) => {
-  if (field && typeof field === 'object' && 'page' in field && 'bbox' in field) {
-    return { page: field.page, bbox: field.bbox };
+  if (field && typeof field === 'object' && 'value' in field && 'page' in field) {
+    return { page: field.page, bbox: field.bbox ?? null };
   }
   return null;
 };
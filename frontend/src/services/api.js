@@ -58,11 +58,16 @@ class ApiService {
   }
 
   /**
-   * Get all documents
-   * @returns {Promise} List of documents
+   * Get a page of documents, newest first
+   * @param {Object} options - Pagination options
+   * @param {string|null} options.cursor - next_cursor from the previous page
+   * @param {number} options.limit - Page size (max 200)
+   * @returns {Promise} { results, limit, next_cursor }
    */
-  async getDocuments() {
-    const response = await fetch(`${API_BASE_URL}/documents/`);
+  async getDocuments({ cursor = null, limit = 50 } = {}) {
+    const params = new URLSearchParams({ limit: String(limit) });
+    if (cursor) params.set('cursor', cursor);
+    const response = await fetch(`${API_BASE_URL}/documents/?${params}`);
     
     if (!response.ok) {
       throw new Error('Failed to fetch documents (Không thể tải danh sách tài liệu)');
@@ -72,12 +77,17 @@ class ApiService {
   }
 
   /**
-   * Get a specific document by ID
+   * Get a specific document by ID (extracted_data comes without bounding boxes)
    * @param {number} id - Document ID
+   * @param {Object} options - { fields, exclude }: arrays of field names for a sparse response
    * @returns {Promise} Document details
    */
-  async getDocument(id) {
-    const response = await fetch(`${API_BASE_URL}/documents/${id}/`);
+  async getDocument(id, { fields = null, exclude = null } = {}) {
+    const params = new URLSearchParams();
+    if (fields?.length) params.set('fields', fields.join(','));
+    if (exclude?.length) params.set('exclude', exclude.join(','));
+    const query = params.toString();
+    const response = await fetch(`${API_BASE_URL}/documents/${id}/${query ? `?${query}` : ''}`);
     
     if (!response.ok) {
       throw new Error('Failed to fetch document (Không thể tải tài liệu)');
@@ -86,14 +96,34 @@ class ApiService {
     return response.json();
   }
 
+  /**
+   * Get page/bbox provenance of extracted fields, loaded only when highlights are needed
+   * @param {number} id - Document ID
+   * @param {number|null} page - Raw page number to limit to (optional)
+   * @returns {Promise<{edit_count: number, fields: Array<{path, page, bbox}>}>}
+   */
+  async getProvenance(id, page = null) {
+    const query = page ? `?page=${page}` : '';
+    const response = await fetch(`${API_BASE_URL}/documents/${id}/provenance/${query}`);
+
+    if (!response.ok) {
+      throw new Error('Failed to fetch field locations (Không thể tải vị trí trường dữ liệu)');
+    }
+
+    return response.json();
+  }
+
   /**
    * Reprocess a document
    * @param {number} id - Document ID
+   * @param {Object} options - { force: re-run the extraction even if a cached result exists }
    * @returns {Promise} Updated document
    */
-  async reprocessDocument(id) {
+  async reprocessDocument(id, { force = false } = {}) {
     const response = await fetch(`${API_BASE_URL}/documents/${id}/reprocess/`, {
       method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ force }),
     });
 
     if (!response.ok) {
@@ -126,6 +156,30 @@ class ApiService {
     return response.json();
   }
 
+  /**
+   * Apply an RFC 6902 JSON Patch to a document's extracted data
+   * @param {number} id - Document ID
+   * @param {Array} operations - JSON Patch operations
+   * @param {string} userComment - Optional comment stored in the change log
+   * @returns {Promise} { changes, updated_columns, edit_count, last_edited_at }
+   */
+  async patchExtractedData(id, operations, userComment = '') {
+    const response = await fetch(`${API_BASE_URL}/documents/${id}/extracted-data/`, {
+      method: 'PATCH',
+      headers: {
+        'Content-Type': 'application/json',
+      },
+      body: JSON.stringify({ operations, user_comment: userComment }),
+    });
+
+    if (!response.ok) {
+      const error = await response.json().catch(() => ({}));
+      throw new Error(error.error || 'Failed to update document (Cập nhật tài liệu thất bại)');
+    }
+
+    return response.json();
+  }
+
   /**
    * Delete a document
    * @param {number} id - Document ID
@@ -158,12 +212,14 @@ class ApiService {
   }
 
   /**
-   * Get optimized PDF pages as images
+   * Get optimized PDF pages (metadata + thumbnail/full image URLs)
    * @param {number} id - Document ID
-   * @returns {Promise} Pages data with base64 images
+   * @param {{offset?: number, limit?: number}} params - Pagination window
+   * @returns {Promise} Pages data with image URLs
    */
-  async getOptimizedPages(id) {
-    const response = await fetch(`${API_BASE_URL}/documents/${id}/optimized_pages/`);
+  async getOptimizedPages(id, { offset = 0, limit = 24 } = {}) {
+    const qs = `?offset=${offset}&limit=${limit}`;
+    const response = await fetch(`${API_BASE_URL}/documents/${id}/optimized_pages/${qs}`);
     
     if (!response.ok) {
       throw new Error('Failed to fetch optimized pages (Không thể tải các trang PDF đã tối ưu)');
@@ -187,6 +243,30 @@ class ApiService {
     return response.json();
   }
 
+  /**
+   * Subscribe to server-sent progress events (processing + RAG)
+   * @param {number|null} id - Document ID, or null for every document
+   * @param {(event:Object)=>void} onEvent - Called with each snapshot/progress event
+   * @returns {Function|null} Unsubscribe function, or null if EventSource is unavailable
+   */
+  subscribeProgress(id, onEvent) {
+    if (typeof EventSource === 'undefined') return null;
+    const url = id == null
+      ? `${API_BASE_URL}/documents/events/`
+      : `${API_BASE_URL}/documents/${id}/events/`;
+    const source = new EventSource(url);
+    const handler = (e) => {
+      try {
+        onEvent(JSON.parse(e.data));
+      } catch (err) {
+        console.warn('Bad progress event:', err);
+      }
+    };
+    source.addEventListener('snapshot', handler);
+    source.addEventListener('progress', handler);
+    return () => source.close();
+  }
+
   /**
    * Check RAG ingestion status
    * @param {number} id - Document ID
@@ -204,12 +284,15 @@ class ApiService {
   }
 
   /**
-   * Get persisted chat history for a document
+   * Get one page of persisted chat history (newest messages first page)
    * @param {number} id - Document ID
-   * @returns {Promise<{history: Array}>}
+   * @param {Object} options - { before: message id to page back from, limit }
+   * @returns {Promise<{history: Array, next_before: number|null}>}
    */
-  async getChatHistory(id) {
-    const response = await fetch(`${API_BASE_URL}/documents/${id}/chat_history/`);
+  async getChatHistory(id, { before = null, limit = 50 } = {}) {
+    const params = new URLSearchParams({ limit: String(limit) });
+    if (before) params.set('before', String(before));
+    const response = await fetch(`${API_BASE_URL}/documents/${id}/chat_history/?${params}`);
 
     if (!response.ok) {
       const error = await response.json().catch(() => ({}));
@@ -220,7 +303,30 @@ class ApiService {
   }
 
   /**
-   * Save persisted chat history for a document
+   * Append messages to the persisted chat history (chat turns are stored by /chat/ itself)
+   * @param {number} id - Document ID
+   * @param {Array} messages - Array of message objects
+   * @returns {Promise<{history: Array}>}
+   */
+  async appendChatMessages(id, messages = []) {
+    const response = await fetch(`${API_BASE_URL}/documents/${id}/chat_history/`, {
+      method: 'POST',
+      headers: {
+        'Content-Type': 'application/json',
+      },
+      body: JSON.stringify({ history: messages }),
+    });
+
+    if (!response.ok) {
+      const error = await response.json().catch(() => ({}));
+      throw new Error(error.error || 'Failed to save chat history (Không thể lưu lịch sử trò chuyện)');
+    }
+
+    return response.json();
+  }
+
+  /**
+   * Overwrite persisted chat history for a document
    * @param {number} id - Document ID
    * @param {Array} history - Array of message objects
    * @returns {Promise<{history: Array}>}
@@ -252,6 +358,39 @@ class ApiService {
     return `${API_BASE_URL}/documents/${id}/preview-page/${pageNum}/`;
   }
 
+  /**
+   * Build the URL of a full-size raw page image
+   * @param {number} id - Document ID
+   * @param {number} pageNum - Raw 1-based page number
+   * @param {string} version - Cache version returned with citations
+   * @returns {string} URL to the page image
+   */
+  getPageImageUrl(id, pageNum, version = '') {
+    const qs = version ? `?v=${encodeURIComponent(version)}` : '';
+    return `${API_BASE_URL}/documents/${id}/pages/${pageNum}/image/${qs}`;
+  }
+
+  /**
+   * Resolve many citations to page images + highlight boxes in one request
+   * @param {number} id - Document ID
+   * @param {Array<{page:number, quote:string}>} citations - Citations to resolve
+   * @returns {Promise} { results: [...] } in the same order as citations
+   */
+  async resolveCitations(id, citations) {
+    const response = await fetch(`${API_BASE_URL}/documents/${id}/citation-context/`, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({
+        citations: citations.map((c) => ({ page: c.page, quote: c.quote || '' })),
+      }),
+    });
+    if (!response.ok) {
+      const error = await response.json().catch(() => ({}));
+      throw new Error(error.error || 'Failed to resolve citations');
+    }
+    return response.json();
+  }
+
   /**
    * Get page image + matched-text highlight boxes for a citation
    * @param {number} id - Document ID